@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+'''
+Created on 18 okt. 2026
+
+@author: sander
+
+Measure the throughput of the internet checksum on IPv4 header and full
+packet sized buffers.
+'''
+from argparse import ArgumentParser
+import os
+import time
+
+# Add the parent directory to the start of the path
+if __name__ == '__main__':
+    import sys
+    sys.path.insert(0, '.')
+    sys.path.insert(0, '..')
+
+from pylisp.utils import checksum
+
+
+def loop_ones_complement(message):
+    # The byte by byte implementation that checksum used to have
+    message = bytes(message)
+    if len(message) % 2 == 1:
+        message = message + '\x00'
+
+    total = 0
+    for i in range(0, len(message), 2):
+        next_16_bits = (ord(message[i]) << 8) + ord(message[i + 1])
+        tmp = total + next_16_bits
+        total = (tmp & 0xffff) + (tmp >> 16)
+
+    return ~total & 0xffff
+
+
+def measure(name, size, count, function):
+    start = time.time()
+    function()
+    elapsed = time.time() - start
+
+    print '%5d bytes %-20s %10.0f checksums/sec %8.1f MB/sec' % (size, name, count / elapsed,
+                                                               count * size / elapsed / 1e6)
+
+
+def run(size, count, loop_count):
+    messages = [os.urandom(size) for dummy in xrange(count)]
+
+    def single():
+        for message in messages:
+            checksum.ones_complement(message)
+
+    def batched():
+        checksum.ones_complement_many(messages)
+
+    measure('ones_complement', size, count, single)
+    measure('ones_complement_many', size, count, batched)
+
+    if loop_count:
+        loop_messages = messages[:loop_count]
+
+        def loop():
+            for message in loop_messages:
+                loop_ones_complement(message)
+
+        measure('byte loop', size, len(loop_messages), loop)
+
+
+def main():
+    parser = ArgumentParser(description='Benchmark the internet checksum')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[20, 1400],
+                        help='message sizes to test with')
+    parser.add_argument('--count', type=int, default=100000,
+                        help='number of messages per size')
+    parser.add_argument('--loop-count', type=int, default=10000,
+                        help='number of messages for the byte loop reference, 0 to skip')
+    args = parser.parse_args()
+
+    for size in args.sizes:
+        run(size, args.count, args.loop_count)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+'''
+Created on 18 okt. 2026
+
+@author: sander
+
+Measure ContainerNode lookup speed for different numbers of children.
+'''
+from argparse import ArgumentParser
+from ipaddress import IPv4Address, IPv4Network
+import random
+import time
+
+# Add the parent directory to the start of the path
+if __name__ == '__main__':
+    import sys
+    sys.path.insert(0, '.')
+    sys.path.insert(0, '..')
+
+from pylisp.application.lispd.address_tree.container_node import ContainerNode
+from pylisp.application.lispd.address_tree.drop_node import DropNode
+
+
+def build_tree(size, rnd):
+    # Use random distinct /24s so that the children don't overlap
+    networks = rnd.sample(xrange(1 << 24), size)
+
+    root = ContainerNode(IPv4Network(u'0.0.0.0/0'))
+    for network in networks:
+        root.add(DropNode(IPv4Network((network << 8, 24))))
+
+    return root, networks
+
+
+def linear_find_one(node, prefix):
+    # The algorithm ContainerNode used before it had a radix tree
+    matches = [child for child in node.children if prefix.overlaps(child.prefix)]
+    if len(matches) == 1 and matches[0].prefix[0] <= prefix[0] \
+    and matches[0].prefix[-1] >= prefix[-1]:
+        return matches[0]
+
+
+def run(size, lookups, linear_lookups, rnd):
+    start = time.time()
+    root, networks = build_tree(size, rnd)
+    build_time = time.time() - start
+
+    # Half of the lookups hit a child, the other half are random
+    queries = []
+    for dummy in xrange(lookups):
+        if rnd.random() < 0.5:
+            address = (rnd.choice(networks) << 8) + rnd.randint(0, 255)
+        else:
+            address = rnd.getrandbits(32)
+        queries.append(IPv4Address(address))
+
+    start = time.time()
+    for query in queries:
+        root.resolve_path(query)
+    lookup_time = time.time() - start
+
+    print '%8d prefixes: built in %6.2fs, %9.0f lookups/sec' % (size, build_time, lookups / lookup_time)
+
+    if linear_lookups and size <= 100000:
+        queries = [IPv4Network(query) for query in queries[:linear_lookups]]
+        start = time.time()
+        for query in queries:
+            linear_find_one(root, query)
+        linear_time = time.time() - start
+
+        print '%8s           linear scan: %9.0f lookups/sec' % ('', len(queries) / linear_time)
+
+
+def main():
+    parser = ArgumentParser(description='Benchmark ContainerNode lookups')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 100000, 1000000],
+                        help='numbers of child prefixes to test with')
+    parser.add_argument('--lookups', type=int, default=100000,
+                        help='number of lookups per size')
+    parser.add_argument('--linear-lookups', type=int, default=10,
+                        help='number of lookups for the linear scan reference, 0 to skip')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rnd = random.Random(args.seed)
+    for size in args.sizes:
+        run(size, args.lookups, args.linear_lookups, rnd)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+'''
+Created on 18 okt. 2026
+
+@author: sander
+
+Measure how long loading a large synthetic ddt_root file takes, with the bulk
+loader and with adding the delegations one by one.
+'''
+from argparse import ArgumentParser
+import os
+import random
+import tempfile
+import time
+
+# Add the parent directory to the start of the path
+if __name__ == '__main__':
+    import sys
+    sys.path.insert(0, '.')
+    sys.path.insert(0, '..')
+
+from pylisp.application.lispd.utils.ddt_root_loader import add_delegation, build_ddt_root, load_ddt_root, \
+    read_ddt_root
+
+
+def write_ddt_root(filename, lines, nodes_per_prefix, rnd):
+    # Random distinct IPv4 /24s and IPv6 /48s in two instances, each
+    # delegated to a few DDT nodes
+    prefixes = lines // nodes_per_prefix
+    networks = rnd.sample(xrange(1 << 24), prefixes)
+
+    with open(filename, 'w') as ddt_root:
+        ddt_root.write('# Synthetic ddt_root with %d lines\n' % lines)
+        for count, network in enumerate(networks):
+            instance_id = count % 2
+            if count % 4 < 3:
+                prefix = '%d.%d.%d.0/24' % (network >> 16, (network >> 8) & 0xff, network & 0xff)
+                afi = 1
+            else:
+                prefix = '2001:%x:%x::/48' % (network >> 8, network & 0xff)
+                afi = 2
+
+            for node in range(nodes_per_prefix):
+                ddt_root.write('%d %d %s 192.0.2.%d\n' % (instance_id, afi, prefix, node + 1))
+
+
+def load_one_by_one(filename):
+    # How load_ddt_root used to work
+    instances = {}
+    for instance_id, afi, prefix, address in read_ddt_root(filename):
+        add_delegation(instances, instance_id, afi, prefix, address)
+    return instances
+
+
+def main():
+    parser = ArgumentParser(description='Benchmark loading a ddt_root file')
+    parser.add_argument('--lines', type=int, default=500000,
+                        help='number of delegations in the ddt_root file')
+    parser.add_argument('--nodes-per-prefix', type=int, default=2,
+                        help='number of DDT nodes for each prefix')
+    parser.add_argument('--one-by-one', action='store_true',
+                        help='also measure adding the delegations one by one')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rnd = random.Random(args.seed)
+    handle, filename = tempfile.mkstemp(prefix='ddt_root-')
+    os.close(handle)
+    try:
+        write_ddt_root(filename, args.lines, args.nodes_per_prefix, rnd)
+
+        start = time.time()
+        delegations = read_ddt_root(filename)
+        parse_time = time.time() - start
+
+        start = time.time()
+        build_ddt_root(delegations)
+        build_time = time.time() - start
+
+        start = time.time()
+        instances = load_ddt_root(filename)
+        load_time = time.time() - start
+
+        children = sum(len(root) for afis in instances.itervalues() for root in afis.itervalues())
+        print '%8d lines, %d prefixes: parsed in %6.2fs, built in %6.2fs, loaded in %6.2fs' % (
+            len(delegations), children, parse_time, build_time, load_time)
+
+        if args.one_by_one:
+            start = time.time()
+            load_one_by_one(filename)
+            print '%8s one by one: loaded in %6.2fs' % ('', time.time() - start)
+    finally:
+        os.unlink(filename)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+'''
+Created on 18 okt. 2026
+
+@author: sander
+
+Compare the old lispd main loop, one select and one recvfrom per datagram,
+with the event loop that drains sockets in batches. A number of datagrams is
+queued on localhost sockets first and then each loop reads them all.
+'''
+from argparse import ArgumentParser
+from ipaddress import ip_address
+import select
+import socket
+import time
+
+# Add the parent directory to the start of the path
+if __name__ == '__main__':
+    import sys
+    sys.path.insert(0, '.')
+    sys.path.insert(0, '..')
+
+from pylisp.utils import syscalls
+from pylisp.utils.event_loop import EventLoop
+
+
+def create_sockets(count):
+    socks = []
+    for dummy in range(count):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 16 * 1024 * 1024)
+        sock.bind(('127.0.0.1', 0))
+        socks.append(sock)
+    return socks
+
+
+def fill(socks, count, size):
+    # Spread the datagrams over the sockets
+    sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    data = 'x' * size
+    sent = 0
+    for i in xrange(count):
+        sock = socks[i % len(socks)]
+        try:
+            sender.sendto(data, sock.getsockname())
+            sent += 1
+        except socket.error:
+            break
+    sender.close()
+    return sent
+
+
+def select_loop(socks, expected):
+    received = 0
+    while received < expected:
+        rlist, dummy, dummy = select.select(socks, [], [], 1.0)
+        if not rlist:
+            break
+
+        for sock in rlist:
+            # Like AutoUDPSocket.recvfrom
+            data, addr = sock.recvfrom(65536)
+            addr = (ip_address(unicode(addr[0])), addr[1])
+            received += 1
+
+    return received
+
+
+def event_loop(socks, expected, budget, batch_size):
+    loop = EventLoop(budget=budget, batch_size=batch_size)
+    counter = [0]
+
+    def handler(sock, data, address):
+        counter[0] += 1
+
+    for sock in socks:
+        loop.add_datagram_socket(sock, handler)
+
+    while counter[0] < expected:
+        before = counter[0]
+        loop.run_once(1.0)
+        if counter[0] == before:
+            break
+
+    loop.close()
+    return counter[0]
+
+
+def measure(name, socks, count, size, function):
+    sent = fill(socks, count, size)
+
+    start = time.time()
+    received = function(socks, sent)
+    elapsed = time.time() - start
+
+    print '%-30s %8d packets %10.0f packets/sec' % (name, received,
+                                                     received / elapsed)
+
+
+def main():
+    parser = ArgumentParser(description='Benchmark the lispd receive loop')
+    parser.add_argument('--count', type=int, default=100000,
+                        help='number of datagrams per run')
+    parser.add_argument('--size', type=int, default=80,
+                        help='size of the datagrams')
+    parser.add_argument('--sockets', type=int, default=2,
+                        help='number of receiving sockets')
+    parser.add_argument('--budget', type=int, default=64,
+                        help='datagrams read from one socket per wake-up')
+    parser.add_argument('--batch-size', type=int, default=32,
+                        help='datagrams read per system call')
+    args = parser.parse_args()
+
+    socks = create_sockets(args.sockets)
+
+    measure('select + recvfrom', socks, args.count, args.size, select_loop)
+
+    def batched(socks, expected):
+        return event_loop(socks, expected, args.budget, args.batch_size)
+
+    if syscalls.have_recvmmsg():
+        measure('event loop + recvmmsg', socks, args.count, args.size, batched)
+
+        # Pretend recvmmsg doesn't exist to measure the fallback
+        syscalls._recvmmsg = None
+
+    measure('event loop + recvfrom loop', socks, args.count, args.size, batched)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+'''
+Created on 18 okt. 2026
+
+@author: sander
+
+Compare the old NFQUEUE callback, which parsed, logged and sent every packet
+on its own, with the batched EncapsulationStage. A fake queue replays the
+packets from a pcap file (Ethernet, raw IP or Linux cooked captures) or
+synthetic UDP packets, and the encapsulated packets are sent to a local
+sink socket.
+'''
+from argparse import ArgumentParser
+from ipaddress import IPv4Address, IPv4Network
+import logging
+import random
+import socket
+import struct
+import time
+
+# Add the parent directory to the start of the path
+if __name__ == '__main__':
+    import sys
+    sys.path.insert(0, '.')
+    sys.path.insert(0, '..')
+
+from pylisp.application.lispd import settings
+from pylisp.application.lispd.data_path import EncapsulationStage
+from pylisp.application.lispd.map_cache import map_cache
+from pylisp.application.lispd.send_message import send_message
+from pylisp.packet.ip.ipv4 import IPv4Packet
+from pylisp.packet.ip.ipv6 import IPv6Packet
+from pylisp.packet.ip.udp import UDPMessage
+from pylisp.packet.lisp.control import LocatorRecord, MapReplyRecord
+from pylisp.packet.lisp.data import DataPacket
+
+
+logger = logging.getLogger('bench_nfqueue')
+
+NF_DROP = 0
+NF_ACCEPT = 1
+
+# Link layer header lengths by pcap link type
+LINK_HEADER_LENGTHS = {1: 14,  # Ethernet
+                       101: 0,  # Raw IP
+                       113: 16}  # Linux cooked capture
+
+
+def read_pcap(filename, limit):
+    packets = []
+    with open(filename, 'rb') as pcap:
+        header = pcap.read(24)
+        magic = struct.unpack('<I', header[:4])[0]
+        if magic == 0xa1b2c3d4:
+            endian = '<'
+        elif magic == 0xd4c3b2a1:
+            endian = '>'
+        else:
+            raise ValueError('Not a pcap file')
+
+        link_type = struct.unpack(endian + 'I', header[20:24])[0]
+        skip = LINK_HEADER_LENGTHS.get(link_type)
+        if skip is None:
+            raise ValueError('Unsupported link type {0}'.format(link_type))
+
+        record_format = struct.Struct(endian + 'IIII')
+        while len(packets) < limit:
+            record = pcap.read(record_format.size)
+            if len(record) < record_format.size:
+                break
+
+            captured = record_format.unpack(record)[2]
+            data = pcap.read(captured)[skip:]
+            if data and ord(data[0]) >> 4 in (4, 6):
+                packets.append(data)
+
+    return packets
+
+
+def synthetic_packets(count, flows, rnd):
+    flow_list = [(IPv4Address(u'172.16.0.1'), IPv4Address(0x0a000000 + rnd.randrange(1 << 24)),
+                  rnd.randrange(1024, 65536)) for dummy in range(flows)]
+
+    packets = []
+    for dummy in xrange(count):
+        source, destination, port = rnd.choice(flow_list)
+        udp = UDPMessage(source_port=port, destination_port=53, payload='x' * rnd.randrange(20, 1400))
+        packets.append(IPv4Packet(ttl=64, protocol=udp.header_type, source=source, destination=destination,
+                                  payload=udp).to_bytes())
+
+    return packets
+
+
+class FakePayload(object):
+    __slots__ = ('data', 'verdict')
+
+    def __init__(self, data):
+        self.data = data
+        self.verdict = None
+
+    def get_data(self):
+        return self.data
+
+    def get_length(self):
+        return len(self.data)
+
+    def set_verdict(self, verdict):
+        self.verdict = verdict
+
+
+class FakeQueue(object):
+    def __init__(self, packets, callback):
+        self.packets = packets
+        self.position = 0
+        self.callback = callback
+
+    def process_pending(self, count):
+        end = min(self.position + count, len(self.packets))
+        for i in xrange(self.position, end):
+            self.callback(FakePayload(self.packets[i]))
+        handled = end - self.position
+        self.position = end
+        return handled
+
+
+class SinkSocket(object):
+    '''
+    Sends everything to a local socket that throws it away
+    '''
+    family = socket.AF_INET
+
+    def __init__(self, sink):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sink = sink
+
+    def getsockname(self):
+        return (IPv4Address(u'198.51.100.1'), 4341)
+
+    def sendto(self, data, address):
+        try:
+            return self.sock.sendto(data, self.sink)
+        except socket.error:
+            return 0
+
+
+class OldCallback(object):
+    '''
+    The callback as it was: parse and log every packet, and encapsulate it
+    with a DataPacket to the PETR
+    '''
+
+    def __init__(self, sockets):
+        self.sockets = sockets
+
+    def __call__(self, payload):
+        payload.set_verdict(NF_DROP)
+
+        try:
+            logger.debug("NFQUEUE callback called: {0} bytes of data".format(payload.get_length()))
+            data = payload.get_data()
+
+            family = ord(data[0]) >> 4
+            if family == 4:
+                packet = IPv4Packet.from_bytes(data, decode_payload=False)
+            elif family == 6:
+                packet = IPv6Packet.from_bytes(data, decode_payload=False)
+            else:
+                return
+
+            logger.debug("Data contents: {0!r}".format(packet))
+
+            message = DataPacket(payload=data)
+            send_message(message=message, my_sockets=self.sockets, destinations=[settings.config.PETR],
+                         port=4341)
+        except:
+            logger.exception("Unexpected exception when handling data packet")
+
+
+def fill_map_cache(prefixes):
+    for i in range(prefixes):
+        prefix = IPv4Network((0x0a000000 + (i << (24 - prefixes.bit_length())), prefixes.bit_length() + 8))
+        map_cache.add_record(MapReplyRecord(ttl=1440, eid_prefix=prefix,
+                                            locator_records=[LocatorRecord(priority=1, weight=50, reachable=True,
+                                                                           address=IPv4Address(0xc6336400 + j))
+                                                             for j in (1, 2)]))
+
+
+def main():
+    parser = ArgumentParser(description='Benchmark the NFQUEUE data path')
+    parser.add_argument('--pcap', help='pcap file with the packets to replay')
+    parser.add_argument('--packets', type=int, default=100000,
+                        help='number of packets')
+    parser.add_argument('--flows', type=int, default=1000,
+                        help='number of synthetic flows')
+    parser.add_argument('--prefixes', type=int, default=256,
+                        help='number of map-cache entries covering 10.0.0.0/8')
+    parser.add_argument('--batch-size', type=int, default=64,
+                        help='packets handled per wakeup')
+    args = parser.parse_args()
+
+    rnd = random.Random(42)
+    if args.pcap:
+        packets = read_pcap(args.pcap, args.packets)
+    else:
+        packets = synthetic_packets(args.packets, args.flows, rnd)
+
+    settings.config.PETR = IPv4Address(u'198.51.100.254')
+    fill_map_cache(args.prefixes)
+
+    sink = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sink.bind(('127.0.0.1', 0))
+    sockets = [SinkSocket(sink.getsockname())]
+
+    old_queue = FakeQueue(packets, OldCallback(sockets))
+    start = time.time()
+    while old_queue.process_pending(5):
+        pass
+    old_time = time.time() - start
+
+    stage = EncapsulationStage([], sockets, accept=NF_ACCEPT, drop=NF_DROP)
+    new_queue = FakeQueue(packets, stage)
+    start = time.time()
+    while stage.process(new_queue, args.batch_size):
+        pass
+    new_time = time.time() - start
+
+    print '%d packets' % len(packets)
+    print 'old   %8.3f sec %8.2f us/packet' % (old_time, old_time / len(packets) * 1e6)
+    print 'batch %8.3f sec %8.2f us/packet' % (new_time, new_time / len(packets) * 1e6)
+    print ', '.join('%s=%d' % item for item in sorted(stage.counters.items()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+'''
+Created on 18 okt. 2026
+
+@author: sander
+
+Compare the old Map-Server cleanup, which walked all registrations every 30
+seconds, with the expiry heap. Time is simulated: every source re-registers
+every 60 seconds with the default timeout of 180 seconds, and some of them
+stop re-registering so that their registrations expire.
+'''
+from argparse import ArgumentParser
+from ipaddress import IPv4Address, IPv4Network
+import random
+import time
+
+# Add the parent directory to the start of the path
+if __name__ == '__main__':
+    import sys
+    sys.path.insert(0, '.')
+    sys.path.insert(0, '..')
+
+from pylisp.application.lispd.address_tree.map_server_node import MapServerNode, MapServerRegistration
+from pylisp.packet.lisp.control import LocatorRecord, MapRegisterRecord
+
+
+def scan_expire(ms_node, now):
+    # The algorithm MSCleanupThread used, returns the total lateness
+    lateness = 0.0
+    for prefix in ms_node.registrations.keys():
+        sources = ms_node.registrations[prefix].keys()
+        for source in sources:
+            deadline = ms_node.registrations[prefix][source].deadline
+            if now > deadline:
+                lateness += now - deadline
+                del ms_node.registrations[prefix][source]
+
+        if len(ms_node.registrations[prefix]) == 0:
+            del ms_node.registrations[prefix]
+
+    return lateness
+
+
+def simulate(mode, sources, prefixes, duration, interval, churn, rnd):
+    ms_node = MapServerNode(IPv4Network(u'10.0.0.0/8'), key='secret')
+    records = [MapRegisterRecord(ttl=1440, eid_prefix=IPv4Network((0x0a000000 + (i << 8), 24)),
+                                 locator_records=[LocatorRecord(priority=1, weight=100,
+                                                                address=IPv4Address(u'198.51.100.1'))])
+               for i in range(prefixes)]
+
+    # (first registration, stop time) for every source
+    schedule = []
+    for i in xrange(sources):
+        first = rnd.random() * interval
+        stop = rnd.random() * duration if rnd.random() < churn else duration
+        schedule.append((first, stop))
+
+    # Bucket the registrations per simulated second
+    registers = [[] for dummy in xrange(int(duration))]
+    for i, (first, stop) in enumerate(schedule):
+        when = first
+        while when < stop:
+            registers[int(when)].append((when, i))
+            when += interval
+
+    expiry_time = 0.0
+    longest_pause = 0.0
+    expired = 0
+    lateness = 0.0
+    for second, bucket in enumerate(registers):
+        for when, i in bucket:
+            record = records[i % prefixes]
+            registration = MapServerRegistration(record)
+            registration.deadline = when + registration.timeout
+            ms_node.store_registration(record.eid_prefix, i, registration)
+
+        now = second + 1.0
+        before = sum(len(sources) for sources in ms_node.registrations.itervalues())
+        start = time.time()
+        if mode == 'heap':
+            # Runs when the next deadline has passed
+            ms_node.expire_registrations(now)
+        elif second % 30 == 29:
+            lateness += scan_expire(ms_node, now)
+        pause = time.time() - start
+        expiry_time += pause
+        longest_pause = max(longest_pause, pause)
+        removed = before - sum(len(sources) for sources in ms_node.registrations.itervalues())
+        if mode == 'heap':
+            # At most one simulated second late
+            lateness += removed * 0.5
+        expired += removed
+
+    return expiry_time, longest_pause, expired, lateness
+
+
+def main():
+    parser = ArgumentParser(description='Benchmark Map-Server registration expiry')
+    parser.add_argument('--sources', type=int, default=100000,
+                        help='number of registering sources')
+    parser.add_argument('--prefixes', type=int, default=1000,
+                        help='number of registered prefixes')
+    parser.add_argument('--duration', type=int, default=600,
+                        help='simulated seconds')
+    parser.add_argument('--interval', type=float, default=60.0,
+                        help='seconds between registrations of a source')
+    parser.add_argument('--churn', type=float, default=0.1,
+                        help='fraction of sources that stop registering')
+    args = parser.parse_args()
+
+    for mode in ('scan', 'heap'):
+        rnd = random.Random(42)
+        expiry_time, longest_pause, expired, lateness = simulate(mode, args.sources, args.prefixes,
+                                                                 args.duration, args.interval, args.churn, rnd)
+        print '%-5s %8d expired %8.3f sec expiry CPU %8.1f ms longest pause %6.1f sec average lateness' % (
+            mode, expired, expiry_time, longest_pause * 1000, lateness / max(expired, 1))
+
+
+if __name__ == '__main__':
+    main()
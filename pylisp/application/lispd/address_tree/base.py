@@ -3,7 +3,7 @@ Created on 10 mrt. 2013
 
 @author: sander
 '''
-from ipaddress import ip_network
+from ipaddress import ip_network, _BaseNetwork
 import logging
 
 
@@ -11,6 +11,13 @@ import logging
 logger = logging.getLogger(__name__)
 
 
+def _as_network(prefix):
+    # Avoid the (expensive) conversion when we already have a network
+    if isinstance(prefix, _BaseNetwork):
+        return prefix
+    return ip_network(prefix)
+
+
 class AbstractNode(object):
     '''
     This is the abstract base class for the lispd address space tree
@@ -18,7 +25,7 @@ class AbstractNode(object):
 
     def __init__(self, prefix):
         super(AbstractNode, self).__init__()
-        self.prefix = ip_network(prefix)
+        self.prefix = _as_network(prefix)
         self.control_plane_sockets = []
         self.data_plane_sockets = []
 
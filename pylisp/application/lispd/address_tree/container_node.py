@@ -3,8 +3,9 @@ Created on 11 mrt. 2013
 
 @author: sander
 '''
-from ipaddress import ip_network
-from pylisp.application.lispd.address_tree.base import AbstractNode, MoreSpecificsFoundError, NotAuthoritativeError
+from pylisp.application.lispd.address_tree.base import AbstractNode, MoreSpecificsFoundError, NotAuthoritativeError, \
+    _as_network
+from pylisp.utils.radix_tree import RadixTree
 import logging
 
 
@@ -17,6 +18,10 @@ class ContainerNode(AbstractNode):
         super(ContainerNode, self).__init__(prefix)
         self.children = set()
 
+        # All children are inside our prefix, so they share our address
+        # family. The tree is used for all lookups, the set for iteration.
+        self._tree = RadixTree(self.prefix.max_prefixlen)
+
         if children:
             self.update(children)
 
@@ -36,6 +41,15 @@ class ContainerNode(AbstractNode):
     def __len__(self):
         return len(self.children)
 
+    def _check_authoritative(self, prefix):
+        # Check that we are authoritative for the given prefix
+        if prefix.version != self.prefix.version \
+        or prefix.prefixlen < self.prefix.prefixlen \
+        or int(prefix.network_address) & int(self.prefix.netmask) \
+           != int(self.prefix.network_address):
+            raise NotAuthoritativeError('This node is not authoritative for %r'
+                                        % prefix)
+
     def resolve_path(self, address):
         '''
         Resolve the given address in this tree branch
@@ -59,9 +73,15 @@ class ContainerNode(AbstractNode):
         Find the given address or prefix
         '''
         # Convert to a network and find all matches
-        prefix = ip_network(address)
-        matches = self.find_all(prefix)
+        prefix = _as_network(address)
+        self._check_authoritative(prefix)
+
+        # Children never overlap, so there can be at most one covering match
+        match = self._tree.longest_match(prefix)
+        if match:
+            return match
 
+        matches = self._tree.covered(prefix, limit=2)
         if not matches:
             # Nothing found
             return None
@@ -70,68 +90,51 @@ class ContainerNode(AbstractNode):
             # Found too much
             raise MoreSpecificsFoundError('Found more-specifics for %r' % prefix)
 
-        # One match is what we want
-        match = matches.pop()
-
-        # The match should completely contain the prefix we look for
-        if match.prefix[0] <= prefix[0] and match.prefix[-1] >= prefix[-1]:
-            return match
+        # A single more-specific doesn't completely contain the prefix we
+        # look for
+        return None
 
     def find_exact(self, prefix):
         '''
         Find the exact child with the given prefix
         '''
-        matches = self.find_all(prefix)
-        if len(matches) == 1:
-            match = matches.pop()
-            if match.prefix == prefix:
-                return match
+        prefix = _as_network(prefix)
+        self._check_authoritative(prefix)
 
-        return None
+        return self._tree.get(prefix)
 
     def find_all(self, prefix):
         '''
         Find everything in the given prefix
         '''
-        prefix = ip_network(prefix)
-
-        # Check that we are authoritative for the given prefix
-        if not self.prefix.overlaps(prefix) \
-        or self.prefix[0] > prefix[0] \
-        or self.prefix[-1] < prefix[-1]:
-            raise NotAuthoritativeError('This node is not authoritative for %r'
-                                        % prefix)
+        prefix = _as_network(prefix)
+        self._check_authoritative(prefix)
 
         # Find all matching existing prefixes and return them in a set
-        matches = set()
-        for child in self.children:
-            if prefix.overlaps(child.prefix):
-                matches.add(child)
-
-        return matches
+        return set(self._tree.overlapping(prefix))
 
     def add(self, child):
         assert isinstance(child, AbstractNode)
 
         # Check that we are authoritative for the child
-        if not self.prefix.overlaps(child.prefix) \
-        or self.prefix[0] > child.prefix[0] \
-        or self.prefix[-1] < child.prefix[-1]:
-            raise NotAuthoritativeError('This node is not authoritative for %r'
-                                        % child.prefix)
+        self._check_authoritative(child.prefix)
 
         # Check for overlap, but ignore exact an match and overwrite it
-        if not self.find_exact(child.prefix):
-            matches = self.find_all(child.prefix)
-            if matches:
+        existing = self._tree.get(child.prefix)
+        if existing is None:
+            if self._tree.overlapping(child.prefix, limit=1):
                 raise ValueError('New prefix %r overlaps with existing '
                                  'prefixes' % child.prefix)
+        else:
+            self.children.discard(existing)
 
         # Add the new child
+        self._tree[child.prefix] = child
         self.children.add(child)
 
     def clear(self):
         self.children = set()
+        self._tree.clear()
 
     def __contains__(self, child):
         # If a node is given then directly look for it
@@ -148,20 +151,63 @@ class ContainerNode(AbstractNode):
     def discard(self, child):
         # If a node is given then directly discard it
         if isinstance(child, AbstractNode):
-            self.children.discard(child)
+            if self._tree.get(child.prefix) is child:
+                self._tree.delete(child.prefix)
+                self.children.discard(child)
             return
 
         # Also allow to discard a node by network
         match = self.find_exact(child)
         if match:
+            self._tree.delete(match.prefix)
             self.children.discard(match)
 
     def remove(self, child):
         orig_len = len(self)
         self.discard(child)
-        if len(self) != orig_len:
+        if len(self) == orig_len:
             raise KeyError(child)
 
     def update(self, children):
         for child in children:
             self.add(child)
+
+    def bulk_update(self, children):
+        '''
+        Add many children at once. They are sorted once and checked for
+        overlap in a single pass instead of looking up every child in the
+        tree. Children with the same prefix replace each other like with
+        add.
+        '''
+        if self.children:
+            # The new children must be checked against the existing ones
+            self.update(children)
+            return
+
+        # Sort by network address, and larger prefixes first
+        ordered = []
+        for child in children:
+            assert isinstance(child, AbstractNode)
+            self._check_authoritative(child.prefix)
+            ordered.append((int(child.prefix.network_address), child.prefix.prefixlen, child))
+        ordered.sort(key=lambda item: item[:2])
+
+        # Sorted children that don't overlap each end before the next starts
+        kept = []
+        max_prefixlen = self.prefix.max_prefixlen
+        last_address = -1
+        for network, prefixlen, child in ordered:
+            if kept and kept[-1][:2] == (network, prefixlen):
+                kept[-1] = (network, prefixlen, child)
+                continue
+
+            if network <= last_address:
+                raise ValueError('New prefix %r overlaps with existing '
+                                 'prefixes' % child.prefix)
+
+            kept.append((network, prefixlen, child))
+            last_address = network | ((1 << (max_prefixlen - prefixlen)) - 1)
+
+        for network, prefixlen, child in kept:
+            self._tree[network, prefixlen] = child
+            self.children.add(child)
@@ -3,11 +3,11 @@ Created on 11 mrt. 2013
 
 @author: sander
 '''
-from ipaddress import ip_address
+from ipaddress import ip_address, IPv4Address, IPv6Address
 from pylisp.application.lispd.address_tree.authoritative_container_node import AuthContainerNode
 from pylisp.application.lispd.address_tree.base import AbstractNode
 from pylisp.application.lispd.address_tree.map_server_node import MapServerNode
-from pylisp.application.lispd.send_message import send_message
+from pylisp.application.lispd.send_message import send_bytes, send_message
 from pylisp.application.lispd.utils.prefix import determine_instance_id_and_afi, resolve_path
 from pylisp.packet.lisp.control.locator_record import LocatorRecord
 from pylisp.packet.lisp.control.map_referral import MapReferralMessage
@@ -19,11 +19,24 @@ import logging
 logger = logging.getLogger(__name__)
 
 
+# The number of delegation hole and not authoritative answers that are kept
+NEGATIVE_REFERRAL_CACHE_SIZE = 1024
+
+# Where the nonce is in a Map-Referral
+_NONCE_OFFSET = 4
+_NONCE_END = 12
+
+_zero_nonce = '\x00' * 8
+
+
 class DDTReferralNode(AbstractNode):
     def __init__(self, prefix, ddt_nodes=None):
         super(DDTReferralNode, self).__init__(prefix)
         self.ddt_nodes = set()
 
+        # The Map-Referral as bytes, built when it is first needed
+        self._referral_bytes = None
+
         if ddt_nodes:
             self.update(ddt_nodes)
 
@@ -37,13 +50,16 @@ class DDTReferralNode(AbstractNode):
         return len(self.ddt_nodes)
 
     def add(self, ddt_node):
-        ddt_node = ip_address(ddt_node)
+        if not isinstance(ddt_node, (IPv4Address, IPv6Address)):
+            ddt_node = ip_address(ddt_node)
 
         # Add the new node
         self.ddt_nodes.add(ddt_node)
+        self._referral_bytes = None
 
     def clear(self):
         self.ddt_nodes = set()
+        self._referral_bytes = None
 
     def __contains__(self, ddt_node):
         return ddt_node in self.ddt_nodes
@@ -53,9 +69,11 @@ class DDTReferralNode(AbstractNode):
 
     def discard(self, ddt_node):
         self.ddt_nodes.discard(ddt_node)
+        self._referral_bytes = None
 
     def remove(self, ddt_node):
         self.ddt_nodes.remove(ddt_node)
+        self._referral_bytes = None
 
     def update(self, ddt_nodes):
         for ddt_node in ddt_nodes:
@@ -66,7 +84,7 @@ class DDTReferralNode(AbstractNode):
         for ddt_node in self.ddt_nodes:
             locator = LocatorRecord(priority=0, weight=0,
                                     m_priority=0, m_weight=0,
-                                    reachable=True, locator=ddt_node)
+                                    reachable=True, address=ddt_node)
             locators.append(locator)
 
         referral = MapReferralRecord(ttl=1440,
@@ -77,6 +95,71 @@ class DDTReferralNode(AbstractNode):
 
         return referral
 
+    def get_referral_bytes(self):
+        '''
+        Return the Map-Referral for this node as bytes with an all-zero
+        nonce. It is built again after the DDT nodes have changed.
+        '''
+        if self._referral_bytes is None:
+            reply = MapReferralMessage(nonce=_zero_nonce,
+                                       records=[self.get_referral()])
+            self._referral_bytes = reply.to_bytes()
+
+        return self._referral_bytes
+
+
+_negative_referrals = {}
+
+
+def get_negative_referral_bytes(action, eid_prefix):
+    '''
+    Return the DELEGATION_HOLE or NOT_AUTHORITATIVE Map-Referral for the
+    requested prefix as bytes with an all-zero nonce
+    '''
+    instance_id, afi, prefix = determine_instance_id_and_afi(eid_prefix)
+    key = (action, instance_id, afi, prefix)
+
+    data = _negative_referrals.get(key)
+    if data is not None:
+        return data
+
+    if action == MapReferralRecord.ACT_DELEGATION_HOLE:
+        # We are authoritative and no matching targets, we seem to have a hole
+        referral = MapReferralRecord(ttl=15,
+                                     authoritative=True,
+                                     action=MapReferralRecord.ACT_DELEGATION_HOLE,
+                                     eid_prefix=eid_prefix)
+    else:
+        # No matching prefixes, we don't seem to be authoritative
+        referral = MapReferralRecord(ttl=0,
+                                     action=MapReferralRecord.ACT_NOT_AUTHORITATIVE,
+                                     incomplete=True,
+                                     eid_prefix=eid_prefix)
+
+    data = MapReferralMessage(nonce=_zero_nonce, records=[referral]).to_bytes()
+
+    # Only remember prefixes that we understand
+    if afi is not None:
+        if len(_negative_referrals) >= NEGATIVE_REFERRAL_CACHE_SIZE:
+            _negative_referrals.clear()
+        _negative_referrals[key] = data
+
+    return data
+
+
+def send_answer_bytes(received_message, data):
+    map_request = received_message.inner_message
+
+    # Fill in the nonce of the request
+    data = data[:_NONCE_OFFSET] + map_request.nonce + data[_NONCE_END:]
+
+    # Send the reply over UDP
+    send_bytes(data=data,
+               my_sockets=[received_message.socket],
+               destinations=[received_message.source[0]],
+               port=received_message.source[1],
+               description='MapReferralMessage')
+
 
 def send_answer(received_message, referral):
     map_request = received_message.inner_message
@@ -101,7 +184,7 @@ def send_referral(received_message, tree_node):
     for ddt_node in tree_node:
         locator = LocatorRecord(priority=0, weight=0,
                                 m_priority=0, m_weight=0,
-                                reachable=True, locator=ddt_node)
+                                reachable=True, address=ddt_node)
         locators.append(locator)
 
     referral = MapReferralRecord(ttl=1440,
@@ -117,28 +200,16 @@ def send_delegation_hole(received_message):
     logger.debug("Sending DELEGATION_HOLE response for message %d", received_message.message_nr)
 
     map_request = received_message.inner_message
-
-    # We are authoritative and no matching targets, we seem to have a hole
-    referral = MapReferralRecord(ttl=15,
-                                 authoritative=True,
-                                 action=MapReferralRecord.ACT_DELEGATION_HOLE,
-                                 eid_prefix=map_request.eid_prefixes[0])
-
-    send_answer(received_message, referral)
+    data = get_negative_referral_bytes(MapReferralRecord.ACT_DELEGATION_HOLE, map_request.eid_prefixes[0])
+    send_answer_bytes(received_message, data)
 
 
 def send_not_authoritative(received_message):
     logger.debug("Sending NOT_AUTHORITATIVE response for message %d", received_message.message_nr)
 
     map_request = received_message.inner_message
-
-    # No matching prefixes, we don't seem to be authoritative
-    referral = MapReferralRecord(ttl=0,
-                                 action=MapReferralRecord.ACT_NOT_AUTHORITATIVE,
-                                 incomplete=True,
-                                 eid_prefix=map_request.eid_prefixes[0])
-
-    send_answer(received_message, referral)
+    data = get_negative_referral_bytes(MapReferralRecord.ACT_NOT_AUTHORITATIVE, map_request.eid_prefixes[0])
+    send_answer_bytes(received_message, data)
 
 
 def send_ms_ack(received_message, ms_prefix, other_map_servers=None):
@@ -150,12 +221,12 @@ def send_ms_ack(received_message, ms_prefix, other_map_servers=None):
     for ddt_node in other_map_servers:
         locator = LocatorRecord(priority=0, weight=0,
                                 m_priority=0, m_weight=0,
-                                reachable=True, locator=ddt_node)
+                                reachable=True, address=ddt_node)
         locators.append(locator)
 
     # MapServer forwarded the request
     referral = MapReferralRecord(ttl=1440,
-                                 action=MapReferralRecord.ACT_MS_NOT_REGISTERED,
+                                 action=MapReferralRecord.ACT_MS_ACK,
                                  incomplete=(len(locators) == 0),
                                  eid_prefix=ms_prefix,
                                  locator_records=locators)
@@ -172,7 +243,7 @@ def send_ms_not_registered(received_message, ms_prefix, other_map_servers=None):
     for ddt_node in other_map_servers:
         locator = LocatorRecord(priority=0, weight=0,
                                 m_priority=0, m_weight=0,
-                                reachable=True, locator=ddt_node)
+                                reachable=True, address=ddt_node)
         locators.append(locator)
 
     # No data in the MapServer
@@ -235,8 +306,7 @@ def handle_ddt_map_request(received_message, control_plane_sockets, data_plane_s
     # We have all the information: handle it
     if isinstance(handling_node, DDTReferralNode):
         # Handle this as a DDT referral
-        referral = handling_node.get_referral()
-        send_answer(received_message, referral)
+        send_answer_bytes(received_message, handling_node.get_referral_bytes())
         return
 
     elif isinstance(tree_node, MapServerNode):
@@ -7,6 +7,7 @@ from ipaddress import ip_address
 from pylisp.application.lispd import settings
 from pylisp.application.lispd.address_tree.base import AbstractNode
 from pylisp.application.lispd.etr_registration import ETRRegistration
+from pylisp.application.lispd.pending_requests import PendingRequestRegistry
 from pylisp.application.lispd.send_message import send_message
 from pylisp.packet.ip.ipv4 import IPv4Packet
 from pylisp.packet.ip.ipv6.base import IPv6Packet
@@ -20,27 +21,27 @@ from pylisp.packet.lisp.control.map_register_record import MapRegisterRecord
 from pylisp.packet.lisp.control.map_reply import MapReplyMessage
 from pylisp.packet.lisp.control.map_reply_record import MapReplyRecord
 from pylisp.packet.lisp.control.map_request import MapRequestMessage
+from pylisp.utils.event_loop import CancelledError, Return, get_event_loop
 from pylisp.utils.lcaf.nat_traversal_address import LCAFNATTraversalAddress
 import logging
 import os
 import random
-import threading
 import time
 import weakref
 
 
 # Design notes:
-# - Each Map-Server gets its own thread
-# - An InfoRequest is sent from the thread and an object is created to remember this
-# - If the main thread received a reply it looks up the corresponding object, stores the reply in it and triggers an event on it
-# - The thread waits for this event, with a timeout in case the Map-Server doesn't support InfoRequests
-# - The thread then sends a MapRegister, optionally with the WantNotify flag set
-# - If the WantNotify flag is set an object is created to remember this
-# - If the main thread received a MapNotify it looks up the corresponding object, stores the reply in it and triggers an event on it
-# - If the thread set the WantNotify flag it waits for that event, with a timeout in case something goes wrong
-# - If there is a timeout the thread tries another MapRegister with the WantNotify flag set
-# - On multiple failures the thread goes back to sending the InfoRequest
-# - The thread also has a triggerable event in case one of the Locators changes
+# - Each Map-Server gets its own task on the event loop
+# - An InfoRequest is sent from the task and registered as a pending request
+# - If a reply is received the pending request registry resolves the future that belongs to its nonce and sender
+# - The task waits for this future, with a timeout in case the Map-Server doesn't support InfoRequests
+# - The task then sends a MapRegister, optionally with the WantNotify flag set
+# - If the WantNotify flag is set the MapRegister is registered as a pending request
+# - If a MapNotify is received the pending request registry resolves the future that belongs to its nonce and sender
+# - If the task set the WantNotify flag it waits for that future, with a timeout in case something goes wrong
+# - If there is a timeout the task tries another MapRegister with the WantNotify flag set
+# - On multiple failures the task goes back to sending the InfoRequest
+# - The task also has a flag in case one of the Locators changes
 # - The MapRegister messages are sent every minute, or when the locator-changed event is triggered
 # - Do we want to restart the InfoRequest stuff on a locator change?
 
@@ -49,6 +50,13 @@ import weakref
 logger = logging.getLogger(__name__)
 
 
+# The outstanding requests of all ETRNodes. A request is sent three times
+# with one second in between, so it should be finished within this time.
+REQUEST_TIMEOUT = 5.0
+info_requests = PendingRequestRegistry('Info-Request')
+map_registers = PendingRequestRegistry('Map-Register')
+
+
 class InfoRequest(object):
     def __init__(self, eid_prefix, etrr, control_plane_sockets):
         # Store input
@@ -61,7 +69,7 @@ class InfoRequest(object):
                                         key_id=self.etrr.key_id,
                                         ttl=1440,
                                         eid_prefix=self.eid_prefix)
-        self.info_request.insert_authentication_data(self.etrr.key)
+        self.info_request.insert_authentication_data(self.etrr.authentication_key)
 
         # Remember source and destination of the outgoing request
         self.sent_from = None
@@ -70,26 +78,16 @@ class InfoRequest(object):
         # Here the reply will be stored
         self.info_reply = None
 
-        # This event will be triggered when the reply is received
-        self.reply_received = threading.Event()
-
     def send(self):
         self.sent_from, self.sent_to = send_message(message=self.info_request,
                                                     my_sockets=self.control_plane_sockets,
                                                     destinations=[self.etrr.map_server],
                                                     port=4342)
 
-    def set_reply_if_matches(self, source, info_message):
-        if source != self.etrr.map_server \
-        or info_message.nonce != self.info_request.nonce:
-            # Not for us
-            return False
-
-        logger.debug(u"Received a reply to InfoRequest from {0}".format(source))
+    def set_reply(self, info_message):
+        logger.debug(u"Received a reply to InfoRequest from {0}".format(self.etrr.map_server))
         self.info_reply = info_message
         self.info_reply.reply.private_etr_rloc = self.sent_from[0]
-        self.reply_received.set()
-        return True
 
 
 class MapRegister(object):
@@ -119,7 +117,7 @@ class MapRegister(object):
                                                                           locator_records=locators)],
                                                xtr_id=settings.config.XTR_ID,
                                                site_id=settings.config.SITE_ID)
-        self.map_register.insert_authentication_data(self.etrr.key)
+        self.map_register.insert_authentication_data(self.etrr.authentication_key)
 
         # Remember source and destination of the outgoing register
         self.sent_from = None
@@ -128,9 +126,6 @@ class MapRegister(object):
         # Here the notify is stored
         self.notify = None
 
-        # This event will be triggered when the notify is received
-        self.notify_received = threading.Event()
-
     def send(self):
         if not self.nat_info:
             # Plain Map_Register
@@ -176,25 +171,18 @@ class MapRegister(object):
                          destinations=self.nat_info.rtr_rlocs,
                          port=4342)
 
-    def set_notify_if_matches(self, source, notify):
+    def set_notify(self, notify):
         assert isinstance(notify, MapNotifyMessage)
 
-        if source != self.etrr.map_server \
-        or notify.nonce != self.map_register.nonce:
-            # Not for us
-            return False
-
-        logger.debug(u"Received a MapNotify from {0}".format(source))
+        logger.debug(u"Received a MapNotify from {0}".format(self.etrr.map_server))
         self.notify = notify
-        self.notify_received.set()
-        return True
 
     def notify_content_ok(self):
-        if not self.notify_received.is_set():
+        if self.notify is None:
             logger.error("Cannot validate a MapNotify message without actually receiving it")
             return False
 
-        if not self.notify.verify_authentication_data(self.etrr.key):
+        if not self.notify.verify_authentication_data(self.etrr.authentication_key):
             logger.debug(u"MapNotify authentication data is not valid")
             return False
 
@@ -270,19 +258,13 @@ class MapRegister(object):
         return True
 
 
-class MSRThread(threading.Thread):
+class MSRTask(object):
     def __init__(self, etr_node, etrr):
         assert(isinstance(etr_node, ETRNode))
         assert(isinstance(etrr, ETRRegistration))
 
-        super(MSRThread, self).__init__()
-
-        # Thread properties
+        # Task properties
         self.name = 'ETR-{0}-{1}'.format(etr_node.prefix, etrr.map_server)
-        self.daemon = True
-
-        # We need our own logger. The global one might disappear on shutdown
-        self.logger = logging.getLogger(__name__)
 
         # Store our state
         self.etr_node = weakref.proxy(etr_node)
@@ -290,42 +272,52 @@ class MSRThread(threading.Thread):
 
         self.need_new_registration = False
 
-        # Shutdown flag
-        self._stop_event = threading.Event()
+        # The running task
+        self._task = None
+
+    def __repr__(self):
+        return u"{0}({1})".format(self.__class__.__name__, self.name)
+
+    def is_alive(self):
+        return self._task is not None and not self._task.done()
+
+    def start(self):
+        self._task = get_event_loop().create_task(self.run())
 
     def get_nat_info(self):
         # Check if we are forced off
         if self.etrr.use_rtr is False:
-            self.logger.debug(u"MSRThread {0} had RTR usage disabled".format(self.name))
-            return None
+            logger.debug(u"MSRTask {0} had RTR usage disabled".format(self.name))
+            raise Return(None)
 
         # Start with sending out an InfoRequest
         info_req = InfoRequest(self.etr_node.prefix, self.etrr, self.etr_node.control_plane_sockets)
-        self.etr_node.outstanding_info_requests.append(info_req)
+        reply_received = info_requests.add(info_req.info_request.nonce, self.etrr.map_server, REQUEST_TIMEOUT)
 
-        for remaining_attempts in [2, 1, 0]:
-            # Send it
-            info_req.send()
-
-            # Wait for the reply for 1 second
-            info_req.reply_received.wait(1.0)
+        try:
+            for remaining_attempts in [2, 1, 0]:
+                # Send it
+                info_req.send()
 
-            if self._stop_event.is_set():
-                return
+                # Wait for the reply for 1 second
+                yield get_event_loop().wait(reply_received, 1.0)
 
-            if info_req.reply_received.is_set():
-                break
+                if reply_received.done():
+                    break
 
-            if remaining_attempts > 0:
-                self.logger.info("MSRThread {0} didn't receive answer to InfoRequest, retrying...".format(self.name))
+                if remaining_attempts > 0:
+                    logger.info("MSRTask {0} didn't receive answer to InfoRequest, retrying...".format(self.name))
+        finally:
+            # Clean up
+            info_requests.remove(info_req.info_request.nonce, self.etrr.map_server)
 
-        # Clean up
-        self.etr_node.outstanding_info_requests.remove(info_req)
+        if reply_received.done() and not reply_received.cancelled():
+            info_req.set_reply(reply_received.result())
 
-        if not info_req.reply_received.is_set():
-            self.logger.error("MapServer {0} doesn't answer to InfoRequests for prefix {1}"
-                              ", assuming no NAT".format(self.etrr.map_server,
-                                                         self.etr_node.prefix))
+        if info_req.info_reply is None:
+            logger.error("MapServer {0} doesn't answer to InfoRequests for prefix {1}"
+                         ", assuming no NAT".format(self.etrr.map_server,
+                                                    self.etr_node.prefix))
             reply = None
             behind_nat = False
         else:
@@ -334,24 +326,24 @@ class MSRThread(threading.Thread):
                           reply.etr_port != 4342)
 
         if not behind_nat:
-            self.logger.info("No NAT detected between us at {0} and MapServer {1}".format(info_req.sent_from[0],
-                                                                                          info_req.sent_to[0]))
+            logger.info("No NAT detected between us at {0} and MapServer {1}".format(info_req.sent_from[0],
+                                                                                     info_req.sent_to[0]))
             if self.etrr.use_rtr is True:
                 if reply:
-                    self.logger.info("Forcing use of RTR, even though no NAT is detected")
+                    logger.info("Forcing use of RTR, even though no NAT is detected")
                     behind_nat = True
                 else:
-                    self.logger.error("Cannot force use of RTR, no answer to InfoRequest received")
+                    logger.error("Cannot force use of RTR, no answer to InfoRequest received")
 
         else:
-            self.logger.info("NAT between us at {0} and MapServer {1} (it sees {2})".format(reply.private_etr_rloc,
-                                                                                            reply.map_server_rloc,
-                                                                                            reply.global_etr_rloc))
+            logger.info("NAT between us at {0} and MapServer {1} (it sees {2})".format(reply.private_etr_rloc,
+                                                                                       reply.map_server_rloc,
+                                                                                       reply.global_etr_rloc))
 
         if not behind_nat:
-            return None
+            raise Return(None)
         else:
-            return reply
+            raise Return(reply)
 
     def register(self, nat_info, force_map_notify=False):
         # Determine the locators
@@ -371,43 +363,44 @@ class MSRThread(threading.Thread):
         if not map_reg.want_map_notify:
             # Fire and forget
             map_reg.send()
-            return True
+            raise Return(True)
 
         # Store it as outstanding
-        self.etr_node.outstanding_map_registrations.append(map_reg)
-
-        for remaining_attempts in [2, 1, 0]:
-            # Send it
-            map_reg.send()
+        notify_received = map_registers.add(map_reg.map_register.nonce, self.etrr.map_server, REQUEST_TIMEOUT)
 
-            # Wait for the reply for 1 second
-            map_reg.notify_received.wait(1.0)
+        try:
+            for remaining_attempts in [2, 1, 0]:
+                # Send it
+                map_reg.send()
 
-            if self._stop_event.is_set():
-                return
+                # Wait for the reply for 1 second
+                yield get_event_loop().wait(notify_received, 1.0)
 
-            if map_reg.notify_received.is_set():
-                break
+                if notify_received.done():
+                    break
 
-            if remaining_attempts > 0:
-                self.logger.info("MSRThread {0} didn't receive MapNotify for MapRegister, retrying...".format(self.name))
+                if remaining_attempts > 0:
+                    logger.info("MSRTask {0} didn't receive MapNotify for MapRegister, retrying...".format(self.name))
+        finally:
+            # Clean up
+            map_registers.remove(map_reg.map_register.nonce, self.etrr.map_server)
 
-        # Clean up
-        self.etr_node.outstanding_map_registrations.remove(map_reg)
+        if notify_received.done() and not notify_received.cancelled():
+            map_reg.set_notify(notify_received.result())
 
-        if map_reg.notify_received.is_set():
+        if map_reg.notify is not None:
             # Check the content
             if not map_reg.notify_content_ok():
-                self.logger.error("The received MapNotify content does not match the MapRegister we sent")
-                return False
+                logger.error("The received MapNotify content does not match the MapRegister we sent")
+                raise Return(False)
 
             # All good
-            return True
+            raise Return(True)
 
         # Bad!
-        self.logger.error("MapServer {0} doesn't answer to MapNotify requests for prefix {1}".format(self.etrr.map_server,
-                                                                                                     self.etr_node.prefix))
-        return False
+        logger.error("MapServer {0} doesn't answer to MapNotify requests for prefix {1}".format(self.etrr.map_server,
+                                                                                                self.etr_node.prefix))
+        raise Return(False)
 
     def run(self):
         last_nat_info = 0
@@ -416,17 +409,13 @@ class MSRThread(threading.Thread):
         try:
             while True:
                 try:
-                    # Check if we need to stop
-                    if self._stop_event.is_set():
-                        return
-
                     # Do we need to refresh our NAT detection
                     now = time.time()
 
                     if not last_registration_was_ok \
                     or last_nat_info + (15 * 60) < now:
                         # See if we are going to use RTRs
-                        nat_info = self.get_nat_info()
+                        nat_info = yield self.get_nat_info()
                         last_nat_info = now
 
                         # Force a Map-Notify by pretending the last registration was not ok
@@ -439,8 +428,8 @@ class MSRThread(threading.Thread):
                         self.need_new_registration = False
 
                         # Register in the Map-Server
-                        last_registration_was_ok = self.register(nat_info=nat_info,
-                                                                 force_map_notify=not last_registration_was_ok)
+                        last_registration_was_ok = yield self.register(nat_info=nat_info,
+                                                                       force_map_notify=not last_registration_was_ok)
                         last_registration = now
 
                         if nat_info:
@@ -449,18 +438,21 @@ class MSRThread(threading.Thread):
                         else:
                             # Clear our RTRs in case we set them previously
                             self.etr_node.set_rtrs(self.etrr, [])
+                except (CancelledError, weakref.ReferenceError):
+                    raise
                 except:
-                    self.logger.exception("MSRThread {0} caught an unexpected exception: trying again in a bit".format(self.name))
+                    logger.exception("MSRTask {0} caught an unexpected exception: trying again in a bit".format(self.name))
 
-                # Sleep a bit, but watch the stop event
-                self._stop_event.wait(5.0)
+                # Sleep a bit
+                yield get_event_loop().sleep(5.0)
 
         except weakref.ReferenceError:
-            self.logger.info("MSRThread {0} does not have an ETRNode anymore: stopping".format(self.name))
+            logger.info("MSRTask {0} does not have an ETRNode anymore: stopping".format(self.name))
 
     def stop(self):
-        self.logger.debug("MSRThread {0} asked to stop".format(self.name))
-        self._stop_event.set()
+        logger.debug("MSRTask {0} asked to stop".format(self.name))
+        if self._task is not None:
+            self._task.cancel()
 
 
 class ETRNode(AbstractNode):
@@ -470,12 +462,9 @@ class ETRNode(AbstractNode):
         self._locators = set()
 
         # Dictionaries with an ETRRegistration as key
-        self._etrr_threads = {}
+        self._etrr_tasks = {}
         self._rtrs = {}
 
-        self.outstanding_info_requests = []
-        self.outstanding_map_registrations = []
-
         locators = locators or []
         for locator in locators:
             self.add_locator(locator)
@@ -485,17 +474,17 @@ class ETRNode(AbstractNode):
             self.add_etr_registration(etrr)
 
     def __del__(self):
-        for etrr_thread in self._etrr_threads.values():
-            etrr_thread.stop()
+        for etrr_task in self._etrr_tasks.values():
+            etrr_task.stop()
 
     def set_sockets(self, control_plane_sockets, data_plane_sockets):
         super(ETRNode, self).set_sockets(control_plane_sockets, data_plane_sockets)
 
         if self.control_plane_sockets:
-            # Make sure the MSR threads are started
-            for etrr_thread in self._etrr_threads.values():
-                if not etrr_thread.is_alive():
-                    etrr_thread.start()
+            # Make sure the MSR tasks are started
+            for etrr_task in self._etrr_tasks.values():
+                if not etrr_task.is_alive():
+                    etrr_task.start()
 
     def add_locator(self, locator):
         # Don't add duplicates
@@ -517,31 +506,31 @@ class ETRNode(AbstractNode):
         self._signal_locator_change()
 
     def _locators_have_changed(self):
-        # Signal the threads that new registration is required
-        logger.debug("Locators have changed, telling all threads to send new registration")
-        for etrr_thread in self._etrr_threads.values():
-            etrr_thread.need_new_registration = True
+        # Signal the tasks that new registration is required
+        logger.debug("Locators have changed, telling all tasks to send new registration")
+        for etrr_task in self._etrr_tasks.values():
+            etrr_task.need_new_registration = True
 
     def add_etr_registration(self, etrr):
         # Don't add duplicate MSRs
-        if etrr in self._etrr_threads:
+        if etrr in self._etrr_tasks:
             logger.debug("Not adding the same MSR {0!r} twice".format(etrr))
             return
 
-        etrr_thread = MSRThread(self, etrr)
+        etrr_task = MSRTask(self, etrr)
         if self.control_plane_sockets:
-            etrr_thread.start()
-        self._etrr_threads[etrr] = etrr_thread
+            etrr_task.start()
+        self._etrr_tasks[etrr] = etrr_task
 
     def remove_etr_registration(self, etrr):
-        etrr_thread = self._etrr_threads.get(etrr)
-        if not etrr_thread:
+        etrr_task = self._etrr_tasks.get(etrr)
+        if not etrr_task:
             logger.warning(u"{0!r} ETRRegistration {1!r} not found".format(self, etrr))
             return
 
         logger.debug(u"{0!r} stopping {1!r}".format(self, etrr))
-        etrr_thread.stop()
-        del self._etrr_threads[etrr]
+        etrr_task.stop()
+        del self._etrr_tasks[etrr]
 
     def set_rtrs(self, etrr, rtrs):
         old_rtrs = self._rtrs.get(etrr, [])
@@ -607,16 +596,21 @@ class ETRNode(AbstractNode):
         map_notify = received_message.message
         assert isinstance(map_notify, MapNotifyMessage)
 
-        for map_reg in self.outstanding_map_registrations:
-            if map_reg.set_notify_if_matches(received_message.source[0], map_notify):
-                # Found it, return
-                return
+        if map_registers.match(map_notify.nonce, received_message.source[0], map_notify):
+            # Found it, return
+            return
 
         logger.warn(u"Received an unexpected Map-Notify for {0} from {1}".format(record.eid_prefix,
                                                                                  received_message.source[0]))
 
     def handle_map_request(self, received_message, eid_prefix, control_plane_sockets, data_plane_sockets):
-        map_request = received_message.message
+        # Map-Requests forwarded by a Map-Server are encapsulated
+        if received_message.inner_message is not None:
+            map_request = received_message.inner_message
+            reply_port = received_message.udp_layer.source_port
+        else:
+            map_request = received_message.message
+            reply_port = received_message.source[1]
         assert isinstance(map_request, MapRequestMessage)
 
         # Return our locators
@@ -654,17 +648,16 @@ class ETRNode(AbstractNode):
         send_message(message=reply,
                      my_sockets=control_plane_sockets,
                      destinations=map_request.itr_rlocs,
-                     port=received_message.source[1])
+                     port=reply_port)
 
     def handle_info_message_reply(self, received_message, control_plane_sockets, data_plane_sockets):
         info_message = received_message.message
         assert isinstance(info_message, InfoMessage)
         assert isinstance(info_message.reply, LCAFNATTraversalAddress)
 
-        for info_req in self.outstanding_info_requests:
-            if info_req.set_reply_if_matches(received_message.source[0], info_message):
-                # Found it, return
-                return
+        if info_requests.match(info_message.nonce, received_message.source[0], info_message):
+            # Found it, return
+            return
 
         logger.warn(u"Received an unexpected Info-Message reply for {0} from {1}".format(info_message.eid_prefix,
                                                                                          received_message.source[0]))
@@ -3,17 +3,24 @@ Created on 1 jun. 2013
 
 @author: sander
 '''
-from ipaddress import IPv4Address, IPv6Address, IPv4Network
+from ipaddress import _BaseNetwork
 from pylisp.application.lispd.address_tree.base import AbstractNode
+from pylisp.application.lispd.map_request_forwarder import ForwardTargets, map_request_forwarder
 from pylisp.application.lispd.received_message import ReceivedMessage
+from pylisp.application.lispd.send_message import send_bytes
 from pylisp.application.lispd.utils.prefix import determine_instance_id_and_afi
-from pylisp.packet.lisp.control.locator_record import LocatorRecord
+from pylisp.packet.lisp.control.authentication import AuthenticationKey
+from pylisp.packet.lisp.control.encapsulated_control_message import EncapsulatedControlMessage
 from pylisp.packet.lisp.control.map_register import MapRegisterMessage
 from pylisp.packet.lisp.control.map_register_record import MapRegisterRecord
-from pylisp.utils.auto_addresses import AutoIPv4Address
-from pylisp.utils.auto_socket import AutoUDPSocket
+from pylisp.packet.lisp.control.map_reply import MapReplyMessage
+from pylisp.packet.lisp.control.map_reply_record import MapReplyRecord
+from pylisp.packet.lisp.control.map_request import MapRequestMessage
+from pylisp.utils.event_loop import Future, get_event_loop
+from pylisp.utils.radix_tree import RadixTree
+import heapq
+import itertools
 import logging
-import threading
 import time
 import weakref
 
@@ -22,6 +29,42 @@ import weakref
 logger = logging.getLogger(__name__)
 
 
+# Remember who wants to know about new registrations
+_registration_targets = weakref.WeakSet()
+
+
+def add_registration_target(registration_target):
+    '''
+    The registration target's on_registration(ms_node, prefix, source,
+    registration) method is called for every registration that is stored
+    because of a received Map-Register
+    '''
+    _registration_targets.add(registration_target)
+
+
+def _send_registration_notifications(ms_node, prefix, source, registration):
+    for registration_target in _registration_targets:
+        try:
+            registration_target.on_registration(ms_node, prefix, source, registration)
+        except:
+            logger.exception("Registration target {0!r} has thrown an exception".format(registration_target))
+
+
+# How long the cleanup task sleeps when there are no registrations
+IDLE_TIMEOUT = 30.0
+
+# Where the nonce is in a Map-Reply
+_NONCE_OFFSET = 4
+_NONCE_END = 12
+
+
+def _tree_key(prefix):
+    # Look up addresses as host prefixes
+    if isinstance(prefix, _BaseNetwork):
+        return int(prefix.network_address), prefix.prefixlen
+    return int(prefix), prefix.max_prefixlen
+
+
 class MapServerException(Exception):
     pass
 
@@ -46,85 +89,166 @@ class MapServerRegistration(object):
         return u"MapServerRegistration({0!r})".format(self.__dict__)
 
 
-class MSCleanupThread(threading.Thread):
+class MSCleanupTask(object):
     def __init__(self, ms_node):
         assert isinstance(ms_node, MapServerNode)
 
-        super(MSCleanupThread, self).__init__()
-
-        # Thread properties
+        # Task properties
         self.name = 'MS-{0}-cleanup'.format(ms_node.prefix)
-        self.daemon = True
-
-        # We need our own logger. The global one might disappear on shutdown
-        self.logger = logging.getLogger(__name__)
 
         # Store our state
         self.ms_node = weakref.proxy(ms_node)
 
-        # Shutdown flag
-        self._stop_event = threading.Event()
+        # The running task
+        self._task = None
+
+    def __repr__(self):
+        return u"{0}({1})".format(self.__class__.__name__, self.name)
+
+    def is_alive(self):
+        return self._task is not None and not self._task.done()
+
+    def start(self):
+        self._task = get_event_loop().create_task(self.run())
 
     def run(self):
+        loop = get_event_loop()
         try:
             while True:
+                next_deadline = None
                 try:
-                    # Check if we need to stop
-                    if self._stop_event.is_set():
-                        return
-
-                    # Store current time
-                    now = time.time()
-
-                    self.logger.debug('{name} running cleanup'.format(name=self.name))
-
-                    with self.ms_node.registrations_lock:
-                        prefixes = self.ms_node.registrations.keys()
-                        for prefix in prefixes:
-                            sources = self.ms_node.registrations[prefix].keys()
-                            for source in sources:
-                                # Delete expired registrations
-                                if now > self.ms_node.registrations[prefix][source].deadline:
-                                    self.logger.info('MapServerRegistration from {source} for {prefix} has expired'.format(source=source,
-                                                                                                                           prefix=prefix))
-                                    del self.ms_node.registrations[prefix][source]
-
-                            # Remove empty dicts
-                            if len(self.ms_node.registrations[prefix]) == 0:
-                                del self.ms_node.registrations[prefix]
-
+                    next_deadline = self.ms_node.expire_registrations()
+
+                    # Wake up early if a registration with an earlier
+                    # deadline arrives
+                    wakeup = Future(loop)
+                    self.ms_node._expiry_wakeup = wakeup
+                except weakref.ReferenceError:
+                    raise
                 except:
-                    self.logger.exception("MSCleanupThread {0} caught an unexpected exception: trying again in a bit".format(self.name))
+                    logger.exception("MSCleanupTask {0} caught an unexpected exception: trying again in a bit".format(self.name))
+                    wakeup = Future(loop)
+
+                # Sleep until the next registration expires
+                if next_deadline is None:
+                    timeout = IDLE_TIMEOUT
+                else:
+                    timeout = max(next_deadline - loop.time(), 0)
 
-                # Sleep a bit, but watch the stop event
-                self._stop_event.wait(30.0)
+                yield loop.wait(wakeup, timeout)
 
         except weakref.ReferenceError:
-            self.logger.info("MSCleanupThread {0} does not have an MapServerNode anymore: stopping".format(self.name))
+            logger.info("MSCleanupTask {0} does not have an MapServerNode anymore: stopping".format(self.name))
 
     def stop(self):
-        self.logger.debug("MSCleanupThread {0} asked to stop".format(self.name))
-        self._stop_event.set()
+        logger.debug("MSCleanupTask {0} asked to stop".format(self.name))
+        if self._task is not None:
+            self._task.cancel()
 
 
 class MapServerNode(AbstractNode):
     def __init__(self, prefix, key, allow_more_specifics=True):
         super(MapServerNode, self).__init__(prefix)
         self.key = key
+        self.authentication_key = AuthenticationKey(key)
         self.allow_more_specifics = allow_more_specifics
 
-        # Our store for all registrations
+        # Our store for all registrations, and a tree to find the
+        # registered prefix that a Map-Request belongs to
         self.registrations = {}
-        self.registrations_lock = threading.RLock()
-
-        # Start a cleanup-thread
-        self._cleanup_thread = MSCleanupThread(self)
-        self._cleanup_thread.start()
+        self._registration_tree = RadixTree(self.prefix.max_prefixlen)
+
+        # The registrations of a prefix get a new version when they change.
+        # Proxy Map-Replies and the ETRs to forward Map-Requests to are
+        # cached by prefix as (version, value).
+        self._registration_versions = {}
+        self._proxy_replies = {}
+        self._forward_targets = {}
+
+        # A heap of (deadline, sequence, prefix, source) to find the
+        # registrations that have expired, and the sequence number of the
+        # current entry for each (prefix, source). An updated registration
+        # keeps its entry, which is moved to the new deadline when it comes
+        # up, so re-registering doesn't touch the heap.
+        self._expiry_heap = []
+        self._expiry_entries = {}
+        self._expiry_sequence = itertools.count()
+        self._expiry_wakeup = None
+
+        # The cleanup-task is started when we get our sockets
+        self._cleanup_task = MSCleanupTask(self)
+
+    def set_sockets(self, control_plane_sockets, data_plane_sockets):
+        super(MapServerNode, self).set_sockets(control_plane_sockets, data_plane_sockets)
+
+        if self._cleanup_task and not self._cleanup_task.is_alive():
+            self._cleanup_task.start()
 
     def __del__(self):
-        if self._cleanup_thread:
-            self._cleanup_thread.stop()
-            self._cleanup_thread = None
+        if self._cleanup_task:
+            self._cleanup_task.stop()
+            self._cleanup_task = None
+
+    def expire_registrations(self, now=None):
+        '''
+        Remove the registrations whose deadline has passed and return the
+        deadline of the next one, or None if there are no registrations
+        '''
+        if now is None:
+            now = time.time()
+
+        heap = self._expiry_heap
+        while heap and heap[0][0] < now:
+            dummy, sequence, prefix, source = heapq.heappop(heap)
+            if self._expiry_entries.get((prefix, source)) != sequence:
+                # Replaced by an entry with an earlier deadline
+                continue
+
+            sources = self.registrations.get(prefix)
+            registration = sources and sources.get(source)
+            if registration is None:
+                del self._expiry_entries[(prefix, source)]
+                continue
+
+            if now <= registration.deadline:
+                # Updated since this entry was added
+                self._schedule_expiry(prefix, source, registration.deadline)
+                continue
+
+            logger.info('MapServerRegistration from {source} for {prefix} has expired'.format(source=source,
+                                                                                              prefix=prefix))
+            del self._expiry_entries[(prefix, source)]
+            del sources[source]
+
+            # Remove empty dicts
+            if len(sources) == 0:
+                del self.registrations[prefix]
+                self._registration_tree.discard(_tree_key(prefix))
+
+            self._registrations_changed(prefix)
+
+        return heap[0][0] if heap else None
+
+    def _registrations_changed(self, prefix):
+        if prefix in self.registrations:
+            self._registration_versions[prefix] = self._registration_versions.get(prefix, 0) + 1
+        else:
+            self._registration_versions.pop(prefix, None)
+
+        # Drop the cached Map-Reply and forwarding targets
+        self._proxy_replies.pop(prefix, None)
+        self._forward_targets.pop(prefix, None)
+
+    def _schedule_expiry(self, prefix, source, deadline):
+        sequence = next(self._expiry_sequence)
+        entry = (deadline, sequence, prefix, source)
+        heapq.heappush(self._expiry_heap, entry)
+        self._expiry_entries[(prefix, source)] = sequence
+
+        # Wake up the cleanup task if this is the first registration to expire
+        if self._expiry_heap[0] is entry \
+        and self._expiry_wakeup is not None and not self._expiry_wakeup.done():
+            self._expiry_wakeup.set_result(None)
 
     def handle_map_register_record(self, received_message, record, control_plane_sockets, data_plane_sockets):
         assert isinstance(received_message, ReceivedMessage)
@@ -134,7 +258,7 @@ class MapServerNode(AbstractNode):
         assert isinstance(map_register, MapRegisterMessage)
 
         # Before we go any further we check the authentication data
-        if not map_register.verify_authentication_data(self.key):
+        if not received_message.verify_authentication_data(self.authentication_key):
             raise MapServerAuthenticationError(u"Ignoring a MapRegister message for {0} "
                                                "with invalid authentication data".format(record.eid_prefix))
 
@@ -159,104 +283,151 @@ class MapServerNode(AbstractNode):
             source = received_message.source[0]
 
         # Store the data for now
-        with self.registrations_lock:
-            if prefix not in self.registrations:
-                self.registrations[prefix] = {}
-
-            # Store registration
-            locators = ', '.join(map(lambda locator: unicode(locator.address), record.locator_records))
-            if source not in self.registrations[prefix]:
-                logger.info('New MapServerRegistration from {source} for {prefix}: {locators}'.format(source=source, prefix=prefix,
-                                                                                                      locators=locators))
-            else:
-                logger.debug('Updating MapServerRegistration from {source} for {prefix}: {locators}'.format(source=source, prefix=prefix,
-                                                                                                      locators=locators))
-
-            self.registrations[prefix][source] = MapServerRegistration(proxy_map_reply=map_register.proxy_map_reply,
-                                                                       record=record)
+        registration = MapServerRegistration(proxy_map_reply=map_register.proxy_map_reply,
+                                             record=record)
+        self.store_registration(prefix, source, registration)
+
+        # Let others, like the other lispd workers, know
+        _send_registration_notifications(self, prefix, source, registration)
+
+    def store_registration(self, prefix, source, registration):
+        if prefix not in self.registrations:
+            self.registrations[prefix] = {}
+            self._registration_tree[_tree_key(prefix)] = prefix
+
+        # Store registration
+        locators = ', '.join(map(lambda locator: unicode(locator.address), registration.record.locator_records))
+        if source not in self.registrations[prefix]:
+            logger.info('New MapServerRegistration from {source} for {prefix}: {locators}'.format(source=source, prefix=prefix,
+                                                                                                  locators=locators))
+        else:
+            logger.debug('Updating MapServerRegistration from {source} for {prefix}: {locators}'.format(source=source, prefix=prefix,
+                                                                                                        locators=locators))
+
+        old_registration = self.registrations[prefix].get(source)
+        self.registrations[prefix][source] = registration
+        self._registrations_changed(prefix)
+
+        # Only a new or earlier deadline needs a new entry in the heap
+        if old_registration is None \
+        or (prefix, source) not in self._expiry_entries \
+        or registration.deadline < old_registration.deadline:
+            self._schedule_expiry(prefix, source, registration.deadline)
+
+    def find_registered_prefix(self, eid):
+        '''
+        Return the most specific registered prefix that contains the given
+        EID address or prefix, or None
+        '''
+        if eid.version != self.prefix.version:
+            return None
+
+        return self._registration_tree.longest_match(_tree_key(eid))
+
+    @staticmethod
+    def _merge_locators(records):
+        # The first registration of an address wins
+        locators = []
+        seen = set()
+        for record in records:
+            for locator in record.locator_records:
+                if locator.address not in seen:
+                    seen.add(locator.address)
+                    locators.append(locator)
+
+        return locators
+
+    def get_forward_targets(self, prefix):
+        '''
+        Return the ForwardTargets for the given registered prefix
+        '''
+        version = self._registration_versions.get(prefix)
+        cached = self._forward_targets.get(prefix)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+
+        registrations = self.registrations.get(prefix, {})
+        records = [registration.record for registration in registrations.itervalues()]
+        targets = ForwardTargets(self._merge_locators(records))
+
+        self._forward_targets[prefix] = (version, targets)
+        return targets
+
+    def get_proxy_reply(self, prefix):
+        '''
+        Return the Map-Reply for the given registered prefix as bytes with an
+        all-zero nonce, or None if the ETRs didn't ask us to reply for them.
+        The locators of all current registrations are merged.
+        '''
+        version = self._registration_versions.get(prefix)
+        cached = self._proxy_replies.get(prefix)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+
+        registrations = self.registrations.get(prefix)
+        if not registrations \
+        or not any(registration.proxy_map_reply for registration in registrations.itervalues()):
+            return None
+
+        records = [registration.record for registration in registrations.itervalues()]
+        locators = self._merge_locators(records)
+
+        # A Map-Server sends non-authoritative Map-Replies on behalf of the ETRs
+        reply_record = MapReplyRecord(ttl=min(record.ttl for record in records),
+                                      authoritative=False,
+                                      map_version=records[0].map_version,
+                                      eid_prefix=records[0].eid_prefix,
+                                      locator_records=locators)
+        reply = MapReplyMessage(records=[reply_record])
+
+        data = reply.to_bytes()
+        self._proxy_replies[prefix] = (version, data)
+        return data
 
     def handle_map_request(self, received_message, control_plane_sockets, data_plane_sockets):
-        pass
-
-
-x = ReceivedMessage(socket=AutoUDPSocket(AutoIPv4Address('vlan2'), 4342),
-                    destination=(AutoIPv4Address('vlan2'), 4342),
-                    source=(IPv4Address(u'95.97.83.93'), 4342),
-                    message_nr=2,
-                    message=MapRegisterMessage(nonce='\xa06k\xf3\xf9v\xf9;',
-                                               for_rtr=False,
-                                               proxy_map_reply=False,
-                                               authentication_data='{\x86\xca>\x1a\x10\xbd\xdb\xa3\xe2m\x01\x8b\x84\xe9%B~\xb5l',
-                                               xtr_id=266545332235412465937187393052518930680L,
-                                               site_id=0L,
-                                               records=[MapRegisterRecord(locator_records=[LocatorRecord(m_priority=255, m_weight=0,
-                                                                                                         priority=50, weight=100,
-                                                                                                         address=IPv4Address(u'87.1.1.77'),
-                                                                                                         reachable=True,
-                                                                                                         probed_locator=False,
-                                                                                                         local=True),
-                                                                                           LocatorRecord(m_priority=255, m_weight=0,
-                                                                                                         priority=10, weight=100,
-                                                                                                         address=IPv4Address(u'95.9.3.93'),
-                                                                                                         reachable=True,
-                                                                                                         probed_locator=False,
-                                                                                                         local=True),
-                                                                                           LocatorRecord(m_priority=255, m_weight=0,
-                                                                                                         priority=50, weight=100,
-                                                                                                         address=IPv6Address(u'2001:9::1'),
-                                                                                                         reachable=True,
-                                                                                                         probed_locator=False,
-                                                                                                         local=True)],
-                                                                          authoritative=True,
-                                                                          eid_prefix=IPv4Network(u'37.77.57.56/30'),
-                                                                          ttl=1440,
-                                                                          action=0,
-                                                                          map_version=0),
-                                                        MapRegisterRecord(locator_records=[LocatorRecord(m_priority=255, m_weight=0,
-                                                                                                         priority=50, weight=100,
-                                                                                                         address=IPv4Address(u'87.1.1.77'),
-                                                                                                         reachable=True,
-                                                                                                         probed_locator=False,
-                                                                                                         local=True),
-                                                                                           LocatorRecord(m_priority=255, m_weight=0,
-                                                                                                         priority=10, weight=100,
-                                                                                                         address=IPv4Address(u'95.9.3.93'),
-                                                                                                         reachable=True,
-                                                                                                         probed_locator=False,
-                                                                                                         local=True),
-                                                                                           LocatorRecord(m_priority=255, m_weight=0,
-                                                                                                         priority=50, weight=100,
-                                                                                                         address=IPv6Address(u'2001:9::1'),
-                                                                                                         reachable=True,
-                                                                                                         probed_locator=False,
-                                                                                                         local=True)],
-                                                                          authoritative=True,
-                                                                          eid_prefix=IPv4Network(u'37.77.56.64/26'),
-                                                                          ttl=1440,
-                                                                          action=0,
-                                                                          map_version=0),
-                                                        MapRegisterRecord(locator_records=[LocatorRecord(m_priority=255, m_weight=0,
-                                                                                                         priority=50, weight=100,
-                                                                                                         address=IPv4Address(u'87.1.1.77'),
-                                                                                                         reachable=True,
-                                                                                                         probed_locator=False,
-                                                                                                         local=True),
-                                                                                           LocatorRecord(m_priority=255, m_weight=0,
-                                                                                                         priority=10, weight=100,
-                                                                                                         address=IPv4Address(u'95.9.3.93'),
-                                                                                                         reachable=True,
-                                                                                                         probed_locator=False,
-                                                                                                         local=True),
-                                                                                           LocatorRecord(m_priority=255, m_weight=0,
-                                                                                                         priority=50, weight=100,
-                                                                                                         address=IPv6Address(u'2001:9::1'),
-                                                                                                         reachable=True,
-                                                                                                         probed_locator=False,
-                                                                                                         local=True)],
-                                                                          authoritative=True,
-                                                                          eid_prefix=IPv4Network(u'37.77.56.32/31'),
-                                                                          ttl=1440,
-                                                                          action=0,
-                                                                          map_version=0)],
-                                               want_map_notify=True,
-                                               key_id=1))
+        '''
+        Handle an encapsulated Map-Request for an EID in our prefix. Returns
+        whether it was handled.
+        '''
+        map_request = received_message.inner_message
+        assert isinstance(map_request, MapRequestMessage)
+
+        dummy, dummy, eid = determine_instance_id_and_afi(map_request.eid_prefixes[0])
+        prefix = None
+        if eid is not None:
+            prefix = self.find_registered_prefix(eid)
+
+        if prefix is None:
+            logger.debug(u"Map-Request in message {0} for {1} which is not registered".format(received_message.message_nr,
+                                                                                           eid))
+            return False
+
+        data = self.get_proxy_reply(prefix)
+        if data is None:
+            return self.forward_map_request(received_message, prefix, control_plane_sockets)
+
+        # Fill in the nonce of the request
+        data = data[:_NONCE_OFFSET] + map_request.nonce + data[_NONCE_END:]
+
+        # Send the reply to the RLOCs in the Map-Request
+        sent_from, sent_to = send_bytes(data=data,
+                                        my_sockets=control_plane_sockets,
+                                        destinations=map_request.itr_rlocs,
+                                        port=received_message.udp_layer.source_port,
+                                        description='proxy Map-Reply')
+        return sent_to is not None
+
+    def forward_map_request(self, received_message, prefix, control_plane_sockets):
+        '''
+        Forward the encapsulated Map-Request to one of the ETRs that
+        registered the prefix. Returns whether it was forwarded.
+        '''
+        targets = self.get_forward_targets(prefix)
+        if not targets:
+            logger.debug(u"No reachable ETRs to forward the Map-Request in message {0} to".format(
+                received_message.message_nr))
+            return False
+
+        # Re-encapsulate the packet as it was received, without the DDT flag
+        ecm = EncapsulatedControlMessage(payload=received_message.message.get_payload_bytes())
+        return map_request_forwarder.forward(ecm.to_bytes(), targets, control_plane_sockets)
@@ -0,0 +1,193 @@
+'''
+Created on 18 okt. 2026
+
+@author: sander
+
+The ITR data path: packets that netfilter queues to us are looked up in the
+map-cache and encapsulated to an RLOC. Packets are handled in batches. Each
+packet gets its verdict straight away, but the encapsulated packets are
+collected per RLOC and sent when the batch is done. The socket for an RLOC is
+looked up once per batch, and all packets from a socket are sent with one
+system call where possible.
+Only the addresses are read from the IP header, the packet is never parsed.
+'''
+from ipaddress import IPv4Address, IPv6Address
+from pylisp.application.lispd import settings
+from pylisp.application.lispd.map_cache import flow_hash, map_cache as shared_map_cache
+from pylisp.application.lispd.send_message import find_matching_sockets, send_datagrams
+from pylisp.packet.lisp.control import MapReplyRecord
+from pylisp.packet.lisp.data import DataHeaderTemplate
+import logging
+import socket
+import struct
+
+
+# Get the logger
+logger = logging.getLogger(__name__)
+
+
+__all__ = ['EncapsulationStage']
+
+
+# The source and destination addresses in IPv4 and IPv6 headers, IPv6
+# addresses split in 64-bit halves
+_ipv4_addresses_format = struct.Struct('!II')
+_ipv6_addresses_format = struct.Struct('!QQQQ')
+
+
+class EncapsulationStage(object):
+    '''
+    Route and encapsulate the packets from one or more NFQUEUEs. The verdicts
+    are given because the nfqueue module is optional and only imported by
+    the script.
+    '''
+
+    def __init__(self, control_plane_sockets, data_plane_sockets, accept, drop, map_cache=None):
+        if map_cache is None:
+            map_cache = shared_map_cache
+
+        self.map_cache = map_cache
+        self.control_plane_sockets = control_plane_sockets
+        self.data_plane_sockets = data_plane_sockets
+        self.accept = accept
+        self.drop = drop
+
+        # The LISP header for packets that are sent to the PETR
+        self.petr_header = DataHeaderTemplate()
+
+        # The encapsulated packets of the current batch per RLOC
+        self._batch = {}
+
+        self.counters = {'packets': 0,
+                         'encapsulated': 0,
+                         'native': 0,
+                         'dropped': 0,
+                         'send_errors': 0,
+                         'batches': 0,
+                         'full_batches': 0,
+                         'largest_batch': 0}
+
+    def __repr__(self):
+        return u"{0}({1} packets)".format(self.__class__.__name__, self.counters['packets'])
+
+    def __call__(self, payload):
+        '''
+        The NFQUEUE callback
+        '''
+        try:
+            verdict = self.route(payload.get_data())
+        except:
+            logger.exception("Unexpected exception when handling data packet")
+            verdict = self.drop
+
+        payload.set_verdict(verdict)
+
+    def _request(self, version, source, destination, prefix=None):
+        # Only misses need address objects
+        address_class = version == 4 and IPv4Address or IPv6Address
+        self.map_cache.request(0, address_class(source), address_class(destination), self.control_plane_sockets,
+                               prefix=prefix)
+
+    def route(self, data):
+        '''
+        Decide what happens to a packet and return the verdict for it. Packets
+        that are encapsulated are added to the batch and dropped.
+        '''
+        self.counters['packets'] += 1
+
+        version = ord(data[0]) >> 4
+        if version == 4:
+            source, destination = _ipv4_addresses_format.unpack_from(data, 12)
+            afi = 1
+        elif version == 6:
+            (source_high, source_low,
+             destination_high, destination_low) = _ipv6_addresses_format.unpack_from(data, 8)
+            source = (source_high << 64) | source_low
+            destination = (destination_high << 64) | destination_low
+            afi = 2
+        else:
+            self.counters['dropped'] += 1
+            return self.drop
+
+        entry = self.map_cache.lookup_value(0, afi, destination)
+        if entry is None:
+            # Ask the Map-Resolver and use the PETR until we know
+            self._request(version, source, destination)
+            rloc = settings.config.PETR
+            header = self.petr_header
+        elif entry.rlocs:
+            rloc = entry.select_rloc(flow_hash(data))
+            header = entry.header
+        elif entry.action == MapReplyRecord.ACT_SEND_MAP_REQUEST:
+            self._request(version, source, destination, entry.prefix)
+            rloc = settings.config.PETR
+            header = self.petr_header
+        elif entry.action in (MapReplyRecord.ACT_NO_ACTION, MapReplyRecord.ACT_NATIVELY_FORWARD):
+            self.counters['native'] += 1
+            return self.accept
+        else:
+            self.counters['dropped'] += 1
+            return self.drop
+
+        if rloc is None:
+            self.counters['dropped'] += 1
+            return self.drop
+
+        packets = self._batch.get(rloc)
+        if packets is None:
+            packets = self._batch[rloc] = []
+        packets.append(header.encapsulate(data))
+
+        # We send the encapsulated packet instead
+        return self.drop
+
+    def flush(self):
+        '''
+        Send the encapsulated packets of the current batch, with one system
+        call per socket where possible
+        '''
+        batch, self._batch = self._batch, {}
+
+        per_socket = {}
+        for rloc, packets in batch.iteritems():
+            sockets = find_matching_sockets(rloc, self.data_plane_sockets)
+            if not sockets:
+                logger.error(u"No socket to send data packets to {0} from".format(rloc))
+                self.counters['send_errors'] += len(packets)
+                continue
+
+            address = (rloc, 4341)
+            datagrams = per_socket.setdefault(sockets[0], [])
+            datagrams.extend([(data, address) for data in packets])
+
+        for sock, datagrams in per_socket.iteritems():
+            try:
+                sent = send_datagrams(sock, datagrams)
+            except socket.error:
+                logger.exception(u"Could not send data packets from {0!r}".format(sock))
+                sent = 0
+
+            self.counters['encapsulated'] += sent
+            self.counters['send_errors'] += len(datagrams) - sent
+
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(u"Sent data packets to {0} RLOCs".format(len(batch)))
+
+    def process(self, queue, count):
+        '''
+        Handle up to count packets that are waiting in the queue and send the
+        result. Returns the number of packets handled.
+        '''
+        before = self.counters['packets']
+        queue.process_pending(count)
+        self.flush()
+
+        handled = self.counters['packets'] - before
+        self.counters['batches'] += 1
+        if handled >= count:
+            # There are probably more packets waiting in the queue
+            self.counters['full_batches'] += 1
+        if handled > self.counters['largest_batch']:
+            self.counters['largest_batch'] = handled
+
+        return handled
@@ -0,0 +1,480 @@
+'''
+Created on 18 okt. 2026
+
+@author: sander
+
+An iterative DDT resolver. It walks the DDT hierarchy for an EID, starting
+from the delegations in the ddt_root, by sending DDT Map-Requests to the DDT
+nodes and following their Map-Referrals until a Map-Server acknowledges the
+request or the EID turns out not to be registered.
+
+Every referral is kept in a referral cache by prefix until its TTL runs out,
+including negative answers, so a resolution starts at the most specific
+referral that is known. Once the Map-Server for a prefix is known it takes a
+single round-trip.
+
+Delegations usually have several DDT nodes. The resolver asks the one that
+answered fastest before, and if it takes longer than usual it asks the next
+one as well. The first answer is used.
+
+The resolver is used by lispd and by the ddt_query script. A resolution is a
+generator that runs as a task on the event loop, and the Map-Referrals are
+given to the resolver by whoever receives them.
+'''
+from collections import OrderedDict
+from ipaddress import ip_network
+from pylisp.application.lispd import settings
+from pylisp.application.lispd.pending_requests import PendingRequestRegistry
+from pylisp.application.lispd.send_message import send_bytes
+from pylisp.application.lispd.server_scores import ServerScores
+from pylisp.application.lispd.utils.prefix import determine_instance_id_and_afi
+from pylisp.packet.lisp.control import EncapsulatedControlMessage, MapReferralRecord
+from pylisp.utils.event_loop import Future, Return, get_event_loop
+from pylisp.utils.radix_tree import RadixTree
+import logging
+import time
+
+
+# Get the logger
+logger = logging.getLogger(__name__)
+
+
+__all__ = ['ReferralCacheEntry', 'ReferralCache', 'DDTResolver', 'ddt_resolver']
+
+
+# How long we wait for a DDT node to answer
+REFERRAL_TIMEOUT = 2.0
+
+# The maximum number of referrals followed for one resolution
+MAX_REFERRALS = 16
+
+# NOT-AUTHORITATIVE answers have a TTL of 0, but asking again straight away
+# won't give a different answer
+NEGATIVE_REFERRAL_MIN_TTL = 60.0
+
+# The AFI for each IP version
+_afis = {4: 1, 6: 2}
+
+# Referrals that point to other DDT nodes or Map-Servers
+_referral_actions = (MapReferralRecord.ACT_NODE_REFERRAL,
+                     MapReferralRecord.ACT_MS_REFERRAL)
+
+# Answers that say the EID can't be resolved
+_negative_actions = (MapReferralRecord.ACT_MS_NOT_REGISTERED,
+                     MapReferralRecord.ACT_DELEGATION_HOLE,
+                     MapReferralRecord.ACT_NOT_AUTHORITATIVE)
+
+
+def _covers(prefix, eid):
+    # Does the prefix contain the EID-prefix?
+    if prefix.version != eid.version or prefix.prefixlen > eid.prefixlen:
+        return False
+
+    shift = prefix.max_prefixlen - prefix.prefixlen
+    return int(prefix.network_address) >> shift == int(eid.network_address) >> shift
+
+
+class ReferralCacheEntry(object):
+    '''
+    What we know about an EID-prefix: which DDT nodes or Map-Servers to ask
+    about it, or that it can't be resolved
+    '''
+    __slots__ = ('instance_id', 'prefix', 'action', 'ddt_nodes', 'expires', 'key')
+
+    def __init__(self, instance_id, prefix, action, ddt_nodes, expires):
+        self.instance_id = instance_id
+        self.prefix = prefix
+        self.action = action
+        self.ddt_nodes = ddt_nodes
+        self.expires = expires
+        self.key = (instance_id, _afis[prefix.version], int(prefix.network_address), prefix.prefixlen)
+
+    def __repr__(self):
+        return u"{0}({1}, {2}, action={3}, ddt_nodes={4!r})".format(self.__class__.__name__, self.instance_id,
+                                                                  self.prefix, self.action, self.ddt_nodes)
+
+    @property
+    def referral(self):
+        return self.action in _referral_actions
+
+    @property
+    def negative(self):
+        return self.action in _negative_actions
+
+
+class ReferralCache(object):
+    '''
+    Referrals by instance-id and EID-prefix. The delegations from the
+    ddt_root never expire. Learned referrals expire after their TTL, and when
+    the cache is full the least recently used ones are evicted.
+    '''
+
+    def __init__(self):
+        # A RadixTree for every instance-id and AFI
+        self._trees = {}
+
+        # The delegations from the ddt_root
+        self._roots = {}
+
+        # All learned entries, least recently used first
+        self._entries = OrderedDict()
+
+        self.counters = {'hits': 0,
+                         'misses': 0,
+                         'expired': 0,
+                         'evicted': 0}
+
+    def __repr__(self):
+        return u"{0}({1} roots, {2} referrals)".format(self.__class__.__name__, len(self._roots),
+                                                       len(self._entries))
+
+    def __len__(self):
+        return len(self._roots) + len(self._entries)
+
+    def _store(self, entry):
+        key = entry.key
+        tree = self._trees.get(key[:2])
+        if tree is None:
+            tree = RadixTree(entry.prefix.max_prefixlen)
+            self._trees[key[:2]] = tree
+
+        tree[key[2:]] = entry
+
+    def _remove(self, entry):
+        key = entry.key
+        del self._entries[key]
+        tree = self._trees[key[:2]]
+        tree.discard(key[2:])
+        if not len(tree):
+            del self._trees[key[:2]]
+
+    def add_root(self, instance_id, afi, prefix, address):
+        '''
+        Add a DDT node for a prefix from the ddt_root
+        '''
+        prefix = ip_network(prefix)
+        if _afis[prefix.version] != afi:
+            raise ValueError(u"Prefix {0} doesn't belong to AFI {1}".format(prefix, afi))
+
+        key = (instance_id, afi, int(prefix.network_address), prefix.prefixlen)
+        entry = self._roots.get(key)
+        if entry is None:
+            entry = ReferralCacheEntry(instance_id, prefix, MapReferralRecord.ACT_NODE_REFERRAL, [],
+                                       float('inf'))
+            self._roots[key] = entry
+
+            # The root replaces what we learned about the same prefix
+            if key in self._entries:
+                self._remove(self._entries[key])
+            self._store(entry)
+
+        if address not in entry.ddt_nodes:
+            entry.ddt_nodes.append(address)
+
+    def load_root(self, delegations):
+        '''
+        Add the (instance-id, AFI, prefix, address) tuples from the ddt_root
+        '''
+        for instance_id, afi, prefix, address in delegations:
+            self.add_root(instance_id, afi, prefix, address)
+
+    def clear(self):
+        '''
+        Forget everything that was learned
+        '''
+        for entry in self._entries.values():
+            self._remove(entry)
+
+    def lookup(self, instance_id, eid, now=None):
+        '''
+        Return the entry with the longest prefix that contains the
+        EID-prefix, or None
+        '''
+        if now is None:
+            now = time.time()
+
+        afi = _afis[eid.version]
+        key = (int(eid.network_address), eid.prefixlen)
+
+        tree = self._trees.get((instance_id, afi))
+        while tree is not None:
+            entry = tree.longest_match(key)
+            if entry is None:
+                break
+
+            if entry.expires <= now:
+                # Remove it and see if a less specific prefix matches
+                self._remove(entry)
+                self.counters['expired'] += 1
+                tree = self._trees.get((instance_id, afi))
+                continue
+
+            # Mark it as recently used
+            if entry.key in self._entries:
+                del self._entries[entry.key]
+                self._entries[entry.key] = entry
+
+            self.counters['hits'] += 1
+            return entry
+
+        self.counters['misses'] += 1
+        return None
+
+    def entry_from_record(self, record, now=None):
+        '''
+        Return what a MapReferralRecord tells us as an entry, or None if we
+        don't understand its EID-prefix
+        '''
+        assert isinstance(record, MapReferralRecord)
+
+        if now is None:
+            now = time.time()
+
+        instance_id, afi, prefix = determine_instance_id_and_afi(record.eid_prefix)
+        if afi is None:
+            return None
+
+        ttl = record.ttl * 60
+        if record.action in _negative_actions:
+            ttl = max(ttl, NEGATIVE_REFERRAL_MIN_TTL)
+
+        return ReferralCacheEntry(instance_id, ip_network(prefix), record.action,
+                                  [locator.address for locator in record.locator_records],
+                                  now + ttl)
+
+    def add(self, entry, now=None):
+        '''
+        Store an entry. MS-ACKs and entries that have already expired are not
+        stored, and neither are entries for the prefixes from the ddt_root.
+        '''
+        if now is None:
+            now = time.time()
+
+        if entry.action == MapReferralRecord.ACT_MS_ACK or entry.expires <= now or entry.key in self._roots:
+            return entry
+
+        old_entry = self._entries.get(entry.key)
+        if old_entry is not None:
+            self._remove(old_entry)
+
+        self._store(entry)
+        self._entries[entry.key] = entry
+
+        # Make room by evicting the least recently used entries
+        while len(self._entries) > settings.config.DDT_REFERRAL_CACHE_SIZE:
+            self._remove(next(self._entries.itervalues()))
+            self.counters['evicted'] += 1
+
+        logger.debug(u"Added {0!r} to the referral cache".format(entry))
+        return entry
+
+    def add_record(self, record, now=None):
+        '''
+        Store what a MapReferralRecord tells us and return it as an entry, or
+        None if it can't be stored
+        '''
+        if now is None:
+            now = time.time()
+
+        entry = self.entry_from_record(record, now)
+        if entry is None:
+            return None
+
+        return self.add(entry, now)
+
+
+class DDTResolver(object):
+    def __init__(self, referral_cache=None, timeout=REFERRAL_TIMEOUT):
+        if referral_cache is None:
+            referral_cache = ReferralCache()
+
+        self.referral_cache = referral_cache
+        self.timeout = timeout
+
+        # The DDT Map-Requests that are waiting for a Map-Referral
+        self.pending = PendingRequestRegistry('DDT Map-Request')
+
+        # How fast the DDT nodes answer
+        self.scores = ServerScores()
+
+        self.counters = {'resolutions': 0,
+                         'queries': 0,
+                         'hedged': 0,
+                         'timeouts': 0,
+                         'resolved': 0,
+                         'negative': 0,
+                         'failed': 0}
+
+    def __repr__(self):
+        return u"{0}({1!r})".format(self.__class__.__name__, self.referral_cache)
+
+    def handle_map_referral(self, map_referral, source):
+        '''
+        Give a received Map-Referral to the resolution that is waiting for
+        it. Returns whether one was.
+        '''
+        return self.pending.match(map_referral.nonce, source, map_referral)
+
+    def send_query(self, ddt_node, data, nonce, control_plane_sockets):
+        '''
+        Send the DDT Map-Request to one DDT node and return the future for
+        its Map-Referral, or None if it couldn't be sent
+        '''
+        try:
+            answer = self.pending.add(nonce, ddt_node, self.timeout)
+        except ValueError:
+            logger.warning(u"Already waiting for {0} to answer a DDT Map-Request with "
+                           "nonce {1!r}".format(ddt_node, nonce))
+            return None
+
+        sent_from, sent_to = send_bytes(data=data,
+                                        my_sockets=control_plane_sockets,
+                                        destinations=[ddt_node],
+                                        port=4342,
+                                        description='DDT Map-Request')
+        if sent_to is None:
+            self.pending.remove(nonce, ddt_node)
+            return None
+
+        self.counters['queries'] += 1
+        return answer
+
+    def query(self, entry, data, nonce, control_plane_sockets):
+        '''
+        Send the DDT Map-Request to the DDT nodes of the entry, and return
+        the first Map-Referral or None. The node that we expect to answer
+        first is asked first. If it doesn't answer within the time it
+        usually takes, the next node is asked as well.
+        '''
+        loop = get_event_loop()
+        candidates = self.scores.rank(entry.ddt_nodes, loop.time())
+
+        # The nodes that we are waiting for, with their answer and when we
+        # asked them
+        waiting = OrderedDict()
+        try:
+            while candidates or waiting:
+                if candidates:
+                    ddt_node = candidates.pop(0)
+                    answer = self.send_query(ddt_node, data, nonce, control_plane_sockets)
+                    if answer is None:
+                        continue
+
+                    if waiting:
+                        self.counters['hedged'] += 1
+                    waiting[ddt_node] = (answer, loop.time())
+
+                # Wait for an answer, but only as long as the node usually
+                # takes if there is another one to ask
+                if candidates:
+                    delay = self.scores.hedge_delay(ddt_node)
+                else:
+                    delay = self.timeout
+
+                first = Future(loop)
+
+                def on_done(dummy):
+                    if not first.done():
+                        first.set_result(None)
+
+                for answer, dummy in waiting.itervalues():
+                    answer.add_done_callback(on_done)
+                try:
+                    yield loop.wait(first, delay)
+                finally:
+                    for answer, dummy in waiting.itervalues():
+                        answer.remove_done_callback(on_done)
+
+                now = loop.time()
+                for ddt_node, (answer, sent) in waiting.items():
+                    if not answer.done():
+                        continue
+
+                    del waiting[ddt_node]
+                    if answer.cancelled():
+                        logger.info(u"DDT node {0} didn't answer for {1}".format(ddt_node, entry.prefix))
+                        self.scores.observe_failure(ddt_node, now)
+                        self.counters['timeouts'] += 1
+                        continue
+
+                    # The others were slower than this
+                    self.scores.observe_rtt(ddt_node, now - sent)
+                    for other_node, (dummy, other_sent) in waiting.iteritems():
+                        self.scores.observe_slow(other_node, now - other_sent)
+
+                    raise Return(answer.result())
+        finally:
+            for ddt_node in waiting:
+                self.pending.remove(nonce, ddt_node)
+
+        raise Return(None)
+
+    def resolve(self, instance_id, eid, packet, nonce, control_plane_sockets):
+        '''
+        Find out who is responsible for the EID-prefix. The packet is the IP
+        packet with the Map-Request with the given nonce, which is sent to the
+        DDT nodes in an ECM. Returns the entry for the MS-ACK when a Map-Server
+        has forwarded the Map-Request, a negative entry when the EID can't be
+        resolved, or None when the DDT nodes didn't give a usable answer.
+
+        This is a generator to run as a task on the event loop.
+        '''
+        eid = ip_network(eid)
+        self.counters['resolutions'] += 1
+
+        data = None
+        entry = self.referral_cache.lookup(instance_id, eid)
+        for dummy in range(MAX_REFERRALS):
+            if entry is None or not entry.referral:
+                break
+
+            if data is None:
+                data = EncapsulatedControlMessage(ddt_originated=True, payload=packet).to_bytes()
+
+            map_referral = yield self.query(entry, data, nonce, control_plane_sockets)
+            if map_referral is None or not map_referral.records:
+                entry = None
+                break
+
+            # Only use what the answer says about our EID
+            next_entry = self.referral_cache.entry_from_record(map_referral.records[0])
+            if next_entry is None \
+            or next_entry.instance_id != instance_id \
+            or not _covers(next_entry.prefix, eid):
+                logger.warning(u"Ignoring Map-Referral for {0}, we asked about {1}".format(
+                    next_entry and next_entry.prefix, eid))
+                entry = None
+                break
+
+            if next_entry.prefix.prefixlen <= entry.prefix.prefixlen:
+                if next_entry.referral:
+                    # A referral must take us further down the tree
+                    logger.warning(u"Map-Referral for {0} is not more specific than {1}".format(next_entry.prefix,
+                                                                                                 entry.prefix))
+                    entry = None
+                    break
+
+                # A node can't deny its whole delegation, only remember the
+                # answer for this EID
+                next_entry = ReferralCacheEntry(instance_id, eid, next_entry.action, [], next_entry.expires)
+
+            self.referral_cache.add(next_entry)
+            entry = next_entry
+        else:
+            logger.warning(u"Too many referrals when resolving {0}".format(eid))
+            entry = None
+
+        if entry is None or entry.referral:
+            self.counters['failed'] += 1
+            raise Return(None)
+
+        if entry.negative:
+            self.counters['negative'] += 1
+        else:
+            self.counters['resolved'] += 1
+
+        raise Return(entry)
+
+
+# The resolver used by lispd
+ddt_resolver = DDTResolver()
@@ -4,6 +4,7 @@ Created on 2 jun. 2013
 @author: sander
 '''
 from ipaddress import ip_address
+from pylisp.packet.lisp.control.authentication import AuthenticationKey
 from pylisp.packet.lisp.control.constants import KEY_ID_NONE
 import logging
 
@@ -18,6 +19,7 @@ class ETRRegistration(object):
         self.map_server = ip_address(map_server)
         self.key_id = int(key_id)
         self.key = key
+        self.authentication_key = AuthenticationKey(key)
         self.proxy_map_reply = bool(proxy_map_reply)
         if use_rtr is None:
             self.use_rtr = None
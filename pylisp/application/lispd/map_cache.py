@@ -0,0 +1,415 @@
+'''
+Created on 18 okt. 2026
+
+@author: sander
+
+The map-cache of an ITR or PITR. It holds the EID-prefix to locator mappings
+learned from Map-Replies, per instance-id and address family, and lookups
+return the entry with the longest matching prefix. Entries expire after the
+TTL of their record, and when the cache is full the least recently used
+entry is evicted. Records without locators are stored as negative entries
+whose action tells the data path what to do. Every entry has a table that
+maps a hash of the flow to one of its locators, which splits the load by
+locator weight while keeping each flow on one locator.
+
+A lookup that misses can trigger a Map-Request to the Map-Resolver. Requests
+for the same EID-prefix are sent at most once per MAP_REQUEST_INTERVAL.
+'''
+from collections import OrderedDict
+from ipaddress import ip_network, IPv4Address
+from pylisp.application.lispd import settings
+from pylisp.application.lispd.send_message import find_matching_addresses, send_message
+from pylisp.application.lispd.utils.prefix import determine_instance_id_and_afi
+from pylisp.packet.ip.ipv4 import IPv4Packet
+from pylisp.packet.ip.ipv6 import IPv6Packet
+from pylisp.packet.ip.udp import UDPMessage
+from pylisp.packet.lisp.control import EncapsulatedControlMessage, MapReplyRecord, MapRequestMessage
+from pylisp.packet.lisp.data import DataHeaderTemplate
+from pylisp.utils.lcaf.instance_address import LCAFInstanceAddress
+from pylisp.utils.radix_tree import RadixTree
+from zlib import crc32
+import logging
+import os
+import time
+
+
+# Get the logger
+logger = logging.getLogger(__name__)
+
+
+__all__ = ['build_selection_table', 'flow_hash', 'build_map_request_packet', 'MapCacheEntry', 'MapCache',
+           'map_cache']
+
+
+# How long we wait for the Map-Reply to a Map-Request
+MAP_REPLY_TIMEOUT = 10.0
+
+# The number of slots in the locator selection table of an entry, indexed
+# by the low byte of the flow hash
+SELECTION_TABLE_SIZE = 256
+
+# The AFI for each IP version
+_afis = {4: 1, 6: 2}
+
+# TCP, UDP and SCTP
+_port_protocols = ('\x06', '\x11', '\x84')
+
+
+def build_selection_table(locators):
+    '''
+    Fill SELECTION_TABLE_SIZE slots with the addresses of the reachable
+    locators with the best priority, each in proportion to its weight. The
+    slots of a locator are spread over the table, and the same locators
+    always give the same table.
+
+    >>> from ipaddress import IPv4Address
+    >>> from pylisp.packet.lisp.control import LocatorRecord
+    >>> table = build_selection_table([
+    ...     LocatorRecord(priority=1, weight=75, reachable=True, address=IPv4Address(u'192.0.2.1')),
+    ...     LocatorRecord(priority=1, weight=25, reachable=True, address=IPv4Address(u'192.0.2.2')),
+    ...     LocatorRecord(priority=2, weight=100, reachable=True, address=IPv4Address(u'192.0.2.3'))])
+    >>> table.count(IPv4Address(u'192.0.2.1')), table.count(IPv4Address(u'192.0.2.2'))
+    (192, 64)
+    >>> table[:4]
+    (IPv4Address(u'192.0.2.1'), IPv4Address(u'192.0.2.1'), IPv4Address(u'192.0.2.2'), IPv4Address(u'192.0.2.1'))
+    '''
+    # Priority 255 means that the locator must not be used
+    best = 255
+    for locator in locators:
+        if locator.reachable and locator.priority < best:
+            best = locator.priority
+
+    candidates = [locator for locator in locators
+                  if locator.reachable and locator.priority == best]
+    if not candidates:
+        return ()
+
+    # If all weights are zero the load is split equally, otherwise locators
+    # with weight zero don't get any traffic
+    weights = [locator.weight for locator in candidates]
+    if not any(weights):
+        weights = [1] * len(candidates)
+
+    # Smooth weighted round robin, so a locator's slots are interleaved
+    # with those of the others
+    total = sum(weights)
+    current = [0] * len(candidates)
+    table = []
+    for dummy in xrange(SELECTION_TABLE_SIZE):
+        for i, weight in enumerate(weights):
+            current[i] += weight
+        chosen = current.index(max(current))
+        current[chosen] -= total
+        table.append(candidates[chosen].address)
+
+    return tuple(table)
+
+
+def flow_hash(data):
+    '''
+    Hash the addresses, protocol and ports of a raw IP packet, so that all
+    packets of a flow are sent to the same locator. Ports are only used for
+    TCP, UDP and SCTP packets that are not fragments.
+    '''
+    if ord(data[0]) >> 4 == 4:
+        protocol = data[9]
+        value = crc32(protocol, crc32(data[12:20]))
+        header_length = (ord(data[0]) & 0x0f) * 4
+
+        # Only the first fragment has the ports
+        if ord(data[6]) & 0x3f or data[7] != '\x00':
+            return value
+    else:
+        protocol = data[6]
+        value = crc32(protocol, crc32(data[8:40]))
+        header_length = 40
+
+    if protocol in _port_protocols:
+        value = crc32(data[header_length:header_length + 4], value)
+
+    return value
+
+
+def build_map_request_packet(map_request, source, destination):
+    '''
+    Put a Map-Request in the IP packet from the source EID to the
+    destination EID that gets encapsulated in an ECM
+    '''
+    udp = UDPMessage(source_port=4342,
+                     destination_port=4342,
+                     payload=map_request)
+    udp.checksum = udp.calculate_checksum(source=source,
+                                          destination=destination)
+    if isinstance(destination, IPv4Address):
+        return IPv4Packet(ttl=64,
+                          protocol=udp.header_type,
+                          source=source,
+                          destination=destination,
+                          payload=udp)
+    else:
+        return IPv6Packet(next_header=udp.header_type,
+                          hop_limit=64,
+                          source=source,
+                          destination=destination,
+                          payload=udp)
+
+
+class MapCacheEntry(object):
+    '''
+    A mapping from an EID-prefix to its locators. An entry without usable
+    locators is negative, and its action says what happens to packets that
+    match it.
+    '''
+    __slots__ = ('instance_id', 'prefix', 'action', 'locators', 'rlocs', 'expires', 'key', 'header')
+
+    def __init__(self, instance_id, prefix, action, locators, expires, map_version=0):
+        self.instance_id = instance_id
+        self.prefix = prefix
+        self.action = action
+        self.locators = locators
+        self.expires = expires
+
+        # Where the entry is stored in the map-cache
+        self.key = (instance_id, _afis[prefix.version], int(prefix.network_address), prefix.prefixlen)
+
+        # The locator to use for each value of the low byte of the flow hash
+        self.rlocs = build_selection_table(locators)
+
+        # The LISP header for packets to this prefix, with the instance-id
+        # and the map version of the ETRs if there are any
+        self.header = None
+        if self.rlocs:
+            self.header = DataHeaderTemplate(instance_id=instance_id or None,
+                                             source_map_version=0 if map_version else None,
+                                             destination_map_version=map_version or None)
+
+    def __repr__(self):
+        return u"{0}({1}, {2}, action={3}, rlocs={4})".format(self.__class__.__name__, self.instance_id,
+                                                              self.prefix, self.action,
+                                                              sorted(set(self.rlocs)))
+
+    @property
+    def negative(self):
+        return not self.rlocs
+
+    def select_rloc(self, hash_value):
+        '''
+        The locator to send a flow with the given hash to
+        '''
+        return self.rlocs[hash_value & 0xff]
+
+
+class MapCache(object):
+    def __init__(self):
+        # A RadixTree for every instance-id and AFI
+        self._trees = {}
+
+        # All entries, least recently used first
+        self._entries = OrderedDict()
+
+        # When we last sent a Map-Request for an EID-prefix, oldest first
+        self._requested = OrderedDict()
+
+        # The Map-Requests that are waiting for a reply, by nonce
+        self._pending = OrderedDict()
+
+        self.counters = {'hits': 0,
+                         'misses': 0,
+                         'expired': 0,
+                         'evicted': 0,
+                         'requests': 0,
+                         'rate_limited': 0,
+                         'replies': 0,
+                         'unmatched': 0}
+
+    def __repr__(self):
+        return u"{0}({1} entries)".format(self.__class__.__name__, len(self._entries))
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _remove(self, entry):
+        key = entry.key
+        del self._entries[key]
+        tree = self._trees[key[:2]]
+        tree.discard(key[2:])
+        if not len(tree):
+            del self._trees[key[:2]]
+
+    def lookup(self, instance_id, address, now=None):
+        '''
+        Return the entry with the longest prefix that contains the address,
+        or None if there is no valid entry
+        '''
+        return self.lookup_value(instance_id, _afis[address.version], int(address), now)
+
+    def lookup_value(self, instance_id, afi, value, now=None):
+        '''
+        Like lookup, with the address given as an integer so the data path
+        doesn't have to create address objects
+        '''
+        if now is None:
+            now = time.time()
+
+        tree = self._trees.get((instance_id, afi))
+        while tree is not None:
+            entry = tree.longest_match((value, tree.max_prefixlen))
+            if entry is None:
+                break
+
+            if entry.expires <= now:
+                # Remove it and see if a less specific prefix matches
+                self._remove(entry)
+                self.counters['expired'] += 1
+                tree = self._trees.get((instance_id, afi))
+                continue
+
+            # Mark it as recently used
+            key = entry.key
+            del self._entries[key]
+            self._entries[key] = entry
+
+            self.counters['hits'] += 1
+            return entry
+
+        self.counters['misses'] += 1
+        return None
+
+    def add_record(self, record, now=None):
+        '''
+        Store the mapping from a MapReplyRecord. Returns the new entry, or
+        None if the record is not cached.
+        '''
+        assert isinstance(record, MapReplyRecord)
+
+        if now is None:
+            now = time.time()
+
+        instance_id, afi, prefix = determine_instance_id_and_afi(record.eid_prefix)
+        if afi is None:
+            return None
+
+        prefix = ip_network(prefix)
+        entry = MapCacheEntry(instance_id, prefix, record.action, record.locator_records,
+                              now + record.ttl * 60, record.map_version)
+
+        key = entry.key
+        old_entry = self._entries.get(key)
+        if old_entry is not None:
+            self._remove(old_entry)
+
+        # A TTL of zero means that the mapping must not be cached
+        if not record.ttl:
+            return None
+
+        tree = self._trees.get(key[:2])
+        if tree is None:
+            tree = RadixTree(prefix.max_prefixlen)
+            self._trees[key[:2]] = tree
+
+        tree[key[2:]] = entry
+        self._entries[key] = entry
+
+        # Make room by evicting the least recently used entries
+        while len(self._entries) > settings.config.MAP_CACHE_SIZE:
+            self._remove(next(self._entries.itervalues()))
+            self.counters['evicted'] += 1
+
+        logger.debug(u"Added {0!r} to the map-cache".format(entry))
+        return entry
+
+    def request(self, instance_id, source, destination, control_plane_sockets, prefix=None, now=None):
+        '''
+        Send a Map-Request for the destination EID to the Map-Resolver,
+        unless we recently sent one for the same prefix. Returns whether a
+        Map-Request was sent.
+        '''
+        map_resolver = settings.config.MAP_RESOLVER
+        if map_resolver is None:
+            return False
+
+        if now is None:
+            now = time.time()
+
+        # Forget the requests that don't limit us anymore
+        interval = settings.config.MAP_REQUEST_INTERVAL
+        while self._requested and next(self._requested.itervalues()) <= now - interval:
+            self._requested.popitem(last=False)
+
+        while self._pending and next(self._pending.itervalues())[2] <= now:
+            self._pending.popitem(last=False)
+
+        if prefix is None:
+            prefix = ip_network(destination)
+
+        request_key = (instance_id, prefix)
+        if request_key in self._requested:
+            self.counters['rate_limited'] += 1
+            return False
+
+        itr_rlocs = find_matching_addresses(map_resolver, control_plane_sockets)
+        if not itr_rlocs:
+            logger.error(u"No address to send a Map-Request to Map-Resolver {0} from".format(map_resolver))
+            return False
+
+        self._requested[request_key] = now
+
+        nonce = os.urandom(8)
+        eid_prefix = ip_network(destination)
+        if instance_id:
+            eid_prefix = LCAFInstanceAddress(instance_id=instance_id, address=eid_prefix)
+
+        map_request = MapRequestMessage(nonce=nonce,
+                                        source_eid=source,
+                                        itr_rlocs=itr_rlocs,
+                                        eid_prefixes=[eid_prefix])
+
+        # The Map-Request is sent to the EID, encapsulated to the Map-Resolver
+        ip_packet = build_map_request_packet(map_request, source, destination)
+        ecm = EncapsulatedControlMessage(payload=ip_packet)
+
+        sent_from, sent_to = send_message(message=ecm,
+                                          my_sockets=control_plane_sockets,
+                                          destinations=[map_resolver],
+                                          port=4342)
+        if sent_to is None:
+            return False
+
+        self._pending[nonce] = (instance_id, destination, now + MAP_REPLY_TIMEOUT)
+        self.counters['requests'] += 1
+        return True
+
+    def handle_map_reply(self, map_reply, now=None):
+        '''
+        Store the records of a Map-Reply to one of our Map-Requests. Only
+        records that cover the requested EID are accepted. Returns whether
+        the Map-Reply matched a Map-Request.
+        '''
+        if now is None:
+            now = time.time()
+
+        pending = self._pending.pop(map_reply.nonce, None)
+        if pending is None or pending[2] <= now:
+            self.counters['unmatched'] += 1
+            return False
+
+        self.counters['replies'] += 1
+
+        instance_id, destination = pending[:2]
+        for record in map_reply.records:
+            record_instance_id, afi, prefix = determine_instance_id_and_afi(record.eid_prefix)
+            if record_instance_id != instance_id \
+            or prefix is None \
+            or prefix.version != destination.version \
+            or destination not in ip_network(prefix):
+                logger.warning(u"Ignoring Map-Reply record for {0}, we asked for {1}".format(prefix,
+                                                                                          destination))
+                continue
+
+            self.add_record(record, now)
+
+        return True
+
+
+# The map-cache used by the data path
+map_cache = MapCache()
@@ -0,0 +1,164 @@
+'''
+Created on 18 okt. 2026
+
+@author: sander
+
+Forward encapsulated Map-Requests from the Map-Server to the registered ETRs.
+The targets are chosen by locator priority and weight. Each ETR has a token
+bucket that limits how many Map-Requests per second it gets from us, and an
+ETR that we could not send to is skipped for a while.
+'''
+from bisect import bisect_right
+from pylisp.application.lispd import settings
+from pylisp.application.lispd.send_message import send_bytes
+import logging
+import random
+import time
+
+
+# Get the logger
+logger = logging.getLogger(__name__)
+
+
+__all__ = ['ForwardTargets', 'MapRequestForwarder', 'map_request_forwarder']
+
+
+# How long an ETR is skipped after sending to it failed
+UNREACHABLE_HOLDDOWN = 10.0
+
+
+class ForwardTargets(object):
+    '''
+    The ETRs to forward to, grouped by locator priority. Locators with
+    priority 255 and locators that are not reachable are left out.
+    '''
+    __slots__ = ('groups',)
+
+    def __init__(self, locators):
+        by_priority = {}
+        for locator in locators:
+            if locator.priority == 255 or not locator.reachable:
+                continue
+
+            by_priority.setdefault(locator.priority, []).append(locator)
+
+        # Every group is (addresses, cumulative weights, total weight)
+        self.groups = []
+        for priority in sorted(by_priority):
+            # If all weights are zero the load is split equally, otherwise
+            # locators with weight zero are not used
+            group = by_priority[priority]
+            weights = [locator.weight for locator in group]
+            if not any(weights):
+                weights = [1] * len(group)
+
+            addresses = []
+            cumulative = []
+            total = 0
+            for locator, weight in zip(group, weights):
+                if not weight:
+                    continue
+
+                addresses.append(locator.address)
+                total += weight
+                cumulative.append(total)
+
+            self.groups.append((addresses, cumulative, total))
+
+    def __repr__(self):
+        return u"{0}({1!r})".format(self.__class__.__name__, [group[0] for group in self.groups])
+
+    def __nonzero__(self):
+        return bool(self.groups)
+
+
+class _ETRState(object):
+    __slots__ = ('tokens', 'updated', 'down_until')
+
+    def __init__(self, tokens, now):
+        self.tokens = tokens
+        self.updated = now
+        self.down_until = 0.0
+
+
+class MapRequestForwarder(object):
+    def __init__(self):
+        self.etrs = {}
+
+        self.counters = {'forwarded': 0,
+                         'rate_limited': 0,
+                         'unreachable': 0,
+                         'failed': 0}
+
+    def __repr__(self):
+        return u"{0}({1} ETRs)".format(self.__class__.__name__, len(self.etrs))
+
+    def _usable(self, address, now):
+        rate = settings.config.MAP_REQUEST_FORWARD_RATE
+        burst = settings.config.MAP_REQUEST_FORWARD_BURST
+
+        state = self.etrs.get(address)
+        if state is None:
+            state = _ETRState(burst, now)
+            self.etrs[address] = state
+
+        if now < state.down_until:
+            self.counters['unreachable'] += 1
+            return False
+
+        # Refill the token bucket
+        state.tokens = min(burst, state.tokens + (now - state.updated) * rate)
+        state.updated = now
+
+        if state.tokens < 1:
+            self.counters['rate_limited'] += 1
+            return False
+
+        state.tokens -= 1
+        return True
+
+    def _send(self, data, address, my_sockets, now):
+        sent_from, sent_to = send_bytes(data=data,
+                                        my_sockets=my_sockets,
+                                        destinations=[address],
+                                        port=4342,
+                                        description='forwarded Map-Request')
+        if sent_to is None:
+            logger.warning(u"Could not forward a Map-Request to ETR {0}, skipping it for {1} seconds".format(
+                address, UNREACHABLE_HOLDDOWN))
+            self.etrs[address].down_until = now + UNREACHABLE_HOLDDOWN
+            self.counters['failed'] += 1
+            return False
+
+        self.counters['forwarded'] += 1
+        return True
+
+    def forward(self, data, targets, my_sockets):
+        '''
+        Send the data to one of the targets. The group with the best priority
+        that has a usable ETR is used, and within the group an ETR is picked
+        by weight. Returns whether the data was sent.
+        '''
+        now = time.time()
+        for addresses, cumulative, total in targets.groups:
+            # Usually the first choice can be used
+            index = bisect_right(cumulative, random.random() * total)
+            address = addresses[index]
+            if self._usable(address, now):
+                if self._send(data, address, my_sockets, now):
+                    return True
+
+            # Try the others in this group in order of weight
+            others = [(cumulative[i] - (i and cumulative[i - 1]), addresses[i])
+                      for i in range(len(addresses)) if i != index]
+            # Only compare the weights, IPv4 and IPv6 addresses can't be compared
+            others.sort(key=lambda item: item[0], reverse=True)
+            for dummy, address in others:
+                if self._usable(address, now) and self._send(data, address, my_sockets, now):
+                    return True
+
+        return False
+
+
+# Shared by all MapServerNodes, so the limits are per ETR
+map_request_forwarder = MapRequestForwarder()
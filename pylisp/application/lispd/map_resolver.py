@@ -0,0 +1,166 @@
+'''
+Created on 18 okt. 2026
+
+@author: sander
+
+The Map-Resolver role. Encapsulated Map-Requests from ITRs for EIDs that we
+are not responsible for ourselves are resolved through DDT. The DDT
+resolver sends the Map-Request of the ITR to the DDT nodes, and the
+Map-Server that gets it forwards it to an ETR, which answers the ITR. When
+the EID can't be resolved we send the ITR a negative Map-Reply.
+
+When many ITRs ask about EIDs in a part of the DDT tree that we haven't
+walked yet, only the first request walks it. The others wait for it and
+then continue from the referrals that it found, which usually leaves one
+query to the Map-Server. When the walk fails, only the requests for EIDs
+below the referral where it got stuck give up. Each ITR can only have a
+limited number of requests waiting for DDT.
+'''
+from ipaddress import ip_network
+from math import ceil
+from pylisp.application.lispd import settings
+from pylisp.application.lispd.ddt_resolver import _covers, ddt_resolver
+from pylisp.application.lispd.send_message import send_message
+from pylisp.packet.lisp.control import MapReferralRecord, MapReplyMessage, MapReplyRecord
+from pylisp.utils.event_loop import Future, Return, get_event_loop
+from pylisp.utils.lcaf.instance_address import LCAFInstanceAddress
+import logging
+import time
+
+
+# Get the logger
+logger = logging.getLogger(__name__)
+
+
+__all__ = ['MapResolver', 'map_resolver']
+
+
+# How long a request waits for another request that is walking the DDT tree
+COALESCE_TIMEOUT = 10.0
+
+
+class MapResolver(object):
+    def __init__(self, resolver):
+        self.resolver = resolver
+
+        # The futures of the resolutions that walk the DDT tree, by the key
+        # of the referral they started from
+        self._walking = {}
+
+        # The number of requests per ITR that are being resolved
+        self._pending = {}
+
+        self.counters = {'requests': 0,
+                         'coalesced': 0,
+                         'limited': 0,
+                         'forwarded': 0,
+                         'negative_replies': 0,
+                         'failed': 0}
+
+    def __repr__(self):
+        return u"{0}({1} ITRs waiting)".format(self.__class__.__name__, len(self._pending))
+
+    def resolve(self, instance_id, eid, packet, nonce, control_plane_sockets):
+        '''
+        Resolve the EID through DDT, but let only one request at a time walk
+        the part of the DDT tree below a referral
+        '''
+        entry = self.resolver.referral_cache.lookup(instance_id, eid)
+        if entry is not None and entry.action == MapReferralRecord.ACT_NODE_REFERRAL:
+            key = entry.key
+            walking = self._walking.get(key)
+            if walking is None:
+                # Walk the tree while others wait for us
+                walking = self._walking[key] = Future(get_event_loop())
+                entry = None
+                try:
+                    entry = yield self.resolver.resolve(instance_id, eid, packet, nonce, control_plane_sockets)
+                finally:
+                    del self._walking[key]
+                    walking.set_result((eid, entry))
+
+                raise Return(entry)
+
+            self.counters['coalesced'] += 1
+            finished = yield get_event_loop().wait(walking, COALESCE_TIMEOUT)
+            if finished:
+                walked_eid, walked_entry = walking.result()
+                if walked_entry is None:
+                    # Don't try what has just failed: the walk got stuck at
+                    # the deepest referral it found
+                    stuck = self.resolver.referral_cache.lookup(instance_id, walked_eid)
+                    if stuck is None or _covers(stuck.prefix, eid):
+                        raise Return(None)
+
+        # Continue from what is known now
+        entry = yield self.resolver.resolve(instance_id, eid, packet, nonce, control_plane_sockets)
+        raise Return(entry)
+
+    def send_negative_reply(self, received_message, entry, control_plane_sockets):
+        '''
+        Tell the ITR that the EID-prefix of the entry is not a LISP EID
+        '''
+        map_request = received_message.inner_message
+
+        eid_prefix = entry.prefix
+        if entry.instance_id:
+            eid_prefix = LCAFInstanceAddress(instance_id=entry.instance_id, address=eid_prefix)
+
+        # The ITR may cache it for as long as we do, in minutes
+        ttl = max(1, int(ceil((entry.expires - time.time()) / 60)))
+
+        reply_record = MapReplyRecord(ttl=ttl,
+                                      action=MapReplyRecord.ACT_NATIVELY_FORWARD,
+                                      authoritative=False,
+                                      eid_prefix=eid_prefix)
+        reply = MapReplyMessage(nonce=map_request.nonce,
+                                records=[reply_record])
+
+        send_message(message=reply,
+                     my_sockets=control_plane_sockets,
+                     destinations=map_request.itr_rlocs,
+                     port=received_message.udp_layer.source_port)
+
+    def handle_map_request(self, received_message, instance_id, eid_prefix, control_plane_sockets):
+        '''
+        Handle an encapsulated Map-Request from an ITR. This is a generator
+        to run as a task on the event loop.
+        '''
+        map_request = received_message.inner_message
+        itr = received_message.source[0]
+        self.counters['requests'] += 1
+
+        pending = self._pending.get(itr, 0)
+        if pending >= settings.config.MAP_RESOLVER_PENDING_PER_ITR:
+            logger.debug(u"Dropping Map-Request in message {0}: too many pending requests "
+                         "from {1}".format(received_message.message_nr, itr))
+            self.counters['limited'] += 1
+            return
+
+        self._pending[itr] = pending + 1
+        try:
+            entry = yield self.resolve(instance_id, ip_network(eid_prefix),
+                                       received_message.message.get_payload_bytes(),
+                                       map_request.nonce, control_plane_sockets)
+        finally:
+            pending = self._pending.pop(itr) - 1
+            if pending:
+                self._pending[itr] = pending
+
+        if entry is None:
+            logger.info(u"Could not resolve {0} for message {1}".format(eid_prefix, received_message.message_nr))
+            self.counters['failed'] += 1
+
+        elif entry.negative:
+            logger.debug(u"Sending negative Map-Reply for {0} to message {1}".format(entry.prefix,
+                                                                                   received_message.message_nr))
+            self.send_negative_reply(received_message, entry, control_plane_sockets)
+            self.counters['negative_replies'] += 1
+
+        else:
+            # A Map-Server has forwarded it to an ETR
+            self.counters['forwarded'] += 1
+
+
+# The Map-Resolver used by lispd
+map_resolver = MapResolver(ddt_resolver)
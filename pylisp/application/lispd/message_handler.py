@@ -4,9 +4,13 @@ Created on 15 jan. 2013
 @author: sander
 '''
 
+from pylisp.application.lispd import settings
 from pylisp.application.lispd.address_tree.ddt_referral_node import handle_ddt_map_request
 from pylisp.application.lispd.address_tree.etr_node import ETRNode
 from pylisp.application.lispd.address_tree.map_server_node import MapServerNode, MapServerException
+from pylisp.application.lispd.ddt_resolver import ddt_resolver
+from pylisp.application.lispd.map_cache import map_cache
+from pylisp.application.lispd.map_resolver import map_resolver
 from pylisp.application.lispd.send_message import send_message
 from pylisp.application.lispd.utils.prefix import determine_instance_id_and_afi, resolve, resolve_path
 from pylisp.packet.lisp.control.encapsulated_control_message import EncapsulatedControlMessage
@@ -17,7 +21,9 @@ from pylisp.packet.lisp.control.map_register import MapRegisterMessage
 from pylisp.packet.lisp.control.map_register_record import MapRegisterRecord
 from pylisp.packet.lisp.control.map_reply import MapReplyMessage
 from pylisp.packet.lisp.control.map_request import MapRequestMessage
+from pylisp.utils.event_loop import get_event_loop
 import logging
+import types
 
 
 # Get the logger
@@ -27,54 +33,66 @@ logger = logging.getLogger(__name__)
 def handle_message(received_message, control_plane_sockets, data_plane_sockets):
     """
     Handle a LISP message. The default handle method determines the type
-    of message and delegates it to the more specific method
+    of message and delegates it to the more specific method. Handlers that
+    need to wait for something can be generators, which are then run as a
+    task on the event loop.
     """
     logger.debug(u"Handling message #{0} ({1}) from {2}".format(received_message.message_nr,
                                                                 received_message.message.__class__.__name__,
                                                                 received_message.source[0]))
 
     try:
+        result = None
         if isinstance(received_message.message, MapRequestMessage):
             # A map-request message
-            handle_map_request(received_message, control_plane_sockets, data_plane_sockets)
+            result = handle_map_request(received_message, control_plane_sockets, data_plane_sockets)
 
         elif isinstance(received_message.message, MapReplyMessage):
             # A map-reply message
-            handle_map_reply(received_message, control_plane_sockets, data_plane_sockets)
+            result = handle_map_reply(received_message, control_plane_sockets, data_plane_sockets)
 
         elif isinstance(received_message.message, MapNotifyMessage):
             # A map-notify message (subclass of MapRegisterMessage, so put above it!)
-            handle_map_notify(received_message, control_plane_sockets, data_plane_sockets)
+            result = handle_map_notify(received_message, control_plane_sockets, data_plane_sockets)
 
         elif isinstance(received_message.message, MapRegisterMessage):
             # A map-register message
-            handle_map_register(received_message, control_plane_sockets, data_plane_sockets)
+            result = handle_map_register(received_message, control_plane_sockets, data_plane_sockets)
 
         elif isinstance(received_message.message, MapReferralMessage):
             # A map-referral message
-            handle_map_referral(received_message, control_plane_sockets, data_plane_sockets)
+            result = handle_map_referral(received_message, control_plane_sockets, data_plane_sockets)
 
         elif isinstance(received_message.message, EncapsulatedControlMessage):
             # Determine the type of ECM
             if isinstance(received_message.inner_message, MapRequestMessage):
                 if received_message.message.ddt_originated:
                     # A DDT map-request message
-                    handle_ddt_map_request(received_message, control_plane_sockets, data_plane_sockets)
+                    result = handle_ddt_map_request(received_message, control_plane_sockets, data_plane_sockets)
                 else:
                     # An encapsulated map-request message
-                    handle_enc_map_request(received_message, control_plane_sockets, data_plane_sockets)
+                    result = handle_enc_map_request(received_message, control_plane_sockets, data_plane_sockets)
             else:
                 logger.warning("ECM does not contain a map-request in message %d", received_message.message_nr)
         elif isinstance(received_message.message, InfoMessage):
-            handle_info_message(received_message, control_plane_sockets, data_plane_sockets)
+            result = handle_info_message(received_message, control_plane_sockets, data_plane_sockets)
         else:
             logger.warning("Unknown content in message %d", received_message.message_nr)
+
+        if isinstance(result, types.GeneratorType):
+            get_event_loop().create_task(result)
     except:
         logger.exception("Unexpected exception while handling message %d", received_message.message_nr)
 
 
 def handle_map_reply(received_message, control_plane_sockets, data_plane_sockets):
-    pass
+    map_reply = received_message.message
+    assert isinstance(map_reply, MapReplyMessage)
+
+    # Put the mappings in the map-cache
+    if not map_cache.handle_map_reply(map_reply):
+        logger.warn(u"Ignoring message {0}: Map-Reply that doesn't match a "
+                    "Map-Request that we sent".format(received_message.message_nr))
 
 
 def handle_map_register(received_message, control_plane_sockets, data_plane_sockets):
@@ -82,7 +100,7 @@ def handle_map_register(received_message, control_plane_sockets, data_plane_sock
     assert isinstance(map_register, MapRegisterMessage)
 
     processed_records = []
-    saved_key = ''
+    saved_key = None
     for record in map_register.records:
         assert isinstance(record, MapRegisterRecord)
 
@@ -96,7 +114,7 @@ def handle_map_register(received_message, control_plane_sockets, data_plane_sock
 
                 # Record processed: store the record, and keep the authentication key in case we want to send back a notify
                 processed_records.append(record)
-                saved_key = tree_node.key
+                saved_key = tree_node.authentication_key
             except MapServerException, e:
                 logger.error("MapServerNode could not process record {0}: {1}".format(record, e.message))
         else:
@@ -121,7 +139,13 @@ def handle_map_register(received_message, control_plane_sockets, data_plane_sock
 
 
 def handle_map_referral(received_message, control_plane_sockets, data_plane_sockets):
-    pass
+    map_referral = received_message.message
+    assert isinstance(map_referral, MapReferralMessage)
+
+    # Give it to the DDT resolution that is waiting for it
+    if not ddt_resolver.handle_map_referral(map_referral, received_message.source[0]):
+        logger.warn(u"Ignoring message {0}: Map-Referral that doesn't match a "
+                    "DDT Map-Request that we sent".format(received_message.message_nr))
 
 
 def handle_map_notify(received_message, control_plane_sockets, data_plane_sockets):
@@ -190,4 +214,31 @@ def handle_map_request(received_message, control_plane_sockets, data_plane_socke
 
 
 def handle_enc_map_request(received_message, control_plane_sockets, data_plane_sockets):
-    pass
+    map_request = received_message.inner_message
+    assert isinstance(map_request, MapRequestMessage)
+
+    if len(map_request.eid_prefixes) != 1:
+        logger.warn(u"Ignoring message {0}: Map-Request with eid-prefix count != 1".format(received_message.message_nr))
+        return
+
+    eid_prefix = map_request.eid_prefixes[0]
+    instance_id, afi, eid_prefix = determine_instance_id_and_afi(eid_prefix)
+    tree_node = resolve(instance_id, afi, eid_prefix)
+    if isinstance(tree_node, ETRNode):
+        # Forwarded to us by a Map-Server
+        tree_node.handle_map_request(received_message, eid_prefix, control_plane_sockets, data_plane_sockets)
+
+    elif isinstance(tree_node, MapServerNode):
+        if not tree_node.handle_map_request(received_message, control_plane_sockets, data_plane_sockets):
+            logger.info(u"MapServer could not handle the Map-Request for {0} in message {1}".format(eid_prefix,
+                                                                                                  received_message.message_nr))
+
+    elif settings.config.DDT_ROOT and eid_prefix is not None:
+        # We are a Map-Resolver, find the Map-Server through DDT
+        return map_resolver.handle_map_request(received_message, instance_id, eid_prefix, control_plane_sockets)
+
+    else:
+        # Not for us: drop
+        logger.warn(u"Ignoring message {0}: Encapsulated Map-Request for prefix {1} in instance {2} "
+                     "for which we are not an ETR or MapServer".format(received_message.message_nr, eid_prefix,
+                                                                       instance_id))
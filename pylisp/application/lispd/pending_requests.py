@@ -0,0 +1,142 @@
+'''
+Created on 18 okt. 2026
+
+@author: sander
+'''
+from collections import OrderedDict
+from ipaddress import IPv4Address, IPv6Address, ip_address
+from pylisp.utils.event_loop import Future, get_event_loop
+import logging
+import threading
+
+
+# Get the logger
+logger = logging.getLogger(__name__)
+
+
+__all__ = ['PendingRequestRegistry']
+
+
+class PendingRequestRegistry(object):
+    '''
+    Requests that are waiting for a reply, by nonce and the address of the
+    peer that should send the reply. Adding a request returns a future that
+    gets the reply as its result. It is cancelled if no reply is received
+    before the timeout.
+
+    Replies that don't match a pending request are counted as late if the
+    request was recently finished, and as unmatched otherwise.
+    '''
+
+    def __init__(self, name, late_window=60.0, max_recent=1024):
+        self.name = name
+        self.late_window = late_window
+        self.max_recent = max_recent
+
+        self._pending = {}
+        self._recent = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.counters = {'requests': 0,
+                         'matched': 0,
+                         'expired': 0,
+                         'late': 0,
+                         'unmatched': 0}
+
+    def __repr__(self):
+        return u"{0}({1!r}, {2} pending)".format(self.__class__.__name__,
+                                                 self.name, len(self._pending))
+
+    def __len__(self):
+        return len(self._pending)
+
+    def __contains__(self, key):
+        return self._key(*key) in self._pending
+
+    @staticmethod
+    def _key(nonce, peer):
+        # AutoAddresses and other sub-classes don't hash like plain addresses
+        if type(peer) not in (IPv4Address, IPv6Address):
+            peer = ip_address(unicode(peer))
+        return nonce, peer
+
+    def _finish(self, key):
+        # Must be called with the lock held
+        future, timer = self._pending.pop(key)
+        timer.cancel()
+
+        # Remember it for a while to recognise late replies
+        self._recent[key] = get_event_loop().time() + self.late_window
+        while len(self._recent) > self.max_recent:
+            self._recent.popitem(last=False)
+
+        return future
+
+    def add(self, nonce, peer, timeout):
+        '''
+        Register a request and return the future for its reply
+        '''
+        key = self._key(nonce, peer)
+        loop = get_event_loop()
+
+        with self._lock:
+            if key in self._pending:
+                raise ValueError(u"There already is a pending {0} with nonce {1!r} for {2}".format(self.name, nonce,
+                                                                                                 key[1]))
+
+            future = Future(loop)
+            timer = loop.call_later(timeout, self._expire, key, future)
+            self._pending[key] = (future, timer)
+            self.counters['requests'] += 1
+
+        return future
+
+    def _expire(self, key, future):
+        with self._lock:
+            pending = self._pending.get(key)
+            if pending is None or pending[0] is not future:
+                return
+
+            self._finish(key)
+            self.counters['expired'] += 1
+
+        logger.debug(u"{0} with nonce {1!r} for {2} has expired".format(self.name, key[0], key[1]))
+        future.cancel()
+
+    def remove(self, nonce, peer):
+        '''
+        Stop waiting for a reply
+        '''
+        key = self._key(nonce, peer)
+        with self._lock:
+            if key not in self._pending:
+                return
+
+            future = self._finish(key)
+
+        future.cancel()
+
+    def match(self, nonce, peer, reply):
+        '''
+        Give the reply to the pending request it belongs to. Returns whether
+        a pending request was found.
+        '''
+        key = self._key(nonce, peer)
+        with self._lock:
+            if key in self._pending:
+                future = self._finish(key)
+                self.counters['matched'] += 1
+            else:
+                future = None
+                deadline = self._recent.get(key)
+                if deadline is not None and deadline >= get_event_loop().time():
+                    self.counters['late'] += 1
+                else:
+                    self.counters['unmatched'] += 1
+
+        if future is None:
+            return False
+
+        if not future.done():
+            future.set_result(reply)
+        return True
@@ -5,6 +5,7 @@ Created on 23 jan. 2013
 '''
 from multiprocessing.dummy import Lock
 from pylisp.packet.lisp.control import EncapsulatedControlMessage, ControlMessage
+from pylisp.packet.lisp.control.authentication import as_authentication_key
 from pylisp.utils.represent import represent
 import logging
 import sys
@@ -18,6 +19,9 @@ class ReceivedMessage(object):
     counter = 0
     counter_lock = Lock()
 
+    # How many HMAC calculations were saved by remembering earlier results
+    authentications_saved = 0
+
     def __init__(self, source, destination, message, socket, message_nr=None):
 
         if message_nr:
@@ -37,6 +41,9 @@ class ReceivedMessage(object):
         self.message = message
         self.socket = socket
 
+        # Authentication results by (key-id, key)
+        self._authentication_results = {}
+
         # Sanity check
         if not isinstance(self.message, ControlMessage):
             raise ValueError("Non-LISP message detected: {0!r}".format(self.message))
@@ -58,6 +65,25 @@ class ReceivedMessage(object):
             self.udp_layer = None
             self.inner_message = None
 
+    def verify_authentication_data(self, key):
+        '''
+        Verify the authentication data of the message with the given key. The
+        result is remembered, so a message with records for several
+        MapServerNodes that share a key is only verified once.
+        '''
+        key = as_authentication_key(key)
+        result_key = (self.message.key_id, key.key)
+
+        result = self._authentication_results.get(result_key)
+        if result is None:
+            result = self.message.verify_authentication_data(key)
+            self._authentication_results[result_key] = result
+        else:
+            with ReceivedMessage.counter_lock:
+                ReceivedMessage.authentications_saved += 1
+
+        return result
+
     def __repr__(self):
         return represent(self.__class__.__name__, self.__dict__,
                          ('udp_layer', 'inner_message'))
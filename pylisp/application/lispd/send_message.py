@@ -3,7 +3,7 @@ Created on 2 jun. 2013
 
 @author: sander
 '''
-from ipaddress import ip_address, IPv4Address
+from ipaddress import ip_address, IPv4Address, IPv6Address
 import logging
 import socket
 
@@ -12,17 +12,88 @@ import socket
 logger = logging.getLogger(__name__)
 
 
+# The number of socket lists whose SocketTable is remembered
+SOCKET_TABLE_CACHE_SIZE = 64
+
+
+class SocketTable(object):
+    '''
+    The sockets in a list per address family, in the order of the list.
+    Sockets that are not bound are left out. The table is built when it is
+    first used and rebuilt after one of the sockets is rebound.
+    '''
+
+    def __init__(self, sockets):
+        self.sockets = sockets
+        self.size = len(sockets)
+        self._families = None
+
+        for sock in sockets:
+            if hasattr(sock, 'add_rebind_target'):
+                sock.add_rebind_target(self)
+
+    def __repr__(self):
+        return u"{0}({1!r})".format(self.__class__.__name__, self.sockets)
+
+    def on_socket_rebind(self, sock):
+        self._families = None
+
+    def get(self, family):
+        if self._families is None:
+            families = {socket.AF_INET: [],
+                        socket.AF_INET6: []}
+            for sock in self.sockets:
+                if not _is_bound(sock):
+                    continue
+
+                families[sock.family].append(sock)
+
+            self._families = families
+
+        return self._families[family]
+
+
+_socket_tables = {}
+
+
+def _is_bound(sock):
+    # AutoUDPSockets have no file descriptor while their address is gone
+    return not hasattr(sock, 'add_rebind_target') or sock.fileno() is not None
+
+
+def get_socket_table(my_sockets):
+    table = _socket_tables.get(id(my_sockets))
+    if table is None or table.sockets is not my_sockets or table.size != len(my_sockets):
+        if len(_socket_tables) >= SOCKET_TABLE_CACHE_SIZE:
+            _socket_tables.clear()
+
+        table = _socket_tables[id(my_sockets)] = SocketTable(my_sockets)
+
+    return table
+
+
+def _as_address(destination):
+    # Plain addresses are used as they are, AutoAddresses and strings are
+    # converted
+    if type(destination) in (IPv4Address, IPv6Address):
+        return destination
+    return ip_address(unicode(destination))
+
+
+def _family(destination):
+    return destination.version == 4 and socket.AF_INET or socket.AF_INET6
+
+
 def find_matching_sockets(destination, my_sockets):
     dest_family = (isinstance(destination, IPv4Address)
                    and socket.AF_INET
                    or socket.AF_INET6)
 
-    matches = []
-    for sock in my_sockets:
-        if sock.family == dest_family:
-            matches.append(sock)
+    # Lists of one socket are often made for a single reply
+    if len(my_sockets) == 1:
+        return [sock for sock in my_sockets if sock.family == dest_family and _is_bound(sock)]
 
-    return matches
+    return get_socket_table(my_sockets).get(dest_family)
 
 
 def find_matching_addresses(destination, my_sockets):
@@ -32,15 +103,25 @@ def find_matching_addresses(destination, my_sockets):
 
 
 def send_message(message, my_sockets, destinations, port=4342):
+    return send_bytes(data=bytes(message),
+                      my_sockets=my_sockets,
+                      destinations=destinations,
+                      port=port,
+                      description=message.__class__.__name__)
+
+
+def send_bytes(data, my_sockets, destinations, port=4342, description='message'):
+    debug = logger.isEnabledFor(logging.DEBUG)
+
     # Find an appropriate destination
     for destination in destinations:
-        destination = ip_address(unicode(destination))
+        destination = _as_address(destination)
         for sock in find_matching_sockets(destination, my_sockets):
             addr = (destination, port)
-            data = bytes(message)
-            logger.debug(u"Sending {0} from {1} to {2}".format(message.__class__.__name__,
-                                                               sock.getsockname()[0],
-                                                               destination))
+            if debug:
+                logger.debug(u"Sending {0} from {1} to {2}".format(description,
+                                                                   sock.getsockname()[0],
+                                                                   destination))
             sent = sock.sendto(data, addr)
             if sent == len(data):
                 return sock.getsockname()[0:2], addr
@@ -48,3 +129,51 @@ def send_message(message, my_sockets, destinations, port=4342):
             logger.warning("Could not send from {0} to {1}".format(sock.getsockname()[0], destination))
 
     return None, None
+
+
+def send_datagrams(sock, datagrams):
+    '''
+    Send a list of (data, (address, port)) tuples from one socket, in one
+    system call if the socket supports it. Returns how many were sent.
+    '''
+    if hasattr(sock, 'send_batch'):
+        return sock.send_batch(datagrams)
+
+    sent_total = 0
+    for data, address in datagrams:
+        if sock.sendto(data, address) == len(data):
+            sent_total += 1
+
+    return sent_total
+
+
+def send_bytes_to_all(data, my_sockets, destinations, port=4342, description='message'):
+    '''
+    Send the same data to all destinations, using one socket per address
+    family. Returns the number of destinations it was sent to.
+    '''
+    per_family = {}
+    for destination in destinations:
+        destination = _as_address(destination)
+        per_family.setdefault(_family(destination), []).append((data, (destination, port)))
+
+    sent_total = 0
+    for family, datagrams in per_family.iteritems():
+        sockets = find_matching_sockets(datagrams[0][1][0], my_sockets)
+        if not sockets:
+            logger.warning(u"No socket to send {0} to {1} destinations from".format(description, len(datagrams)))
+            continue
+
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(u"Sending {0} from {1} to {2}".format(description,
+                                                               sockets[0].getsockname()[0],
+                                                               ', '.join(unicode(address[0])
+                                                                         for dummy, address in datagrams)))
+
+        sent = send_datagrams(sockets[0], datagrams)
+        if sent != len(datagrams):
+            logger.warning(u"Could only send {0} to {1} of {2} destinations".format(description, sent,
+                                                                                     len(datagrams)))
+        sent_total += sent
+
+    return sent_total
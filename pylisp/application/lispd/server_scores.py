@@ -0,0 +1,158 @@
+'''
+Created on 18 okt. 2026
+
+@author: sander
+
+How fast and how reliable the servers that we send queries to are. The
+round-trip time of each server is estimated like the TCP retransmission
+timer (RFC 6298), and failures are counted until the server answers again.
+Servers are ranked by their estimated round-trip time, with a penalty for
+recent failures, and the time to wait before asking the next server follows
+from the estimate.
+
+>>> scores = ServerScores()
+>>> scores.observe_rtt('a', 0.100)
+>>> scores.observe_rtt('b', 0.020)
+>>> scores.rank(['a', 'b', 'c'])
+['b', 'a', 'c']
+>>> round(scores.hedge_delay('b'), 3)
+0.06
+>>> scores.observe_failure('b', now=100.0)
+>>> scores.observe_failure('b', now=101.0)
+>>> scores.observe_failure('b', now=102.0)
+>>> scores.rank(['a', 'b'], now=110.0)
+['a', 'b']
+>>> scores.rank(['a', 'b'], now=1000.0)
+['b', 'a']
+'''
+import logging
+import time
+
+
+# Get the logger
+logger = logging.getLogger(__name__)
+
+
+__all__ = ['ServerScore', 'ServerScores']
+
+
+# The round-trip time that we assume for servers we haven't heard from
+INITIAL_RTT = 0.5
+
+# Limits for the time before a query is also sent to the next server
+MIN_HEDGE_DELAY = 0.01
+MAX_HEDGE_DELAY = 1.0
+
+# How long failures count against a server
+FAILURE_MEMORY = 300.0
+
+# The number of servers that we keep scores for
+SERVER_SCORES_SIZE = 10000
+
+
+class ServerScore(object):
+    __slots__ = ('srtt', 'rttvar', 'failures', 'last_failure')
+
+    def __init__(self):
+        self.srtt = None
+        self.rttvar = None
+        self.failures = 0
+        self.last_failure = None
+
+    def __repr__(self):
+        return u"{0}(srtt={1!r}, rttvar={2!r}, failures={3})".format(self.__class__.__name__, self.srtt,
+                                                                     self.rttvar, self.failures)
+
+    def observe_rtt(self, rtt):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+
+        self.failures = 0
+
+    def observe_failure(self, now):
+        self.failures += 1
+        self.last_failure = now
+
+    def rank_value(self, now):
+        value = self.srtt is None and INITIAL_RTT or self.srtt
+        if self.failures and self.last_failure > now - FAILURE_MEMORY:
+            value *= 2 ** min(self.failures, 10)
+        return value
+
+    def hedge_delay(self):
+        if self.srtt is None:
+            return MAX_HEDGE_DELAY
+
+        return min(max(self.srtt + 4 * self.rttvar, MIN_HEDGE_DELAY), MAX_HEDGE_DELAY)
+
+
+# The score of servers we know nothing about
+_unknown = ServerScore()
+
+
+class ServerScores(object):
+    '''
+    The scores of servers by address
+    '''
+
+    def __init__(self):
+        self._scores = {}
+
+    def __repr__(self):
+        return u"{0}({1!r})".format(self.__class__.__name__, self._scores)
+
+    def __len__(self):
+        return len(self._scores)
+
+    def get(self, server):
+        score = self._scores.get(server)
+        if score is None:
+            if len(self._scores) >= SERVER_SCORES_SIZE:
+                self._scores.clear()
+            score = self._scores[server] = ServerScore()
+        return score
+
+    def observe_rtt(self, server, rtt):
+        '''
+        The server answered after rtt seconds
+        '''
+        self.get(server).observe_rtt(rtt)
+
+    def observe_slow(self, server, elapsed):
+        '''
+        Another server answered first, and this one hasn't answered after
+        elapsed seconds
+        '''
+        score = self.get(server)
+        if score.srtt is None or elapsed > score.srtt:
+            score.observe_rtt(elapsed)
+
+    def observe_failure(self, server, now=None):
+        '''
+        The server didn't answer at all
+        '''
+        if now is None:
+            now = time.time()
+        self.get(server).observe_failure(now)
+
+    def rank(self, servers, now=None):
+        '''
+        Return the servers, the one that we expect to answer first first
+        '''
+        if now is None:
+            now = time.time()
+
+        ranked = [(self._scores.get(server, _unknown).rank_value(now), i, server)
+                  for i, server in enumerate(servers)]
+        ranked.sort()
+        return [server for dummy, dummy, server in ranked]
+
+    def hedge_delay(self, server):
+        '''
+        How long to wait for the server before also asking the next one
+        '''
+        return self._scores.get(server, _unknown).hedge_delay()
@@ -38,12 +38,34 @@ class Settings(object):
         # An IPv4Address or IPv6Address of the PETR
         self.PETR = None
 
+        # An IPv4Address or IPv6Address of the Map-Resolver that the ITR
+        # sends its Map-Requests to
+        self.MAP_RESOLVER = None
+
+        # The maximum number of entries in the map-cache, and how many
+        # seconds to wait before sending another Map-Request for the same
+        # EID-prefix
+        self.MAP_CACHE_SIZE = 10000
+        self.MAP_REQUEST_INTERVAL = 1.0
+
+        # The delegations that a DDT resolver starts from, as (instance-id,
+        # AFI, prefix, address) tuples like read_ddt_root returns, and the
+        # maximum number of referrals it caches
+        self.DDT_ROOT = []
+        self.DDT_REFERRAL_CACHE_SIZE = 10000
+
+        # When we have a DDT_ROOT we are a Map-Resolver. This is how many
+        # Map-Requests from one ITR can wait for DDT.
+        self.MAP_RESOLVER_PENDING_PER_ITR = 64
+
         # Enable NAT and RTR detection
         self.NATT = True
 
-        # The NF-Queue IDs for IPv4 and IPv6
+        # The NF-Queue IDs for IPv4 and IPv6, and the maximum number of
+        # packets handled per wakeup
         self.NFQUEUE_IPV4 = None
         self.NFQUEUE_IPV6 = None
+        self.NFQUEUE_BATCH_SIZE = 64
 
         # xTR-ID and Site-ID
         self.XTR_ID = id_generators.get_xtr_id()
@@ -52,6 +74,16 @@ class Settings(object):
         # Do we process data?
         self.PROCESS_DATA = True
 
+        # The maximum number of datagrams read from one socket before the
+        # other sockets get a turn, and how many are read per system call
+        self.READ_BUDGET = 64
+        self.READ_BATCH_SIZE = 32
+
+        # How many Map-Requests per second a Map-Server forwards to one ETR,
+        # and how many it may forward in a burst
+        self.MAP_REQUEST_FORWARD_RATE = 100.0
+        self.MAP_REQUEST_FORWARD_BURST = 200
+
         if not self.only_defaults:
             # Apply the config
             self.apply_config_files()
@@ -149,6 +181,31 @@ class Settings(object):
         if not isinstance(self.PETR, (IPv4Address, IPv6Address, NoneType)):
             raise ConfigurationError("PETR must be an IPv4Address, an IPv6Address or None")
 
+        if not isinstance(self.MAP_RESOLVER, (IPv4Address, IPv6Address, NoneType)):
+            raise ConfigurationError("MAP_RESOLVER must be an IPv4Address, an IPv6Address or None")
+
+        if not isinstance(self.MAP_CACHE_SIZE, int) or self.MAP_CACHE_SIZE < 1:
+            raise ConfigurationError("MAP_CACHE_SIZE must be a positive integer")
+
+        if not isinstance(self.MAP_REQUEST_INTERVAL, (int, float)) or self.MAP_REQUEST_INTERVAL < 0:
+            raise ConfigurationError("MAP_REQUEST_INTERVAL must be a number of seconds")
+
+        try:
+            for instance_id, address_family, prefix, address in self.DDT_ROOT:
+                if not isinstance(instance_id, int) \
+                or address_family not in (afi.IPv4, afi.IPv6) \
+                or not isinstance(prefix, (IPv4Network, IPv6Network)) \
+                or not isinstance(address, (IPv4Address, IPv6Address)):
+                    raise ConfigurationError("Invalid DDT_ROOT delegation for {0}".format(prefix))
+        except (TypeError, ValueError):
+            raise ConfigurationError("DDT_ROOT must be a list of (instance-id, AFI, prefix, address) tuples")
+
+        if not isinstance(self.DDT_REFERRAL_CACHE_SIZE, int) or self.DDT_REFERRAL_CACHE_SIZE < 1:
+            raise ConfigurationError("DDT_REFERRAL_CACHE_SIZE must be a positive integer")
+
+        if not isinstance(self.MAP_RESOLVER_PENDING_PER_ITR, int) or self.MAP_RESOLVER_PENDING_PER_ITR < 1:
+            raise ConfigurationError("MAP_RESOLVER_PENDING_PER_ITR must be a positive integer")
+
         if not isinstance(self.NATT, bool):
             raise ConfigurationError("NATT must be a boolena")
 
@@ -158,6 +215,21 @@ class Settings(object):
         if not isinstance(self.NFQUEUE_IPV6, (int, NoneType)):
             raise ConfigurationError("NFQUEUE_IPV6 must be an integer or None")
 
+        if not isinstance(self.NFQUEUE_BATCH_SIZE, int) or self.NFQUEUE_BATCH_SIZE < 1:
+            raise ConfigurationError("NFQUEUE_BATCH_SIZE must be a positive integer")
+
+        if not isinstance(self.READ_BUDGET, int) or self.READ_BUDGET < 1:
+            raise ConfigurationError("READ_BUDGET must be a positive integer")
+
+        if not isinstance(self.READ_BATCH_SIZE, int) or self.READ_BATCH_SIZE < 1:
+            raise ConfigurationError("READ_BATCH_SIZE must be a positive integer")
+
+        if not isinstance(self.MAP_REQUEST_FORWARD_RATE, (int, float)) or self.MAP_REQUEST_FORWARD_RATE <= 0:
+            raise ConfigurationError("MAP_REQUEST_FORWARD_RATE must be a positive number")
+
+        if not isinstance(self.MAP_REQUEST_FORWARD_BURST, int) or self.MAP_REQUEST_FORWARD_BURST < 1:
+            raise ConfigurationError("MAP_REQUEST_FORWARD_BURST must be a positive integer")
+
 
 # Common configuration
 config = Settings(only_defaults=True)
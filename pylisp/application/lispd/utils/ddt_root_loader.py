@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 from ipaddress import ip_address, ip_network, IPv4Network, IPv6Network
 from pylisp.application.lispd.address_tree.authoritative_container_node import AuthContainerNode
+from pylisp.application.lispd.address_tree.base import NotAuthoritativeError
 from pylisp.application.lispd.address_tree.container_node import ContainerNode
 from pylisp.application.lispd.address_tree.ddt_referral_node import DDTReferralNode
 import logging
@@ -52,10 +53,17 @@ def add_delegation(instances, instance_id, afi, prefix, address):
         raise ValueError('Overlapping node of unrecognised type {0}'.format(best_match))
 
 
-def load_ddt_root(filename):
-    instances = {}
+def read_ddt_root(filename):
+    '''
+    Return the delegations in a ddt_root file as (instance-id, AFI, prefix,
+    address) tuples. AFI 0 delegates both 0.0.0.0/0 and ::/0.
+    '''
+    delegations = []
     ddt_root = file(filename)
 
+    # There are only a few DDT nodes, so parse each address once
+    addresses = {}
+
     for line in ddt_root:
         line = line.split('#')[0].strip()
         if not line:
@@ -68,17 +76,59 @@ def load_ddt_root(filename):
         groups = match.groupdict()
         instance_id = int(groups['instance'])
         afi = int(groups['afi'])
-        address = ip_address(unicode(groups['address']))
+        address = addresses.get(groups['address'])
+        if address is None:
+            address = addresses[groups['address']] = ip_address(unicode(groups['address']))
+
+        if afi == 0:
+            # If AFI is 0 then add wildcard references for both IPv4 and IPv6
+            delegations.append((instance_id, 1, IPv4Network(u'0.0.0.0/0'), address))
+            delegations.append((instance_id, 2, IPv6Network(u'::/0'), address))
+        else:
+            try:
+                prefix = ip_network(unicode(groups['prefix']))
+            except ValueError, e:
+                raise ValueError('{0} in ddt_root line {1}'.format(e, line))
+            delegations.append((instance_id, afi, prefix, address))
+
+    return delegations
+
+
+def build_ddt_root(delegations):
+    '''
+    Build the address trees for (instance-id, AFI, prefix, address) tuples.
+    All delegations for a prefix become one DDTReferralNode, and the nodes
+    for each instance-id and AFI are added to a new AuthContainerNode at
+    once, which is a lot faster than add_delegation for large sets.
+    '''
+    # The DDT nodes by instance-id, AFI and prefix, in order of appearance
+    referrals = {}
+    for instance_id, afi, prefix, address in delegations:
+        prefixes = referrals.setdefault((instance_id, afi), {})
+        addresses = prefixes.get(prefix)
+        if addresses is None:
+            prefixes[prefix] = [address]
+        elif address not in addresses:
+            addresses.append(address)
+
+    instances = {}
+    for (instance_id, afi), prefixes in referrals.iteritems():
+        if afi == 1:
+            root = AuthContainerNode(u'0.0.0.0/0')
+        elif afi == 2:
+            root = AuthContainerNode(u'::/0')
+        else:
+            raise ValueError('Unknown AFI {0} in ddt_root instance {1}'.format(afi, instance_id))
 
         try:
-            if afi == 0:
-                # If AFI is 0 then add wildcard references for both IPv4 and IPv6
-                add_delegation(instances, instance_id, 1, IPv4Network(u'0.0.0.0/0'), address)
-                add_delegation(instances, instance_id, 2, IPv6Network(u'::/0'), address)
-            else:
-                prefix = ip_network(unicode(groups['prefix']))
-                add_delegation(instances, instance_id, afi, prefix, address)
-        except ValueError, e:
-            raise ValueError('{0} in ddt_root line {1}'.format(e, line))
+            root.bulk_update(DDTReferralNode(prefix, addresses) for prefix, addresses in prefixes.iteritems())
+        except (ValueError, NotAuthoritativeError), e:
+            raise ValueError('{0} in ddt_root instance {1} AFI {2}'.format(e, instance_id, afi))
+
+        instances.setdefault(instance_id, {})[afi] = root
 
     return instances
+
+
+def load_ddt_root(filename):
+    return build_ddt_root(read_ddt_root(filename))
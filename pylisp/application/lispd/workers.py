@@ -0,0 +1,351 @@
+'''
+Created on 18 okt. 2026
+
+@author: sander
+
+Run lispd as multiple worker processes. Every worker binds its own control
+and data plane sockets with SO_REUSEPORT and the kernel spreads the incoming
+datagrams over them. The supervisor starts the workers, restarts them when
+they die and passes SIGHUP on to them.
+
+Map-Server registrations are stored by the worker that received the
+Map-Register. Each worker sends its new registrations to the supervisor,
+which passes them on to the other workers and keeps a copy so that a
+restarted worker can be brought up to date.
+'''
+from pylisp.application.lispd.address_tree.map_server_node import MapServerNode, MapServerRegistration
+from pylisp.application.lispd.utils.prefix import determine_instance_id_and_afi, resolve
+from pylisp.packet.lisp.control.map_register_record import MapRegisterRecord
+from pylisp.utils.event_loop import EventLoop
+import cPickle as pickle
+import errno
+import fcntl
+import logging
+import os
+import signal
+import socket
+import time
+
+
+# Get the logger
+logger = logging.getLogger(__name__)
+
+
+__all__ = ['Supervisor', 'WorkerChannel']
+
+
+# The largest message passed between the supervisor and the workers
+MAX_MESSAGE_SIZE = 65536
+
+
+def _pack_entries(entries):
+    '''
+    Pickle the entries into as few messages as possible
+    '''
+    messages = []
+    chunk = []
+    for entry in entries:
+        chunk.append(entry)
+        if len(pickle.dumps(chunk, 2)) > MAX_MESSAGE_SIZE:
+            if len(chunk) == 1:
+                logger.error(u"Registration too large to pass to other workers: {0!r}".format(entry))
+                chunk = []
+                continue
+
+            messages.append(pickle.dumps(chunk[:-1], 2))
+            chunk = [entry]
+
+    if chunk:
+        messages.append(pickle.dumps(chunk, 2))
+
+    return messages
+
+
+def _send(sock, data):
+    try:
+        sock.send(data)
+        return True
+    except socket.error, e:
+        logger.error(u"Could not pass a message to another lispd process: {0}".format(e))
+        return False
+
+
+class WorkerChannel(object):
+    '''
+    The worker side of the connection with the supervisor
+    '''
+
+    def __init__(self, sock, worker_nr):
+        self.sock = sock
+        self.worker_nr = worker_nr
+
+    def __repr__(self):
+        return u"{0}({1})".format(self.__class__.__name__, self.worker_nr)
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def on_registration(self, ms_node, prefix, source, registration):
+        '''
+        Called by MapServerNodes for every Map-Register that they accept
+        '''
+        instance_id, dummy, dummy = determine_instance_id_and_afi(registration.record.eid_prefix)
+        entry = {'key': (instance_id, prefix, source),
+                 'source': source,
+                 'proxy_map_reply': registration.proxy_map_reply,
+                 'timeout': registration.timeout,
+                 'deadline': registration.deadline,
+                 'record': registration.record.to_bytes()}
+
+        for data in _pack_entries([entry]):
+            _send(self.sock, data)
+
+    def handle_messages(self, dummy=None):
+        '''
+        Apply the registrations that the other workers have received
+        '''
+        while True:
+            try:
+                data = self.sock.recv(MAX_MESSAGE_SIZE, socket.MSG_DONTWAIT)
+            except socket.error, e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    return
+                raise
+
+            if not data:
+                # The supervisor has gone away
+                return
+
+            for entry in pickle.loads(data):
+                try:
+                    self.apply_registration(entry)
+                except:
+                    logger.exception(u"Could not apply registration {0!r} from another worker".format(entry['key']))
+
+    def apply_registration(self, entry):
+        if entry['deadline'] < time.time():
+            # Already expired
+            return
+
+        record = MapRegisterRecord.from_bytes(entry['record'])
+        instance_id, afi, prefix = determine_instance_id_and_afi(record.eid_prefix)
+        ms_node = resolve(instance_id, afi, prefix)
+        if not isinstance(ms_node, MapServerNode):
+            logger.warn(u"Received a registration for {0} from another worker"
+                        ", but we are not a MapServer for that EID space".format(prefix))
+            return
+
+        registration = MapServerRegistration(record=record,
+                                             proxy_map_reply=entry['proxy_map_reply'],
+                                             timeout=entry['timeout'])
+        registration.deadline = entry['deadline']
+
+        ms_node.store_registration(prefix, entry['source'], registration)
+
+
+class _Worker(object):
+    def __init__(self, worker_nr, pid, sock):
+        self.worker_nr = worker_nr
+        self.pid = pid
+        self.sock = sock
+        self.started = time.time()
+
+    def __repr__(self):
+        return u"Worker({0}, pid={1})".format(self.worker_nr, self.pid)
+
+    def fileno(self):
+        return self.sock.fileno()
+
+
+class Supervisor(object):
+    def __init__(self, worker_count, worker_main, restart_delay=1.0):
+        '''
+        Each worker calls worker_main(channel) with its WorkerChannel and
+        exits with the returned exit code
+        '''
+        self.worker_count = worker_count
+        self.worker_main = worker_main
+        self.restart_delay = restart_delay
+
+        self.workers = {}
+        self.restarts = {}
+
+        # The latest registration for each (instance-id, prefix, source)
+        # as (deadline, entry)
+        self.registrations = {}
+
+        self.event_loop = None
+        self.signal_pipe = None
+        self.stopping = False
+
+    def _handle_signals(self):
+        signal_pipe, signal_pipe_w = os.pipe()
+
+        flags = fcntl.fcntl(signal_pipe_w, fcntl.F_GETFL, 0)
+        fcntl.fcntl(signal_pipe_w, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+        def signal_handler(sig, frame):
+            os.write(signal_pipe_w, chr(sig))
+
+        for sig in (signal.SIGHUP, signal.SIGINT, signal.SIGTERM, signal.SIGCHLD):
+            signal.signal(sig, signal_handler)
+
+        return signal_pipe, signal_pipe_w
+
+    def start_worker(self, worker_nr):
+        supervisor_sock, worker_sock = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+
+        pid = os.fork()
+        if pid == 0:
+            # This is the worker
+            exit_code = 1
+            try:
+                for sig in (signal.SIGHUP, signal.SIGINT, signal.SIGTERM, signal.SIGCHLD):
+                    signal.signal(sig, signal.SIG_DFL)
+
+                supervisor_sock.close()
+                for worker in self.workers.values():
+                    worker.sock.close()
+                for fd in self.signal_pipe:
+                    os.close(fd)
+
+                exit_code = self.worker_main(WorkerChannel(worker_sock, worker_nr))
+            except:
+                logger.exception(u"Worker {0} caught an unexpected exception".format(worker_nr))
+            finally:
+                os._exit(exit_code or 0)
+
+        worker_sock.close()
+
+        worker = _Worker(worker_nr, pid, supervisor_sock)
+        self.workers[worker_nr] = worker
+        logger.info(u"Started {0!r}".format(worker))
+
+        # Bring the new worker up to date. The worker isn't reading yet, so
+        # wait for it instead of dropping messages when its queue is full.
+        now = time.time()
+        entries = [entry for deadline, entry in self.registrations.itervalues() if deadline > now]
+        supervisor_sock.settimeout(5.0)
+        for data in _pack_entries(entries):
+            if not _send(supervisor_sock, data):
+                break
+
+        # Don't let one slow worker hold up the others
+        supervisor_sock.settimeout(1.0)
+
+        self.event_loop.add_reader(worker, self.handle_worker_message)
+
+    def handle_worker_message(self, worker):
+        try:
+            data = worker.sock.recv(MAX_MESSAGE_SIZE, socket.MSG_DONTWAIT)
+        except socket.error, e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return
+            raise
+
+        if not data:
+            return
+
+        for entry in pickle.loads(data):
+            self.registrations[entry['key']] = (entry['deadline'], entry)
+
+        # Pass it on to the other workers
+        for other in self.workers.values():
+            if other is not worker:
+                _send(other.sock, data)
+
+    def expire_registrations(self):
+        now = time.time()
+        for key, (deadline, dummy) in self.registrations.items():
+            if deadline < now:
+                del self.registrations[key]
+
+    def reap_workers(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError, e:
+                if e.errno == errno.ECHILD:
+                    return
+                raise
+
+            if pid == 0:
+                return
+
+            for worker in self.workers.values():
+                if worker.pid == pid:
+                    break
+            else:
+                continue
+
+            logger.log(self.stopping and logging.INFO or logging.ERROR,
+                       u"{0!r} has stopped with status {1}".format(worker, status))
+
+            self.event_loop.remove_reader(worker)
+            worker.sock.close()
+            del self.workers[worker.worker_nr]
+
+            if not self.stopping:
+                # Don't restart a worker that keeps dying too quickly
+                self.restarts[worker.worker_nr] = worker.started + self.restart_delay
+
+    def handle_signal(self, fd):
+        sig = ord(os.read(fd, 1))
+        if sig in (signal.SIGINT, signal.SIGTERM):
+            logger.info("Shutting down workers")
+            self.stop()
+
+        elif sig == signal.SIGHUP:
+            logger.info("Received HUP, passing it on to the workers")
+            for worker in self.workers.values():
+                os.kill(worker.pid, signal.SIGHUP)
+
+        elif sig == signal.SIGCHLD:
+            self.reap_workers()
+
+    def stop(self):
+        self.stopping = True
+        for worker in self.workers.values():
+            try:
+                os.kill(worker.pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+    def run(self):
+        self.event_loop = EventLoop()
+        self.signal_pipe = self._handle_signals()
+        self.event_loop.add_reader(self.signal_pipe[0], self.handle_signal)
+
+        for worker_nr in range(self.worker_count):
+            self.start_worker(worker_nr)
+
+        last_expiry = time.time()
+        while not self.stopping:
+            self.event_loop.run_once(self.restarts and self.restart_delay or 5.0)
+
+            now = time.time()
+            for worker_nr, restart_at in self.restarts.items():
+                if now >= restart_at and not self.stopping:
+                    del self.restarts[worker_nr]
+                    self.start_worker(worker_nr)
+
+            if now - last_expiry > 30.0:
+                self.expire_registrations()
+                last_expiry = now
+
+        # Wait for the workers to stop
+        while self.workers:
+            try:
+                pid, status = os.wait()
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                break
+
+            for worker in self.workers.values():
+                if worker.pid == pid:
+                    logger.info(u"{0!r} has stopped".format(worker))
+                    del self.workers[worker.worker_nr]
+
+        self.event_loop.close()
+        return 0
@@ -7,9 +7,20 @@ from bitstring import ConstBitStream, BitStream, Bits
 from ipaddress import IPv4Address
 from pylisp.packet.ip import protocol_registry
 from pylisp.packet.ip.protocol import Protocol
+from pylisp.packet.ip.udp import UDPMessage
 from pylisp.utils import checksum
+from pylisp.utils.buffers import BufferView, sub_buffer, unpack_from
 import math
 import numbers
+import struct
+
+
+# The fixed part of the header
+_header_format = struct.Struct('!BBHHHBBHII')
+
+# Fields that are patched in place
+_word_format = struct.Struct('!H')
+_address_format = struct.Struct('!I')
 
 
 class IPv4Packet(Protocol):
@@ -136,7 +147,7 @@ class IPv4Packet(Protocol):
             raise ValueError('Destination address must be IPv4')
 
     @classmethod
-    def from_bytes(cls, bitstream, decode_payload=True):
+    def from_bitstream(cls, bitstream, decode_payload=True):
         '''
         Parse the given packet and update properties accordingly
         '''
@@ -229,6 +240,68 @@ class IPv4Packet(Protocol):
 
         return packet
 
+    @classmethod
+    def from_buffer(cls, data, offset=0, decode_payload=True):
+        '''
+        Parse the given packet in place
+        '''
+        packet = cls()
+
+        (version_ihl, packet.tos, total_length, packet.identification,
+         flags_offset, packet.ttl, packet.protocol, header_checksum,
+         source, destination) = unpack_from(_header_format, data, offset)
+
+        # Check the version
+        if version_ihl >> 4 != packet.version:
+            raise ValueError('Provided bytes do not contain an IPv4 packet')
+
+        # Check the header length
+        ihl = version_ihl & 0x0f
+        if ihl < 5:
+            raise ValueError('Invalid IPv4 header length')
+
+        header_length = ihl * 4
+        if total_length < header_length:
+            raise ValueError('Total length is shorter than the header')
+
+        # Read the flags
+        if flags_offset & 0x8000:
+            raise ValueError('Reserved flag must be 0')
+
+        packet.dont_fragment = bool(flags_offset & 0x4000)
+        packet.more_fragments = bool(flags_offset & 0x2000)
+        packet.fragment_offset = flags_offset & 0x1fff
+
+        # Verify the header checksum, skipping the checksum bytes themselves
+        header = bytes(sub_buffer(data, offset, header_length))
+        my_checksum = checksum.ones_complement(header[:10] + header[12:])
+        if my_checksum != header_checksum:
+            raise ValueError('Header checksum does not match')
+
+        packet.source = IPv4Address(source)
+        packet.destination = IPv4Address(destination)
+
+        # Read the options
+        packet.options = header[20:]
+
+        # And the rest is payload, up to the total length
+        packet.payload = BufferView(sub_buffer(data, offset + header_length,
+                                               total_length - header_length))
+
+        # There should be no remaining bytes
+        if offset + total_length != len(data):
+            raise ValueError('Bits remaining after processing packet')
+
+        if decode_payload:
+            payload_class = protocol_registry.get_type_class(packet.protocol)
+            if payload_class:
+                packet.payload = payload_class.from_bytes(packet.payload)
+
+        # Verify that the properties make sense
+        packet.sanitize()
+
+        return packet
+
     def to_bytes(self):
         '''
         Create bytes from properties
@@ -287,6 +360,76 @@ class IPv4Packet(Protocol):
 
         return bitstream.bytes + payload_bytes
 
+    @staticmethod
+    def _patch_header(data, offset, start, new_bytes):
+        # Replace bytes in the header of the packet in the bytearray and
+        # update the header checksum for the change
+        start += offset
+        end = start + len(new_bytes)
+        old_bytes = bytes(data[start:end])
+        data[start:end] = new_bytes
+
+        old_checksum = _word_format.unpack_from(data, offset + 10)[0]
+        new_checksum = checksum.incremental_update(old_checksum, old_bytes,
+                                                   new_bytes)
+        _word_format.pack_into(data, offset + 10, new_checksum)
+
+        return old_bytes
+
+    @classmethod
+    def patch_ttl(cls, data, ttl, offset=0):
+        '''
+        Change the TTL of the packet in the given bytearray in place and
+        update the header checksum
+        '''
+        if ttl < 0 or ttl > 255:
+            raise ValueError('Invalid TTL')
+
+        # The TTL shares a 16-bit word with the protocol
+        protocol = data[offset + 9]
+        cls._patch_header(data, offset, 8, bytearray((ttl, protocol)))
+
+    @classmethod
+    def decrement_ttl(cls, data, offset=0):
+        '''
+        Decrement the TTL of the packet in the given bytearray in place and
+        return the new TTL. A packet with a TTL of 0 can't be forwarded.
+        '''
+        ttl = data[offset + 8]
+        if ttl == 0:
+            raise ValueError('TTL expired')
+
+        cls.patch_ttl(data, ttl - 1, offset)
+        return ttl - 1
+
+    @classmethod
+    def patch_addresses(cls, data, source=None, destination=None, offset=0):
+        '''
+        Change the source and/or destination address of the packet in the
+        given bytearray in place. The checksum of a UDP payload is updated as
+        well because it covers the addresses.
+        '''
+        old_addresses = bytes(data[offset + 12:offset + 20])
+
+        if source is not None:
+            source = IPv4Address(source)
+            cls._patch_header(data, offset, 12,
+                              _address_format.pack(int(source)))
+
+        if destination is not None:
+            destination = IPv4Address(destination)
+            cls._patch_header(data, offset, 16,
+                              _address_format.pack(int(destination)))
+
+        # Only the first fragment contains the UDP header
+        header_length = (data[offset] & 0x0f) * 4
+        flags_offset = _word_format.unpack_from(data, offset + 6)[0]
+        if data[offset + 9] == UDPMessage.header_type \
+        and flags_offset & 0x1fff == 0:
+            new_addresses = bytes(data[offset + 12:offset + 20])
+            UDPMessage.patch_pseudo_header(data, old_addresses, new_addresses,
+                                           offset + header_length)
+
 
 # Register this header type
 protocol_registry.register_type_class(IPv4Packet)
@@ -7,7 +7,13 @@ from bitstring import ConstBitStream, BitStream, Bits
 from ipaddress import IPv6Address
 from pylisp.packet.ip import protocol_registry
 from pylisp.packet.ip.protocol import Protocol
+from pylisp.utils.buffers import BufferView, sub_buffer, unpack_from
 import numbers
+import struct
+
+
+# The fixed header, with the addresses split in 64-bit halves
+_header_format = struct.Struct('!IHBBQQQQ')
 
 
 class IPv6Packet(Protocol):
@@ -101,7 +107,7 @@ class IPv6Packet(Protocol):
             raise ValueError('Destination address must be IPv6')
 
     @classmethod
-    def from_bytes(cls, bitstream, decode_payload=True):
+    def from_bitstream(cls, bitstream, decode_payload=True):
         '''
         Parse the given packet and update properties accordingly
         '''
@@ -155,6 +161,49 @@ class IPv6Packet(Protocol):
 
         return packet
 
+    @classmethod
+    def from_buffer(cls, data, offset=0, decode_payload=True):
+        '''
+        Parse the given packet in place
+        '''
+        packet = cls()
+
+        (first_word, payload_length, packet.next_header, packet.hop_limit,
+         source_high, source_low,
+         destination_high, destination_low) = unpack_from(_header_format,
+                                                          data, offset)
+
+        # Check the version
+        if first_word >> 28 != packet.version:
+            raise ValueError('Provided bytes do not contain an IPv6 packet')
+
+        # Read the traffic class and flow label
+        packet.traffic_class = (first_word >> 20) & 0xff
+        packet.flow_label = first_word & 0xfffff
+
+        # Read the source and destination addresses
+        packet.source = IPv6Address((source_high << 64) | source_low)
+        packet.destination = IPv6Address((destination_high << 64)
+                                         | destination_low)
+
+        # And the rest is payload
+        offset += _header_format.size
+        packet.payload = BufferView(sub_buffer(data, offset, payload_length))
+
+        # There should be no remaining bytes
+        if offset + payload_length != len(data):
+            raise ValueError('Bits remaining after processing packet')
+
+        if decode_payload:
+            payload_class = protocol_registry.get_type_class(packet.next_header)
+            if payload_class:
+                packet.payload = payload_class.from_bytes(packet.payload)
+
+        # Verify that the properties make sense
+        packet.sanitize()
+
+        return packet
+
     def to_bytes(self):
         '''
         Create bytes from properties
@@ -189,6 +238,20 @@ class IPv6Packet(Protocol):
 
         return bitstream.bytes + payload_bytes
 
+    @staticmethod
+    def decrement_hop_limit(data, offset=0):
+        '''
+        Decrement the hop limit of the packet in the given bytearray in place
+        and return the new hop limit. IPv6 has no header checksum to update.
+        A packet with a hop limit of 0 can't be forwarded.
+        '''
+        hop_limit = data[offset + 7]
+        if hop_limit == 0:
+            raise ValueError('Hop limit expired')
+
+        data[offset + 7] = hop_limit - 1
+        return hop_limit - 1
+
 
 class IPv6ExtensionHeader(Protocol):
     '''
@@ -6,7 +6,12 @@ Created on 11 jan. 2013
 from bitstring import BitStream, ConstBitStream, Bits
 from pylisp.packet.ip import protocol_registry
 from pylisp.packet.ip.ipv6.base import IPv6ExtensionHeader
+from pylisp.utils.buffers import BufferView, sub_buffer, unpack_from
 import math
+import struct
+
+
+_header_format = struct.Struct('!BB')
 
 
 class IPv6DestinationOptionsHeader(IPv6ExtensionHeader):
@@ -26,7 +31,7 @@ class IPv6DestinationOptionsHeader(IPv6ExtensionHeader):
         # TODO: implement
 
     @classmethod
-    def from_bytes(cls, bitstream):
+    def from_bitstream(cls, bitstream):
         packet = cls()
 
         # Convert to ConstBitStream (if not already provided)
@@ -59,6 +64,31 @@ class IPv6DestinationOptionsHeader(IPv6ExtensionHeader):
 
         return packet
 
+    @classmethod
+    def from_buffer(cls, data, offset=0):
+        packet = cls()
+
+        # Read the next header type and the header length, given in
+        # multiples of 8 octets
+        packet.next_header, header_length = unpack_from(_header_format,
+                                                        data, offset)
+        header_length = (header_length + 1) * 8
+
+        # Read the options
+        packet.options = bytes(sub_buffer(data, offset + 2, header_length - 2))
+
+        # And the rest is payload
+        packet.payload = BufferView(sub_buffer(data, offset + header_length))
+
+        payload_class = protocol_registry.get_type_class(packet.next_header)
+        if payload_class:
+            packet.payload = payload_class.from_bytes(packet.payload)
+
+        # Verify that the properties make sense
+        packet.sanitize()
+
+        return packet
+
     def to_bytes(self):
         '''
         Create bytes from properties
@@ -6,6 +6,11 @@ Created on 11 jan. 2013
 from bitstring import BitStream, ConstBitStream, Bits
 from pylisp.packet.ip import protocol_registry
 from pylisp.packet.ip.ipv6.base import IPv6ExtensionHeader
+from pylisp.utils.buffers import BufferView, sub_buffer, unpack_from
+import struct
+
+
+_header_format = struct.Struct('!BBHI')
 
 
 class IPv6FragmentHeader(IPv6ExtensionHeader):
@@ -28,7 +33,7 @@ class IPv6FragmentHeader(IPv6ExtensionHeader):
         # TODO: implement
 
     @classmethod
-    def from_bytes(cls, bitstream):
+    def from_bitstream(cls, bitstream):
         packet = cls()
 
         # Convert to ConstBitStream (if not already provided)
@@ -65,6 +70,27 @@ class IPv6FragmentHeader(IPv6ExtensionHeader):
 
         return packet
 
+    @classmethod
+    def from_buffer(cls, data, offset=0):
+        packet = cls()
+
+        # Read the next header type, the fragment offset and flags and the
+        # identification, skipping over the reserved bits
+        (packet.next_header, dummy, offset_flags,
+         packet.identification) = unpack_from(_header_format, data, offset)
+
+        packet.fragment_offset = offset_flags >> 3
+        packet.more_fragments = bool(offset_flags & 0x0001)
+
+        # And the rest is payload
+        offset += _header_format.size
+        packet.payload = BufferView(sub_buffer(data, offset))
+
+        # Verify that the properties make sense
+        packet.sanitize()
+
+        return packet
+
     def to_bytes(self):
         '''
         Create bytes from properties
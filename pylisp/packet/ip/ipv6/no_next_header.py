@@ -6,6 +6,7 @@ Created on 11 jan. 2013
 from bitstring import ConstBitStream, Bits
 from pylisp.packet.ip import protocol_registry
 from pylisp.packet.ip.ipv6.base import IPv6ExtensionHeader
+from pylisp.utils.buffers import BufferView, sub_buffer
 
 
 class IPv6NoNextHeader(IPv6ExtensionHeader):
@@ -26,7 +27,7 @@ class IPv6NoNextHeader(IPv6ExtensionHeader):
         # TODO: implement
 
     @classmethod
-    def from_bytes(cls, bitstream):
+    def from_bitstream(cls, bitstream):
         packet = cls()
 
         # Convert to ConstBitStream (if not already provided)
@@ -45,6 +46,18 @@ class IPv6NoNextHeader(IPv6ExtensionHeader):
 
         return packet
 
+    @classmethod
+    def from_buffer(cls, data, offset=0):
+        packet = cls()
+
+        # Everything is payload
+        packet.payload = BufferView(sub_buffer(data, offset))
+
+        # Verify that the properties make sense
+        packet.sanitize()
+
+        return packet
+
     def to_bytes(self):
         '''
         Create bytes from properties
@@ -4,6 +4,8 @@ Created on 11 jan. 2013
 @author: sander
 '''
 from abc import abstractmethod, ABCMeta
+from bitstring import Bits
+from pylisp.utils import buffers
 from pylisp.utils.represent import represent
 
 
@@ -70,3 +72,29 @@ class Protocol(ProtocolElement):
         # the header_type)
         if isinstance(self.payload, Protocol):
             self.next_header = self.payload.header_type
+
+    @classmethod
+    def from_bytes(cls, data, **kwargs):
+        '''
+        Parse the given packet. Bitstrings are parsed with bitstring, all
+        other data is parsed in place and the payload will refer to the
+        original data instead of a copy.
+        '''
+        if isinstance(data, Bits):
+            return cls.from_bitstream(data, **kwargs)
+        else:
+            return cls.from_buffer(buffers.as_buffer(data), **kwargs)
+
+    @classmethod
+    @abstractmethod
+    def from_bitstream(cls, bitstream):
+        '''
+        Parse the given bitstream with bitstring
+        '''
+
+    @classmethod
+    @abstractmethod
+    def from_buffer(cls, data, offset=0):
+        '''
+        Parse the given buffer in place, starting at the given offset
+        '''
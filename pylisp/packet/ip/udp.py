@@ -8,7 +8,16 @@ from ipaddress import IPv4Address, IPv6Address
 from pylisp.packet.ip import protocol_registry
 from pylisp.packet.ip.protocol import Protocol
 from pylisp.utils import checksum
+from pylisp.utils.buffers import BufferView, sub_buffer, unpack_from
 import numbers
+import struct
+
+
+_header_format = struct.Struct('!HHHH')
+
+# Fields that are patched in place
+_ports_format = struct.Struct('!HH')
+_word_format = struct.Struct('!H')
 
 
 class UDPMessage(Protocol):
@@ -136,7 +145,7 @@ class UDPMessage(Protocol):
         return self.get_lisp_message(only_control=True)
 
     @classmethod
-    def from_bytes(cls, bitstream):
+    def from_bitstream(cls, bitstream):
         '''
         Parse the given packet and update properties accordingly
         '''
@@ -166,14 +175,7 @@ class UDPMessage(Protocol):
         packet.payload = bitstream.read('bytes:%d' % payload_bytes)
 
         # LISP-specific handling
-        if packet.source_port == 4341 or packet.destination_port == 4341:
-            # Payload is a LISP data packet
-            from pylisp.packet.lisp.data import DataPacket
-            packet.payload = DataPacket.from_bytes(packet.payload)
-        elif packet.source_port == 4342 or packet.destination_port == 4342:
-            # Payload is a LISP control message
-            from pylisp.packet.lisp.control.base import ControlMessage
-            packet.payload = ControlMessage.from_bytes(packet.payload)
+        packet.decode_lisp_payload()
 
         # There should be no remaining bits
         if bitstream.pos != bitstream.len:
@@ -184,6 +186,47 @@ class UDPMessage(Protocol):
 
         return packet
 
+    @classmethod
+    def from_buffer(cls, data, offset=0):
+        '''
+        Parse the given packet in place
+        '''
+        packet = cls()
+
+        (packet.source_port, packet.destination_port,
+         length, packet.checksum) = unpack_from(_header_format, data, offset)
+
+        if length < 8:
+            raise ValueError('Invalid UDP length')
+
+        # And the rest is payload
+        packet.payload = BufferView(sub_buffer(data, offset + 8, length - 8))
+
+        # There should be no remaining bytes
+        if offset + length != len(data):
+            raise ValueError('Bits remaining after processing packet')
+
+        # LISP-specific handling
+        packet.decode_lisp_payload()
+
+        # Verify that the properties make sense
+        packet.sanitize()
+
+        return packet
+
+    def decode_lisp_payload(self):
+        '''
+        Parse the payload if it is LISP, based on the UDP ports
+        '''
+        if self.source_port == 4341 or self.destination_port == 4341:
+            # Payload is a LISP data packet
+            from pylisp.packet.lisp.data import DataPacket
+            self.payload = DataPacket.from_bytes(self.payload)
+        elif self.source_port == 4342 or self.destination_port == 4342:
+            # Payload is a LISP control message
+            from pylisp.packet.lisp.control.base import ControlMessage
+            self.payload = ControlMessage.from_bytes(self.payload)
+
     def to_bytes(self):
         '''
         Create bytes from properties
@@ -206,5 +249,47 @@ class UDPMessage(Protocol):
 
         return bitstream.bytes + payload_bytes
 
+    @staticmethod
+    def _update_checksum(data, offset, old_bytes, new_bytes):
+        # An all zero checksum means that the sender didn't generate one
+        old_checksum = _word_format.unpack_from(data, offset + 6)[0]
+        if old_checksum == 0:
+            return
+
+        new_checksum = checksum.incremental_update(old_checksum, old_bytes,
+                                                   new_bytes)
+
+        # A computed checksum of zero is transmitted as all ones
+        _word_format.pack_into(data, offset + 6, new_checksum or 0xffff)
+
+    @classmethod
+    def patch_ports(cls, data, source_port=None, destination_port=None,
+                    offset=0):
+        '''
+        Change the source and/or destination port of the UDP message in the
+        given bytearray in place and update the checksum
+        '''
+        old_ports = bytes(data[offset:offset + 4])
+        old_source_port, old_destination_port = _ports_format.unpack(old_ports)
+
+        if source_port is None:
+            source_port = old_source_port
+        if destination_port is None:
+            destination_port = old_destination_port
+
+        new_ports = _ports_format.pack(source_port, destination_port)
+        data[offset:offset + 4] = new_ports
+        cls._update_checksum(data, offset, old_ports, new_ports)
+
+    @classmethod
+    def patch_pseudo_header(cls, data, old_addresses, new_addresses,
+                            offset=0):
+        '''
+        Update the checksum of the UDP message in the given bytearray in
+        place after the addresses in the IP header have been changed. The
+        addresses are given as the source and destination bytes together.
+        '''
+        cls._update_checksum(data, offset, old_addresses, new_addresses)
+
 # Register this header type
 protocol_registry.register_type_class(UDPMessage)
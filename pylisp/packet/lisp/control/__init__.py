@@ -8,6 +8,10 @@ Created on 5 jan. 2013
 # =========
 from constants import *
 
+# Authentication
+# ==============
+from authentication import AuthenticationKey
+
 # Records
 # =======
 from locator_record import LocatorRecord
@@ -0,0 +1,216 @@
+'''
+Created on 18 okt. 2026
+
+@author: sander
+
+Authentication data for Map-Register, Map-Notify and Info messages. The HMAC
+is calculated over the whole message with the authentication data filled
+with zeroes.
+
+An AuthenticationKey keeps HMAC objects that have already processed the key,
+so calculating the authentication data only has to copy their state instead
+of starting from scratch. Messages parsed with the struct codec remember the
+bytes they were parsed from, and as long as the message isn't changed those
+are verified as they are instead of encoding the message again.
+'''
+from pylisp.packet.lisp.control.constants import KEY_ID_HMAC_SHA_1_96, KEY_ID_HMAC_SHA_256_128, KEY_ID_NONE
+import hashlib
+import hmac
+
+
+__all__ = ['AUTHENTICATION_DATA_OFFSET', 'AuthenticationKey', 'WireDataMixin',
+           'get_authentication_data_length', 'as_authentication_key',
+           'calculate_authentication_data', 'verify_authentication_data']
+
+
+# The authentication data follows the type, flags, nonce, key-id and
+# authentication data length
+AUTHENTICATION_DATA_OFFSET = 16
+
+# The digestmod and authentication data length for each key-id
+_digests = {KEY_ID_HMAC_SHA_1_96: (hashlib.sha1, 20),
+            KEY_ID_HMAC_SHA_256_128: (hashlib.sha256, 32)}
+
+# Keys given as strings are converted once. The cache holds the keys
+# themselves, which are configured in the settings and live as long as the
+# process anyway, and is emptied when it gets too large.
+MAX_CACHED_KEYS = 64
+_key_cache = {}
+
+
+def _get_digest(key_id):
+    try:
+        return _digests[key_id]
+    except KeyError:
+        raise ValueError('Unknown Key ID')
+
+
+def get_authentication_data_length(key_id):
+    '''
+    The length of the authentication data for the given key-id
+
+    >>> get_authentication_data_length(KEY_ID_HMAC_SHA_1_96)
+    20
+    >>> get_authentication_data_length(KEY_ID_NONE)
+    0
+    '''
+    if key_id == KEY_ID_NONE:
+        return 0
+
+    return _get_digest(key_id)[1]
+
+
+class AuthenticationKey(object):
+    '''
+    A key together with the HMAC state after processing it, per digestmod
+
+    >>> key = AuthenticationKey('secret')
+    >>> key.calculate(KEY_ID_HMAC_SHA_1_96, 'message') == \\
+    ...     hmac.new('secret', 'message', hashlib.sha1).digest()
+    True
+    '''
+
+    def __init__(self, key):
+        self.key = key
+        self._hmacs = {}
+
+    def __repr__(self):
+        # Don't show the key itself in logs
+        return u"{0}()".format(self.__class__.__name__)
+
+    def new_hmac(self, key_id):
+        '''
+        Return a new HMAC object for the given key-id
+        '''
+        keyed_hmac = self._hmacs.get(key_id)
+        if keyed_hmac is None:
+            digestmod, dummy = _get_digest(key_id)
+            keyed_hmac = hmac.new(self.key, digestmod=digestmod)
+            self._hmacs[key_id] = keyed_hmac
+
+        return keyed_hmac.copy()
+
+    def calculate(self, key_id, data):
+        '''
+        Calculate the HMAC of the data for the given key-id
+        '''
+        message_hmac = self.new_hmac(key_id)
+        message_hmac.update(data)
+        return message_hmac.digest()
+
+    def verify(self, key_id, data, authentication_data, offset=AUTHENTICATION_DATA_OFFSET):
+        '''
+        Verify the authentication data of a message as it was received. The
+        data must contain the authentication data at the given offset, it is
+        replaced with zeroes while calculating the HMAC.
+        '''
+        data_length = len(authentication_data)
+        if data_length != get_authentication_data_length(key_id):
+            return False
+
+        end = offset + data_length
+        message_hmac = self.new_hmac(key_id)
+        message_hmac.update(buffer(data, 0, offset))
+        message_hmac.update('\x00' * data_length)
+        message_hmac.update(buffer(data, end))
+        return hmac.compare_digest(message_hmac.digest(), bytes(authentication_data))
+
+
+class WireDataMixin(object):
+    '''
+    For messages that remember the bytes they were parsed from. Setting an
+    attribute of the message makes it forget them, and so does adding,
+    removing or replacing records. Changes inside a record are not noticed,
+    replace the record instead.
+    '''
+
+    def __setattr__(self, name, value):
+        if name != '_wire_data' and name != '_wire_records':
+            self.__dict__['_wire_data'] = None
+        object.__setattr__(self, name, value)
+
+    def set_wire_data(self, data):
+        '''
+        Remember the bytes that the message was parsed from
+        '''
+        self._wire_data = data
+        self._wire_records = list(getattr(self, 'records', ()))
+
+    def get_wire_data(self):
+        '''
+        Return the bytes that the message was parsed from, or None if it has
+        been changed since
+        '''
+        wire_data = self.__dict__.get('_wire_data')
+        if wire_data is None:
+            return None
+
+        records = getattr(self, 'records', ())
+        wire_records = self._wire_records
+        if len(records) != len(wire_records) \
+        or any(record is not wire_record for record, wire_record in zip(records, wire_records)):
+            return None
+
+        return wire_data
+
+
+def as_authentication_key(key):
+    '''
+    Return the AuthenticationKey for the given key
+    '''
+    if isinstance(key, AuthenticationKey):
+        return key
+
+    authentication_key = _key_cache.get(key)
+    if authentication_key is None:
+        if len(_key_cache) >= MAX_CACHED_KEYS:
+            _key_cache.clear()
+
+        authentication_key = AuthenticationKey(key)
+        _key_cache[key] = authentication_key
+
+    return authentication_key
+
+
+def calculate_authentication_data(message, key):
+    '''
+    Calculate the authentication data for the message based on its current
+    key-id and the given key
+    '''
+    # This one is easy
+    if message.key_id == KEY_ID_NONE:
+        return ''
+
+    data_length = get_authentication_data_length(message.key_id)
+
+    # Fill the authentication data with the right number of zeroes
+    # after storing the original first so we can restore it later
+    current_authentication_data = message.authentication_data
+    message.authentication_data = '\x00' * data_length
+    try:
+        msg = message.to_bytes()
+    finally:
+        message.authentication_data = current_authentication_data
+
+    return as_authentication_key(key).calculate(message.key_id, msg)
+
+
+def verify_authentication_data(message, key):
+    '''
+    Verify the authentication data of the message based on its current
+    key-id and the given key. Use the received bytes if we have them.
+    '''
+    if message.key_id == KEY_ID_NONE:
+        return message.authentication_data == ''
+
+    wire_data = None
+    if isinstance(message, WireDataMixin):
+        wire_data = message.get_wire_data()
+
+    if wire_data is not None:
+        return as_authentication_key(key).verify(message.key_id, wire_data,
+                                                 message.authentication_data)
+
+    correct_authentication_data = calculate_authentication_data(message, key)
+    return hmac.compare_digest(correct_authentication_data,
+                               bytes(message.authentication_data))
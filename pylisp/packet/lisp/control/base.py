@@ -4,7 +4,8 @@ Created on 6 jan. 2013
 @author: sander
 '''
 from abc import ABCMeta, abstractmethod
-from bitstring import ConstBitStream, Bits
+from bitstring import Bits, ReadError
+from pylisp.packet.lisp.control import codec
 from pylisp.packet.ip.protocol import ProtocolElement
 
 
@@ -32,34 +33,82 @@ class ControlMessage(ProtocolElement):
         '''
 
     @classmethod
-    @abstractmethod
     def from_bytes(cls, bitstream):
         '''
         Look at the type of the message, instantiate the correct class and
-        let it parse the message.
+        let it parse the message. Bitstrings are parsed with the bitstring
+        codec, everything else with the struct codec unless it is disabled.
+        Both codecs raise ValueError for truncated messages.
         '''
         from pylisp.packet.lisp.control import type_registry
 
-        # Convert to ConstBitStream (if not already provided)
-        if not isinstance(bitstream, ConstBitStream):
-            if isinstance(bitstream, Bits):
-                bitstream = ConstBitStream(auto=bitstream)
-            else:
-                bitstream = ConstBitStream(bytes=bitstream)
+        use_bitstream = isinstance(bitstream, Bits) \
+                        or not codec.USE_STRUCT_CODEC
+        if use_bitstream:
+            # Convert to ConstBitStream (if not already provided)
+            bitstream = codec.as_bitstream(bitstream)
+            if not bitstream.len:
+                raise ValueError('Empty message')
+
+            # Peek at the bitstream to see which type it is
+            type_nr = bitstream.peek('uint:4')
+        else:
+            bitstream = codec.as_buffer(bitstream)
+            if not bitstream:
+                raise ValueError('Empty message')
 
-        # Peek at the bitstream to see which type it is
-        type_nr = bitstream.peek('uint:4')
+            # The type is in the first four bits
+            type_nr = ord(bitstream[0]) >> 4
 
         # Look for the right class
-        type_class = type_registry.get_type_class(type_nr)
-        if not type_class:
-            raise ValueError("Can't handle message type {0}".format(type_nr))
+        if cls.message_type is not None:
+            type_class = cls
+        else:
+            type_class = type_registry.get_type_class(type_nr)
+            if not type_class:
+                raise ValueError("Can't handle message type {0}".format(type_nr))
 
         # Let the specific class handle it from now on
-        return type_class.from_bytes(bitstream)
+        if use_bitstream:
+            try:
+                return type_class.from_bitstream(bitstream)
+            except ReadError:
+                # Running out of bits is what the struct codec calls truncated
+                raise ValueError('Message is truncated')
+        else:
+            return type_class.from_buffer(bitstream)
+
+    @classmethod
+    @abstractmethod
+    def from_bitstream(cls, bitstream):
+        '''
+        Parse the given bitstream with the bitstring codec
+        '''
 
+    @classmethod
     @abstractmethod
+    def from_buffer(cls, data, offset=0):
+        '''
+        Parse the given bytes with the struct codec
+        '''
+
     def to_bytes(self):
         '''
         Create bytes from properties
         '''
+        if codec.USE_STRUCT_CODEC:
+            return self.to_buffer()
+        else:
+            return self.to_bitstream().bytes
+
+    @abstractmethod
+    def to_bitstream(self):
+        '''
+        Create a bitstream from properties with the bitstring codec
+        '''
+
+    @abstractmethod
+    def to_buffer(self):
+        '''
+        Create bytes from properties with the struct codec
+        '''
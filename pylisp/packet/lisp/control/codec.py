@@ -0,0 +1,52 @@
+'''
+Created on 18 okt. 2026
+
+@author: sander
+
+Control messages can be encoded and decoded in two ways: with bitstring
+(from_bitstream/to_bitstream), which follows the packet diagrams bit by bit
+and is kept as the reference implementation, and with precompiled struct
+formats (from_buffer/to_buffer), which is much faster. ControlMessage's
+from_bytes and to_bytes use the struct codec unless USE_STRUCT_CODEC is set
+to False.
+'''
+from bitstring import Bits, ConstBitStream
+from pylisp.utils.buffers import as_buffer
+
+
+__all__ = ['USE_STRUCT_CODEC', 'as_bitstream', 'as_buffer', 'read_bytes']
+
+
+# Use the struct based codec by default
+USE_STRUCT_CODEC = True
+
+
+def as_bitstream(data):
+    '''
+    Convert the given data to a ConstBitStream (if not already provided)
+    '''
+    if isinstance(data, ConstBitStream):
+        return data
+    elif isinstance(data, Bits):
+        return ConstBitStream(auto=data)
+    else:
+        return ConstBitStream(bytes=bytes(data))
+
+
+def read_bytes(data, offset, length):
+    '''
+    Read a number of bytes from the buffer and return them together with the
+    new offset. Raise an error when there is not enough data.
+
+    >>> read_bytes('abcdef', 1, 3)
+    ('bcd', 4)
+    >>> read_bytes('abcdef', 4, 3)
+    Traceback (most recent call last):
+        ...
+    ValueError: Message is truncated
+    '''
+    end = offset + length
+    if end > len(data):
+        raise ValueError('Message is truncated')
+
+    return data[offset:end], end
@@ -3,15 +3,21 @@ Created on 7 jan. 2013
 
 @author: sander
 '''
-from bitstring import ConstBitStream, BitArray, Bits
+from bitstring import BitArray
 from pylisp.packet.ip import IPv4Packet, IPv6Packet
-from pylisp.packet.lisp.control import type_registry, ControlMessage
+from pylisp.packet.lisp.control import type_registry, ControlMessage, codec
 from pylisp.packet.ip.udp import UDPMessage
+from pylisp.utils.buffers import BufferView, sub_buffer, unpack_from
+import struct
 
 
 __all__ = ['EncapsulatedControlMessage']
 
 
+# Type, flags and reserved bits
+_header_format = struct.Struct('!I')
+
+
 class EncapsulatedControlMessage(ControlMessage):
     # Class property: which message type do we represent?
     message_type = 8
@@ -30,7 +36,10 @@ class EncapsulatedControlMessage(ControlMessage):
         self.payload = payload
 
         # Store space for reserved bits
-        self._reserved1 = BitArray(26)
+        self._reserved1 = 0
+
+        # The received bytes of the payload
+        self._payload_data = None
 
     def sanitize(self):
         '''
@@ -77,6 +86,21 @@ class EncapsulatedControlMessage(ControlMessage):
         # sent for RLOC-probing purposes (i.e the probe-bit is set), they
         # MUST NOT be sent inside Encapsulated Control Messages.
 
+    def get_payload_bytes(self):
+        '''
+        Return the encapsulated packet as bytes. For a received message these
+        are the bytes as they were received, so the packet can be passed on
+        without encoding it again.
+        '''
+        if self._payload_data is not None:
+            return BufferView(self._payload_data)
+
+        payload = self.payload
+        if hasattr(payload, 'to_bytes'):
+            payload = payload.to_bytes()
+
+        return bytes(payload)
+
     def get_udp(self):
         # Encapsulated, look inside
         if not isinstance(self.payload, (IPv4Packet, IPv6Packet)):
@@ -94,7 +118,79 @@ class EncapsulatedControlMessage(ControlMessage):
         return udp
 
     @classmethod
-    def from_bytes(cls, bitstream):
+    def from_bitstream(cls, bitstream):
+        '''
+        Parse the given packet with the bitstring codec
+        '''
+        packet = cls()
+
+        # Convert to ConstBitStream (if not already provided)
+        bitstream = codec.as_bitstream(bitstream)
+
+        # Read the type
+        type_nr = bitstream.read('uint:4')
+        if type_nr != packet.message_type:
+            msg = 'Invalid bitstream for a {0} packet'
+            class_name = packet.__class__.__name__
+            raise ValueError(msg.format(class_name))
+
+        # Read the flags
+        (packet.security,
+         packet.ddt_originated) = bitstream.readlist('2*bool')
+
+        # Read reserved bits
+        packet._reserved1 = bitstream.read('uint:26')
+
+        # If the security flag is set then there should be security data here
+        # TODO: deal with security flag [LISP-Security]
+        if packet.security:
+            raise NotImplementedError('Handling security data is not ' +
+                                      'implemented yet')
+
+        # The rest of the packet is payload
+        remaining = bitstream[bitstream.pos:]
+
+        # Parse IP packet
+        if len(remaining):
+            ip_version = remaining.peek('uint:4')
+            if ip_version == 4:
+                packet.payload = IPv4Packet.from_bytes(remaining)
+            elif ip_version == 6:
+                packet.payload = IPv6Packet.from_bytes(remaining)
+            else:
+                packet.payload = remaining.bytes
+
+        # Verify that the properties make sense
+        packet.sanitize()
+
+        return packet
+
+    def to_bitstream(self):
+        '''
+        Create a bitstream from properties with the bitstring codec
+        '''
+        # Verify that properties make sense
+        self.sanitize()
+
+        # Start with the type
+        bitstream = BitArray('uint:4=%d' % self.message_type)
+
+        # Add the flags
+        bitstream += BitArray('bool=%d, bool=%d' % (self.security,
+                                                    self.ddt_originated))
+
+        # Add padding
+        bitstream += BitArray('uint:26=%d' % self._reserved1)
+
+        # Determine payload
+        payload = self.payload
+        if hasattr(payload, 'to_bytes'):
+            payload = payload.to_bytes()
+
+        return bitstream + BitArray(bytes=bytes(payload))
+
+    @classmethod
+    def from_buffer(cls, data, offset=0):
         r'''
         Parse the given packet and update properties accordingly
 
@@ -119,26 +215,19 @@ class EncapsulatedControlMessage(ControlMessage):
         '''
         packet = cls()
 
-        # Convert to ConstBitStream (if not already provided)
-        if not isinstance(bitstream, ConstBitStream):
-            if isinstance(bitstream, Bits):
-                bitstream = ConstBitStream(auto=bitstream)
-            else:
-                bitstream = ConstBitStream(bytes=bitstream)
+        flags = unpack_from(_header_format, data, offset)[0]
+        offset += _header_format.size
 
-        # Read the type
-        type_nr = bitstream.read('uint:4')
-        if type_nr != packet.message_type:
+        # Check the message type
+        if flags >> 28 != packet.message_type:
             msg = 'Invalid bitstream for a {0} packet'
             class_name = packet.__class__.__name__
             raise ValueError(msg.format(class_name))
 
         # Read the flags
-        (packet.security,
-         packet.ddt_originated) = bitstream.readlist('2*bool')
-
-        # Read reserved bits
-        packet._reserved1 = bitstream.read(26)
+        packet.security = bool(flags & 0x08000000)
+        packet.ddt_originated = bool(flags & 0x04000000)
+        packet._reserved1 = flags & 0x3ffffff
 
         # If the security flag is set then there should be security data here
         # TODO: deal with security flag [LISP-Security]
@@ -146,25 +235,26 @@ class EncapsulatedControlMessage(ControlMessage):
             raise NotImplementedError('Handling security data is not ' +
                                       'implemented yet')
 
-        # The rest of the packet is payload
-        remaining = bitstream[bitstream.pos:]
+        # The rest of the packet is payload, referring to the original data
+        remaining = sub_buffer(data, offset)
+        packet._payload_data = remaining
 
         # Parse IP packet
         if len(remaining):
-            ip_version = remaining.peek('uint:4')
+            ip_version = ord(remaining[0]) >> 4
             if ip_version == 4:
-                packet.payload = IPv4Packet.from_bytes(remaining)
+                packet.payload = IPv4Packet.from_buffer(remaining)
             elif ip_version == 6:
-                packet.payload = IPv6Packet.from_bytes(remaining)
+                packet.payload = IPv6Packet.from_buffer(remaining)
             else:
-                packet.payload = remaining.bytes
+                packet.payload = BufferView(remaining)
 
         # Verify that the properties make sense
         packet.sanitize()
 
         return packet
 
-    def to_bytes(self):
+    def to_buffer(self):
         r'''
         Create bytes from properties
 
@@ -175,22 +265,17 @@ class EncapsulatedControlMessage(ControlMessage):
         # Verify that properties make sense
         self.sanitize()
 
-        # Start with the type
-        bitstream = BitArray('uint:4=%d' % self.message_type)
-
-        # Add the flags
-        bitstream += BitArray('bool=%d, bool=%d' % (self.security,
-                                                    self.ddt_originated))
-
-        # Add padding
-        bitstream += self._reserved1
+        flags = (self.message_type << 28
+                 | self.security << 27
+                 | self.ddt_originated << 26
+                 | self._reserved1)
 
         # Determine payload
         payload = self.payload
         if hasattr(payload, 'to_bytes'):
             payload = payload.to_bytes()
 
-        return bitstream.bytes + payload
+        return _header_format.pack(flags) + bytes(payload)
 
 
 # Register this class in the registry
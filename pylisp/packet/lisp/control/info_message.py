@@ -3,24 +3,32 @@ Created on 6 jan. 2013
 
 @author: sander
 '''
-from bitstring import ConstBitStream, BitArray, Bits
+from bitstring import BitArray
 from ipaddress import IPv4Network, IPv6Network
-from pylisp.packet.lisp.control import type_registry, KEY_ID_HMAC_SHA_1_96, KEY_ID_HMAC_SHA_256_128, KEY_ID_NONE
+from pylisp.packet.lisp.control import authentication, type_registry, KEY_ID_HMAC_SHA_1_96, KEY_ID_HMAC_SHA_256_128, KEY_ID_NONE, codec
 from pylisp.packet.lisp.control.base import ControlMessage
-from pylisp.utils.afi import read_afi_address_from_bitstream, get_bitstream_for_afi_address
+from pylisp.utils.afi import read_afi_address_from_bitstream, get_bitstream_for_afi_address, \
+    read_afi_address_from_buffer, get_bytes_for_afi_address
+from pylisp.utils.buffers import sub_buffer, unpack_from
 from pylisp.utils.lcaf.nat_traversal_address import LCAFNATTraversalAddress
-import hashlib
-import hmac
 import numbers
+import struct
 
 
 __all__ = ['InfoMessage']
 
+
+# Type, flag, reserved bits, nonce, key id and authentication data length
+_header_format = struct.Struct('!I8sHH')
+
+# TTL, reserved bits and EID mask length
+_ttl_format = struct.Struct('!IBB')
+
 # This implementation is based on http://tools.ietf.org/html/draft-ermagan-lisp-nat-traversal-03, which specifies that
 # both the InfoRequest and InfoReply have message type 7, so we implement them as one message with two variants.
 
 
-class InfoMessage(ControlMessage):
+class InfoMessage(authentication.WireDataMixin, ControlMessage):
     # Class property: which message type do we represent?
     message_type = 7
 
@@ -41,8 +49,12 @@ class InfoMessage(ControlMessage):
         self.reply = reply
 
         # Store space for reserved bits
-        self._reserved1 = BitArray(27)
-        self._reserved2 = BitArray(8)
+        self._reserved1 = 0
+        self._reserved2 = 0
+
+        # The bytes this message was parsed from, used to verify the
+        # authentication data
+        self._wire_data = None
 
     def sanitize(self):
         '''
@@ -112,66 +124,33 @@ class InfoMessage(ControlMessage):
     def calculate_authentication_data(self, key):
         '''
         Calculate the authentication data based on the current key-id and the
-        given key.
+        given key. The key can be a string or an AuthenticationKey.
         '''
-        # This one is easy
-        if self.key_id == KEY_ID_NONE:
-            return ''
-
-        # Determine the digestmod and how long the authentication data will be
-        if self.key_id == KEY_ID_HMAC_SHA_1_96:
-            digestmod = hashlib.sha1
-            data_length = 20
-        elif self.key_id == KEY_ID_HMAC_SHA_256_128:
-            digestmod = hashlib.sha256
-            data_length = 32
-        else:
-            raise ValueError('Unknown Key ID')
-
-        # Fill the authentication data with the right number of zeroes
-        # after storing the original first so we can restore it later
-        current_authentication_data = self.authentication_data
-        self.authentication_data = '\x00' * data_length
-
-        # Build the packet
-        msg = self.to_bytes()
-
-        # Restore the authentication data
-        self.authentication_data = current_authentication_data
-
-        # Return the authentication data based on the generated packet
-        # and the given key
-        return hmac.new(key, msg, digestmod).digest()
+        return authentication.calculate_authentication_data(self, key)
 
     def verify_authentication_data(self, key):
         '''
         Verify the current authentication data based on the current key-id and
         the given key.
         '''
-        correct_authentication_data = self.calculate_authentication_data(key)
-        return self.authentication_data == correct_authentication_data
+        return authentication.verify_authentication_data(self, key)
 
     def insert_authentication_data(self, key):
         '''
         Insert authentication data based on the current key-id and the given
         key.
         '''
-        correct_authentication_data = self.calculate_authentication_data(key)
-        self.authentication_data = correct_authentication_data
+        self.authentication_data = self.calculate_authentication_data(key)
 
     @classmethod
-    def from_bytes(cls, bitstream):
+    def from_bitstream(cls, bitstream):
         '''
-        Parse the given packet and update properties accordingly
+        Parse the given packet with the bitstring codec
         '''
         packet = cls()
 
         # Convert to ConstBitStream (if not already provided)
-        if not isinstance(bitstream, ConstBitStream):
-            if isinstance(bitstream, Bits):
-                bitstream = ConstBitStream(auto=bitstream)
-            else:
-                bitstream = ConstBitStream(bytes=bitstream)
+        bitstream = codec.as_bitstream(bitstream)
 
         # Read the type
         type_nr = bitstream.read('uint:4')
@@ -184,7 +163,7 @@ class InfoMessage(ControlMessage):
         packet.is_reply = bitstream.read('bool')
 
         # Skip reserved bits
-        packet._reserved1 = bitstream.read(27)
+        packet._reserved1 = bitstream.read('uint:27')
 
         # Read the nonce
         packet.nonce = bitstream.read('bytes:8')
@@ -200,7 +179,7 @@ class InfoMessage(ControlMessage):
         packet.ttl = bitstream.read('uint:32')
 
         # Skip reserved bits
-        packet._reserved2 = bitstream.read(8)
+        packet._reserved2 = bitstream.read('uint:8')
 
         # Store the EID prefix mask length until we need it
         eid_prefix_len = bitstream.read('uint:8')
@@ -216,9 +195,9 @@ class InfoMessage(ControlMessage):
 
         return packet
 
-    def to_bytes(self):
+    def to_bitstream(self):
         '''
-        Create bytes from properties
+        Create a bitstream from properties with the bitstring codec
         '''
         # Verify that properties make sense
         self.sanitize()
@@ -230,22 +209,22 @@ class InfoMessage(ControlMessage):
         bitstream += BitArray('bool=%d' % self.is_reply)
 
         # Add reserved bits
-        bitstream += self._reserved1
+        bitstream += BitArray('uint:27=%d' % self._reserved1)
 
         # Add the nonce
         bitstream += BitArray(bytes=self.nonce)
 
         # Add the key-id and authentication data
-        bitstream += BitArray('uint:16=%d, uint:16=%d, hex=%s'
+        bitstream += BitArray('uint:16=%d, uint:16=%d'
                               % (self.key_id,
-                                 len(self.authentication_data),
-                                 self.authentication_data.encode('hex')))
+                                 len(self.authentication_data)))
+        bitstream += BitArray(bytes=self.authentication_data)
 
         # Add the TTL
         bitstream += BitArray('uint:32=%d' % self.ttl)
 
         # Add reserved bits
-        bitstream += self._reserved2
+        bitstream += BitArray('uint:8=%d' % self._reserved2)
 
         # Add the EID prefix mask length
         bitstream += BitArray('uint:8=%d' % self.eid_prefix.prefixlen)
@@ -256,7 +235,69 @@ class InfoMessage(ControlMessage):
         # Add the reply
         bitstream += get_bitstream_for_afi_address(self.reply)
 
-        return bitstream.bytes
+        return bitstream
+
+    @classmethod
+    def from_buffer(cls, data, offset=0):
+        '''
+        Parse the given packet with the struct codec
+        '''
+        packet = cls()
+        start = offset
+
+        (flags, packet.nonce, packet.key_id,
+         data_length) = unpack_from(_header_format, data, offset)
+        offset += _header_format.size
+
+        # Check the message type
+        if flags >> 28 != packet.message_type:
+            msg = 'Invalid bitstream for a {0} packet'
+            class_name = packet.__class__.__name__
+            raise ValueError(msg.format(class_name))
+
+        packet.is_reply = bool(flags & 0x08000000)
+        packet._reserved1 = flags & 0x7ffffff
+
+        # Read the authentication data
+        packet.authentication_data, offset = codec.read_bytes(data, offset,
+                                                              data_length)
+
+        # Read the TTL, reserved bits and EID prefix length
+        (packet.ttl, packet._reserved2,
+         eid_prefix_len) = unpack_from(_ttl_format, data, offset)
+        offset += _ttl_format.size
+
+        # Read the EID prefix and the reply
+        packet.eid_prefix, offset = read_afi_address_from_buffer(data, offset,
+                                                                 eid_prefix_len)
+        packet.reply, offset = read_afi_address_from_buffer(data, offset)
+
+        # Verify that the properties make sense
+        packet.sanitize()
+
+        # Keep the received bytes for verifying the authentication data
+        packet.set_wire_data(sub_buffer(data, start, offset - start))
+
+        return packet
+
+    def to_buffer(self):
+        '''
+        Create bytes from properties with the struct codec
+        '''
+        # Verify that properties make sense
+        self.sanitize()
+
+        flags = (self.message_type << 28
+                 | self.is_reply << 27
+                 | self._reserved1)
+
+        return ''.join([_header_format.pack(flags, self.nonce, self.key_id,
+                                            len(self.authentication_data)),
+                        self.authentication_data,
+                        _ttl_format.pack(self.ttl, self._reserved2,
+                                         self.eid_prefix.prefixlen),
+                        get_bytes_for_afi_address(self.eid_prefix),
+                        get_bytes_for_afi_address(self.reply)])
 
 
 # Register this class in the registry
@@ -3,15 +3,19 @@ Created on 6 jan. 2013
 
 @author: sander
 '''
-from bitstring import ConstBitStream, BitArray, Bits
+from bitstring import BitArray, Bits
 from ipaddress import IPv4Address, IPv6Address, IPv4Network, IPv6Network
 from pylisp.application.lispd.utils.prefix import determine_instance_id_and_afi
-from pylisp.utils.afi import read_afi_address_from_bitstream, get_bitstream_for_afi_address
+from pylisp.packet.lisp.control import codec
+from pylisp.utils.afi import read_afi_address_from_bitstream, get_bitstream_for_afi_address, \
+    read_afi_address_from_buffer, get_bytes_for_afi_address
 from pylisp.utils.auto_addresses import AutoAddress
+from pylisp.utils.buffers import unpack_from
 from pylisp.utils.lcaf.base import LCAFAddress
 from pylisp.utils.represent import represent
 import logging
 import numbers
+import struct
 import weakref
 
 
@@ -22,6 +26,16 @@ __all__ = ['LocatorRecord']
 logger = logging.getLogger(__name__)
 
 
+# Addresses that can not be used as locators
+_IPV4_BROADCAST = IPv4Address(u'255.255.255.255')
+_IPV4_LINK_LOCAL_MULTICAST = IPv4Network(u'224.0.0.0/24')
+_IPV6_LINK_LOCAL_MULTICAST = (IPv6Network(u'ff02::/16'),
+                              IPv6Network(u'ff12::/16'))
+
+# Priorities, weights, reserved bits and flags
+_header_format = struct.Struct('!BBBBH')
+
+
 class LocatorRecord(object):
     def __init__(self, priority=255, weight=0, m_priority=255, m_weight=0,
                  local=False, probed_locator=False, reachable=False,
@@ -40,7 +54,7 @@ class LocatorRecord(object):
         self.address = address
 
         # Store space for reserved bits
-        self._reserved1 = BitArray(13)
+        self._reserved1 = 0
 
         # Remember who wants to be notified on change
         self._notify_targets = weakref.WeakSet()
@@ -192,17 +206,17 @@ class LocatorRecord(object):
 
         for address in addresses:
             if isinstance(self.address, IPv4Address):
-                if address == IPv4Address(u'255.255.255.255'):
+                if address == _IPV4_BROADCAST:
                     raise ValueError('Locator must not be the broadcast '
                                      'address')
 
-                if address in IPv4Network(u'224.0.0.0/24'):
+                if address in _IPV4_LINK_LOCAL_MULTICAST:
                     raise ValueError('Locator must not be a link-local '
                                      'multicast address')
 
             elif isinstance(self.address, IPv6Address):
-                if address in IPv6Network(u'ff02::/16') \
-                or address in IPv6Network(u'ff12::/16'):
+                if address in _IPV6_LINK_LOCAL_MULTICAST[0] \
+                or address in _IPV6_LINK_LOCAL_MULTICAST[1]:
                     raise ValueError('Locator must not be a link-local '
                                      'multicast address')
 
@@ -214,21 +228,28 @@ class LocatorRecord(object):
         '''
         Parse the given record and update properties accordingly
         '''
+        if isinstance(bitstream, Bits) or not codec.USE_STRUCT_CODEC:
+            return cls.from_bitstream(bitstream)
+
+        record, dummy = cls.from_buffer(codec.as_buffer(bitstream))
+        return record
+
+    @classmethod
+    def from_bitstream(cls, bitstream):
+        '''
+        Parse the given record with the bitstring codec
+        '''
         record = cls()
 
         # Convert to ConstBitStream (if not already provided)
-        if not isinstance(bitstream, ConstBitStream):
-            if isinstance(bitstream, Bits):
-                bitstream = ConstBitStream(auto=bitstream)
-            else:
-                bitstream = ConstBitStream(bytes=bitstream)
+        bitstream = codec.as_bitstream(bitstream)
 
         # Read the priorities and weights
         (record.priority, record.weight, record.m_priority,
          record.m_weight) = bitstream.readlist('4*uint:8')
 
         # Read over unused flags
-        record._reserved1 = bitstream.read(13)
+        record._reserved1 = bitstream.read('uint:13')
 
         # Read the flags
         (record.local,
@@ -243,11 +264,56 @@ class LocatorRecord(object):
 
         return record
 
+    @classmethod
+    def from_buffer(cls, data, offset=0):
+        '''
+        Parse the record at the given offset with the struct codec. Returns
+        the record and the offset of the first byte after it.
+        '''
+        record = cls()
+
+        # Read the priorities, weights and flags
+        (record.priority, record.weight, record.m_priority,
+         record.m_weight, flags) = unpack_from(_header_format, data, offset)
+
+        record._reserved1 = flags >> 3
+        record.local = bool(flags & 0x4)
+        record.probed_locator = bool(flags & 0x2)
+        record.reachable = bool(flags & 0x1)
+
+        # Read the locator
+        record.address, offset = read_afi_address_from_buffer(data, offset + 6)
+
+        # Verify that the properties make sense
+        record.sanitize()
+
+        return record, offset
+
     def to_bytes(self):
         '''
         Create bytes from properties
         '''
-        return self.to_bitstream().bytes
+        if codec.USE_STRUCT_CODEC:
+            return self.to_buffer()
+        else:
+            return self.to_bitstream().bytes
+
+    def to_buffer(self):
+        '''
+        Create bytes from properties with the struct codec
+        '''
+        # Verify that properties make sense
+        self.sanitize()
+
+        flags = (self._reserved1 << 3
+                 | self.local << 2
+                 | self.probed_locator << 1
+                 | self.reachable)
+
+        return _header_format.pack(self.priority, self.weight,
+                                   self.m_priority, self.m_weight,
+                                   flags) \
+            + get_bytes_for_afi_address(self.address)
 
     def to_bitstream(self):
         '''
@@ -264,7 +330,7 @@ class LocatorRecord(object):
                                             self.m_weight))
 
         # Add padding
-        bitstream += self._reserved1
+        bitstream += BitArray('uint:13=%d' % self._reserved1)
 
         # Add the flags
         bitstream += BitArray('bool=%d, bool=%d, bool=%d'
@@ -4,18 +4,26 @@ Created on 6 jan. 2013
 @author: sander
 '''
 from base import ControlMessage
-from bitstring import ConstBitStream, BitArray, Bits
-from pylisp.packet.lisp.control import type_registry, MapRegisterRecord, \
-    KEY_ID_HMAC_SHA_1_96, KEY_ID_HMAC_SHA_256_128, KEY_ID_NONE
-import hashlib
-import hmac
+from bitstring import BitArray
+from pylisp.packet.lisp.control import authentication, type_registry, MapRegisterRecord, \
+    KEY_ID_HMAC_SHA_1_96, KEY_ID_HMAC_SHA_256_128, KEY_ID_NONE, codec
+from pylisp.utils.buffers import sub_buffer, unpack_from
 import numbers
+import struct
 
 
 __all__ = ['MapNotifyMessage']
 
 
-class MapNotifyMessage(ControlMessage):
+# Type, flags, reserved bits, record count, nonce, key id and
+# authentication data length
+_header_format = struct.Struct('!I8sHH')
+
+# The xTR-ID and site-ID at the end of the message
+_xtr_site_id_format = struct.Struct('!QQQ')
+
+
+class MapNotifyMessage(authentication.WireDataMixin, ControlMessage):
     # Class property: which message type do we represent?
     message_type = 4
 
@@ -35,7 +43,11 @@ class MapNotifyMessage(ControlMessage):
         self.site_id = site_id
 
         # Store space for reserved bits
-        self._reserved1 = BitArray(19)
+        self._reserved1 = 0
+
+        # The bytes this message was parsed from, used to verify the
+        # authentication data
+        self._wire_data = None
 
     def sanitize(self):
         '''
@@ -97,66 +109,33 @@ class MapNotifyMessage(ControlMessage):
     def calculate_authentication_data(self, key):
         '''
         Calculate the authentication data based on the current key-id and the
-        given key.
+        given key. The key can be a string or an AuthenticationKey.
         '''
-        # This one is easy
-        if self.key_id == KEY_ID_NONE:
-            return ''
-
-        # Determine the digestmod and how long the authentication data will be
-        if self.key_id == KEY_ID_HMAC_SHA_1_96:
-            digestmod = hashlib.sha1
-            data_length = 20
-        elif self.key_id == KEY_ID_HMAC_SHA_256_128:
-            digestmod = hashlib.sha256
-            data_length = 32
-        else:
-            raise ValueError('Unknown Key ID')
-
-        # Fill the authentication data with the right number of zeroes
-        # after storing the original first so we can restore it later
-        current_authentication_data = self.authentication_data
-        self.authentication_data = '\x00' * data_length
-
-        # Build the packet
-        msg = self.to_bytes()
-
-        # Restore the authentication data
-        self.authentication_data = current_authentication_data
-
-        # Return the authentication data based on the generated packet
-        # and the given key
-        return hmac.new(key, msg, digestmod).digest()
+        return authentication.calculate_authentication_data(self, key)
 
     def verify_authentication_data(self, key):
         '''
         Verify the current authentication data based on the current key-id and
         the given key.
         '''
-        correct_authentication_data = self.calculate_authentication_data(key)
-        return self.authentication_data == correct_authentication_data
+        return authentication.verify_authentication_data(self, key)
 
     def insert_authentication_data(self, key):
         '''
         Insert authentication data based on the current key-id and the given
         key.
         '''
-        correct_authentication_data = self.calculate_authentication_data(key)
-        self.authentication_data = correct_authentication_data
+        self.authentication_data = self.calculate_authentication_data(key)
 
     @classmethod
-    def from_bytes(cls, bitstream):
+    def from_bitstream(cls, bitstream):
         '''
-        Parse the given packet and update properties accordingly
+        Parse the given packet with the bitstring codec
         '''
         packet = cls()
 
         # Convert to ConstBitStream (if not already provided)
-        if not isinstance(bitstream, ConstBitStream):
-            if isinstance(bitstream, Bits):
-                bitstream = ConstBitStream(auto=bitstream)
-            else:
-                bitstream = ConstBitStream(bytes=bitstream)
+        bitstream = codec.as_bitstream(bitstream)
 
         # Read the type
         type_nr = bitstream.read('uint:4')
@@ -169,7 +148,7 @@ class MapNotifyMessage(ControlMessage):
         has_xtr_site_id = bitstream.read('bool')
 
         # Skip reserved bits
-        packet._reserved1 = bitstream.read(19)
+        packet._reserved1 = bitstream.read('uint:19')
 
         # Store the record count until we need it
         record_count = bitstream.read('uint:8')
@@ -186,7 +165,7 @@ class MapNotifyMessage(ControlMessage):
 
         # Read the records
         for dummy in range(record_count):
-            record = MapRegisterRecord.from_bytes(bitstream)
+            record = MapRegisterRecord.from_bitstream(bitstream)
             packet.records.append(record)
 
         # Read the xtr-id and site-id
@@ -199,9 +178,9 @@ class MapNotifyMessage(ControlMessage):
 
         return packet
 
-    def to_bytes(self):
+    def to_bitstream(self):
         '''
-        Create bytes from properties
+        Create a bitstream from properties with the bitstring codec
         '''
         # Verify that properties make sense
         self.sanitize()
@@ -214,7 +193,7 @@ class MapNotifyMessage(ControlMessage):
         bitstream += BitArray('bool=%d' % has_xtr_site_id)
 
         # Add reserved bits
-        bitstream += self._reserved1
+        bitstream += BitArray('uint:19=%d' % self._reserved1)
 
         # Add record count
         bitstream += BitArray('uint:8=%d' % len(self.records))
@@ -223,10 +202,10 @@ class MapNotifyMessage(ControlMessage):
         bitstream += BitArray(bytes=self.nonce)
 
         # Add the key-id and authentication data
-        bitstream += BitArray('uint:16=%d, uint:16=%d, hex=%s'
+        bitstream += BitArray('uint:16=%d, uint:16=%d'
                               % (self.key_id,
-                                 len(self.authentication_data),
-                                 self.authentication_data.encode('hex')))
+                                 len(self.authentication_data)))
+        bitstream += BitArray(bytes=self.authentication_data)
 
         # Add the map-reply records
         for record in self.records:
@@ -237,7 +216,82 @@ class MapNotifyMessage(ControlMessage):
             bitstream += BitArray('uint:128=%d, uint:64=%d' % (self.xtr_id,
                                                                self.site_id))
 
-        return bitstream.bytes
+        return bitstream
+
+    @classmethod
+    def from_buffer(cls, data, offset=0):
+        '''
+        Parse the given packet with the struct codec
+        '''
+        packet = cls()
+        start = offset
+
+        (flags, packet.nonce, packet.key_id,
+         data_length) = unpack_from(_header_format, data, offset)
+        offset += _header_format.size
+
+        # Check the message type
+        if flags >> 28 != packet.message_type:
+            msg = 'Invalid bitstream for a {0} packet'
+            class_name = packet.__class__.__name__
+            raise ValueError(msg.format(class_name))
+
+        # Read the flags
+        has_xtr_site_id = bool(flags & 0x08000000)
+        packet._reserved1 = (flags >> 8) & 0x7ffff
+        record_count = flags & 0xff
+
+        # Read the authentication data
+        packet.authentication_data, offset = codec.read_bytes(data, offset,
+                                                              data_length)
+
+        # Read the records
+        for dummy in range(record_count):
+            record, offset = MapRegisterRecord.from_buffer(data, offset)
+            packet.records.append(record)
+
+        # Read the xtr-id and site-id
+        if has_xtr_site_id:
+            (xtr_id_high, xtr_id_low,
+             packet.site_id) = unpack_from(_xtr_site_id_format, data, offset)
+            packet.xtr_id = (xtr_id_high << 64) | xtr_id_low
+            offset += _xtr_site_id_format.size
+
+        # Verify that the properties make sense
+        packet.sanitize()
+
+        # Keep the received bytes for verifying the authentication data
+        packet.set_wire_data(sub_buffer(data, start, offset - start))
+
+        return packet
+
+    def to_buffer(self):
+        '''
+        Create bytes from properties with the struct codec
+        '''
+        # Verify that properties make sense
+        self.sanitize()
+
+        has_xtr_site_id = bool(self.xtr_id or self.site_id)
+
+        flags = (self.message_type << 28
+                 | has_xtr_site_id << 27
+                 | self._reserved1 << 8
+                 | len(self.records))
+
+        parts = [_header_format.pack(flags, self.nonce, self.key_id,
+                                     len(self.authentication_data)),
+                 self.authentication_data]
+
+        for record in self.records:
+            parts.append(record.to_buffer())
+
+        if has_xtr_site_id:
+            parts.append(_xtr_site_id_format.pack(self.xtr_id >> 64,
+                                                  self.xtr_id & 0xffffffffffffffff,
+                                                  self.site_id))
+
+        return ''.join(parts)
 
 
 # Register this class in the registry
@@ -3,14 +3,20 @@ Created on 7 jan. 2013
 
 @author: sander
 '''
-from bitstring import ConstBitStream, BitArray, Bits
+from bitstring import BitArray
 from pylisp.packet.lisp.control import type_registry, ControlMessage, \
-    MapReferralRecord
+    MapReferralRecord, codec
+from pylisp.utils.buffers import unpack_from
+import struct
 
 
 __all__ = ['MapReferralMessage']
 
 
+# Type, reserved bits, record count and nonce
+_header_format = struct.Struct('!I8s')
+
+
 class MapReferralMessage(ControlMessage):
     # Class property: which message type do we represent?
     message_type = 6
@@ -26,7 +32,7 @@ class MapReferralMessage(ControlMessage):
         self.records = records or []
 
         # Store space for reserved bits
-        self._reserved1 = BitArray(20)
+        self._reserved1 = 0
 
     def sanitize(self):
         '''
@@ -61,18 +67,14 @@ class MapReferralMessage(ControlMessage):
             record.sanitize()
 
     @classmethod
-    def from_bytes(cls, bitstream):
+    def from_bitstream(cls, bitstream):
         '''
-        Parse the given packet and update properties accordingly
+        Parse the given packet with the bitstring codec
         '''
         packet = cls()
 
         # Convert to ConstBitStream (if not already provided)
-        if not isinstance(bitstream, ConstBitStream):
-            if isinstance(bitstream, Bits):
-                bitstream = ConstBitStream(auto=bitstream)
-            else:
-                bitstream = ConstBitStream(bytes=bitstream)
+        bitstream = codec.as_bitstream(bitstream)
 
         # Read the type
         type_nr = bitstream.read('uint:4')
@@ -82,7 +84,7 @@ class MapReferralMessage(ControlMessage):
             raise ValueError(msg.format(class_name))
 
         # Skip reserved bits
-        packet._reserved1 = bitstream.read(20)
+        packet._reserved1 = bitstream.read('uint:20')
 
         # Store the record count
         record_count = bitstream.read('uint:8')
@@ -92,7 +94,7 @@ class MapReferralMessage(ControlMessage):
 
         # Read the records
         for dummy in range(record_count):
-            record = MapReferralRecord.from_bytes(bitstream)
+            record = MapReferralRecord.from_bitstream(bitstream)
             packet.records.append(record)
 
         # Verify that the properties make sense
@@ -100,9 +102,9 @@ class MapReferralMessage(ControlMessage):
 
         return packet
 
-    def to_bytes(self):
+    def to_bitstream(self):
         '''
-        Create bytes from properties
+        Create a bitstream from properties with the bitstring codec
         '''
         # Verify that properties make sense
         self.sanitize()
@@ -111,7 +113,7 @@ class MapReferralMessage(ControlMessage):
         bitstream = BitArray('uint:4=%d' % self.message_type)
 
         # Add padding
-        bitstream += self._reserved1
+        bitstream += BitArray('uint:20=%d' % self._reserved1)
 
         # Add the record count
         bitstream += BitArray('uint:8=%d' % len(self.records))
@@ -123,7 +125,53 @@ class MapReferralMessage(ControlMessage):
         for record in self.records:
             bitstream += record.to_bitstream()
 
-        return bitstream.bytes
+        return bitstream
+
+    @classmethod
+    def from_buffer(cls, data, offset=0):
+        '''
+        Parse the given packet with the struct codec
+        '''
+        packet = cls()
+
+        (flags, packet.nonce) = unpack_from(_header_format, data, offset)
+        offset += _header_format.size
+
+        # Check the message type
+        if flags >> 28 != packet.message_type:
+            msg = 'Invalid bitstream for a {0} packet'
+            class_name = packet.__class__.__name__
+            raise ValueError(msg.format(class_name))
+
+        packet._reserved1 = (flags >> 8) & 0xfffff
+        record_count = flags & 0xff
+
+        # Read the records
+        for dummy in range(record_count):
+            record, offset = MapReferralRecord.from_buffer(data, offset)
+            packet.records.append(record)
+
+        # Verify that the properties make sense
+        packet.sanitize()
+
+        return packet
+
+    def to_buffer(self):
+        '''
+        Create bytes from properties with the struct codec
+        '''
+        # Verify that properties make sense
+        self.sanitize()
+
+        flags = (self.message_type << 28
+                 | self._reserved1 << 8
+                 | len(self.records))
+
+        parts = [_header_format.pack(flags, self.nonce)]
+        for record in self.records:
+            parts.append(record.to_buffer())
+
+        return ''.join(parts)
 
 
 # Register this class in the registry
@@ -3,19 +3,27 @@ Created on 6 jan. 2013
 
 @author: sander
 '''
-from bitstring import ConstBitStream, BitArray, Bits
+from bitstring import BitArray, Bits
 from ipaddress import IPv4Network, IPv6Network
-from pylisp.packet.lisp.control import LocatorRecord
+from pylisp.packet.lisp.control import LocatorRecord, codec
 from pylisp.utils.afi import read_afi_address_from_bitstream, \
-    get_bitstream_for_afi_address
+    get_bitstream_for_afi_address, read_afi_address_from_buffer, \
+    get_bytes_for_afi_address
+from pylisp.utils.buffers import unpack_from
 from pylisp.utils.lcaf.instance_address import LCAFInstanceAddress
 from pylisp.utils.represent import represent
 import numbers
+import struct
 
 
 __all__ = ['MapReferralRecord']
 
 
+# TTL, referral count, EID mask length, action, flags, reserved bits,
+# signature count and the map version
+_header_format = struct.Struct('!IBBI')
+
+
 class MapReferralRecord(object):
     # ACT: The "action" field of the mapping record in a Map-Referral
     # message encodes 6 action types.  The values for the action types are:
@@ -76,7 +84,7 @@ class MapReferralRecord(object):
         self.signatures = signatures or []
 
         # Store space for reserved bits
-        self._reserved1 = BitArray(11)
+        self._reserved1 = 0
 
     def __repr__(self):
         return represent(self.__class__.__name__, self.__dict__)
@@ -282,14 +290,21 @@ class MapReferralRecord(object):
         '''
         Parse the given record and update properties accordingly
         '''
+        if isinstance(bitstream, Bits) or not codec.USE_STRUCT_CODEC:
+            return cls.from_bitstream(bitstream)
+
+        record, dummy = cls.from_buffer(codec.as_buffer(bitstream))
+        return record
+
+    @classmethod
+    def from_bitstream(cls, bitstream):
+        '''
+        Parse the given record with the bitstring codec
+        '''
         record = cls()
 
         # Convert to ConstBitStream (if not already provided)
-        if not isinstance(bitstream, ConstBitStream):
-            if isinstance(bitstream, Bits):
-                bitstream = ConstBitStream(auto=bitstream)
-            else:
-                bitstream = ConstBitStream(bytes=bitstream)
+        bitstream = codec.as_bitstream(bitstream)
 
         # Read the record TTL
         record.ttl = bitstream.read('uint:32')
@@ -308,7 +323,7 @@ class MapReferralRecord(object):
          record.incomplete) = bitstream.readlist('2*bool')
 
         # Read reserved bits
-        record._reserved1 = bitstream.read(11)
+        record._reserved1 = bitstream.read('uint:11')
 
         # Read the signature count
         sig_count = bitstream.read('uint:4')
@@ -322,7 +337,7 @@ class MapReferralRecord(object):
 
         # Read the locator records
         for dummy in range(referral_count):
-            locator_record = LocatorRecord.from_bytes(bitstream)
+            locator_record = LocatorRecord.from_bitstream(bitstream)
             record.locator_records.append(locator_record)
 
         # TODO: Can't handle signatures yet! [LISP-Security]
@@ -334,11 +349,78 @@ class MapReferralRecord(object):
 
         return record
 
+    @classmethod
+    def from_buffer(cls, data, offset=0):
+        '''
+        Parse the record at the given offset with the struct codec. Returns
+        the record and the offset of the first byte after it.
+        '''
+        record = cls()
+
+        (record.ttl, referral_count, eid_prefix_len,
+         flags) = unpack_from(_header_format, data, offset)
+
+        record.action = flags >> 29
+        record.authoritative = bool(flags & 0x10000000)
+        record.incomplete = bool(flags & 0x08000000)
+        record._reserved1 = (flags >> 16) & 0x7ff
+        sig_count = (flags >> 12) & 0xf
+        record.map_version = flags & 0xfff
+
+        # Read the EID prefix
+        record.eid_prefix, offset = read_afi_address_from_buffer(data,
+                                                                 offset + 10,
+                                                                 eid_prefix_len)
+
+        # Read the locator records
+        for dummy in range(referral_count):
+            locator_record, offset = LocatorRecord.from_buffer(data, offset)
+            record.locator_records.append(locator_record)
+
+        # TODO: Can't handle signatures yet! [LISP-Security]
+        if sig_count:
+            raise NotImplementedError('Cannot handle signatures yet')
+
+        # Verify that the properties make sense
+        record.sanitize()
+
+        return record, offset
+
     def to_bytes(self):
         '''
         Create bytes from properties
         '''
-        return self.to_bitstream().bytes
+        if codec.USE_STRUCT_CODEC:
+            return self.to_buffer()
+        else:
+            return self.to_bitstream().bytes
+
+    def to_buffer(self):
+        '''
+        Create bytes from properties with the struct codec
+        '''
+        # Verify that properties make sense
+        self.sanitize()
+
+        # TODO: Can't handle signatures yet! [LISP-Security]
+        if self.signatures:
+            raise NotImplementedError('Cannot handle signatures yet')
+
+        flags = (self.action << 29
+                 | self.authoritative << 28
+                 | self.incomplete << 27
+                 | self._reserved1 << 16
+                 | len(self.signatures) << 12
+                 | self.map_version)
+
+        parts = [_header_format.pack(self.ttl, len(self.locator_records),
+                                     self.eid_prefix.prefixlen, flags),
+                 get_bytes_for_afi_address(self.eid_prefix)]
+
+        for locator_record in self.locator_records:
+            parts.append(locator_record.to_buffer())
+
+        return ''.join(parts)
 
     def to_bitstream(self):
         '''
@@ -364,7 +446,7 @@ class MapReferralRecord(object):
                                                     self.incomplete))
 
         # Add reserved bits
-        bitstream += self._reserved1
+        bitstream += BitArray('uint:11=%d' % self._reserved1)
 
         # Add sigcount
         bitstream += BitArray('uint:4=%d' % len(self.signatures))
@@ -4,22 +4,30 @@ Created on 6 jan. 2013
 @author: sander
 '''
 from base import ControlMessage
-from bitstring import ConstBitStream, BitArray, Bits
-from pylisp.packet.lisp.control import type_registry, MapRegisterRecord, KEY_ID_HMAC_SHA_1_96, KEY_ID_HMAC_SHA_256_128, KEY_ID_NONE
-import hashlib
-import hmac
+from bitstring import BitArray
+from pylisp.packet.lisp.control import authentication, type_registry, MapRegisterRecord, KEY_ID_HMAC_SHA_1_96, KEY_ID_HMAC_SHA_256_128, KEY_ID_NONE, codec
+from pylisp.utils.buffers import sub_buffer, unpack_from
 import logging
 import numbers
+import struct
 
 
 __all__ = ['MapRegisterMessage']
 
 
+# Type, flags, reserved bits, record count, nonce, key id and
+# authentication data length
+_header_format = struct.Struct('!I8sHH')
+
+# The xTR-ID and site-ID at the end of the message
+_xtr_site_id_format = struct.Struct('!QQQ')
+
+
 # Get the logger
 logger = logging.getLogger(__name__)
 
 
-class MapRegisterMessage(ControlMessage):
+class MapRegisterMessage(authentication.WireDataMixin, ControlMessage):
     # Class property: which message type do we represent?
     message_type = 3
 
@@ -43,8 +51,12 @@ class MapRegisterMessage(ControlMessage):
         self.site_id = site_id
 
         # Store space for reserved bits
-        self._reserved1 = BitArray(1)
-        self._reserved2 = BitArray(15)
+        self._reserved1 = 0
+        self._reserved2 = 0
+
+        # The bytes this message was parsed from, used to verify the
+        # authentication data
+        self._wire_data = None
 
     def sanitize(self):
         '''
@@ -159,66 +171,33 @@ class MapRegisterMessage(ControlMessage):
     def calculate_authentication_data(self, key):
         '''
         Calculate the authentication data based on the current key-id and the
-        given key.
+        given key. The key can be a string or an AuthenticationKey.
         '''
-        # This one is easy
-        if self.key_id == KEY_ID_NONE:
-            return ''
-
-        # Determine the digestmod and how long the authentication data will be
-        if self.key_id == KEY_ID_HMAC_SHA_1_96:
-            digestmod = hashlib.sha1
-            data_length = 20
-        elif self.key_id == KEY_ID_HMAC_SHA_256_128:
-            digestmod = hashlib.sha256
-            data_length = 32
-        else:
-            raise ValueError('Unknown Key ID')
-
-        # Fill the authentication data with the right number of zeroes
-        # after storing the original first so we can restore it later
-        current_authentication_data = self.authentication_data
-        self.authentication_data = '\x00' * data_length
-
-        # Build the packet
-        msg = self.to_bytes()
-
-        # Restore the authentication data
-        self.authentication_data = current_authentication_data
-
-        # Return the authentication data based on the generated packet
-        # and the given key
-        return hmac.new(key, msg, digestmod).digest()
+        return authentication.calculate_authentication_data(self, key)
 
     def verify_authentication_data(self, key):
         '''
         Verify the current authentication data based on the current key-id and
         the given key.
         '''
-        correct_authentication_data = self.calculate_authentication_data(key)
-        return self.authentication_data == correct_authentication_data
+        return authentication.verify_authentication_data(self, key)
 
     def insert_authentication_data(self, key):
         '''
         Insert authentication data based on the current key-id and the given
         key.
         '''
-        correct_authentication_data = self.calculate_authentication_data(key)
-        self.authentication_data = correct_authentication_data
+        self.authentication_data = self.calculate_authentication_data(key)
 
     @classmethod
-    def from_bytes(cls, bitstream):
+    def from_bitstream(cls, bitstream):
         '''
-        Parse the given packet and update properties accordingly
+        Parse the given packet with the bitstring codec
         '''
         packet = cls()
 
         # Convert to ConstBitStream (if not already provided)
-        if not isinstance(bitstream, ConstBitStream):
-            if isinstance(bitstream, Bits):
-                bitstream = ConstBitStream(auto=bitstream)
-            else:
-                bitstream = ConstBitStream(bytes=bitstream)
+        bitstream = codec.as_bitstream(bitstream)
 
         # Read the type
         type_nr = bitstream.read('uint:4')
@@ -231,14 +210,14 @@ class MapRegisterMessage(ControlMessage):
         packet.proxy_map_reply = bitstream.read('bool')
 
         # Skip reserved bits
-        packet._reserved1 = bitstream.read(1)
+        packet._reserved1 = bitstream.read('uint:1')
 
         # NATT bits
         has_xtr_site_id = bitstream.read('bool')
         packet.for_rtr = bitstream.read('bool')
 
         # Skip reserved bits
-        packet._reserved2 = bitstream.read(15)
+        packet._reserved2 = bitstream.read('uint:15')
 
         # Read the rest of the flags
         packet.want_map_notify = bitstream.read('bool')
@@ -258,7 +237,7 @@ class MapRegisterMessage(ControlMessage):
 
         # Read the records
         for dummy in range(record_count):
-            record = MapRegisterRecord.from_bytes(bitstream)
+            record = MapRegisterRecord.from_bitstream(bitstream)
             packet.records.append(record)
 
         # Read the xtr-id and site-id
@@ -271,9 +250,9 @@ class MapRegisterMessage(ControlMessage):
 
         return packet
 
-    def to_bytes(self):
+    def to_bitstream(self):
         '''
-        Create bytes from properties
+        Create a bitstream from properties with the bitstring codec
         '''
         # Verify that properties make sense
         self.sanitize()
@@ -285,7 +264,7 @@ class MapRegisterMessage(ControlMessage):
         bitstream += BitArray('bool=%d' % self.proxy_map_reply)
 
         # Add reserved bits
-        bitstream += self._reserved1
+        bitstream += BitArray('uint:1=%d' % self._reserved1)
 
         # Decide on the has_xtr_site_id value
         has_xtr_site_id = bool(self.xtr_id or self.site_id or self.for_rtr)
@@ -293,7 +272,7 @@ class MapRegisterMessage(ControlMessage):
                                                     self.for_rtr))
 
         # Add reserved bits
-        bitstream += self._reserved2
+        bitstream += BitArray('uint:15=%d' % self._reserved2)
 
         # Add the rest of the flags
         bitstream += BitArray('bool=%d' % self.want_map_notify)
@@ -305,10 +284,10 @@ class MapRegisterMessage(ControlMessage):
         bitstream += BitArray(bytes=self.nonce)
 
         # Add the key-id and authentication data
-        bitstream += BitArray('uint:16=%d, uint:16=%d, hex=%s'
+        bitstream += BitArray('uint:16=%d, uint:16=%d'
                               % (self.key_id,
-                                 len(self.authentication_data),
-                                 self.authentication_data.encode('hex')))
+                                 len(self.authentication_data)))
+        bitstream += BitArray(bytes=self.authentication_data)
 
         # Add the map-reply records
         for record in self.records:
@@ -319,7 +298,90 @@ class MapRegisterMessage(ControlMessage):
             bitstream += BitArray('uint:128=%d, uint:64=%d' % (self.xtr_id,
                                                                self.site_id))
 
-        return bitstream.bytes
+        return bitstream
+
+    @classmethod
+    def from_buffer(cls, data, offset=0):
+        '''
+        Parse the given packet with the struct codec
+        '''
+        packet = cls()
+        start = offset
+
+        (flags, packet.nonce, packet.key_id,
+         data_length) = unpack_from(_header_format, data, offset)
+        offset += _header_format.size
+
+        # Check the message type
+        if flags >> 28 != packet.message_type:
+            msg = 'Invalid bitstream for a {0} packet'
+            class_name = packet.__class__.__name__
+            raise ValueError(msg.format(class_name))
+
+        # Read the flags
+        packet.proxy_map_reply = bool(flags & 0x08000000)
+        packet._reserved1 = (flags >> 26) & 0x1
+        has_xtr_site_id = bool(flags & 0x02000000)
+        packet.for_rtr = bool(flags & 0x01000000)
+        packet._reserved2 = (flags >> 9) & 0x7fff
+        packet.want_map_notify = bool(flags & 0x00000100)
+        record_count = flags & 0xff
+
+        # Read the authentication data
+        packet.authentication_data, offset = codec.read_bytes(data, offset,
+                                                              data_length)
+
+        # Read the records
+        for dummy in range(record_count):
+            record, offset = MapRegisterRecord.from_buffer(data, offset)
+            packet.records.append(record)
+
+        # Read the xtr-id and site-id
+        if has_xtr_site_id:
+            (xtr_id_high, xtr_id_low,
+             packet.site_id) = unpack_from(_xtr_site_id_format, data, offset)
+            packet.xtr_id = (xtr_id_high << 64) | xtr_id_low
+            offset += _xtr_site_id_format.size
+
+        # Verify that the properties make sense
+        packet.sanitize()
+
+        # Keep the received bytes for verifying the authentication data
+        packet.set_wire_data(sub_buffer(data, start, offset - start))
+
+        return packet
+
+    def to_buffer(self):
+        '''
+        Create bytes from properties with the struct codec
+        '''
+        # Verify that properties make sense
+        self.sanitize()
+
+        has_xtr_site_id = bool(self.xtr_id or self.site_id or self.for_rtr)
+
+        flags = (self.message_type << 28
+                 | self.proxy_map_reply << 27
+                 | self._reserved1 << 26
+                 | has_xtr_site_id << 25
+                 | self.for_rtr << 24
+                 | self._reserved2 << 9
+                 | self.want_map_notify << 8
+                 | len(self.records))
+
+        parts = [_header_format.pack(flags, self.nonce, self.key_id,
+                                     len(self.authentication_data)),
+                 self.authentication_data]
+
+        for record in self.records:
+            parts.append(record.to_buffer())
+
+        if has_xtr_site_id:
+            parts.append(_xtr_site_id_format.pack(self.xtr_id >> 64,
+                                                  self.xtr_id & 0xffffffffffffffff,
+                                                  self.site_id))
+
+        return ''.join(parts)
 
 
 # Register this class in the registry
@@ -3,14 +3,20 @@ Created on 6 jan. 2013
 
 @author: sander
 '''
-from bitstring import ConstBitStream, BitArray, Bits
+from bitstring import BitArray
 from pylisp.packet.lisp.control import type_registry, ControlMessage, \
-    MapReplyRecord
+    MapReplyRecord, codec
+from pylisp.utils.buffers import unpack_from
+import struct
 
 
 __all__ = ['MapReplyMessage']
 
 
+# Type, flags, reserved bits, record count and nonce
+_header_format = struct.Struct('!I8s')
+
+
 class MapReplyMessage(ControlMessage):
     # Class property: which message type do we represent?
     message_type = 2
@@ -30,7 +36,7 @@ class MapReplyMessage(ControlMessage):
         self.records = records or []
 
         # Store space for reserved bits
-        self._reserved1 = BitArray(17)
+        self._reserved1 = 0
 
     def sanitize(self):
         '''
@@ -83,18 +89,14 @@ class MapReplyMessage(ControlMessage):
             record.sanitize()
 
     @classmethod
-    def from_bytes(cls, bitstream):
+    def from_bitstream(cls, bitstream):
         '''
-        Parse the given packet and update properties accordingly
+        Parse the given packet with the bitstring codec
         '''
         packet = cls()
 
         # Convert to ConstBitStream (if not already provided)
-        if not isinstance(bitstream, ConstBitStream):
-            if isinstance(bitstream, Bits):
-                bitstream = ConstBitStream(auto=bitstream)
-            else:
-                bitstream = ConstBitStream(bytes=bitstream)
+        bitstream = codec.as_bitstream(bitstream)
 
         # Read the type
         type_nr = bitstream.read('uint:4')
@@ -109,7 +111,7 @@ class MapReplyMessage(ControlMessage):
          packet.security) = bitstream.readlist('3*bool')
 
         # Skip reserved bits
-        packet._reserved1 = bitstream.read(17)
+        packet._reserved1 = bitstream.read('uint:17')
 
         # Store the record count until we need it
         record_count = bitstream.read('uint:8')
@@ -119,7 +121,7 @@ class MapReplyMessage(ControlMessage):
 
         # Read the records
         for dummy in range(record_count):
-            record = MapReplyRecord.from_bytes(bitstream)
+            record = MapReplyRecord.from_bitstream(bitstream)
             packet.records.append(record)
 
         # If the security flag is set then there should be security data left
@@ -133,9 +135,9 @@ class MapReplyMessage(ControlMessage):
 
         return packet
 
-    def to_bytes(self):
+    def to_bitstream(self):
         '''
-        Create bytes from properties
+        Create a bitstream from properties with the bitstring codec
         '''
         # Verify that properties make sense
         self.sanitize()
@@ -150,7 +152,7 @@ class MapReplyMessage(ControlMessage):
                                  self.security))
 
         # Add padding
-        bitstream += self._reserved1
+        bitstream += BitArray('uint:17=%d' % self._reserved1)
 
         # Add record count
         bitstream += BitArray('uint:8=%d' % len(self.records))
@@ -173,7 +175,75 @@ class MapReplyMessage(ControlMessage):
             raise NotImplementedError('Handling security data is not ' +
                                       'implemented yet')
 
-        return bitstream.bytes
+        return bitstream
+
+    @classmethod
+    def from_buffer(cls, data, offset=0):
+        '''
+        Parse the given packet with the struct codec
+        '''
+        packet = cls()
+
+        (flags, packet.nonce) = unpack_from(_header_format, data, offset)
+        offset += _header_format.size
+
+        # Check the message type
+        if flags >> 28 != packet.message_type:
+            msg = 'Invalid bitstream for a {0} packet'
+            class_name = packet.__class__.__name__
+            raise ValueError(msg.format(class_name))
+
+        # Read the flags
+        packet.probe = bool(flags & 0x08000000)
+        packet.enlra_enabled = bool(flags & 0x04000000)
+        packet.security = bool(flags & 0x02000000)
+        packet._reserved1 = (flags >> 8) & 0x1ffff
+        record_count = flags & 0xff
+
+        # Read the records
+        for dummy in range(record_count):
+            record, offset = MapReplyRecord.from_buffer(data, offset)
+            packet.records.append(record)
+
+        # If the security flag is set then there should be security data here
+        # TODO: deal with security flag [LISP-Security]
+        if packet.security:
+            raise NotImplementedError('Handling security data is not ' +
+                                      'implemented yet')
+
+        # Verify that the properties make sense
+        packet.sanitize()
+
+        return packet
+
+    def to_buffer(self):
+        '''
+        Create bytes from properties with the struct codec
+        '''
+        # Verify that properties make sense
+        self.sanitize()
+
+        # If the security flag is set then there should be security data here
+        # TODO: deal with security flag [LISP-Security]
+        if self.security:
+            raise NotImplementedError('Handling security data is not ' +
+                                      'implemented yet')
+
+        flags = (self.message_type << 28
+                 | self.probe << 27
+                 | self.enlra_enabled << 26
+                 | self.security << 25
+                 | self._reserved1 << 8
+                 | len(self.records))
+
+        # Pad short nonces with zeroes at the front
+        nonce = bytes(self.nonce).rjust(8, '\x00')
+
+        parts = [_header_format.pack(flags, nonce)]
+        for record in self.records:
+            parts.append(record.to_buffer())
+
+        return ''.join(parts)
 
 
 # Register this class in the registry
@@ -3,18 +3,26 @@ Created on 6 jan. 2013
 
 @author: sander
 '''
-from bitstring import ConstBitStream, BitArray, Bits
+from bitstring import BitArray, Bits
 from ipaddress import IPv4Network, IPv6Network
-from pylisp.packet.lisp.control import LocatorRecord
+from pylisp.packet.lisp.control import LocatorRecord, codec
 from pylisp.utils.afi import read_afi_address_from_bitstream, \
-    get_bitstream_for_afi_address
+    get_bitstream_for_afi_address, read_afi_address_from_buffer, \
+    get_bytes_for_afi_address
+from pylisp.utils.buffers import unpack_from
 from pylisp.utils.represent import represent
 import numbers
+import struct
 
 
 __all__ = ['MapReplyRecord']
 
 
+# TTL, locator count, EID mask length, action, flag, reserved bits and the
+# map version
+_header_format = struct.Struct('!IBBI')
+
+
 class MapReplyRecord(object):
     # The actions defined are used by an ITR or PITR when a
     # destination EID matches a negative mapping cache entry.
@@ -51,7 +59,7 @@ class MapReplyRecord(object):
         self.locator_records = list(locator_records or [])
 
         # Store space for reserved bits
-        self._reserved1 = BitArray(12 + 4)
+        self._reserved1 = 0
 
     def __repr__(self):
         return represent(self.__class__.__name__, self.__dict__)
@@ -143,14 +151,21 @@ class MapReplyRecord(object):
         '''
         Parse the given record and update properties accordingly
         '''
+        if isinstance(bitstream, Bits) or not codec.USE_STRUCT_CODEC:
+            return cls.from_bitstream(bitstream)
+
+        record, dummy = cls.from_buffer(codec.as_buffer(bitstream))
+        return record
+
+    @classmethod
+    def from_bitstream(cls, bitstream):
+        '''
+        Parse the given record with the bitstring codec
+        '''
         record = cls()
 
         # Convert to ConstBitStream (if not already provided)
-        if not isinstance(bitstream, ConstBitStream):
-            if isinstance(bitstream, Bits):
-                bitstream = ConstBitStream(auto=bitstream)
-            else:
-                bitstream = ConstBitStream(bytes=bitstream)
+        bitstream = codec.as_bitstream(bitstream)
 
         # Read the record TTL
         record.ttl = bitstream.read('uint:32')
@@ -168,7 +183,7 @@ class MapReplyRecord(object):
         record.authoritative = bitstream.read('bool')
 
         # Read reserved bits
-        record._reserved1 = bitstream.read(12 + 4)
+        record._reserved1 = bitstream.read('uint:16')
 
         # Read the map version
         record.map_version = bitstream.read('uint:12')
@@ -179,7 +194,7 @@ class MapReplyRecord(object):
 
         # Read the locator records
         for dummy in range(locator_record_count):
-            locator_record = LocatorRecord.from_bytes(bitstream)
+            locator_record = LocatorRecord.from_bitstream(bitstream)
             record.locator_records.append(locator_record)
 
         # Verify that the properties make sense
@@ -187,11 +202,66 @@ class MapReplyRecord(object):
 
         return record
 
+    @classmethod
+    def from_buffer(cls, data, offset=0):
+        '''
+        Parse the record at the given offset with the struct codec. Returns
+        the record and the offset of the first byte after it.
+        '''
+        record = cls()
+
+        (record.ttl, locator_record_count, eid_prefix_len,
+         flags) = unpack_from(_header_format, data, offset)
+
+        record.action = flags >> 29
+        record.authoritative = bool(flags & 0x10000000)
+        record._reserved1 = (flags >> 12) & 0xffff
+        record.map_version = flags & 0xfff
+
+        # Read the EID prefix
+        record.eid_prefix, offset = read_afi_address_from_buffer(data,
+                                                                 offset + 10,
+                                                                 eid_prefix_len)
+
+        # Read the locator records
+        for dummy in range(locator_record_count):
+            locator_record, offset = LocatorRecord.from_buffer(data, offset)
+            record.locator_records.append(locator_record)
+
+        # Verify that the properties make sense
+        record.sanitize()
+
+        return record, offset
+
     def to_bytes(self):
         '''
         Create bytes from properties
         '''
-        return self.to_bitstream().bytes
+        if codec.USE_STRUCT_CODEC:
+            return self.to_buffer()
+        else:
+            return self.to_bitstream().bytes
+
+    def to_buffer(self):
+        '''
+        Create bytes from properties with the struct codec
+        '''
+        # Verify that properties make sense
+        self.sanitize()
+
+        flags = (self.action << 29
+                 | self.authoritative << 28
+                 | self._reserved1 << 12
+                 | self.map_version)
+
+        parts = [_header_format.pack(self.ttl, len(self.locator_records),
+                                     self.eid_prefix.prefixlen, flags),
+                 get_bytes_for_afi_address(self.eid_prefix)]
+
+        for locator_record in self.locator_records:
+            parts.append(locator_record.to_buffer())
+
+        return ''.join(parts)
 
     def to_bitstream(self):
         '''
@@ -216,7 +286,7 @@ class MapReplyRecord(object):
         bitstream += BitArray('bool=%d' % self.authoritative)
 
         # Add reserved bits
-        bitstream += self._reserved1
+        bitstream += BitArray('uint:16=%d' % self._reserved1)
 
         # Add the map version
         bitstream += BitArray('uint:12=%d' % self.map_version)
@@ -3,19 +3,26 @@ Created on 6 jan. 2013
 
 @author: sander
 '''
-from bitstring import ConstBitStream, BitArray, Bits
+from bitstring import BitArray
 from ipaddress import IPv4Address, IPv6Address, IPv4Network, IPv6Network, \
     ip_network
 from pylisp.packet.lisp.control import type_registry, ControlMessage, \
-    MapReplyRecord
+    MapReplyRecord, codec
 from pylisp.utils.afi import read_afi_address_from_bitstream, \
-    get_bitstream_for_afi_address
+    get_bitstream_for_afi_address, read_afi_address_from_buffer, \
+    get_bytes_for_afi_address
+from pylisp.utils.buffers import unpack_from
 from pylisp.utils.lcaf.base import LCAFAddress
+import struct
 
 
 __all__ = ['MapRequestMessage']
 
 
+# Type, flags, reserved bits, IRC, record count and nonce
+_header_format = struct.Struct('!I8s')
+
+
 class MapRequestMessage(ControlMessage):
     # Class property: which message type do we represent?
     message_type = 1
@@ -42,7 +49,7 @@ class MapRequestMessage(ControlMessage):
         self.map_reply = map_reply
 
         # Store space for reserved bits
-        self._reserved1 = BitArray(9)
+        self._reserved1 = 0
 
     def sanitize(self):
         '''
@@ -180,44 +187,14 @@ class MapRequestMessage(ControlMessage):
             self.map_reply.sanitize()
 
     @classmethod
-    def from_bytes(cls, bitstream):
-        r'''
-        Parse the given packet and update properties accordingly
-
-        >>> data_hex = ('13000001ae92b5574f849cd00001ac10'
-        ...             '1f0300015cfe1cbd00200001ac101f01')
-        >>> data = data_hex.decode('hex')
-        >>> message = ControlMessage.from_bytes(data)
-        >>> message.message_type
-        1
-        >>> message.authoritative
-        False
-        >>> message.probe
-        True
-        >>> message.smr
-        True
-        >>> message.pitr
-        False
-        >>> message.smr_invoked
-        False
-        >>> message.nonce
-        '\xae\x92\xb5WO\x84\x9c\xd0'
-        >>> message.source_eid
-        IPv4Address(u'172.16.31.3')
-        >>> message.itr_rlocs
-        [IPv4Address(u'92.254.28.189')]
-        >>> message.eid_prefixes
-        [IPv4Network(u'172.16.31.1/32')]
-        >>> message.map_reply
+    def from_bitstream(cls, bitstream):
+        '''
+        Parse the given packet with the bitstring codec
         '''
         packet = cls()
 
         # Convert to ConstBitStream (if not already provided)
-        if not isinstance(bitstream, ConstBitStream):
-            if isinstance(bitstream, Bits):
-                bitstream = ConstBitStream(auto=bitstream)
-            else:
-                bitstream = ConstBitStream(bytes=bitstream)
+        bitstream = codec.as_bitstream(bitstream)
 
         # Read the message type
         type_nr = bitstream.read('uint:4')
@@ -235,7 +212,7 @@ class MapRequestMessage(ControlMessage):
          packet.smr_invoked) = bitstream.readlist('6*bool')
 
         # Skip over reserved bits
-        packet._reserved1 = bitstream.read(9)
+        packet._reserved1 = bitstream.read('uint:9')
 
         # Save the IRC until we reach the actual data
         irc = bitstream.read('uint:5')
@@ -268,24 +245,16 @@ class MapRequestMessage(ControlMessage):
 
         # Read the map-reply record if present
         if map_data_present:
-            packet.map_reply = MapReplyRecord.from_bytes(bitstream)
+            packet.map_reply = MapReplyRecord.from_bitstream(bitstream)
 
         # Verify that the properties make sense
         packet.sanitize()
 
         return packet
 
-    def to_bytes(self):
-        r'''
-        Create bytes from properties
-
-        >>> message = MapRequestMessage(itr_rlocs=[IPv4Address(u'192.0.2.1')],
-        ...                       eid_prefixes=[IPv6Network(u'2001:db8::/32')])
-        >>> hex = message.to_bytes().encode('hex')
-        >>> hex[:40]
-        '10000001000000000000000000000001c0000201'
-        >>> hex[40:]
-        '0020000220010db8000000000000000000000000'
+    def to_bitstream(self):
+        '''
+        Create a bitstream from properties with the bitstring codec
         '''
         # Verify that properties make sense
         self.sanitize()
@@ -303,7 +272,7 @@ class MapRequestMessage(ControlMessage):
                                                     self.smr_invoked))
 
         # Add padding
-        bitstream += self._reserved1
+        bitstream += BitArray('uint:9=%d' % self._reserved1)
 
         # Add IRC
         bitstream += BitArray('uint:5=%d' % (len(self.itr_rlocs) - 1))
@@ -337,7 +306,135 @@ class MapRequestMessage(ControlMessage):
         if self.map_reply is not None:
             bitstream += self.map_reply.to_bitstream()
 
-        return bitstream.bytes
+        return bitstream
+
+    @classmethod
+    def from_buffer(cls, data, offset=0):
+        r'''
+        Parse the given packet and update properties accordingly
+
+        >>> data_hex = ('13000001ae92b5574f849cd00001ac10'
+        ...             '1f0300015cfe1cbd00200001ac101f01')
+        >>> data = data_hex.decode('hex')
+        >>> message = ControlMessage.from_bytes(data)
+        >>> message.message_type
+        1
+        >>> message.authoritative
+        False
+        >>> message.probe
+        True
+        >>> message.smr
+        True
+        >>> message.pitr
+        False
+        >>> message.smr_invoked
+        False
+        >>> message.nonce
+        '\xae\x92\xb5WO\x84\x9c\xd0'
+        >>> message.source_eid
+        IPv4Address(u'172.16.31.3')
+        >>> message.itr_rlocs
+        [IPv4Address(u'92.254.28.189')]
+        >>> message.eid_prefixes
+        [IPv4Network(u'172.16.31.1/32')]
+        >>> message.map_reply
+        '''
+        packet = cls()
+
+        (flags, packet.nonce) = unpack_from(_header_format, data, offset)
+        offset += _header_format.size
+
+        # Check the message type
+        if flags >> 28 != packet.message_type:
+            msg = 'Invalid bitstream for a {0} packet'
+            class_name = packet.__class__.__name__
+            raise ValueError(msg.format(class_name))
+
+        # Read the flags
+        packet.authoritative = bool(flags & 0x08000000)
+        map_data_present = bool(flags & 0x04000000)
+        packet.probe = bool(flags & 0x02000000)
+        packet.smr = bool(flags & 0x01000000)
+        packet.pitr = bool(flags & 0x00800000)
+        packet.smr_invoked = bool(flags & 0x00400000)
+        packet._reserved1 = (flags >> 13) & 0x1ff
+        irc = (flags >> 8) & 0x1f
+        record_count = flags & 0xff
+
+        # Read the source EID
+        packet.source_eid, offset = read_afi_address_from_buffer(data, offset)
+
+        # Read the ITR RLOCs
+        for dummy in range(irc + 1):
+            itr_rloc, offset = read_afi_address_from_buffer(data, offset)
+            packet.itr_rlocs.append(itr_rloc)
+
+        # Read the EIDs
+        for dummy in range(record_count):
+            # A record begins with 8 reserved bits and the prefix length
+            prefix_len = ord(codec.read_bytes(data, offset + 1, 1)[0])
+
+            # Then an AFI style prefix
+            eid_prefix, offset = read_afi_address_from_buffer(data, offset + 2,
+                                                              prefix_len)
+            packet.eid_prefixes.append(eid_prefix)
+
+        # Read the map-reply record if present
+        if map_data_present:
+            packet.map_reply, offset = MapReplyRecord.from_buffer(data, offset)
+
+        # Verify that the properties make sense
+        packet.sanitize()
+
+        return packet
+
+    def to_buffer(self):
+        r'''
+        Create bytes from properties
+
+        >>> message = MapRequestMessage(itr_rlocs=[IPv4Address(u'192.0.2.1')],
+        ...                       eid_prefixes=[IPv6Network(u'2001:db8::/32')])
+        >>> hex = message.to_bytes().encode('hex')
+        >>> hex[:40]
+        '10000001000000000000000000000001c0000201'
+        >>> hex[40:]
+        '0020000220010db8000000000000000000000000'
+        '''
+        # Verify that properties make sense
+        self.sanitize()
+
+        flags = (self.message_type << 28
+                 | self.authoritative << 27
+                 | (self.map_reply is not None) << 26
+                 | self.probe << 25
+                 | self.smr << 24
+                 | self.pitr << 23
+                 | self.smr_invoked << 22
+                 | self._reserved1 << 13
+                 | (len(self.itr_rlocs) - 1) << 8
+                 | len(self.eid_prefixes))
+
+        parts = [_header_format.pack(flags, self.nonce),
+                 get_bytes_for_afi_address(self.source_eid)]
+
+        # Add the ITR RLOCs
+        for itr_rloc in self.itr_rlocs:
+            parts.append(get_bytes_for_afi_address(itr_rloc))
+
+        # Add the EIDs
+        for eid_prefix in self.eid_prefixes:
+            # Make sure it is a network
+            eid_prefix = ip_network(eid_prefix)
+
+            # Add padding, prefix length and the address
+            parts.append(chr(0) + chr(eid_prefix.prefixlen))
+            parts.append(get_bytes_for_afi_address(eid_prefix))
+
+        # Add the map-reply record if present
+        if self.map_reply is not None:
+            parts.append(self.map_reply.to_buffer())
+
+        return ''.join(parts)
 
 
 # Register this class in the registry
@@ -4,13 +4,25 @@ Created on 5 jan. 2013
 @author: sander
 '''
 from bitstring import ConstBitStream, BitArray, Bits
+from ipaddress import IPv4Address, IPv6Address
 from pylisp.packet.ip.ipv4 import IPv4Packet
 from pylisp.packet.ip.ipv6.base import IPv6Packet
 from pylisp.packet.ip.protocol import ProtocolElement
+from pylisp.utils.buffers import BufferView, as_buffer, sub_buffer, unpack_from
 import collections
 import numbers
+import struct
 
-__all__ = ['DataPacket']
+__all__ = ['DataPacket', 'DataHeaderTemplate', 'LazyDataPacket']
+
+
+_header_format = struct.Struct('!II')
+_word_format = struct.Struct('!I')
+
+# The addresses in the inner IP header, with IPv6 addresses split in 64-bit
+# halves
+_ipv4_addresses_format = struct.Struct('!II')
+_ipv6_addresses_format = struct.Struct('!QQQQ')
 
 
 class DataPacket(ProtocolElement):
@@ -133,6 +145,17 @@ class DataPacket(ProtocolElement):
         ... # doctest: +ELLIPSIS
         'E\xc0\x00X5@\x00\x00\xff\x06\tJ%M8...\xdd\xa4%\x88\x01'
         '''
+        if isinstance(bitstream, Bits):
+            return cls.from_bitstream(bitstream, decode_payload)
+        else:
+            return cls.from_buffer(as_buffer(bitstream),
+                                   decode_payload=decode_payload)
+
+    @classmethod
+    def from_bitstream(cls, bitstream, decode_payload=True):
+        '''
+        Parse the given packet with bitstring
+        '''
         packet = cls()
 
         # Convert to ConstBitStream (if not already provided)
@@ -149,6 +172,9 @@ class DataPacket(ProtocolElement):
          map_version_present,
          instance_id_present) = bitstream.readlist('5*bool')
 
+        # The E bit has no meaning without a nonce
+        packet.echo_nonce_request = packet.echo_nonce_request and nonce_present
+
         # Skip over reserved bits
         bitstream.read(3)
 
@@ -210,6 +236,63 @@ class DataPacket(ProtocolElement):
 
         return packet
 
+    @classmethod
+    def from_buffer(cls, data, offset=0, decode_payload=True):
+        '''
+        Parse the given packet in place
+        '''
+        packet = cls()
+
+        first_word, second_word = unpack_from(_header_format, data, offset)
+
+        # Read the flags
+        flags = first_word >> 24
+
+        # The E bit has no meaning without a nonce
+        packet.echo_nonce_request = bool(flags & 0x20) and bool(flags & 0x80)
+
+        # Parse nonce or map versions
+        if flags & 0x80:
+            # Nonce: yes, versions: no
+            packet.nonce = bytes(sub_buffer(data, offset + 1, 3))
+        elif flags & 0x10:
+            # Nonce: no, versions: yes
+            packet.source_map_version = (first_word >> 12) & 0xfff
+            packet.destination_map_version = first_word & 0xfff
+
+        # Parse instance-id
+        if flags & 0x08:
+            packet.instance_id = second_word >> 8
+
+            # 8 bits remaining for LSB
+            lsb_bits = 8
+        else:
+            # 32 bits remaining for LSB
+            lsb_bits = 32
+
+        # Parse LSBs, least significant locator-bit first
+        if flags & 0x40:
+            packet.lsb = [bool(second_word & (1 << bit))
+                          for bit in range(lsb_bits)]
+
+        # The rest of the packet is payload
+        remaining = sub_buffer(data, offset + _header_format.size)
+
+        # Parse IP packet
+        if len(remaining):
+            ip_version = ord(remaining[0]) >> 4
+            if ip_version == 4:
+                packet.payload = IPv4Packet.from_buffer(remaining, decode_payload=decode_payload)
+            elif ip_version == 6:
+                packet.payload = IPv6Packet.from_buffer(remaining, decode_payload=decode_payload)
+            else:
+                packet.payload = BufferView(remaining)
+
+        # Verify that the properties make sense
+        packet.sanitize()
+
+        return packet
+
     def to_bytes(self):
         r'''
         Create bytes from properties
@@ -264,3 +347,268 @@ class DataPacket(ProtocolElement):
             bitstream += BitArray(lsb_bits)
 
         return bitstream.bytes + bytes(self.payload)
+
+
+class DataHeaderTemplate(object):
+    r'''
+    A prebuilt LISP data header for encapsulating many packets. The header is
+    encoded once, and the nonce, map versions and locator status bits are
+    patched into it in place, so sending a packet doesn't need a DataPacket
+    or bitstring.
+
+    >>> template = DataHeaderTemplate(nonce='\x00\x00\x00', instance_id=1234)
+    >>> template.set_nonce('XyZ')
+    >>> template.encapsulate('SomeDummyPayloadData')
+    '\x88XyZ\x00\x04\xd2\x00SomeDummyPayloadData'
+    >>> template = DataHeaderTemplate(source_map_version=0,
+    ...                               destination_map_version=0,
+    ...                               lsb=[False] * 32)
+    >>> template.set_map_versions(1, 4095)
+    >>> template.set_lsb(0x5)
+    >>> template.to_bytes()
+    'P\x00\x1f\xff\x00\x00\x00\x05'
+    '''
+    __slots__ = ('header', '_bytes')
+
+    def __init__(self, echo_nonce_request=False, nonce=None,
+                 source_map_version=None, destination_map_version=None,
+                 lsb=None, instance_id=None):
+        '''
+        Constructor, the flags are set by which of the fields are present
+        '''
+        packet = DataPacket(echo_nonce_request=echo_nonce_request,
+                            nonce=nonce,
+                            source_map_version=source_map_version,
+                            destination_map_version=destination_map_version,
+                            lsb=lsb,
+                            instance_id=instance_id)
+        self.header = bytearray(packet.to_bytes())
+        self._bytes = bytes(self.header)
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, self.to_bytes())
+
+    def set_nonce(self, nonce):
+        '''
+        Patch a 3 byte nonce into the header
+        '''
+        if not self.header[0] & 0x80:
+            raise ValueError('Template has no nonce')
+
+        if not isinstance(nonce, bytes) or len(nonce) != 3:
+            raise ValueError('Nonce must be a sequence of 3 bytes')
+
+        self.header[1:4] = nonce
+        self._bytes = None
+
+    def set_map_versions(self, source_map_version, destination_map_version):
+        '''
+        Patch the source and destination map versions into the header
+        '''
+        if not self.header[0] & 0x10 or self.header[0] & 0x80:
+            raise ValueError('Template has no map versions')
+
+        if not 0 <= source_map_version < 2 ** 12 \
+        or not 0 <= destination_map_version < 2 ** 12:
+            raise ValueError('Invalid map version')
+
+        _word_format.pack_into(self.header, 0, (self.header[0] << 24) |
+                                               (source_map_version << 12) |
+                                               destination_map_version)
+        self._bytes = None
+
+    def set_lsb(self, lsb):
+        '''
+        Patch the locator status bits into the header. They are given as an
+        integer with the first locator in the least significant bit.
+        '''
+        if not self.header[0] & 0x40:
+            raise ValueError('Template has no locator status bits')
+
+        if self.header[0] & 0x08:
+            # 8 bits next to the instance-id
+            if not 0 <= lsb < 2 ** 8:
+                raise ValueError('Invalid locator status bits')
+            self.header[7] = lsb
+        else:
+            if not 0 <= lsb < 2 ** 32:
+                raise ValueError('Invalid locator status bits')
+            _word_format.pack_into(self.header, 4, lsb)
+
+        self._bytes = None
+
+    def to_bytes(self):
+        '''
+        The header as it currently is
+        '''
+        if self._bytes is None:
+            self._bytes = bytes(self.header)
+        return self._bytes
+
+    def encapsulate(self, payload):
+        '''
+        Put the header in front of an IP packet
+        '''
+        return self.to_bytes() + payload
+
+
+class LazyDataPacket(ProtocolElement):
+    r'''
+    A received LISP data packet that is only decoded as far as necessary. The
+    LISP header fields and the addresses of the inner IP packet are decoded
+    when they are accessed, and the inner packet can be forwarded as it was
+    received without parsing and re-encoding it.
+
+    >>> data_hex = ('c033d3c10000000745c0005835400000'
+    ...             'ff06094a254d38204d45d1a30016f597'
+    ...             'a1c3c7406718bf1b50180ff0793f0000'
+    ...             'b555e59ff5ba6aad33d875c600fd8c1f'
+    ...             'c5268078f365ee199179fbd09d09d690'
+    ...             '193622a6b70bcbc7bf5f20dda4258801')
+    >>> data = data_hex.decode('hex')
+    >>> message = LazyDataPacket.from_bytes(data)
+    >>> message.nonce
+    '3\xd3\xc1'
+    >>> message.inner_version
+    4
+    >>> message.inner_destination
+    IPv4Address(u'77.69.209.163')
+    >>> message.inner_packet == data[8:]
+    True
+    '''
+
+    def __init__(self, data):
+        '''
+        Constructor
+        '''
+        self._data = as_buffer(data)
+        self._first_word, self._second_word = unpack_from(_header_format,
+                                                          self._data)
+        self._payload = None
+
+    def __repr__(self):
+        return ('%s(nonce=%r, source_map_version=%r, '
+                'destination_map_version=%r, instance_id=%r, '
+                'inner_source=%r, inner_destination=%r)'
+                % (self.__class__.__name__, self.nonce,
+                   self.source_map_version, self.destination_map_version,
+                   self.instance_id, self.inner_source,
+                   self.inner_destination))
+
+    def __len__(self):
+        return len(self._data)
+
+    @property
+    def _flags(self):
+        return self._first_word >> 24
+
+    @property
+    def echo_nonce_request(self):
+        # The E bit has no meaning without a nonce
+        return bool(self._flags & 0x20) and bool(self._flags & 0x80)
+
+    @property
+    def nonce(self):
+        if self._flags & 0x80:
+            return bytes(sub_buffer(self._data, 1, 3))
+
+    @property
+    def source_map_version(self):
+        if self._flags & 0x10 and not self._flags & 0x80:
+            return (self._first_word >> 12) & 0xfff
+
+    @property
+    def destination_map_version(self):
+        if self._flags & 0x10 and not self._flags & 0x80:
+            return self._first_word & 0xfff
+
+    @property
+    def instance_id(self):
+        if self._flags & 0x08:
+            return self._second_word >> 8
+
+    @property
+    def lsb(self):
+        if self._flags & 0x40:
+            lsb_bits = self._flags & 0x08 and 8 or 32
+            return [bool(self._second_word & (1 << bit))
+                    for bit in range(lsb_bits)]
+
+    @property
+    def inner_packet(self):
+        '''
+        The encapsulated packet as it was received
+        '''
+        return BufferView(sub_buffer(self._data, _header_format.size))
+
+    @property
+    def inner_version(self):
+        '''
+        The IP version of the encapsulated packet, or None if there is no
+        encapsulated IP packet
+        '''
+        if len(self._data) > _header_format.size:
+            version = ord(self._data[_header_format.size]) >> 4
+            if version in (4, 6):
+                return version
+
+    def _inner_addresses(self):
+        offset = _header_format.size
+        version = self.inner_version
+        if version == 4:
+            addresses = unpack_from(_ipv4_addresses_format, self._data,
+                                    offset + 12)
+            return IPv4Address, addresses
+        elif version == 6:
+            (source_high, source_low,
+             destination_high,
+             destination_low) = unpack_from(_ipv6_addresses_format,
+                                            self._data, offset + 8)
+            addresses = ((source_high << 64) | source_low,
+                         (destination_high << 64) | destination_low)
+            return IPv6Address, addresses
+        else:
+            raise ValueError('Payload is not an IP packet')
+
+    @property
+    def inner_source(self):
+        address_class, addresses = self._inner_addresses()
+        return address_class(addresses[0])
+
+    @property
+    def inner_destination(self):
+        address_class, addresses = self._inner_addresses()
+        return address_class(addresses[1])
+
+    @property
+    def payload(self):
+        '''
+        The fully decoded payload, like DataPacket.payload
+        '''
+        if self._payload is None:
+            self._payload = self.decode().payload
+        return self._payload
+
+    def decode(self):
+        '''
+        Fully decode the packet into a DataPacket
+        '''
+        return DataPacket.from_buffer(self._data)
+
+    def sanitize(self):
+        '''
+        Nothing to check, the view can not be changed
+        '''
+
+    @classmethod
+    def from_bytes(cls, data):
+        '''
+        Create a view on the given packet
+        '''
+        return cls(data)
+
+    def to_bytes(self):
+        '''
+        Return the packet as it was received
+        '''
+        return bytes(self._data)
@@ -6,6 +6,8 @@ Created on 6 jan. 2013
 from bitstring import BitArray, ConstBitStream, Bits
 from ipaddress import IPv4Address, IPv6Address, IPv4Network, IPv6Network, \
     ip_network
+from pylisp.utils.buffers import unpack_from
+import struct
 
 
 # Constants
@@ -14,6 +16,19 @@ IPv4 = 1
 IPv6 = 2
 LCAF = 16387
 
+# Precompiled formats for the struct based functions
+_afi_format = struct.Struct('!H')
+_ipv4_format = struct.Struct('!I')
+_ipv6_format = struct.Struct('!QQ')
+_afi_ipv4_format = struct.Struct('!HI')
+_afi_ipv6_format = struct.Struct('!HQQ')
+_lcaf_header_format = struct.Struct('!BBBBH')
+_lcaf_instance_format = struct.Struct('!HBBBBHI')
+
+# The LCAF type of instance addresses, which are common enough to deserve
+# their own fast path
+_LCAF_INSTANCE = 2
+
 
 def read_afi_address_from_bitstream(bitstream, prefix_len=None):
     '''
@@ -114,3 +129,157 @@ def get_bitstream_for_afi_address(address):
     else:
         # Nobody encoded it...
         raise ValueError('Unsupported address type')
+
+
+def _make_prefix(address_class, network_class, address_int, prefix_len):
+    '''
+    Create a network from an integer address, with the same checks as
+    read_afi_address_from_bitstream.
+    '''
+    max_prefixlen = address_class._max_prefixlen
+    if prefix_len < 0 or prefix_len > max_prefixlen:
+        raise ValueError("invalid prefix length %s for %r"
+                         % (prefix_len, address_class(address_int)))
+
+    host_mask = (1 << (max_prefixlen - prefix_len)) - 1
+    if address_int & host_mask:
+        raise ValueError("invalid prefix length %s for %r"
+                         % (prefix_len, address_class(address_int)))
+
+    return network_class((address_int, prefix_len))
+
+
+def read_afi_address_from_buffer(data, offset=0, prefix_len=None):
+    '''
+    This function decodes an AFI address from a byte buffer. It returns the
+    address and the offset of the first byte after it.
+
+    This is an example of an IPv4 address:
+    >>> afi_address = '0001c00002ab'.decode('hex')
+    >>> read_afi_address_from_buffer(afi_address)
+    (IPv4Address(u'192.0.2.171'), 6)
+
+    If a prefix length is provided then a prefix is returned:
+    >>> afi_address = 'ff0001c0000200'.decode('hex')
+    >>> read_afi_address_from_buffer(afi_address, 1, 24)
+    (IPv4Network(u'192.0.2.0/24'), 7)
+    '''
+    afi = unpack_from(_afi_format, data, offset)[0]
+    offset += 2
+
+    if afi == Empty:
+        # No address
+        if prefix_len:
+            raise ValueError('Empty AFI addresses can not have prefix_len')
+
+        return None, offset
+
+    elif afi == IPv4:
+        # IPv4 address
+        address_int = unpack_from(_ipv4_format, data, offset)[0]
+        offset += 4
+        if prefix_len is None:
+            return IPv4Address(address_int), offset
+
+        return _make_prefix(IPv4Address, IPv4Network, address_int, prefix_len), offset
+
+    elif afi == IPv6:
+        # IPv6 address
+        high, low = unpack_from(_ipv6_format, data, offset)
+        address_int = (high << 64) | low
+        offset += 16
+        if prefix_len is None:
+            return IPv6Address(address_int), offset
+
+        return _make_prefix(IPv6Address, IPv6Network, address_int, prefix_len), offset
+
+    elif afi == LCAF:
+        from pylisp.utils.lcaf import LCAFAddress, LCAFInstanceAddress
+
+        (dummy, dummy, lcaf_type, rsvd2,
+         length) = unpack_from(_lcaf_header_format, data, offset)
+        end = offset + _lcaf_header_format.size + length
+        if end > len(data):
+            raise ValueError('LCAF address is truncated')
+
+        if lcaf_type == _LCAF_INSTANCE and length >= 4:
+            # Decode instance addresses without a bitstream
+            instance_id = unpack_from(_ipv4_format, data, offset + 6)[0]
+            address, address_end = read_afi_address_from_buffer(data, offset + 10)
+            if address_end != end:
+                raise ValueError('Invalid LCAF instance address length')
+
+            if prefix_len is not None:
+                if isinstance(address, IPv4Address):
+                    address = _make_prefix(IPv4Address, IPv4Network, int(address), prefix_len)
+                elif isinstance(address, IPv6Address):
+                    address = _make_prefix(IPv6Address, IPv6Network, int(address), prefix_len)
+                else:
+                    orig_address = address
+                    address = ip_network(address).supernet(new_prefix=prefix_len)
+                    if address[0] != orig_address:
+                        raise ValueError("invalid prefix length %s for %r"
+                                         % (prefix_len, address))
+
+            lcaf = LCAFInstanceAddress(instance_id=instance_id, address=address,
+                                       iid_mask_len=rsvd2)
+            lcaf.sanitize()
+            return lcaf, end
+
+        # Let the LCAF classes parse the rest
+        bitstream = ConstBitStream(bytes=bytes(data[offset:end]))
+        return LCAFAddress.from_bytes(bitstream, prefix_len), end
+
+    else:
+        raise ValueError('Unable to handle AFI {0}'.format(afi))
+
+
+def get_bytes_for_afi_address(address):
+    '''
+    This function encodes an address as AFI address bytes:
+    >>> get_bytes_for_afi_address(IPv4Network(u'192.0.2.0/24')).encode('hex')
+    '0001c0000200'
+    >>> get_bytes_for_afi_address(None).encode('hex')
+    '0000'
+    '''
+    # No address is AFI 0
+    if address is None:
+        return '\x00\x00'
+
+    # IPv4
+    if isinstance(address, IPv4Address):
+        return _afi_ipv4_format.pack(IPv4, int(address))
+
+    elif isinstance(address, IPv4Network):
+        return _afi_ipv4_format.pack(IPv4, int(address.network_address))
+
+    # IPv6
+    elif isinstance(address, IPv6Address):
+        address_int = int(address)
+        return _afi_ipv6_format.pack(IPv6, address_int >> 64,
+                                     address_int & 0xffffffffffffffff)
+
+    elif isinstance(address, IPv6Network):
+        address_int = int(address.network_address)
+        return _afi_ipv6_format.pack(IPv6, address_int >> 64,
+                                     address_int & 0xffffffffffffffff)
+
+    # Only import LCAF when we need it, pylisp.utils.lcaf imports the packet
+    # classes, which import this module
+    from pylisp.utils.lcaf import LCAFAddress, LCAFInstanceAddress
+
+    if type(address) is LCAFInstanceAddress:
+        # Encode instance addresses without a bitstream
+        address.sanitize()
+        address_bytes = get_bytes_for_afi_address(address.address)
+        return _lcaf_instance_format.pack(LCAF, 0, 0, _LCAF_INSTANCE,
+                                          address.iid_mask_len,
+                                          4 + len(address_bytes),
+                                          address.instance_id) + address_bytes
+
+    elif isinstance(address, LCAFAddress):
+        return _afi_format.pack(LCAF) + bytes(address)
+
+    else:
+        # Nobody encoded it...
+        raise ValueError('Unsupported address type')
@@ -1,12 +1,19 @@
 from ipaddress import IPv4Address, IPv6Address, ip_address
+from pylisp.utils import syscalls
 from pylisp.utils.auto_addresses import AutoAddress
+import errno
 import logging
 import socket
+import weakref
 
 # Get the logger
 logger = logging.getLogger(__name__)
 
 
+# How many socket errors a read may run into before giving up
+RECV_ATTEMPTS = 3
+
+
 class AutoUDPSocket(object):
     def __init__(self, address, port):
         # Convert to IPv*Address if necessary
@@ -18,6 +25,11 @@ class AutoUDPSocket(object):
         self.port = port
         self.family = isinstance(self.address, IPv4Address) and socket.AF_INET or socket.AF_INET6
 
+        # Objects that want to know when the socket is replaced
+        self._rebind_targets = weakref.WeakSet()
+        self._receiver = None
+        self._sender = None
+
         # Bind
         self._sock = None
         self._sock_address = isinstance(self.address, IPv4Address) and IPv4Address(0) or IPv6Address(0)
@@ -34,7 +46,27 @@ class AutoUDPSocket(object):
         logger.info("{0!r} received a notification that our address has changed: rebinding".format(self))
         self.rebind()
 
+    def add_rebind_target(self, rebind_target):
+        self._rebind_targets.add(rebind_target)
+
+    def _send_rebind_notifications(self):
+        for rebind_target in self._rebind_targets:
+            try:
+                rebind_target.on_socket_rebind(self)
+            except:
+                logger.exception("{0!r} rebind target {1!r} has thrown an exception".format(self, rebind_target))
+
     def rebind(self):
+        old_sock = self._sock
+        result = self._rebind()
+
+        # Let others know that the file descriptor has changed
+        if self._sock is not old_sock:
+            self._send_rebind_notifications()
+
+        return result
+
+    def _rebind(self):
         # Don't rebind if nothing changed
         if int(self.address) == int(self._sock_address):
             logger.info("Rebinding of {0!r} not necessary, address hasn't changed".format(self))
@@ -109,6 +141,37 @@ class AutoUDPSocket(object):
             # On exception return an empty response
             return ('', (self._sock_address, 0))
 
+    def recv_batch(self, count, bufsize=65536):
+        '''
+        Receive up to count datagrams without blocking, with a single
+        recvmmsg call where available
+        '''
+        # If we don't have a real socket then return nothing
+        if self._sock is None:
+            return []
+
+        if self._receiver is None and syscalls.have_recvmmsg():
+            self._receiver = syscalls.RecvMMsg(count, bufsize)
+
+        # An error can be pending on the socket, like the port unreachable
+        # from an earlier send to a dead peer. Reading reports and clears it,
+        # so read again to get the datagrams that are still waiting. The
+        # event loop thinks the socket is empty when we return less than it
+        # asked for, so we only give up by raising the error.
+        errors = 0
+        while True:
+            try:
+                return syscalls.recv_batch(self._sock, count, bufsize, self._receiver)
+            except socket.error, e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return []
+
+                errors += 1
+                if errors >= RECV_ATTEMPTS:
+                    raise
+
+                logger.debug("Error when receiving on {0!r}: {1}".format(self, e))
+
     def sendto(self, data, flags, address=None):
         # Handle when only two parameters are provided
         if address is None:
@@ -119,9 +182,27 @@ class AutoUDPSocket(object):
         if self._sock is None:
             return 0
 
-        address = (unicode(address[0]), address[1])
+        address = (syscalls.host_string(address[0]), address[1])
 
         return self._sock.sendto(data, flags, address)
 
+    def send_batch(self, datagrams):
+        '''
+        Send a list of (data, (address, port)) tuples, with a single sendmmsg
+        call where available. Returns how many were sent.
+        '''
+        # Check if we have a real socket
+        if self._sock is None:
+            return 0
+
+        if self._sender is None and syscalls.have_sendmmsg():
+            self._sender = syscalls.SendMMsg(64)
+
+        try:
+            return syscalls.send_batch(self._sock, datagrams, self._sender)
+        except socket.error:
+            logger.exception("Could not send from {0!r}".format(self))
+            return 0
+
     def getsockname(self):
         return self._sock_address, 0
@@ -0,0 +1,136 @@
+'''
+Created on 18 okt. 2026
+
+@author: sander
+
+Helpers to parse packets in place. The parsers slice the original receive
+buffer with read-only buffer objects, so parsing a packet and its payloads
+doesn't copy the data for every layer. Payloads that are not
+decoded are stored as a BufferView, which only materialises the data when
+bytes() or str() is called on it. Because of that the receive buffer must
+not be reused while the parsed packet is alive.
+'''
+from bitstring import Bits
+
+
+__all__ = ['BufferView', 'as_buffer', 'sub_buffer', 'unpack_from']
+
+
+class BufferView(object):
+    '''
+    A read-only view on (part of) a receive buffer. It behaves like the bytes
+    it contains, but doesn't copy them until they are needed.
+
+    >>> view = BufferView(sub_buffer('abcdef', 2, 3))
+    >>> view
+    'cde'
+    >>> view == 'cde', len(view), view[1:]
+    (True, 3, 'de')
+    '''
+    __slots__ = ('_buffer',)
+
+    def __init__(self, data):
+        self._buffer = as_buffer(data)
+
+    def __len__(self):
+        return len(self._buffer)
+
+    def __getitem__(self, item):
+        return self._buffer[item]
+
+    def __str__(self):
+        return str(self._buffer)
+
+    def __repr__(self):
+        return repr(str(self._buffer))
+
+    def __eq__(self, other):
+        if isinstance(other, BufferView):
+            other = other._buffer
+        elif not isinstance(other, (bytes, buffer, bytearray)):
+            return NotImplemented
+
+        return self._buffer == buffer(other)
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        if equal is NotImplemented:
+            return equal
+        return not equal
+
+    def __hash__(self):
+        return hash(str(self._buffer))
+
+    def tobytes(self):
+        return str(self._buffer)
+
+
+def as_buffer(data):
+    '''
+    Return the given data in a form that can be sliced without copying.
+    Strings and buffers are returned as they are, other objects supporting
+    the buffer interface are wrapped in a buffer. A memoryview can't be
+    wrapped in a Python 2 buffer, so it is copied once.
+
+    >>> as_buffer('abc')
+    'abc'
+    >>> str(as_buffer(bytearray('abc')))
+    'abc'
+    >>> as_buffer(memoryview('abc'))
+    'abc'
+    '''
+    if isinstance(data, (bytes, buffer)):
+        return data
+    elif isinstance(data, BufferView):
+        return data._buffer
+    elif isinstance(data, (Bits, memoryview)):
+        return data.tobytes()
+    else:
+        return buffer(data)
+
+
+def sub_buffer(data, offset, length=None):
+    '''
+    Return a buffer that refers to part of the given data. If no length is
+    given the buffer extends to the end of the data. Raise an error when
+    there is not enough data.
+
+    >>> str(sub_buffer('abcdef', 1, 3))
+    'bcd'
+    >>> str(sub_buffer(sub_buffer('abcdef', 1), 2))
+    'def'
+    >>> sub_buffer('abcdef', 4, 3)
+    Traceback (most recent call last):
+        ...
+    ValueError: Packet is truncated
+    '''
+    data_len = len(data)
+    if length is None:
+        length = data_len - offset
+
+    if length < 0 or offset + length > data_len:
+        raise ValueError('Packet is truncated')
+
+    if offset == 0 and length == data_len:
+        return data
+
+    return buffer(data, offset, length)
+
+
+def unpack_from(struct_format, data, offset=0):
+    '''
+    Unpack a precompiled struct from the data at the given offset, raising a
+    ValueError instead of a struct.error when there is not enough data.
+
+    >>> import struct
+    >>> unpack_from(struct.Struct('!H'), 'abc', 1)
+    (25187,)
+    >>> unpack_from(struct.Struct('!H'), 'abc', 2)
+    Traceback (most recent call last):
+        ...
+    ValueError: Packet is truncated
+    '''
+    if offset + struct_format.size > len(data):
+        raise ValueError('Packet is truncated')
+
+    return struct_format.unpack_from(data, offset)
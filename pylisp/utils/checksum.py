@@ -2,21 +2,111 @@
 Created on 9 jan. 2013
 
 @author: sander
+
+The one's complement sum doesn't depend on byte order (RFC 1071), so the
+data is summed as 16-bit words in the native byte order with array, which
+runs in C, and only the final result is swapped when necessary.
+
+When only a few fields in a packet change, the checksum can be updated with
+incremental_update (RFC 1624) without going over the whole packet again.
 '''
+from array import array
+from pylisp.utils.buffers import as_buffer
+import sys
+
+
+__all__ = ['ones_complement', 'ones_complement_many', 'incremental_update']
+
+
+_LITTLE_ENDIAN = sys.byteorder == 'little'
+
+
+def _sum_words(data):
+    '''
+    Add all 16-bit words in the data in native byte order, padding the data
+    with a zero byte if it has an odd length
+    '''
+    data = as_buffer(data)
+    length = len(data)
+
+    words = array('H')
+    words.fromstring(buffer(data, 0, length & ~1))
+    total = sum(words)
+
+    if length & 1:
+        last = ord(data[length - 1])
+        if _LITTLE_ENDIAN:
+            total += last
+        else:
+            total += last << 8
+
+    return total
+
+
+def _swap(value):
+    # Convert a 16-bit value between network and native byte order
+    if _LITTLE_ENDIAN:
+        return ((value & 0xff) << 8) | (value >> 8)
+    return value
+
+
+def _finish(total):
+    '''
+    Fold the carries back in, convert to network byte order and take the
+    complement
+    '''
+    while total >> 16:
+        total = (total & 0xffff) + (total >> 16)
+
+    return ~_swap(total) & 0xffff
 
 
 def ones_complement(message):
-    message = bytes(message)
+    '''
+    Calculate the internet checksum of the message
+
+    >>> ones_complement('\\x45\\x00\\x00\\x1c\\x00\\x00\\x00\\x00\\x40\\x11'
+    ...                 '\\x00\\x00\\xc0\\x00\\x02\\x01\\xc0\\x00\\x02\\x02')
+    63181
+    >>> ones_complement('\\x01')
+    65279
+    '''
+    return _finish(_sum_words(message))
+
+
+def ones_complement_many(messages):
+    '''
+    Calculate the internet checksums of a sequence of messages in one call
+
+    >>> ones_complement_many(['\\x00\\x01', '\\xff\\xff', ''])
+    [65534, 0, 65535]
+    '''
+    return [_finish(_sum_words(message)) for message in messages]
+
+
+def incremental_update(old_checksum, old_data, new_data):
+    '''
+    Update a checksum after the old data in the checksummed message has been
+    replaced by the new data, using equation 3 from RFC 1624:
+    HC' = ~(~HC + ~m + m'). The replaced data must start at an even offset
+    in the message.
 
-    # Add padding if the message has an odd number of bytes
-    if len(message) % 2 == 1:
-        message = message + '\x00'
+    >>> message = bytearray('\\x45\\x00\\x00\\x1c\\x00\\x00\\x00\\x00\\x40\\x11'
+    ...                     '\\x00\\x00\\xc0\\x00\\x02\\x01\\xc0\\x00\\x02\\x02')
+    >>> old_checksum = ones_complement(message)
+    >>> message[8] = 0x3f
+    >>> incremental_update(old_checksum, '\\x40\\x11', '\\x3f\\x11')
+    63437
+    >>> ones_complement(message)
+    63437
+    '''
+    if len(old_data) != len(new_data):
+        raise ValueError('Old and new data must have the same length')
 
-    checksum = 0
-    for i in range(0, len(message), 2):
-        next_16_bits = (ord(message[i]) << 8) + ord(message[i + 1])
-        tmp = checksum + next_16_bits
-        checksum = (tmp & 0xffff) + (tmp >> 16)
-    checksum = ~checksum & 0xffff
+    # The complement of a word is 0xffff minus the word
+    words = (len(old_data) + 1) // 2
+    total = ((~_swap(old_checksum) & 0xffff)
+             + words * 0xffff - _sum_words(old_data)
+             + _sum_words(new_data))
 
-    return checksum
+    return _finish(total)
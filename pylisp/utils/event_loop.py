@@ -0,0 +1,558 @@
+'''
+Created on 18 okt. 2026
+
+@author: sander
+
+A small event loop for lispd. Datagram sockets are registered edge-triggered
+with epoll and drained in batches, with a limit on the number of datagrams
+read from one socket per wake-up so that a flood on one socket can't starve
+the others. Sockets that still have data waiting when their budget runs out
+are revisited in the next round without waiting for a new event. Other file
+descriptors, like the signal pipe, are registered level-triggered. On
+systems without epoll select is used instead.
+
+Timers, futures and tasks follow asyncio, which Python 2 doesn't have. A
+task runs a generator that yields futures, or other generators, and is
+resumed with their result when they are done. A generator returns a value
+by raising Return(value).
+'''
+from collections import deque
+from pylisp.utils import syscalls
+import errno
+import heapq
+import itertools
+import logging
+import select
+import time
+import types
+
+
+# Get the logger
+logger = logging.getLogger(__name__)
+
+
+__all__ = ['EventLoop', 'Future', 'Task', 'Return', 'CancelledError',
+           'get_event_loop', 'set_event_loop']
+
+
+class CancelledError(Exception):
+    pass
+
+
+class Return(Exception):
+    '''
+    Raised by a task generator to return a value
+    '''
+    def __init__(self, value=None):
+        super(Return, self).__init__(value)
+        self.value = value
+
+
+class TimerHandle(object):
+    __slots__ = ('when', 'callback', 'args', 'cancelled')
+
+    def __init__(self, when, callback, args):
+        self.when = when
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+    def _run(self):
+        try:
+            self.callback(*self.args)
+        except:
+            logger.exception(u"Uncaught exception in callback {0!r}".format(self.callback))
+
+
+class Future(object):
+    '''
+    The result of an operation that hasn't finished yet
+    '''
+
+    def __init__(self, loop=None):
+        self._loop = loop or get_event_loop()
+        self._done = False
+        self._cancelled = False
+        self._result = None
+        self._exception = None
+        self._callbacks = []
+
+    def __repr__(self):
+        if not self._done:
+            state = 'pending'
+        elif self._cancelled:
+            state = 'cancelled'
+        elif self._exception is not None:
+            state = 'exception={0!r}'.format(self._exception)
+        else:
+            state = 'result={0!r}'.format(self._result)
+
+        return '{0}({1})'.format(self.__class__.__name__, state)
+
+    def done(self):
+        return self._done
+
+    def cancelled(self):
+        return self._cancelled
+
+    def result(self):
+        if not self._done:
+            raise ValueError('Result is not ready')
+        if self._cancelled:
+            raise CancelledError()
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+    def exception(self):
+        if not self._done:
+            raise ValueError('Result is not ready')
+        if self._cancelled:
+            raise CancelledError()
+        return self._exception
+
+    def add_done_callback(self, callback):
+        '''
+        Call callback(future) from the event loop when the future is done
+        '''
+        if self._done:
+            self._loop.call_soon(callback, self)
+        else:
+            self._callbacks.append(callback)
+
+    def remove_done_callback(self, callback):
+        if callback in self._callbacks:
+            self._callbacks.remove(callback)
+
+    def _finish(self):
+        self._done = True
+
+        callbacks = self._callbacks
+        self._callbacks = []
+        for callback in callbacks:
+            self._loop.call_soon(callback, self)
+
+    def set_result(self, result):
+        if self._done:
+            raise ValueError('Future is already done')
+
+        self._result = result
+        self._finish()
+
+    def set_exception(self, exception):
+        if self._done:
+            raise ValueError('Future is already done')
+
+        self._exception = exception
+        self._finish()
+
+    def cancel(self):
+        if self._done:
+            return False
+
+        self._cancelled = True
+        self._finish()
+        return True
+
+
+class Task(Future):
+    '''
+    Run a generator on the event loop
+    '''
+
+    def __init__(self, coroutine, loop=None):
+        super(Task, self).__init__(loop)
+        self._coroutine = coroutine
+        self._waiting_on = None
+        self._loop.call_soon(self._step, None, None)
+
+    def cancel(self):
+        if self._done:
+            return False
+
+        # Let the generator handle the cancellation
+        if self._waiting_on is not None:
+            self._waiting_on.remove_done_callback(self._wakeup)
+            self._waiting_on.cancel()
+            self._waiting_on = None
+
+        self._loop.call_soon(self._step, None, CancelledError())
+        return True
+
+    def _step(self, value, exception):
+        if self._done:
+            return
+
+        try:
+            if exception is not None:
+                yielded = self._coroutine.throw(exception)
+            else:
+                yielded = self._coroutine.send(value)
+        except StopIteration:
+            self.set_result(None)
+            return
+        except Return, e:
+            self.set_result(e.value)
+            return
+        except CancelledError:
+            super(Task, self).cancel()
+            return
+        except Exception, e:
+            if not self._callbacks:
+                # Nobody is waiting for us, so at least log it
+                logger.exception(u"Uncaught exception in {0!r}".format(self._coroutine))
+            self.set_exception(e)
+            return
+
+        if isinstance(yielded, types.GeneratorType):
+            yielded = Task(yielded, self._loop)
+
+        if isinstance(yielded, Future):
+            self._waiting_on = yielded
+            yielded.add_done_callback(self._wakeup)
+        elif yielded is None:
+            # Give others a turn
+            self._loop.call_soon(self._step, None, None)
+        else:
+            self._loop.call_soon(self._step, None,
+                                 TypeError('Task yielded {0!r}'.format(yielded)))
+
+    def _wakeup(self, future):
+        self._waiting_on = None
+        try:
+            value = future.result()
+        except Exception, e:
+            self._step(None, e)
+        else:
+            self._step(value, None)
+
+
+class _Reader(object):
+    '''
+    A registered file object with its callback
+    '''
+    __slots__ = ('fileobj', 'fd', 'callback', 'edge_triggered')
+
+    def __init__(self, fileobj, callback, edge_triggered):
+        self.fileobj = fileobj
+        self.fd = None
+        self.callback = callback
+        self.edge_triggered = edge_triggered
+
+
+class EventLoop(object):
+    def __init__(self, budget=64, batch_size=32, bufsize=65536):
+        '''
+        The budget is the maximum number of datagrams read from one socket
+        per wake-up, the batch size the number of datagrams read with one
+        system call.
+        '''
+        self.budget = budget
+        self.batch_size = min(batch_size, budget)
+        self.bufsize = bufsize
+
+        self._readers = {}
+        self._fds = {}
+        self._pending = set()
+        self._running = False
+
+        if hasattr(select, 'epoll'):
+            self._epoll = select.epoll()
+        else:
+            self._epoll = None
+
+        # Only used for plain sockets, AutoUDPSockets have their own
+        self._receivers = {}
+
+        # Callbacks to run now and a heap of (when, sequence, handle)
+        self._ready = deque()
+        self._timers = []
+        self._sequence = itertools.count()
+
+    def __repr__(self):
+        return '{0}({1} readers)'.format(self.__class__.__name__,
+                                         len(self._readers))
+
+    def _register(self, reader):
+        if isinstance(reader.fileobj, (int, long)):
+            fd = reader.fileobj
+        else:
+            fd = reader.fileobj.fileno()
+        if fd is None:
+            # An AutoUDPSocket without a bound socket
+            reader.fd = None
+            return
+
+        reader.fd = fd
+        self._fds[fd] = reader
+
+        if self._epoll is not None:
+            events = select.EPOLLIN
+            if reader.edge_triggered:
+                events |= select.EPOLLET
+            self._epoll.register(fd, events)
+
+    def _unregister(self, reader):
+        if reader.fd is None:
+            return
+
+        self._fds.pop(reader.fd, None)
+        self._pending.discard(reader)
+
+        if self._epoll is not None:
+            try:
+                self._epoll.unregister(reader.fd)
+            except (IOError, OSError, ValueError):
+                # The file descriptor has already been closed
+                pass
+
+        reader.fd = None
+
+    def add_reader(self, fileobj, callback, edge_triggered=False):
+        '''
+        Call callback(fileobj) when the file object, which can also be a
+        file descriptor, becomes readable. An edge-triggered callback must
+        return True when it has read all available data and False when it
+        should be called again.
+        '''
+        self.remove_reader(fileobj)
+
+        reader = _Reader(fileobj, callback, edge_triggered)
+        self._readers[fileobj] = reader
+        self._register(reader)
+
+        # Make sure we see the new file descriptor when it is rebound
+        if hasattr(fileobj, 'add_rebind_target'):
+            fileobj.add_rebind_target(self)
+
+        # There might be data waiting that we will never get an edge for
+        if edge_triggered:
+            self._pending.add(reader)
+
+    def add_datagram_socket(self, sock, handler):
+        '''
+        Call handler(sock, data, address) for every datagram received on the
+        socket, which can be an AutoUDPSocket or a normal socket
+        '''
+        def read_datagrams(sock):
+            return self._read_datagrams(sock, handler)
+
+        self.add_reader(sock, read_datagrams, edge_triggered=True)
+
+    def remove_reader(self, fileobj):
+        reader = self._readers.pop(fileobj, None)
+        if reader is not None:
+            self._unregister(reader)
+        self._receivers.pop(fileobj, None)
+
+    def on_socket_rebind(self, sock):
+        '''
+        Called by AutoUDPSocket when it has replaced its socket
+        '''
+        reader = self._readers.get(sock)
+        if reader is None:
+            return
+
+        logger.debug(u"Re-registering {0!r} with the event loop".format(sock))
+        self._unregister(reader)
+        self._register(reader)
+
+        if reader.edge_triggered:
+            self._pending.add(reader)
+
+    def _recv_batch(self, sock, count):
+        if hasattr(sock, 'recv_batch'):
+            return sock.recv_batch(count, self.bufsize)
+
+        receiver = self._receivers.get(sock)
+        if receiver is None and syscalls.have_recvmmsg():
+            receiver = syscalls.RecvMMsg(self.batch_size, self.bufsize)
+            self._receivers[sock] = receiver
+
+        return syscalls.recv_batch(sock, count, self.bufsize, receiver)
+
+    def _read_datagrams(self, sock, handler):
+        # Read until the socket is empty or the budget is used up
+        remaining = self.budget
+        while remaining > 0:
+            count = min(self.batch_size, remaining)
+            datagrams = self._recv_batch(sock, count)
+
+            for data, address in datagrams:
+                try:
+                    handler(sock, data, address)
+                except:
+                    logger.exception(u"Uncaught exception when handling datagram from {0}".format(address))
+
+            remaining -= len(datagrams)
+            if len(datagrams) < count:
+                # Drained
+                return True
+
+        return False
+
+    def _wait(self, timeout):
+        # Return the readers that are ready
+        if self._epoll is not None:
+            try:
+                events = self._epoll.poll(timeout is None and -1 or timeout)
+            except IOError, e:
+                if e.errno == errno.EINTR:
+                    return []
+                raise
+
+            return [self._fds[fd] for fd, dummy in events if fd in self._fds]
+
+        else:
+            try:
+                rlist, dummy, dummy = select.select(self._fds.keys(), [], [],
+                                                    timeout)
+            except select.error, e:
+                if e[0] == errno.EINTR:
+                    return []
+                raise
+
+            return [self._fds[fd] for fd in rlist if fd in self._fds]
+
+    def time(self):
+        return time.time()
+
+    def call_soon(self, callback, *args):
+        handle = TimerHandle(None, callback, args)
+        self._ready.append(handle)
+        return handle
+
+    def call_later(self, delay, callback, *args):
+        return self.call_at(self.time() + delay, callback, *args)
+
+    def call_at(self, when, callback, *args):
+        handle = TimerHandle(when, callback, args)
+        heapq.heappush(self._timers, (when, next(self._sequence), handle))
+        return handle
+
+    def create_task(self, coroutine):
+        return Task(coroutine, self)
+
+    def sleep(self, delay, result=None):
+        '''
+        Return a future that is done after delay seconds
+        '''
+        future = Future(self)
+
+        def wake_up():
+            if not future.done():
+                future.set_result(result)
+
+        self.call_later(delay, wake_up)
+        return future
+
+    def wait(self, future, timeout):
+        '''
+        Return a future with result True when the given future is done
+        within timeout seconds and False otherwise. Unlike
+        asyncio.wait_for the given future is not cancelled.
+        '''
+        waiter = Future(self)
+
+        def on_done(dummy):
+            if not waiter.done():
+                waiter.set_result(True)
+            handle.cancel()
+
+        def on_timeout():
+            future.remove_done_callback(on_done)
+            if not waiter.done():
+                waiter.set_result(False)
+
+        handle = self.call_later(timeout, on_timeout)
+        future.add_done_callback(on_done)
+        return waiter
+
+    def _run_timers(self):
+        # Only run what is due now, new callbacks wait for the next round
+        now = self.time()
+        while self._timers and self._timers[0][0] <= now:
+            handle = heapq.heappop(self._timers)[2]
+            self._ready.append(handle)
+
+        for dummy in range(len(self._ready)):
+            handle = self._ready.popleft()
+            if not handle.cancelled:
+                handle._run()
+
+    def run_once(self, timeout=None):
+        '''
+        Wait for events for at most timeout seconds and handle them
+        '''
+        # Don't wait if some sockets still have data
+        if self._pending or self._ready:
+            timeout = 0
+        elif self._timers:
+            # Drop cancelled timers so they don't wake us up
+            while self._timers and self._timers[0][2].cancelled:
+                heapq.heappop(self._timers)
+
+            if self._timers:
+                delay = max(0, self._timers[0][0] - self.time())
+                if timeout is None or delay < timeout:
+                    timeout = delay
+
+        ready = set(self._wait(timeout))
+        ready.update(self._pending)
+        self._pending = set()
+
+        for reader in ready:
+            # The reader might have been removed by a previous callback
+            if self._readers.get(reader.fileobj) is not reader \
+            or reader.fd is None:
+                continue
+
+            try:
+                done = reader.callback(reader.fileobj)
+            except:
+                logger.exception(u"Uncaught exception when handling {0!r}".format(reader.fileobj))
+                done = True
+
+            if reader.edge_triggered and not done:
+                self._pending.add(reader)
+
+        self._run_timers()
+
+    def run(self, timeout=5.0):
+        '''
+        Handle events until stop is called
+        '''
+        self._running = True
+        while self._running:
+            self.run_once(timeout)
+
+    def stop(self):
+        self._running = False
+
+    def close(self):
+        for fileobj in self._readers.keys():
+            self.remove_reader(fileobj)
+
+        if self._epoll is not None:
+            self._epoll.close()
+
+
+_event_loop = None
+
+
+def get_event_loop():
+    '''
+    Return the event loop of this process, creating one when necessary
+    '''
+    global _event_loop
+    if _event_loop is None:
+        _event_loop = EventLoop()
+    return _event_loop
+
+
+def set_event_loop(event_loop):
+    global _event_loop
+    _event_loop = event_loop
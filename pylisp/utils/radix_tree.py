@@ -0,0 +1,350 @@
+'''
+Created on 18 okt. 2026
+
+@author: sander
+'''
+from ipaddress import ip_network, _BaseNetwork
+
+
+__all__ = ['RadixTree']
+
+
+class RadixNode(object):
+    '''
+    A node in the radix tree. Nodes without a value are glue nodes that only
+    exist to split the tree where two prefixes diverge.
+    '''
+    __slots__ = ('network', 'prefixlen', 'value', 'children')
+
+    def __init__(self, network, prefixlen, value=None):
+        self.network = network
+        self.prefixlen = prefixlen
+        self.value = value
+        self.children = [None, None]
+
+    def __repr__(self):
+        return 'RadixNode(%d, %d, %r)' % (self.network, self.prefixlen,
+                                          self.value)
+
+
+class RadixTree(object):
+    '''
+    A binary radix (PATRICIA) tree that maps prefixes of one address family
+    to values. Prefixes are stored as an integer network address and a prefix
+    length, so all operations take time proportional to the number of bits in
+    an address instead of the number of stored prefixes.
+
+    >>> from ipaddress import IPv4Network
+    >>> tree = RadixTree(32)
+    >>> tree[IPv4Network(u'10.0.0.0/8')] = 'ten'
+    >>> tree[IPv4Network(u'10.1.0.0/16')] = 'ten-one'
+    >>> tree.longest_match(IPv4Network(u'10.1.2.3/32'))
+    'ten-one'
+    >>> tree.longest_match(IPv4Network(u'10.2.0.0/16'))
+    'ten'
+    >>> sorted(tree.covered(IPv4Network(u'10.0.0.0/7')))
+    ['ten', 'ten-one']
+    >>> del tree[IPv4Network(u'10.0.0.0/8')]
+    >>> tree.longest_match(IPv4Network(u'10.2.0.0/16'))
+    >>> len(tree)
+    1
+    '''
+
+    def __init__(self, max_prefixlen):
+        self.max_prefixlen = max_prefixlen
+        self._root = None
+        self._len = 0
+
+    def __len__(self):
+        return self._len
+
+    def __iter__(self):
+        return self.itervalues()
+
+    def __repr__(self):
+        return 'RadixTree(%d, %r)' % (self.max_prefixlen, list(self))
+
+    def _key(self, prefix):
+        # Accept (network, prefixlen) tuples to avoid object creation
+        if isinstance(prefix, tuple):
+            return prefix
+
+        if not isinstance(prefix, _BaseNetwork):
+            prefix = ip_network(prefix)
+
+        if prefix.max_prefixlen != self.max_prefixlen:
+            raise ValueError('Prefix %s does not belong in this tree' % prefix)
+
+        return int(prefix.network_address), prefix.prefixlen
+
+    def _mask(self, prefixlen):
+        return ((1 << prefixlen) - 1) << (self.max_prefixlen - prefixlen)
+
+    def _bit(self, network, position):
+        return (network >> (self.max_prefixlen - 1 - position)) & 1
+
+    def _common_prefixlen(self, network1, prefixlen1, network2, prefixlen2):
+        limit = min(prefixlen1, prefixlen2)
+        diff = network1 ^ network2
+        if not diff:
+            return limit
+
+        return min(self.max_prefixlen - diff.bit_length(), limit)
+
+    def _contains(self, node, network, prefixlen):
+        # Does the node's prefix contain the given prefix?
+        return node.prefixlen <= prefixlen \
+            and (network & self._mask(node.prefixlen)) == node.network
+
+    def insert(self, prefix, value):
+        '''
+        Store a value for the given prefix, replacing any existing value
+        '''
+        if value is None:
+            raise ValueError('None can not be stored in a RadixTree')
+
+        network, prefixlen = self._key(prefix)
+        new_node = RadixNode(network, prefixlen, value)
+
+        parent = None
+        parent_bit = 0
+        node = self._root
+        while node is not None:
+            common = self._common_prefixlen(node.network, node.prefixlen,
+                                            network, prefixlen)
+
+            if common < node.prefixlen:
+                # The new prefix diverges from this node: split here
+                if common == prefixlen:
+                    # The new node becomes the parent of this node
+                    new_node.children[self._bit(node.network, common)] = node
+                    replacement = new_node
+                else:
+                    # Insert a glue node above both
+                    glue = RadixNode(network & self._mask(common), common)
+                    glue.children[self._bit(node.network, common)] = node
+                    glue.children[self._bit(network, common)] = new_node
+                    replacement = glue
+
+                if parent is None:
+                    self._root = replacement
+                else:
+                    parent.children[parent_bit] = replacement
+
+                self._len += 1
+                return
+
+            if node.prefixlen == prefixlen:
+                # Exact match: replace the value
+                if node.value is None:
+                    self._len += 1
+                node.value = value
+                return
+
+            # Go deeper
+            parent = node
+            parent_bit = self._bit(network, node.prefixlen)
+            node = node.children[parent_bit]
+
+        # Reached the end of a branch
+        if parent is None:
+            self._root = new_node
+        else:
+            parent.children[parent_bit] = new_node
+
+        self._len += 1
+
+    __setitem__ = insert
+
+    def get(self, prefix, default=None):
+        '''
+        Find the value stored for exactly the given prefix
+        '''
+        network, prefixlen = self._key(prefix)
+
+        node = self._root
+        while node is not None and self._contains(node, network, prefixlen):
+            if node.prefixlen == prefixlen:
+                if node.value is not None:
+                    return node.value
+                break
+
+            node = node.children[self._bit(network, node.prefixlen)]
+
+        return default
+
+    def __getitem__(self, prefix):
+        value = self.get(prefix)
+        if value is None:
+            raise KeyError(prefix)
+        return value
+
+    def __contains__(self, prefix):
+        return self.get(prefix) is not None
+
+    def covering(self, prefix):
+        '''
+        Return the values of all stored prefixes that contain the given
+        prefix, from the least to the most specific
+        '''
+        network, prefixlen = self._key(prefix)
+
+        matches = []
+        node = self._root
+        while node is not None and self._contains(node, network, prefixlen):
+            if node.value is not None:
+                matches.append(node.value)
+
+            if node.prefixlen == prefixlen:
+                break
+
+            node = node.children[self._bit(network, node.prefixlen)]
+
+        return matches
+
+    def longest_match(self, prefix):
+        '''
+        Return the value of the most specific stored prefix that contains the
+        given prefix, or None
+        '''
+        network, prefixlen = self._key(prefix)
+
+        match = None
+        node = self._root
+        while node is not None and self._contains(node, network, prefixlen):
+            if node.value is not None:
+                match = node.value
+
+            if node.prefixlen == prefixlen:
+                break
+
+            node = node.children[self._bit(network, node.prefixlen)]
+
+        return match
+
+    def covered(self, prefix, limit=None):
+        '''
+        Return the values of all stored prefixes that are contained in the
+        given prefix, including an exact match. When a limit is given the
+        search stops after finding that many values.
+        '''
+        network, prefixlen = self._key(prefix)
+        mask = self._mask(prefixlen)
+
+        # Find the top of the sub-tree that lies within the given prefix
+        node = self._root
+        while node is not None and node.prefixlen < prefixlen:
+            if (network & self._mask(node.prefixlen)) != node.network:
+                return []
+
+            node = node.children[self._bit(network, node.prefixlen)]
+
+        if node is None or (node.network & mask) != network & mask:
+            return []
+
+        return self._collect(node, limit)
+
+    def overlapping(self, prefix, limit=None):
+        '''
+        Return the values of all stored prefixes that overlap with the given
+        prefix: the ones that contain it and the ones contained in it
+        '''
+        matches = self.covering(prefix)
+        if limit is not None and len(matches) >= limit:
+            return matches[:limit]
+
+        # An exact match is returned by both searches
+        network, prefixlen = self._key(prefix)
+        exact = matches and self.get((network, prefixlen))
+        more_specifics = [value for value in self.covered((network, prefixlen),
+                                                          limit and limit + 1)
+                          if value is not exact]
+
+        matches.extend(more_specifics)
+        if limit is not None:
+            return matches[:limit]
+        return matches
+
+    def _collect(self, node, limit=None):
+        values = []
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            if node.value is not None:
+                values.append(node.value)
+                if limit is not None and len(values) >= limit:
+                    break
+
+            # Push the right child first so the left one is handled first
+            if node.children[1] is not None:
+                stack.append(node.children[1])
+            if node.children[0] is not None:
+                stack.append(node.children[0])
+
+        return values
+
+    def delete(self, prefix):
+        '''
+        Remove the value for the given prefix and clean up the tree structure
+        '''
+        network, prefixlen = self._key(prefix)
+
+        # Find the node and remember the path to it
+        path = []
+        node = self._root
+        while node is not None and self._contains(node, network, prefixlen):
+            if node.prefixlen == prefixlen:
+                break
+
+            path.append(node)
+            node = node.children[self._bit(network, node.prefixlen)]
+        else:
+            node = None
+
+        if node is None or node.value is None:
+            raise KeyError(prefix)
+
+        node.value = None
+        self._len -= 1
+
+        # Remove glue nodes that are no longer needed
+        while node is not None and node.value is None:
+            children = [child for child in node.children if child is not None]
+            if len(children) == 2:
+                break
+
+            replacement = children and children[0] or None
+            parent = path and path.pop() or None
+            if parent is None:
+                self._root = replacement
+            elif parent.children[0] is node:
+                parent.children[0] = replacement
+            else:
+                parent.children[1] = replacement
+
+            if replacement is not None:
+                break
+
+            # The parent lost a child, it might have become redundant
+            node = parent
+
+    __delitem__ = delete
+
+    def discard(self, prefix):
+        try:
+            self.delete(prefix)
+        except KeyError:
+            pass
+
+    def clear(self):
+        self._root = None
+        self._len = 0
+
+    def itervalues(self):
+        if self._root is None:
+            return iter([])
+
+        return iter(self._collect(self._root))
+
+    def values(self):
+        return list(self.itervalues())
@@ -0,0 +1,426 @@
+'''
+Created on 18 okt. 2026
+
+@author: sander
+
+Access to socket system calls that the Python 2 socket module doesn't
+provide. They are called through ctypes when the C library has them, and
+callers are expected to fall back to the standard socket methods otherwise.
+'''
+from ipaddress import IPv4Address, IPv6Address
+import ctypes
+import ctypes.util
+import errno
+import socket
+import struct
+
+
+__all__ = ['have_recvmmsg', 'have_sendmmsg', 'parse_sockaddr', 'make_sockaddr',
+           'RecvMMsg', 'recv_batch', 'SendMMsg', 'send_batch']
+
+
+# Flags from <sys/socket.h>
+MSG_DONTWAIT = 0x40
+
+# Large enough for any socket address
+SOCKADDR_SIZE = 128
+
+# Converting addresses to IPv4Address/IPv6Address objects costs more than
+# receiving the datagram, and most traffic comes from a few peers
+ADDRESS_CACHE_SIZE = 1024
+
+
+class iovec(ctypes.Structure):
+    _fields_ = [('iov_base', ctypes.c_void_p),
+                ('iov_len', ctypes.c_size_t)]
+
+
+class msghdr(ctypes.Structure):
+    _fields_ = [('msg_name', ctypes.c_void_p),
+                ('msg_namelen', ctypes.c_uint32),
+                ('msg_iov', ctypes.POINTER(iovec)),
+                ('msg_iovlen', ctypes.c_size_t),
+                ('msg_control', ctypes.c_void_p),
+                ('msg_controllen', ctypes.c_size_t),
+                ('msg_flags', ctypes.c_int)]
+
+
+class mmsghdr(ctypes.Structure):
+    _fields_ = [('msg_hdr', msghdr),
+                ('msg_len', ctypes.c_uint)]
+
+
+def _load_libc():
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    except OSError:
+        return None, None, None
+
+    recvmmsg = getattr(libc, 'recvmmsg', None)
+    if recvmmsg is not None:
+        recvmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(mmsghdr),
+                             ctypes.c_uint, ctypes.c_int, ctypes.c_void_p]
+        recvmmsg.restype = ctypes.c_int
+
+    sendmmsg = getattr(libc, 'sendmmsg', None)
+    if sendmmsg is not None:
+        sendmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(mmsghdr),
+                             ctypes.c_uint, ctypes.c_int]
+        sendmmsg.restype = ctypes.c_int
+
+    return libc, recvmmsg, sendmmsg
+
+
+_libc, _recvmmsg, _sendmmsg = _load_libc()
+
+# Gives the address and length of the data of a string, buffer or bytearray
+_as_read_buffer = ctypes.pythonapi.PyObject_AsReadBuffer
+_as_read_buffer.argtypes = [ctypes.py_object, ctypes.POINTER(ctypes.c_void_p),
+                            ctypes.POINTER(ctypes.c_ssize_t)]
+_as_read_buffer.restype = ctypes.c_int
+
+
+def have_recvmmsg():
+    return _recvmmsg is not None
+
+
+def have_sendmmsg():
+    return _sendmmsg is not None
+
+
+# Socket address layouts: family in native byte order, then the port and
+# the address in network byte order
+_family_format = struct.Struct('=H')
+_ipv4_sockaddr_format = struct.Struct('!2xHI')
+_ipv6_sockaddr_format = struct.Struct('!2xH4xQQ')
+_ipv4_sockaddr_pack_format = struct.Struct('!HI8x')
+_ipv6_sockaddr_pack_format = struct.Struct('!HIQQI')
+
+
+_address_cache = {}
+_sockaddr_cache = {}
+_host_cache = {}
+
+
+def _cached(key, convert, value):
+    result = _address_cache.get(key)
+    if result is None:
+        if len(_address_cache) >= ADDRESS_CACHE_SIZE:
+            _address_cache.clear()
+
+        result = _address_cache[key] = convert(value)
+
+    return result
+
+
+def parse_sockaddr(data):
+    '''
+    Convert a raw socket address to an (address, port) tuple
+
+    >>> parse_sockaddr('\\x02\\x00\\x10\\xf6\\xc0\\x00\\x02\\x01')
+    (IPv4Address(u'192.0.2.1'), 4342)
+    '''
+    family = _family_format.unpack_from(data)[0]
+    if family == socket.AF_INET:
+        port, address = _ipv4_sockaddr_format.unpack_from(data)
+        return IPv4Address(address), port
+    elif family == socket.AF_INET6:
+        port, high, low = _ipv6_sockaddr_format.unpack_from(data)
+        return IPv6Address((high << 64) | low), port
+    else:
+        raise ValueError('Unsupported address family {0}'.format(family))
+
+
+def make_sockaddr(address, port):
+    '''
+    Convert an address and port to a raw socket address
+
+    >>> make_sockaddr(IPv4Address(u'192.0.2.1'), 4342)[:8]
+    '\\x02\\x00\\x10\\xf6\\xc0\\x00\\x02\\x01'
+    >>> parse_sockaddr(make_sockaddr(IPv6Address(u'2001:db8::1'), 4341))
+    (IPv6Address(u'2001:db8::1'), 4341)
+    '''
+    value = int(address)
+    if address.version == 4:
+        return (_family_format.pack(socket.AF_INET) +
+                _ipv4_sockaddr_pack_format.pack(port, value))
+    else:
+        return (_family_format.pack(socket.AF_INET6) +
+                _ipv6_sockaddr_pack_format.pack(port, 0, value >> 64,
+                                                value & 0xffffffffffffffff, 0))
+
+
+def host_string(address):
+    '''
+    The address as the socket module wants it. Only plain addresses are
+    cached, because sub-classes like AutoAddress can change.
+    '''
+    if type(address) not in (IPv4Address, IPv6Address):
+        return unicode(address)
+
+    return _cached(address, unicode, address)
+
+
+def _sockaddr(address):
+    # Kept in ctypes memory, so message headers can point to it
+    name = _sockaddr_cache.get(address)
+    if name is None:
+        if len(_sockaddr_cache) >= ADDRESS_CACHE_SIZE:
+            _sockaddr_cache.clear()
+
+        data = make_sockaddr(*address)
+        name = _sockaddr_cache[address] = (ctypes.create_string_buffer(data, len(data)), len(data))
+
+    return name
+
+
+class RecvMMsg(object):
+    '''
+    Receive up to count datagrams with one recvmmsg system call. The message
+    headers and buffers are allocated once and reused for every call.
+    '''
+
+    def __init__(self, count, bufsize=65536):
+        if _recvmmsg is None:
+            raise NotImplementedError('recvmmsg is not available')
+
+        self.count = count
+        self.bufsize = bufsize
+
+        # One block of memory for the data and one for the addresses
+        self._data = ctypes.create_string_buffer(count * bufsize)
+        self._names = ctypes.create_string_buffer(count * SOCKADDR_SIZE)
+        self._iovecs = (iovec * count)()
+        self._messages = (mmsghdr * count)()
+
+        data_address = ctypes.addressof(self._data)
+        names_address = ctypes.addressof(self._names)
+        for i in range(count):
+            self._iovecs[i].iov_base = data_address + i * bufsize
+            self._iovecs[i].iov_len = bufsize
+
+            header = self._messages[i].msg_hdr
+            header.msg_name = names_address + i * SOCKADDR_SIZE
+            header.msg_namelen = SOCKADDR_SIZE
+            header.msg_iov = ctypes.pointer(self._iovecs[i])
+            header.msg_iovlen = 1
+
+        # Accessing ctypes fields one by one is slow, so the headers are
+        # copied out in one go after each call and the address and data
+        # lengths are unpacked with one struct per number of messages
+        self._headers = ctypes.cast(self._messages,
+                                    ctypes.POINTER(ctypes.c_char))
+        namelen_offset = mmsghdr.msg_hdr.offset + msghdr.msg_namelen.offset
+        len_offset = mmsghdr.msg_len.offset
+        header_format = '{0}xI{1}xI{2}x'.format(namelen_offset,
+                                               len_offset - namelen_offset - 4,
+                                               ctypes.sizeof(mmsghdr) - len_offset - 4)
+        self._header_formats = [struct.Struct('=' + header_format * received)
+                                for received in range(count + 1)]
+
+    def __call__(self, sock, count=None):
+        '''
+        Return a list of (data, (address, port)) tuples for the datagrams
+        that are waiting on the socket, without blocking
+        '''
+        count = min(count or self.count, self.count)
+
+        received = _recvmmsg(sock.fileno(), self._messages, count,
+                             MSG_DONTWAIT, None)
+        if received < 0:
+            error = ctypes.get_errno()
+            if error in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return []
+            raise socket.error(error, 'recvmmsg failed')
+
+        header_format = self._header_formats[received]
+        lengths = header_format.unpack(self._headers[:header_format.size])
+        data = buffer(self._data)
+        names = buffer(self._names)
+        bufsize = self.bufsize
+
+        datagrams = []
+        for i in range(received):
+            namelen = lengths[2 * i]
+            if namelen != SOCKADDR_SIZE:
+                # The kernel has overwritten the address length
+                self._messages[i].msg_hdr.msg_namelen = SOCKADDR_SIZE
+
+            name = names[i * SOCKADDR_SIZE:i * SOCKADDR_SIZE + namelen]
+            datagrams.append((data[i * bufsize:i * bufsize + lengths[2 * i + 1]],
+                              _cached(name, parse_sockaddr, name)))
+
+        return datagrams
+
+
+def _ip_address(address):
+    # Strip the scope from link-local IPv6 addresses
+    host = unicode(address[0]).split('%')[0]
+    if ':' in host:
+        return IPv6Address(host), address[1]
+    else:
+        return IPv4Address(host), address[1]
+
+
+def recv_batch(sock, count, bufsize=65536, receiver=None):
+    '''
+    Receive up to count datagrams from a socket without blocking and return
+    a list of (data, (address, port)) tuples. A RecvMMsg receiver is used
+    when given, otherwise non-blocking recvfrom calls are made until there
+    is nothing left to read.
+    '''
+    if receiver is not None:
+        return receiver(sock, count)
+
+    datagrams = []
+    errors = 0
+    while len(datagrams) < count:
+        try:
+            data, address = sock.recvfrom(bufsize, MSG_DONTWAIT)
+        except socket.error, e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                break
+
+            if not datagrams:
+                raise
+
+            # Don't lose what we have read. Errors like a port unreachable
+            # are cleared by reporting them, so continue with the datagrams
+            # behind it.
+            errors += 1
+            if errors >= count:
+                break
+            continue
+
+        datagrams.append((data, _cached(address, _ip_address, address)))
+
+    return datagrams
+
+
+class SendMMsg(object):
+    '''
+    Send up to count datagrams with one sendmmsg system call. The message
+    headers are allocated once and reused for every call.
+    '''
+
+    def __init__(self, count):
+        if _sendmmsg is None:
+            raise NotImplementedError('sendmmsg is not available')
+
+        self.count = count
+
+        self._iovecs = (iovec * count)()
+        self._messages = (mmsghdr * count)()
+
+        # Every message has one iovec. The headers and iovecs are packed in
+        # one go with a struct per number of messages, which is much faster
+        # than setting the ctypes fields one by one. A size_t is packed as an
+        # unsigned long, which has the same size on Linux.
+        header_offset = mmsghdr.msg_hdr.offset
+        fields = [(header_offset + msghdr.msg_name.offset, 'P'),
+                  (header_offset + msghdr.msg_namelen.offset, 'I'),
+                  (header_offset + msghdr.msg_iov.offset, 'P'),
+                  (header_offset + msghdr.msg_iovlen.offset, 'L'),
+                  (mmsghdr.msg_len.offset, 'I')]
+        message_format = ''
+        position = 0
+        for offset, code in fields:
+            message_format += '{0}x{1}'.format(offset - position, code)
+            position = offset + struct.calcsize(code)
+        message_format += '{0}x'.format(ctypes.sizeof(mmsghdr) - position)
+
+        self._message_formats = [struct.Struct('@' + message_format * number)
+                                 for number in range(count + 1)]
+        self._iovec_formats = [struct.Struct('@' + 'PL' * number)
+                               for number in range(count + 1)]
+        self._message_buffer = (ctypes.c_char * ctypes.sizeof(self._messages)).from_buffer(self._messages)
+        self._iovec_buffer = (ctypes.c_char * ctypes.sizeof(self._iovecs)).from_buffer(self._iovecs)
+
+        # The iovecs stay at the same addresses
+        base = ctypes.addressof(self._iovecs)
+        self._iovec_addresses = [base + i * ctypes.sizeof(iovec)
+                                 for i in range(count)]
+
+        self._base = ctypes.c_void_p()
+        self._length = ctypes.c_ssize_t()
+
+    def __call__(self, sock, datagrams):
+        '''
+        Send the (data, (address, port)) tuples and return how many were sent.
+        The data can be strings, buffers or bytearrays. Consecutive datagrams
+        with the same data object or address are cheaper.
+        '''
+        fd = sock.fileno()
+        base = self._base
+        length = self._length
+        sent_total = 0
+        for start in range(0, len(datagrams), self.count):
+            chunk = datagrams[start:start + self.count]
+            number = len(chunk)
+
+            message_values = []
+            iovec_values = []
+
+            # The cache can be cleared while the chunk is built, so keep the
+            # addresses that the headers point to alive until they are sent
+            names = []
+            previous_data = previous_address = None
+            for i, (data, address) in enumerate(chunk):
+                if data is not previous_data:
+                    _as_read_buffer(data, ctypes.byref(base), ctypes.byref(length))
+                    previous_data = data
+                    data_base = base.value
+                    data_length = length.value
+
+                if address is not previous_address:
+                    name, name_length = _sockaddr(address)
+                    names.append(name)
+                    name_address = ctypes.addressof(name)
+                    previous_address = address
+
+                message_values.extend((name_address, name_length,
+                                       self._iovec_addresses[i], 1, 0))
+                iovec_values.extend((data_base, data_length))
+
+            self._iovec_formats[number].pack_into(self._iovec_buffer, 0,
+                                                  *iovec_values)
+            self._message_formats[number].pack_into(self._message_buffer, 0,
+                                                    *message_values)
+
+            sent = _sendmmsg(fd, self._messages, number, 0)
+            if sent < 0:
+                error = ctypes.get_errno()
+                if error in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    return sent_total
+                raise socket.error(error, 'sendmmsg failed')
+
+            sent_total += sent
+            if sent < number:
+                break
+
+        return sent_total
+
+
+def send_batch(sock, datagrams, sender=None):
+    '''
+    Send a list of (data, (address, port)) tuples and return how many were
+    sent. A SendMMsg sender is used when given, otherwise sendto is called
+    for every datagram.
+    '''
+    if sender is not None:
+        return sender(sock, datagrams)
+
+    sent_total = 0
+    for data, address in datagrams:
+        try:
+            sent = sock.sendto(data, (host_string(address[0]), address[1]))
+        except socket.error, e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                break
+            raise
+
+        if sent != len(data):
+            break
+        sent_total += 1
+
+    return sent_total
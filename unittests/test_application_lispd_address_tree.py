@@ -0,0 +1,266 @@
+#!/usr/bin/env python
+from ipaddress import IPv4Address, IPv4Network, IPv6Network
+from pylisp.application.lispd.address_tree.base import MoreSpecificsFoundError, NotAuthoritativeError
+from pylisp.application.lispd.address_tree.container_node import ContainerNode
+from pylisp.application.lispd.address_tree.ddt_referral_node import DDTReferralNode, get_negative_referral_bytes, \
+    send_answer_bytes
+from pylisp.application.lispd.address_tree.drop_node import DropNode
+from pylisp.application.lispd.address_tree.map_server_node import MapServerNode, MapServerRegistration
+from pylisp.application.lispd.received_message import ReceivedMessage
+from pylisp.packet.ip import IPv4Packet, UDPMessage
+from pylisp.packet.lisp.control import EncapsulatedControlMessage, LocatorRecord, MapRegisterRecord, \
+    MapReferralMessage, MapReferralRecord, MapReplyMessage, MapRequestMessage
+import socket
+import unittest
+
+# Add the parent directory to the start of the path
+if __name__ == '__main__':
+    import sys
+    sys.path.insert(0, '.')
+    sys.path.insert(0, '..')
+
+
+class ContainerNodeTestCase(unittest.TestCase):
+    def setUp(self):
+        self.leaf = DropNode(u'10.1.0.0/16')
+        self.branch = ContainerNode(u'10.2.0.0/16', [DropNode(u'10.2.3.0/24')])
+        self.root = ContainerNode(u'10.0.0.0/8', [self.leaf, self.branch])
+
+    def test_resolve_path(self):
+        path = self.root.resolve_path(IPv4Address(u'10.2.3.4'))
+        self.assertEqual([node.prefix for node in path],
+                         [IPv4Network(u'10.2.3.0/24'),
+                          IPv4Network(u'10.2.0.0/16'),
+                          IPv4Network(u'10.0.0.0/8')])
+
+        self.assertIs(self.root.resolve(u'10.1.2.3/32'), self.leaf)
+        self.assertIs(self.root.resolve(u'10.3.0.0/16'), self.root)
+
+    def test_find(self):
+        self.assertIs(self.root.find_one(u'10.1.0.0/24'), self.leaf)
+        self.assertIs(self.root.find_exact(u'10.1.0.0/16'), self.leaf)
+        self.assertIsNone(self.root.find_exact(u'10.1.0.0/24'))
+        self.assertEqual(self.root.find_all(u'10.0.0.0/8'),
+                         set([self.leaf, self.branch]))
+
+        with self.assertRaises(MoreSpecificsFoundError):
+            self.root.find_one(u'10.0.0.0/14')
+
+        with self.assertRaises(NotAuthoritativeError):
+            self.root.find_one(u'11.0.0.0/8')
+
+        with self.assertRaises(NotAuthoritativeError):
+            self.root.find_one(IPv6Network(u'::/0'))
+
+    def test_add(self):
+        with self.assertRaises(ValueError):
+            self.root.add(DropNode(u'10.1.2.0/24'))
+
+        with self.assertRaises(NotAuthoritativeError):
+            self.root.add(DropNode(u'0.0.0.0/0'))
+
+        # An exact match replaces the existing child
+        new_leaf = DropNode(u'10.1.0.0/16')
+        self.root.add(new_leaf)
+        self.assertEqual(len(self.root), 2)
+        self.assertIs(self.root.find_exact(u'10.1.0.0/16'), new_leaf)
+        self.assertNotIn(self.leaf, self.root)
+
+    def test_bulk_update(self):
+        root = ContainerNode(u'10.0.0.0/8')
+        last = DropNode(u'10.2.0.0/16')
+        root.bulk_update([DropNode(u'10.3.0.0/16'), self.leaf, DropNode(u'10.2.0.0/16'), last])
+        self.assertEqual(len(root), 3)
+        self.assertIs(root.resolve(u'10.1.2.3/32'), self.leaf)
+        self.assertIs(root.find_exact(u'10.2.0.0/16'), last)
+
+        with self.assertRaises(ValueError):
+            ContainerNode(u'10.0.0.0/8').bulk_update([DropNode(u'10.1.2.0/24'), DropNode(u'10.0.0.0/15')])
+
+        with self.assertRaises(NotAuthoritativeError):
+            ContainerNode(u'10.0.0.0/8').bulk_update([DropNode(u'11.0.0.0/8')])
+
+        # Existing children are taken into account
+        with self.assertRaises(ValueError):
+            self.root.bulk_update([DropNode(u'10.1.2.0/24')])
+
+    def test_remove(self):
+        self.root.remove(u'10.1.0.0/16')
+        self.assertNotIn(u'10.1.0.0/16', self.root)
+        self.assertIs(self.root.resolve(u'10.1.2.3/32'), self.root)
+
+        with self.assertRaises(KeyError):
+            self.root.remove(self.leaf)
+
+
+
+class LoopbackSocket(object):
+    '''
+    Like an AutoUDPSocket, which doesn't bind to loopback addresses. Only
+    data for loopback addresses is really sent.
+    '''
+    family = socket.AF_INET
+
+    def __init__(self):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sent = []
+
+    def getsockname(self):
+        return self.sock.getsockname()
+
+    def sendto(self, data, address):
+        self.sent.append((data, address))
+        if not address[0].is_loopback:
+            return len(data)
+
+        return self.sock.sendto(data, (unicode(address[0]), address[1]))
+
+
+class DDTReferralNodeTestCase(unittest.TestCase):
+    def test_referral_bytes(self):
+        node = DDTReferralNode(IPv4Network(u'10.0.0.0/8'), [u'192.0.2.1'])
+        data = node.get_referral_bytes()
+        self.assertIs(node.get_referral_bytes(), data)
+        self.assertEqual(data, MapReferralMessage(records=[node.get_referral()]).to_bytes())
+
+        # Changing the DDT nodes builds a new referral
+        node.add(u'192.0.2.2')
+        referral = MapReferralMessage.from_bytes(node.get_referral_bytes())
+        self.assertEqual(sorted(locator.address for locator in referral.records[0].locator_records),
+                         [IPv4Address(u'192.0.2.1'), IPv4Address(u'192.0.2.2')])
+
+        node.remove(IPv4Address(u'192.0.2.1'))
+        referral = MapReferralMessage.from_bytes(node.get_referral_bytes())
+        self.assertEqual([locator.address for locator in referral.records[0].locator_records],
+                         [IPv4Address(u'192.0.2.2')])
+
+    def test_send_answer_bytes(self):
+        sock = LoopbackSocket()
+        received_message = MapServerNodeTestCase('map_request_message').map_request_message(4342)
+        received_message.source = (IPv4Address(u'192.0.2.100'), 4342)
+        received_message.socket = sock
+
+        data = get_negative_referral_bytes(MapReferralRecord.ACT_DELEGATION_HOLE, IPv4Network(u'10.1.2.3/32'))
+        self.assertIs(get_negative_referral_bytes(MapReferralRecord.ACT_DELEGATION_HOLE,
+                                                  IPv4Network(u'10.1.2.3/32')), data)
+        try:
+            send_answer_bytes(received_message, data)
+        finally:
+            sock.sock.close()
+
+        [(sent, address)] = sock.sent
+        self.assertEqual(address, (IPv4Address(u'192.0.2.100'), 4342))
+        referral = MapReferralMessage.from_bytes(sent)
+        self.assertEqual(referral.nonce, 'abcdefgh')
+        self.assertEqual(referral.records[0].action, MapReferralRecord.ACT_DELEGATION_HOLE)
+        self.assertEqual(referral.records[0].eid_prefix.address, IPv4Network(u'10.1.2.3/32'))
+
+
+class MapServerNodeTestCase(unittest.TestCase):
+    def register(self, ms_node, prefix, source, deadline=None, locators=(), proxy_map_reply=False):
+        locator_records = [LocatorRecord(priority=1, weight=100, reachable=True, address=IPv4Address(locator))
+                           for locator in locators]
+        registration = MapServerRegistration(MapRegisterRecord(ttl=1440, eid_prefix=prefix,
+                                                               locator_records=locator_records),
+                                             proxy_map_reply=proxy_map_reply)
+        if deadline is not None:
+            registration.deadline = deadline
+        ms_node.store_registration(prefix, source, registration)
+
+    def test_expire_registrations(self):
+        ms_node = MapServerNode(u'10.0.0.0/8', key='secret')
+        prefix = IPv4Network(u'10.1.0.0/16')
+
+        self.register(ms_node, prefix, 'a', 100.0)
+        self.register(ms_node, prefix, 'b', 150.0)
+        self.assertEqual(ms_node.expire_registrations(50.0), 100.0)
+
+        # Re-registering moves the deadline
+        self.register(ms_node, prefix, 'a', 200.0)
+        self.assertEqual(ms_node.expire_registrations(120.0), 150.0)
+        self.assertEqual(sorted(ms_node.registrations[prefix]), ['a', 'b'])
+
+        self.assertEqual(ms_node.expire_registrations(160.0), 200.0)
+        self.assertEqual(sorted(ms_node.registrations[prefix]), ['a'])
+
+        self.assertIsNone(ms_node.expire_registrations(210.0))
+        self.assertEqual(ms_node.registrations, {})
+
+    def test_proxy_reply(self):
+        ms_node = MapServerNode(u'10.0.0.0/8', key='secret')
+        prefix = IPv4Network(u'10.1.0.0/16')
+
+        self.register(ms_node, prefix, 'a', locators=[u'192.0.2.1'])
+        self.assertEqual(ms_node.find_registered_prefix(IPv4Address(u'10.1.2.3')), prefix)
+        self.assertIsNone(ms_node.find_registered_prefix(IPv4Address(u'10.2.3.4')))
+        self.assertIsNone(ms_node.get_proxy_reply(prefix))
+
+        # The locators of all registrations are merged
+        self.register(ms_node, prefix, 'b', locators=[u'192.0.2.1', u'192.0.2.2'], proxy_map_reply=True)
+        data = ms_node.get_proxy_reply(prefix)
+        self.assertIs(ms_node.get_proxy_reply(prefix), data)
+
+        reply = MapReplyMessage.from_bytes(data)
+        self.assertEqual([locator.address for locator in reply.records[0].locator_records],
+                         [IPv4Address(u'192.0.2.1'), IPv4Address(u'192.0.2.2')])
+        self.assertFalse(reply.records[0].authoritative)
+
+        # Registering again builds a new reply
+        self.register(ms_node, prefix, 'b', locators=[u'192.0.2.3'], proxy_map_reply=True)
+        self.assertIsNot(ms_node.get_proxy_reply(prefix), data)
+
+    def map_request_message(self, itr_port):
+        map_request = MapRequestMessage(nonce='abcdefgh',
+                                        itr_rlocs=[IPv4Address(u'127.0.0.1')],
+                                        eid_prefixes=[IPv4Network(u'10.1.2.3/32')])
+        udp = UDPMessage(source_port=itr_port, destination_port=4342, payload=map_request)
+        ip = IPv4Packet(ttl=64, protocol=udp.header_type,
+                        source=IPv4Address(u'127.0.0.1'), destination=IPv4Address(u'10.1.2.3'),
+                        payload=udp)
+        ecm = EncapsulatedControlMessage(ddt_originated=True, payload=ip)
+        return ReceivedMessage(source=(IPv4Address(u'127.0.0.1'), 4342),
+                               destination=(IPv4Address(u'127.0.0.1'), 4342),
+                               message=EncapsulatedControlMessage.from_bytes(ecm.to_bytes()),
+                               socket=None)
+
+    def test_handle_map_request(self):
+        ms_node = MapServerNode(u'10.0.0.0/8', key='secret')
+        self.register(ms_node, IPv4Network(u'10.1.0.0/16'), 'a', locators=[u'192.0.2.1'], proxy_map_reply=True)
+
+        itr = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        itr.bind(('127.0.0.1', 0))
+        itr.settimeout(1.0)
+        sock = LoopbackSocket()
+
+        received_message = self.map_request_message(itr.getsockname()[1])
+        try:
+            self.assertTrue(ms_node.handle_map_request(received_message, [sock], []))
+            reply = MapReplyMessage.from_bytes(itr.recv(65536))
+            self.assertEqual(reply.nonce, 'abcdefgh')
+            self.assertEqual(reply.records[0].eid_prefix, IPv4Network(u'10.1.0.0/16'))
+        finally:
+            itr.close()
+            sock.sock.close()
+
+    def test_forward_map_request(self):
+        ms_node = MapServerNode(u'10.0.0.0/8', key='secret')
+        self.register(ms_node, IPv4Network(u'10.1.0.0/16'), 'a', locators=[u'192.0.2.1'])
+        sock = LoopbackSocket()
+
+        received_message = self.map_request_message(12345)
+        try:
+            self.assertTrue(ms_node.handle_map_request(received_message, [sock], []))
+        finally:
+            sock.sock.close()
+
+        # The ETR gets the received packet, without the DDT flag
+        [(data, address)] = sock.sent
+        self.assertEqual(address, (IPv4Address(u'192.0.2.1'), 4342))
+        ecm = EncapsulatedControlMessage.from_bytes(data)
+        self.assertFalse(ecm.ddt_originated)
+        self.assertEqual(bytes(ecm.get_payload_bytes()), bytes(received_message.message.get_payload_bytes()))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+from ipaddress import IPv4Address, IPv4Network
+from pylisp.application.lispd import settings
+from pylisp.application.lispd.data_path import EncapsulationStage
+from pylisp.application.lispd.map_cache import MapCache
+from pylisp.packet.ip.ipv4 import IPv4Packet
+from pylisp.packet.ip.udp import UDPMessage
+from pylisp.packet.lisp.control import LocatorRecord, MapReplyRecord
+from pylisp.packet.lisp.data import DataPacket
+import socket
+import unittest
+
+# Add the parent directory to the start of the path
+if __name__ == '__main__':
+    import sys
+    sys.path.insert(0, '.')
+    sys.path.insert(0, '..')
+
+
+class RecordingSocket(object):
+    family = socket.AF_INET
+
+    def __init__(self):
+        self.sent = []
+
+    def getsockname(self):
+        return (IPv4Address(u'198.51.100.1'), 4341)
+
+    def sendto(self, data, address):
+        self.sent.append((data, address))
+        return len(data)
+
+
+class FakePayload(object):
+    def __init__(self, data):
+        self.data = data
+        self.verdict = None
+
+    def get_data(self):
+        return self.data
+
+    def set_verdict(self, verdict):
+        self.verdict = verdict
+
+
+class FakeQueue(object):
+    def __init__(self, payloads, callback):
+        self.payloads = list(payloads)
+        self.callback = callback
+
+    def process_pending(self, count):
+        batch, self.payloads = self.payloads[:count], self.payloads[count:]
+        for payload in batch:
+            self.callback(payload)
+        return len(batch)
+
+
+def packet(destination):
+    udp = UDPMessage(source_port=1234, destination_port=53, payload='query')
+    return IPv4Packet(ttl=64, protocol=udp.header_type,
+                      source=IPv4Address(u'172.16.0.1'), destination=IPv4Address(destination),
+                      payload=udp).to_bytes()
+
+
+class EncapsulationStageTestCase(unittest.TestCase):
+    def setUp(self):
+        self.old_petr = settings.config.PETR
+        settings.config.PETR = None
+
+        map_cache = MapCache()
+        map_cache.add_record(MapReplyRecord(ttl=60, eid_prefix=IPv4Network(u'10.0.0.0/8'),
+                                            locator_records=[LocatorRecord(priority=1, weight=100, reachable=True,
+                                                                           address=IPv4Address(u'192.0.2.1'))]))
+        map_cache.add_record(MapReplyRecord(ttl=60, eid_prefix=IPv4Network(u'10.1.0.0/16'),
+                                            action=MapReplyRecord.ACT_NATIVELY_FORWARD))
+        map_cache.add_record(MapReplyRecord(ttl=60, eid_prefix=IPv4Network(u'10.2.0.0/16'),
+                                            action=MapReplyRecord.ACT_DROP))
+
+        self.sock = RecordingSocket()
+        self.stage = EncapsulationStage([], [self.sock], accept='accept', drop='drop', map_cache=map_cache)
+
+    def tearDown(self):
+        settings.config.PETR = self.old_petr
+
+    def test_batch(self):
+        payloads = [FakePayload(packet(destination))
+                    for destination in (u'10.0.0.1', u'10.1.0.1', u'10.2.0.1', u'10.3.0.1', u'11.0.0.1')]
+        queue = FakeQueue(payloads, self.stage)
+
+        self.assertEqual(self.stage.process(queue, 4), 4)
+        self.assertEqual(self.stage.process(queue, 4), 1)
+        self.assertEqual([payload.verdict for payload in payloads], ['drop', 'accept', 'drop', 'drop', 'drop'])
+
+        # Without a PETR the miss is dropped
+        self.assertEqual(len(self.sock.sent), 2)
+        for data, address in self.sock.sent:
+            self.assertEqual(address, (IPv4Address(u'192.0.2.1'), 4341))
+            self.assertIn(DataPacket.from_bytes(data).payload.destination,
+                          (IPv4Address(u'10.0.0.1'), IPv4Address(u'10.3.0.1')))
+
+        self.assertEqual(self.stage.counters['encapsulated'], 2)
+        self.assertEqual(self.stage.counters['native'], 1)
+        self.assertEqual(self.stage.counters['dropped'], 2)
+        self.assertEqual(self.stage.counters['full_batches'], 1)
+
+    def test_petr(self):
+        settings.config.PETR = IPv4Address(u'192.0.2.254')
+        self.assertEqual(self.stage.route(packet(u'11.0.0.1')), 'drop')
+        self.stage.flush()
+        self.assertEqual(self.sock.sent[0][1], (IPv4Address(u'192.0.2.254'), 4341))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+from ipaddress import IPv4Address, IPv4Network
+from pylisp.application.lispd import server_scores
+from pylisp.application.lispd.ddt_resolver import DDTResolver, ReferralCache
+from pylisp.application.lispd.map_cache import build_map_request_packet
+from pylisp.packet.lisp.control import EncapsulatedControlMessage, LocatorRecord, MapReferralMessage, \
+    MapReferralRecord, MapRequestMessage
+from pylisp.utils.event_loop import EventLoop, get_event_loop, set_event_loop
+import doctest
+import socket
+import time
+import unittest
+
+# Add the parent directory to the start of the path
+if __name__ == '__main__':
+    import sys
+    sys.path.insert(0, '.')
+    sys.path.insert(0, '..')
+
+
+def load_tests(loader, tests, ignore):
+    '''
+    Add doctests to the test set
+    '''
+    tests.addTests(doctest.DocTestSuite(server_scores))
+    return tests
+
+
+def referral(action, prefix, ddt_nodes=(), ttl=1440, incomplete=False):
+    locators = [LocatorRecord(priority=0, weight=0, reachable=True, address=IPv4Address(ddt_node))
+                for ddt_node in ddt_nodes]
+    return MapReferralRecord(ttl=ttl, action=action, authoritative=True, incomplete=incomplete,
+                             eid_prefix=IPv4Network(prefix), locator_records=locators)
+
+
+class DDTSocket(object):
+    '''
+    Answers DDT Map-Requests with the Map-Referral of the node they are sent
+    to, as if they came back over the network
+    '''
+    family = socket.AF_INET
+
+    def __init__(self, resolver, answers):
+        self.resolver = resolver
+        self.answers = answers
+
+    def getsockname(self):
+        return (IPv4Address(u'198.51.100.1'), 4342)
+
+    def sendto(self, data, address):
+        ecm = EncapsulatedControlMessage.from_bytes(data)
+        assert ecm.ddt_originated
+
+        record = self.answers.get(address[0])
+        if record is not None:
+            message = MapReferralMessage(nonce='abcdefgh', records=[record])
+            get_event_loop().call_soon(self.resolver.handle_map_referral,
+                                       MapReferralMessage.from_bytes(message.to_bytes()), address[0])
+        return len(data)
+
+
+class DDTResolverTestCase(unittest.TestCase):
+    def setUp(self):
+        self.old_loop = get_event_loop()
+        self.loop = EventLoop()
+        set_event_loop(self.loop)
+
+        cache = ReferralCache()
+        cache.load_root([(0, 1, IPv4Network(u'10.0.0.0/8'), IPv4Address(u'192.0.2.1'))])
+        self.resolver = DDTResolver(cache, timeout=0.05)
+
+        MS = MapReferralRecord
+        self.sock = DDTSocket(self.resolver, {
+            IPv4Address(u'192.0.2.1'): referral(MS.ACT_NODE_REFERRAL, u'10.1.0.0/16', [u'192.0.2.2']),
+            IPv4Address(u'192.0.2.2'): referral(MS.ACT_MS_REFERRAL, u'10.1.2.0/24', [u'192.0.2.3']),
+            IPv4Address(u'192.0.2.3'): referral(MS.ACT_MS_ACK, u'10.1.2.0/24'),
+        })
+
+    def tearDown(self):
+        set_event_loop(self.old_loop)
+        self.loop.close()
+
+    def resolve(self, eid):
+        eid = IPv4Address(eid)
+        map_request = MapRequestMessage(nonce='abcdefgh', itr_rlocs=[IPv4Address(u'198.51.100.1')],
+                                        eid_prefixes=[IPv4Network(eid)])
+        packet = build_map_request_packet(map_request, IPv4Address(0), eid)
+
+        task = self.loop.create_task(self.resolver.resolve(0, eid, packet, 'abcdefgh', [self.sock]))
+        deadline = time.time() + 2.0
+        while not task.done() and time.time() < deadline:
+            self.loop.run_once(0.01)
+
+        return task.result()
+
+    def test_walk(self):
+        entry = self.resolve(u'10.1.2.3')
+        self.assertEqual(entry.action, MapReferralRecord.ACT_MS_ACK)
+        self.assertEqual(self.resolver.counters['queries'], 3)
+
+        # The Map-Server is known now
+        entry = self.resolve(u'10.1.2.4')
+        self.assertEqual(entry.action, MapReferralRecord.ACT_MS_ACK)
+        self.assertEqual(self.resolver.counters['queries'], 4)
+
+        # Other parts of the tree start at the deepest known referral
+        self.sock.answers[IPv4Address(u'192.0.2.2')] = referral(MapReferralRecord.ACT_DELEGATION_HOLE,
+                                                                u'10.1.3.0/24', ttl=15)
+        self.resolve(u'10.1.3.1')
+        self.assertEqual(self.resolver.counters['queries'], 5)
+
+    def test_negative(self):
+        self.sock.answers[IPv4Address(u'192.0.2.1')] = referral(MapReferralRecord.ACT_DELEGATION_HOLE,
+                                                                u'10.9.0.0/16', ttl=15)
+        entry = self.resolve(u'10.9.0.1')
+        self.assertTrue(entry.negative)
+        self.assertEqual(entry.prefix, IPv4Network(u'10.9.0.0/16'))
+
+        # Answered from the cache
+        self.assertIs(self.resolve(u'10.9.1.1'), entry)
+        self.assertEqual(self.resolver.counters['queries'], 1)
+        self.assertEqual(self.resolver.counters['negative'], 2)
+
+    def test_whole_delegation_denied(self):
+        # A node can only deny the EID that we asked about
+        self.sock.answers[IPv4Address(u'192.0.2.1')] = referral(MapReferralRecord.ACT_NOT_AUTHORITATIVE,
+                                                                u'10.0.0.0/8', ttl=0, incomplete=True)
+        entry = self.resolve(u'10.9.0.1')
+        self.assertEqual(entry.prefix, IPv4Network(u'10.9.0.1/32'))
+        self.assertIs(self.resolve(u'10.9.0.1'), entry)
+
+        entry = self.resolve(u'10.9.0.2')
+        self.assertEqual(entry.prefix, IPv4Network(u'10.9.0.2/32'))
+        self.assertEqual(self.resolver.counters['queries'], 2)
+
+    def test_timeout(self):
+        del self.sock.answers[IPv4Address(u'192.0.2.1')]
+        self.assertIsNone(self.resolve(u'10.1.2.3'))
+        self.assertEqual(self.resolver.counters['timeouts'], 1)
+
+    def test_referral_loop(self):
+        self.sock.answers[IPv4Address(u'192.0.2.1')] = referral(MapReferralRecord.ACT_NODE_REFERRAL,
+                                                                u'10.0.0.0/8', [u'192.0.2.1'])
+        self.assertIsNone(self.resolve(u'10.1.2.3'))
+        self.assertEqual(self.resolver.counters['failed'], 1)
+
+    def test_hedged_query(self):
+        # A second root node, and the first one that we know stops answering
+        self.resolver.referral_cache.add_root(0, 1, IPv4Network(u'10.0.0.0/8'), IPv4Address(u'192.0.2.4'))
+        self.resolver.timeout = 1.0
+        self.resolver.scores.observe_rtt(IPv4Address(u'192.0.2.1'), 0.01)
+        self.sock.answers[IPv4Address(u'192.0.2.4')] = self.sock.answers.pop(IPv4Address(u'192.0.2.1'))
+
+        start = time.time()
+        entry = self.resolve(u'10.1.2.3')
+        self.assertEqual(entry.action, MapReferralRecord.ACT_MS_ACK)
+        self.assertLess(time.time() - start, 0.5)
+        self.assertEqual(self.resolver.counters['hedged'], 1)
+        self.assertEqual(self.resolver.counters['timeouts'], 0)
+        self.assertEqual(len(self.resolver.pending), 0)
+
+        # Now the other root node is asked first
+        self.assertEqual(self.resolver.scores.rank([IPv4Address(u'192.0.2.1'), IPv4Address(u'192.0.2.4')]),
+                         [IPv4Address(u'192.0.2.4'), IPv4Address(u'192.0.2.1')])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+from ipaddress import IPv4Address, IPv4Network
+from pylisp.application.lispd import settings
+from pylisp.application.lispd import map_cache
+from pylisp.application.lispd.map_cache import flow_hash, MapCache
+from pylisp.packet.ip.ipv4 import IPv4Packet
+from pylisp.packet.ip.udp import UDPMessage
+from pylisp.packet.lisp.control import EncapsulatedControlMessage, LocatorRecord, MapReplyMessage, MapReplyRecord
+import doctest
+import socket
+import unittest
+
+# Add the parent directory to the start of the path
+if __name__ == '__main__':
+    import sys
+    sys.path.insert(0, '.')
+    sys.path.insert(0, '..')
+
+
+def load_tests(loader, tests, ignore):
+    '''
+    Add doctests to the test set
+    '''
+    tests.addTests(doctest.DocTestSuite(map_cache))
+    return tests
+
+
+class RecordingSocket(object):
+    family = socket.AF_INET
+
+    def __init__(self):
+        self.sent = []
+
+    def getsockname(self):
+        return (IPv4Address(u'198.51.100.1'), 4342)
+
+    def sendto(self, data, address):
+        self.sent.append((data, address))
+        return len(data)
+
+
+def record(prefix, ttl=60, locators=(), action=MapReplyRecord.ACT_NO_ACTION, map_version=0):
+    return MapReplyRecord(ttl=ttl, action=action, map_version=map_version, eid_prefix=IPv4Network(prefix),
+                          locator_records=[LocatorRecord(priority=priority, weight=100, reachable=True,
+                                                         address=IPv4Address(address))
+                                           for address, priority in locators])
+
+
+class MapCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.old_settings = (settings.config.MAP_RESOLVER,
+                             settings.config.MAP_CACHE_SIZE,
+                             settings.config.MAP_REQUEST_INTERVAL)
+        settings.config.MAP_RESOLVER = IPv4Address(u'192.0.2.100')
+
+        self.map_cache = MapCache()
+
+    def tearDown(self):
+        (settings.config.MAP_RESOLVER,
+         settings.config.MAP_CACHE_SIZE,
+         settings.config.MAP_REQUEST_INTERVAL) = self.old_settings
+
+    def test_longest_match(self):
+        self.map_cache.add_record(record(u'10.0.0.0/8', locators=[(u'192.0.2.1', 1)]), now=0)
+        self.map_cache.add_record(record(u'10.1.0.0/16', locators=[(u'192.0.2.3', 2), (u'192.0.2.2', 1)]), now=0)
+
+        self.assertEqual(self.map_cache.lookup(0, IPv4Address(u'10.1.2.3'), now=1).select_rloc(0),
+                         IPv4Address(u'192.0.2.2'))
+        self.assertEqual(self.map_cache.lookup(0, IPv4Address(u'10.2.3.4'), now=1).select_rloc(0),
+                         IPv4Address(u'192.0.2.1'))
+        self.assertIsNone(self.map_cache.lookup(1, IPv4Address(u'10.1.2.3'), now=1))
+        self.assertIsNone(self.map_cache.lookup(0, IPv4Address(u'11.1.2.3'), now=1))
+
+    def test_negative(self):
+        entry = self.map_cache.add_record(record(u'10.0.0.0/8', action=MapReplyRecord.ACT_NATIVELY_FORWARD), now=0)
+        self.assertTrue(entry.negative)
+        self.assertIs(self.map_cache.lookup(0, IPv4Address(u'10.1.2.3'), now=1), entry)
+
+        # A TTL of zero removes the entry
+        self.assertIsNone(self.map_cache.add_record(record(u'10.0.0.0/8', ttl=0), now=0))
+        self.assertEqual(len(self.map_cache), 0)
+
+    def test_map_version(self):
+        entry = self.map_cache.add_record(record(u'10.0.0.0/8', locators=[(u'192.0.2.1', 1)], map_version=5),
+                                          now=0)
+
+        # Our source map version is unknown, the destination is the ETRs'
+        self.assertEqual(entry.header.to_bytes()[1:4], '\x00\x00\x05')
+
+    def test_flows(self):
+        entry = self.map_cache.add_record(record(u'10.0.0.0/8', locators=[(u'192.0.2.1', 1),
+                                                                          (u'192.0.2.2', 1)]), now=0)
+
+        def packet(source_port):
+            udp = UDPMessage(source_port=source_port, destination_port=53, payload='query')
+            return IPv4Packet(ttl=64, protocol=udp.header_type, identification=source_port,
+                              source=IPv4Address(u'172.16.0.1'), destination=IPv4Address(u'10.1.2.3'),
+                              payload=udp).to_bytes()
+
+        # Packets of one flow go to the same locator, and flows are spread
+        rlocs = [entry.select_rloc(flow_hash(packet(port))) for port in range(1024, 1124)]
+        self.assertEqual(entry.select_rloc(flow_hash(packet(1024))), rlocs[0])
+        self.assertGreater(rlocs.count(IPv4Address(u'192.0.2.1')), 25)
+        self.assertGreater(rlocs.count(IPv4Address(u'192.0.2.2')), 25)
+
+    def test_expiry(self):
+        self.map_cache.add_record(record(u'10.0.0.0/8', ttl=10, locators=[(u'192.0.2.1', 1)]), now=0)
+        self.map_cache.add_record(record(u'10.1.0.0/16', ttl=1, locators=[(u'192.0.2.2', 1)]), now=0)
+
+        # The expired more specific is removed and the less specific is used
+        self.assertEqual(self.map_cache.lookup(0, IPv4Address(u'10.1.2.3'), now=60).select_rloc(0),
+                         IPv4Address(u'192.0.2.1'))
+        self.assertEqual(len(self.map_cache), 1)
+        self.assertIsNone(self.map_cache.lookup(0, IPv4Address(u'10.1.2.3'), now=600))
+        self.assertEqual(self.map_cache.counters['expired'], 2)
+
+    def test_lru(self):
+        settings.config.MAP_CACHE_SIZE = 2
+
+        self.map_cache.add_record(record(u'10.0.0.0/8', locators=[(u'192.0.2.1', 1)]), now=0)
+        self.map_cache.add_record(record(u'11.0.0.0/8', locators=[(u'192.0.2.1', 1)]), now=0)
+        self.map_cache.lookup(0, IPv4Address(u'10.1.2.3'), now=1)
+        self.map_cache.add_record(record(u'12.0.0.0/8', locators=[(u'192.0.2.1', 1)]), now=2)
+
+        self.assertIsNotNone(self.map_cache.lookup(0, IPv4Address(u'10.1.2.3'), now=3))
+        self.assertIsNone(self.map_cache.lookup(0, IPv4Address(u'11.1.2.3'), now=3))
+        self.assertEqual(self.map_cache.counters['evicted'], 1)
+
+    def test_request(self):
+        sock = RecordingSocket()
+        source = IPv4Address(u'172.16.0.1')
+        destination = IPv4Address(u'10.1.2.3')
+
+        self.assertTrue(self.map_cache.request(0, source, destination, [sock], now=0))
+        self.assertFalse(self.map_cache.request(0, source, destination, [sock], now=0.5))
+        self.assertEqual(self.map_cache.counters['rate_limited'], 1)
+
+        [(data, address)] = sock.sent
+        self.assertEqual(address, (IPv4Address(u'192.0.2.100'), 4342))
+        map_request = EncapsulatedControlMessage.from_bytes(data).payload.payload.payload
+        self.assertEqual(map_request.eid_prefixes, [IPv4Network(u'10.1.2.3/32')])
+
+        # Only the records that cover the requested EID are stored
+        map_reply = MapReplyMessage(nonce=map_request.nonce,
+                                    records=[record(u'10.1.0.0/16', locators=[(u'192.0.2.1', 1)]),
+                                             record(u'11.0.0.0/8', locators=[(u'192.0.2.1', 1)])])
+        self.assertTrue(self.map_cache.handle_map_reply(map_reply, now=0.5))
+        self.assertFalse(self.map_cache.handle_map_reply(map_reply, now=0.5))
+        self.assertEqual(len(self.map_cache), 1)
+        self.assertEqual(self.map_cache.lookup(0, destination, now=1).prefix, IPv4Network(u'10.1.0.0/16'))
+
+        # After the interval we can ask again
+        self.assertTrue(self.map_cache.request(0, source, destination, [sock], now=1.5))
+
+
+if __name__ == '__main__':
+    unittest.main()
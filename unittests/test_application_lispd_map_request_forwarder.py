@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+from ipaddress import IPv4Address, ip_address
+from pylisp.application.lispd import settings
+from pylisp.application.lispd.map_request_forwarder import ForwardTargets, MapRequestForwarder
+from pylisp.packet.lisp.control import LocatorRecord
+import socket
+import unittest
+
+# Add the parent directory to the start of the path
+if __name__ == '__main__':
+    import sys
+    sys.path.insert(0, '.')
+    sys.path.insert(0, '..')
+
+
+class RecordingSocket(object):
+    family = socket.AF_INET
+
+    def __init__(self, unreachable=()):
+        self.unreachable = unreachable
+        self.sent = []
+
+    def getsockname(self):
+        return (IPv4Address(u'198.51.100.1'), 4342)
+
+    def sendto(self, data, address):
+        if address[0] in self.unreachable:
+            return 0
+
+        self.sent.append(address[0])
+        return len(data)
+
+
+def locator(address, priority, weight=0, reachable=True):
+    return LocatorRecord(priority=priority, weight=weight, reachable=reachable,
+                         address=ip_address(address))
+
+
+class MapRequestForwarderTestCase(unittest.TestCase):
+    def setUp(self):
+        self.old_rate = settings.config.MAP_REQUEST_FORWARD_RATE
+        self.old_burst = settings.config.MAP_REQUEST_FORWARD_BURST
+
+        self.forwarder = MapRequestForwarder()
+        self.targets = ForwardTargets([locator(u'192.0.2.3', 2),
+                                       locator(u'192.0.2.1', 1, 100),
+                                       locator(u'192.0.2.2', 1, 0),
+                                       locator(u'192.0.2.4', 0, reachable=False),
+                                       locator(u'192.0.2.5', 255)])
+
+    def tearDown(self):
+        settings.config.MAP_REQUEST_FORWARD_RATE = self.old_rate
+        settings.config.MAP_REQUEST_FORWARD_BURST = self.old_burst
+
+    def test_targets(self):
+        # A weight of 0 next to a weight of 100 is not used
+        self.assertEqual([group[0] for group in self.targets.groups],
+                         [[IPv4Address(u'192.0.2.1')],
+                          [IPv4Address(u'192.0.2.3')]])
+
+    def test_zero_weights(self):
+        # If all weights are zero the load is split equally
+        targets = ForwardTargets([locator(u'192.0.2.1', 1), locator(u'192.0.2.2', 1)])
+        self.assertEqual(targets.groups, [([IPv4Address(u'192.0.2.1'), IPv4Address(u'192.0.2.2')], [1, 2], 2)])
+
+    def test_weight(self):
+        sock = RecordingSocket()
+        for dummy in range(100):
+            self.assertTrue(self.forwarder.forward('data', self.targets, [sock]))
+
+        self.assertEqual(sock.sent, [IPv4Address(u'192.0.2.1')] * 100)
+
+    def test_rate_limit(self):
+        settings.config.MAP_REQUEST_FORWARD_RATE = 0.001
+        settings.config.MAP_REQUEST_FORWARD_BURST = 2
+
+        sock = RecordingSocket()
+        for dummy in range(7):
+            self.forwarder.forward('data', self.targets, [sock])
+
+        # Every ETR gets its burst, then we give up
+        self.assertEqual(sorted(sock.sent), [IPv4Address(u'192.0.2.1')] * 2 +
+                                            [IPv4Address(u'192.0.2.3')] * 2)
+        self.assertEqual(self.forwarder.counters['forwarded'], 4)
+
+    def test_unreachable(self):
+        sock = RecordingSocket(unreachable=[IPv4Address(u'192.0.2.1')])
+        self.assertTrue(self.forwarder.forward('data', self.targets, [sock]))
+        self.assertEqual(sock.sent, [IPv4Address(u'192.0.2.3')])
+        self.assertEqual(self.forwarder.counters['failed'], 1)
+
+        # The failed ETR is skipped for a while
+        self.assertTrue(self.forwarder.forward('data', self.targets, [sock]))
+        self.assertEqual(self.forwarder.counters['failed'], 1)
+        self.assertEqual(self.forwarder.counters['unreachable'], 1)
+
+    def test_dual_stack(self):
+        # Equal weights of IPv4 and IPv6 ETRs must not make us compare
+        # their addresses
+        targets = ForwardTargets([locator(u'192.0.2.1', 1, 50),
+                                  locator(u'192.0.2.2', 1, 50),
+                                  locator(u'2001:db8::1', 1, 50)])
+        sock = RecordingSocket(unreachable=[IPv4Address(u'192.0.2.1'), IPv4Address(u'192.0.2.2')])
+        self.assertFalse(self.forwarder.forward('data', targets, [sock]))
+        self.assertEqual(sock.sent, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
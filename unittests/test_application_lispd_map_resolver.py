@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+from ipaddress import IPv4Address, IPv4Network
+from pylisp.application.lispd import settings
+from pylisp.application.lispd.ddt_resolver import DDTResolver, ReferralCache
+from pylisp.application.lispd.map_cache import build_map_request_packet
+from pylisp.application.lispd.map_resolver import MapResolver
+from pylisp.application.lispd.received_message import ReceivedMessage
+from pylisp.packet.lisp.control import EncapsulatedControlMessage, LocatorRecord, MapReferralMessage, \
+    MapReferralRecord, MapReplyMessage, MapReplyRecord, MapRequestMessage
+from pylisp.utils.event_loop import EventLoop, get_event_loop, set_event_loop
+from pylisp.utils.lcaf.instance_address import LCAFInstanceAddress
+import socket
+import time
+import unittest
+
+# Add the parent directory to the start of the path
+if __name__ == '__main__':
+    import sys
+    sys.path.insert(0, '.')
+    sys.path.insert(0, '..')
+
+
+def referral(action, prefix, ddt_nodes=(), ttl=1440):
+    locators = [LocatorRecord(priority=0, weight=0, reachable=True, address=IPv4Address(ddt_node))
+                for ddt_node in ddt_nodes]
+    return MapReferralRecord(ttl=ttl, action=action, authoritative=True, eid_prefix=IPv4Network(prefix),
+                             locator_records=locators)
+
+
+def plain_prefix(prefix):
+    if isinstance(prefix, LCAFInstanceAddress):
+        return prefix.address
+    return prefix
+
+
+class ResolverSocket(object):
+    '''
+    Answers DDT Map-Requests with the Map-Referral of the node they are sent
+    to a little later, and records everything else
+    '''
+    family = socket.AF_INET
+
+    def __init__(self, resolver, answers):
+        self.resolver = resolver
+        self.answers = answers
+        self.queries = []
+        self.sent = []
+
+    def getsockname(self):
+        return (IPv4Address(u'198.51.100.1'), 4342)
+
+    def answer(self, nonce, eid, address):
+        # A node can have different answers for different parts of the tree
+        records = self.answers.get(address)
+        if not isinstance(records, list):
+            records = [records]
+        records = [record for record in records
+                   if record is not None and eid in plain_prefix(record.eid_prefix)]
+        if not records:
+            return
+
+        message = MapReferralMessage(nonce=nonce, records=records[:1])
+        self.resolver.handle_map_referral(MapReferralMessage.from_bytes(message.to_bytes()), address)
+
+    def sendto(self, data, address):
+        if ord(data[0]) >> 4 != 8:
+            self.sent.append((data, address))
+            return len(data)
+
+        self.queries.append(address[0])
+        map_request = EncapsulatedControlMessage.from_bytes(data).get_udp().get_lisp_control_message()
+        eid = plain_prefix(map_request.eid_prefixes[0]).network_address
+        get_event_loop().call_later(0.01, self.answer, map_request.nonce, eid, address[0])
+        return len(data)
+
+
+class MapResolverTestCase(unittest.TestCase):
+    def setUp(self):
+        self.old_loop = get_event_loop()
+        self.loop = EventLoop()
+        set_event_loop(self.loop)
+        self.old_limit = settings.config.MAP_RESOLVER_PENDING_PER_ITR
+
+        cache = ReferralCache()
+        cache.load_root([(0, 1, IPv4Network(u'10.0.0.0/8'), IPv4Address(u'192.0.2.1'))])
+        resolver = DDTResolver(cache, timeout=0.5)
+        self.map_resolver = MapResolver(resolver)
+
+        MS = MapReferralRecord
+        self.sock = ResolverSocket(resolver, {
+            IPv4Address(u'192.0.2.1'): referral(MS.ACT_NODE_REFERRAL, u'10.1.0.0/16', [u'192.0.2.2']),
+            IPv4Address(u'192.0.2.2'): referral(MS.ACT_MS_REFERRAL, u'10.1.2.0/24', [u'192.0.2.3']),
+            IPv4Address(u'192.0.2.3'): referral(MS.ACT_MS_ACK, u'10.1.2.0/24'),
+        })
+
+    def tearDown(self):
+        settings.config.MAP_RESOLVER_PENDING_PER_ITR = self.old_limit
+        set_event_loop(self.old_loop)
+        self.loop.close()
+
+    def received_message(self, itr, eid, nonce):
+        eid = IPv4Address(eid)
+        map_request = MapRequestMessage(nonce=nonce, itr_rlocs=[IPv4Address(itr)],
+                                        eid_prefixes=[IPv4Network(eid)])
+        ecm = EncapsulatedControlMessage(payload=build_map_request_packet(map_request, IPv4Address(0), eid))
+        return ReceivedMessage(source=(IPv4Address(itr), 4342),
+                               destination=(IPv4Address(u'198.51.100.1'), 4342),
+                               message=EncapsulatedControlMessage.from_bytes(ecm.to_bytes()),
+                               socket=None)
+
+    def handle(self, *requests):
+        tasks = []
+        for itr, eid, nonce in requests:
+            received_message = self.received_message(itr, eid, nonce)
+            handler = self.map_resolver.handle_map_request(received_message, 0, IPv4Address(eid), [self.sock])
+            tasks.append(self.loop.create_task(handler))
+
+        deadline = time.time() + 2.0
+        while not all(task.done() for task in tasks) and time.time() < deadline:
+            self.loop.run_once(0.01)
+
+    def test_coalescing(self):
+        self.handle((u'192.0.2.101', u'10.1.2.3', 'nonce--1'),
+                    (u'192.0.2.102', u'10.1.2.3', 'nonce--2'),
+                    (u'192.0.2.103', u'10.1.2.4', 'nonce--3'))
+
+        # One walk through the tree, then every request to the Map-Server
+        self.assertEqual(self.sock.queries.count(IPv4Address(u'192.0.2.1')), 1)
+        self.assertEqual(self.sock.queries.count(IPv4Address(u'192.0.2.2')), 1)
+        self.assertEqual(self.sock.queries.count(IPv4Address(u'192.0.2.3')), 3)
+        self.assertEqual(self.map_resolver.counters['coalesced'], 2)
+        self.assertEqual(self.map_resolver.counters['forwarded'], 3)
+
+    def test_pending_limit(self):
+        settings.config.MAP_RESOLVER_PENDING_PER_ITR = 1
+        self.handle((u'192.0.2.101', u'10.1.2.3', 'nonce--1'),
+                    (u'192.0.2.101', u'10.1.2.4', 'nonce--2'),
+                    (u'192.0.2.102', u'10.1.2.5', 'nonce--3'))
+
+        self.assertEqual(self.map_resolver.counters['limited'], 1)
+        self.assertEqual(self.map_resolver.counters['forwarded'], 2)
+
+        # Finished requests don't count anymore
+        self.handle((u'192.0.2.101', u'10.1.2.4', 'nonce--2'))
+        self.assertEqual(self.map_resolver.counters['forwarded'], 3)
+
+    def test_failed_walk(self):
+        # The DDT node for 10.1.0.0/16 doesn't answer, but the rest of the
+        # tree works
+        MS = MapReferralRecord
+        self.sock.answers[IPv4Address(u'192.0.2.1')] = [
+            referral(MS.ACT_NODE_REFERRAL, u'10.1.0.0/16', [u'192.0.2.2']),
+            referral(MS.ACT_DELEGATION_HOLE, u'10.9.0.0/16', ttl=15),
+        ]
+        del self.sock.answers[IPv4Address(u'192.0.2.2')]
+
+        self.handle((u'192.0.2.101', u'10.1.2.3', 'nonce--1'),
+                    (u'192.0.2.102', u'10.9.0.1', 'nonce--2'),
+                    (u'192.0.2.103', u'10.1.5.5', 'nonce--3'))
+
+        # Only the request below the failed referral gives up with it
+        self.assertEqual(self.sock.queries.count(IPv4Address(u'192.0.2.2')), 1)
+        self.assertEqual(self.map_resolver.counters['coalesced'], 2)
+        self.assertEqual(self.map_resolver.counters['failed'], 2)
+        self.assertEqual(self.map_resolver.counters['negative_replies'], 1)
+        [(data, address)] = self.sock.sent
+        self.assertEqual(address, (IPv4Address(u'192.0.2.102'), 4342))
+
+    def test_negative_reply(self):
+        self.sock.answers[IPv4Address(u'192.0.2.1')] = referral(MapReferralRecord.ACT_DELEGATION_HOLE,
+                                                                u'10.9.0.0/16', ttl=15)
+        self.handle((u'192.0.2.101', u'10.9.0.1', 'nonce--1'))
+
+        [(data, address)] = self.sock.sent
+        self.assertEqual(address, (IPv4Address(u'192.0.2.101'), 4342))
+        reply = MapReplyMessage.from_bytes(data)
+        self.assertEqual(reply.nonce, 'nonce--1')
+        self.assertEqual(reply.records[0].action, MapReplyRecord.ACT_NATIVELY_FORWARD)
+        self.assertEqual(reply.records[0].ttl, 15)
+        self.assertEqual(reply.records[0].eid_prefix, IPv4Network(u'10.9.0.0/16'))
+
+
+if __name__ == '__main__':
+    unittest.main()
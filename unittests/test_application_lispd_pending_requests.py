@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+from ipaddress import IPv4Address
+from pylisp.application.lispd.pending_requests import PendingRequestRegistry
+from pylisp.utils.event_loop import EventLoop, get_event_loop, set_event_loop
+import time
+import unittest
+
+# Add the parent directory to the start of the path
+if __name__ == '__main__':
+    import sys
+    sys.path.insert(0, '.')
+    sys.path.insert(0, '..')
+
+
+class PendingRequestRegistryTestCase(unittest.TestCase):
+    def setUp(self):
+        self.old_loop = get_event_loop()
+        self.loop = EventLoop()
+        set_event_loop(self.loop)
+
+        self.registry = PendingRequestRegistry('Test')
+        self.peer = IPv4Address(u'192.0.2.1')
+
+    def tearDown(self):
+        set_event_loop(self.old_loop)
+        self.loop.close()
+
+    def test_match(self):
+        future = self.registry.add('nonce', self.peer, 10.0)
+        self.assertIn(('nonce', self.peer), self.registry)
+
+        # Same nonce, wrong peer
+        self.assertFalse(self.registry.match('nonce', IPv4Address(u'192.0.2.2'), 'reply'))
+        self.assertFalse(future.done())
+
+        self.assertTrue(self.registry.match('nonce', self.peer, 'reply'))
+        self.assertEqual(future.result(), 'reply')
+        self.assertEqual(len(self.registry), 0)
+
+        # A duplicate reply is late
+        self.assertFalse(self.registry.match('nonce', self.peer, 'reply'))
+        self.assertEqual(self.registry.counters, {'requests': 1,
+                                                  'matched': 1,
+                                                  'expired': 0,
+                                                  'late': 1,
+                                                  'unmatched': 1})
+
+    def test_expire(self):
+        future = self.registry.add('nonce', self.peer, 0.01)
+        self.assertRaises(ValueError, self.registry.add, 'nonce', self.peer, 0.01)
+
+        deadline = time.time() + 1.0
+        while not future.done() and time.time() < deadline:
+            self.loop.run_once(0.1)
+
+        self.assertTrue(future.cancelled())
+        self.assertEqual(self.registry.counters['expired'], 1)
+
+        # The reply arrived too late
+        self.assertFalse(self.registry.match('nonce', self.peer, 'reply'))
+        self.assertEqual(self.registry.counters['late'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
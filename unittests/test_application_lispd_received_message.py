@@ -0,0 +1,38 @@
+#!/usr/bin/env python
+from ipaddress import IPv4Address, IPv4Network
+from pylisp.application.lispd.received_message import ReceivedMessage
+from pylisp.packet.lisp.control import AuthenticationKey, MapRegisterMessage, MapRegisterRecord, KEY_ID_HMAC_SHA_1_96
+import unittest
+
+# Add the parent directory to the start of the path
+if __name__ == '__main__':
+    import sys
+    sys.path.insert(0, '.')
+    sys.path.insert(0, '..')
+
+
+class ReceivedMessageTestCase(unittest.TestCase):
+    def test_authentication_results(self):
+        '''
+        Records for MapServerNodes that share a key are verified only once
+        '''
+        records = [MapRegisterRecord(ttl=1440, eid_prefix=IPv4Network(u'192.0.2.0/25')),
+                   MapRegisterRecord(ttl=1440, eid_prefix=IPv4Network(u'192.0.2.128/25'))]
+        map_register = MapRegisterMessage(key_id=KEY_ID_HMAC_SHA_1_96, records=records)
+        map_register.insert_authentication_data('secret')
+        map_register = MapRegisterMessage.from_bytes(map_register.to_bytes())
+
+        received_message = ReceivedMessage(source=(IPv4Address(u'198.51.100.1'), 4342),
+                                           destination=(IPv4Address(u'198.51.100.2'), 4342),
+                                           message=map_register,
+                                           socket=None)
+
+        saved = ReceivedMessage.authentications_saved
+        self.assertTrue(received_message.verify_authentication_data(AuthenticationKey('secret')))
+        self.assertTrue(received_message.verify_authentication_data(AuthenticationKey('secret')))
+        self.assertFalse(received_message.verify_authentication_data(AuthenticationKey('wrong')))
+        self.assertEqual(ReceivedMessage.authentications_saved, saved + 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
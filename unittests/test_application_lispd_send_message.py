@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+from ipaddress import IPv4Address, IPv6Address
+from pylisp.application.lispd.send_message import find_matching_sockets, send_bytes, send_bytes_to_all
+import socket
+import unittest
+
+# Add the parent directory to the start of the path
+if __name__ == '__main__':
+    import sys
+    sys.path.insert(0, '.')
+    sys.path.insert(0, '..')
+
+
+class RecordingSocket(object):
+    def __init__(self, family, address, bound=True):
+        self.family = family
+        self.address = address
+        self.bound = bound
+        self.rebind_targets = []
+        self.sent = []
+
+    def add_rebind_target(self, target):
+        self.rebind_targets.append(target)
+
+    def fileno(self):
+        return self.bound and 3 or None
+
+    def getsockname(self):
+        return (self.address, 4342)
+
+    def sendto(self, data, address):
+        self.sent.append((data, address))
+        return len(data)
+
+
+class SendMessageTestCase(unittest.TestCase):
+    def setUp(self):
+        self.sockets = [RecordingSocket(socket.AF_INET, IPv4Address(u'198.51.100.1'), bound=False),
+                        RecordingSocket(socket.AF_INET, IPv4Address(u'198.51.100.2')),
+                        RecordingSocket(socket.AF_INET6, IPv6Address(u'2001:db8::1'))]
+
+    def test_socket_table(self):
+        '''
+        Sockets that are not bound are skipped until they are rebound
+        '''
+        self.assertEqual(find_matching_sockets(IPv4Address(u'192.0.2.1'), self.sockets), self.sockets[1:2])
+
+        self.sockets[0].bound = True
+        for target in self.sockets[0].rebind_targets:
+            target.on_socket_rebind(self.sockets[0])
+        self.assertEqual(find_matching_sockets(IPv4Address(u'192.0.2.1'), self.sockets), self.sockets[:2])
+
+        self.assertEqual(send_bytes('data', self.sockets, [u'2001:db8::2']),
+                         ((IPv6Address(u'2001:db8::1'), 4342), (IPv6Address(u'2001:db8::2'), 4342)))
+
+    def test_single_socket(self):
+        '''
+        A single socket that is not bound is skipped as well
+        '''
+        self.assertEqual(find_matching_sockets(IPv4Address(u'192.0.2.1'), self.sockets[:1]), [])
+        self.assertEqual(find_matching_sockets(IPv4Address(u'192.0.2.1'), self.sockets[1:2]), self.sockets[1:2])
+        self.assertEqual(find_matching_sockets(IPv6Address(u'2001:db8::2'), self.sockets[1:2]), [])
+
+    def test_send_to_all(self):
+        destinations = [IPv4Address(u'192.0.2.1'), IPv6Address(u'2001:db8::2'), u'192.0.2.2']
+        self.assertEqual(send_bytes_to_all('data', self.sockets, destinations, port=4341), 3)
+        self.assertEqual(self.sockets[1].sent, [('data', (IPv4Address(u'192.0.2.1'), 4341)),
+                                                ('data', (IPv4Address(u'192.0.2.2'), 4341))])
+        self.assertEqual(self.sockets[2].sent, [('data', (IPv6Address(u'2001:db8::2'), 4341))])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+from ipaddress import IPv4Address, IPv4Network, IPv6Network
+from pylisp.application.lispd.address_tree.authoritative_container_node import AuthContainerNode
+from pylisp.application.lispd.address_tree.ddt_referral_node import DDTReferralNode
+from pylisp.application.lispd.utils.ddt_root_loader import add_delegation, build_ddt_root
+import unittest
+
+# Add the parent directory to the start of the path
+if __name__ == '__main__':
+    import sys
+    sys.path.insert(0, '.')
+    sys.path.insert(0, '..')
+
+
+class DDTRootLoaderTestCase(unittest.TestCase):
+    delegations = [(0, 1, IPv4Network(u'10.0.0.0/8'), IPv4Address(u'192.0.2.1')),
+                   (0, 1, IPv4Network(u'11.0.0.0/8'), IPv4Address(u'192.0.2.1')),
+                   (0, 1, IPv4Network(u'10.0.0.0/8'), IPv4Address(u'192.0.2.2')),
+                   (0, 2, IPv6Network(u'2001:db8::/32'), IPv4Address(u'192.0.2.1')),
+                   (5, 1, IPv4Network(u'10.0.0.0/8'), IPv4Address(u'192.0.2.3'))]
+
+    def test_build_ddt_root(self):
+        instances = build_ddt_root(self.delegations)
+        self.assertEqual(sorted(instances), [0, 5])
+        self.assertEqual(sorted(instances[0]), [1, 2])
+        self.assertIsInstance(instances[0][1], AuthContainerNode)
+
+        node = instances[0][1].resolve(u'10.1.2.3/32')
+        self.assertIsInstance(node, DDTReferralNode)
+        self.assertEqual(node.ddt_nodes, set([IPv4Address(u'192.0.2.1'), IPv4Address(u'192.0.2.2')]))
+        self.assertEqual(len(instances[0][1]), 2)
+
+        # The same as adding them one by one
+        one_by_one = {}
+        for delegation in self.delegations:
+            add_delegation(one_by_one, *delegation)
+        for instance_id, afis in one_by_one.iteritems():
+            for afi, root in afis.iteritems():
+                self.assertEqual(sorted((child.prefix, sorted(child.ddt_nodes)) for child in root),
+                                 sorted((child.prefix, sorted(child.ddt_nodes))
+                                        for child in instances[instance_id][afi]))
+
+    def test_overlap(self):
+        with self.assertRaises(ValueError):
+            build_ddt_root(self.delegations + [(0, 1, IPv4Network(u'10.1.0.0/16'), IPv4Address(u'192.0.2.1'))])
+
+        with self.assertRaises(ValueError):
+            build_ddt_root([(0, 1, IPv6Network(u'2001:db8::/32'), IPv4Address(u'192.0.2.1'))])
+
+
+if __name__ == '__main__':
+    unittest.main()
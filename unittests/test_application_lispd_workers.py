@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+from ipaddress import IPv4Address, IPv4Network, IPv6Network
+from pylisp.application.lispd import settings
+from pylisp.application.lispd.address_tree.container_node import ContainerNode
+from pylisp.application.lispd.address_tree.map_server_node import MapServerNode, MapServerRegistration
+from pylisp.application.lispd.workers import WorkerChannel
+from pylisp.packet.lisp.control.locator_record import LocatorRecord
+from pylisp.packet.lisp.control.map_register_record import MapRegisterRecord
+import socket
+import time
+import unittest
+
+# Add the parent directory to the start of the path
+if __name__ == '__main__':
+    import sys
+    sys.path.insert(0, '.')
+    sys.path.insert(0, '..')
+
+
+class WorkerChannelTestCase(unittest.TestCase):
+    def setUp(self):
+        self.old_instances = settings.config.INSTANCES
+
+        sock1, sock2 = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sender = WorkerChannel(sock1, 0)
+        self.receiver = WorkerChannel(sock2, 1)
+
+    def tearDown(self):
+        settings.config.INSTANCES = self.old_instances
+        self.sender.sock.close()
+        self.receiver.sock.close()
+
+    def use_map_server(self):
+        ms_node = MapServerNode(u'192.0.2.0/24', key='secret')
+        settings.config.INSTANCES = {0: {1: ContainerNode(u'0.0.0.0/0', [ms_node]),
+                                         2: ContainerNode(u'::/0')}}
+        return ms_node
+
+    def test_replication(self):
+        '''
+        A registration is stored by the other worker with the same deadline
+        '''
+        prefix = IPv4Network(u'192.0.2.16/28')
+        record = MapRegisterRecord(ttl=1440, authoritative=True,
+                                   eid_prefix=prefix,
+                                   locator_records=[LocatorRecord(priority=1, weight=100,
+                                                                  address=IPv4Address(u'198.51.100.1'),
+                                                                  reachable=True)])
+        registration = MapServerRegistration(record, proxy_map_reply=True)
+
+        ms_node1 = self.use_map_server()
+        self.sender.on_registration(ms_node1, prefix, '0-1234', registration)
+
+        # The receiving worker has its own tree
+        ms_node2 = self.use_map_server()
+        self.receiver.handle_messages()
+
+        copy = ms_node2.registrations[prefix]['0-1234']
+        self.assertEqual(copy.record.to_bytes(), record.to_bytes())
+        self.assertTrue(copy.proxy_map_reply)
+        self.assertEqual(copy.deadline, registration.deadline)
+
+        # Expired registrations are ignored
+        registration.deadline = time.time() - 1
+        self.sender.on_registration(ms_node1, prefix, '0-5678', registration)
+        self.receiver.handle_messages()
+        self.assertNotIn('0-5678', ms_node2.registrations[prefix])
+
+
+if __name__ == '__main__':
+    unittest.main()
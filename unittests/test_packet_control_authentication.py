@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+
+# Add the parent directory to the start of the path
+if __name__ == '__main__':
+    import sys
+    sys.path.insert(0, '.')
+    sys.path.insert(0, '..')
+
+from ipaddress import IPv4Address, IPv4Network
+from pylisp.packet.lisp.control import authentication, AuthenticationKey, \
+    MapRegisterMessage, MapNotifyMessage, InfoMessage, MapRegisterRecord, \
+    LocatorRecord, KEY_ID_HMAC_SHA_1_96, KEY_ID_HMAC_SHA_256_128
+import doctest
+import unittest
+
+
+def load_tests(loader, tests, ignore):
+    '''
+    Add doctests to the test set
+    '''
+    tests.addTests(doctest.DocTestSuite(authentication))
+    return tests
+
+
+def sample_messages():
+    records = [MapRegisterRecord(ttl=1440, authoritative=True,
+                                 eid_prefix=IPv4Network(u'192.0.2.0/24'),
+                                 locator_records=[LocatorRecord(priority=1, weight=100, reachable=True,
+                                                                address=IPv4Address(u'198.51.100.1'))])]
+    return [MapRegisterMessage(want_map_notify=True, key_id=KEY_ID_HMAC_SHA_1_96,
+                               records=records, xtr_id=1234, site_id=5678),
+            MapNotifyMessage(nonce='12345678', key_id=KEY_ID_HMAC_SHA_256_128,
+                             records=records),
+            InfoMessage(nonce='abcdefgh', key_id=KEY_ID_HMAC_SHA_1_96,
+                        eid_prefix=IPv4Network(u'192.0.2.0/24'))]
+
+
+class AuthenticationTestCase(unittest.TestCase):
+    def test_received(self):
+        '''
+        Received messages are verified over the bytes they were parsed from
+        '''
+        key = AuthenticationKey('secret')
+        for message in sample_messages():
+            message.insert_authentication_data(key)
+            data = message.to_bytes()
+
+            received = message.__class__.from_bytes(data)
+            self.assertEqual(str(received._wire_data), data)
+            self.assertTrue(received.verify_authentication_data(key))
+            self.assertTrue(received.verify_authentication_data('secret'))
+            self.assertFalse(received.verify_authentication_data('wrong'))
+
+            # Tampering with the nonce is detected
+            tampered = data[:4] + chr(ord(data[4]) ^ 1) + data[5:]
+            received = message.__class__.from_bytes(tampered)
+            self.assertFalse(received.verify_authentication_data(key))
+
+    def test_received_changed(self):
+        '''
+        Changed messages are not verified over the bytes they were parsed from
+        '''
+        key = AuthenticationKey('secret')
+        for message in sample_messages():
+            message.insert_authentication_data(key)
+            data = message.to_bytes()
+
+            received = message.__class__.from_bytes(data)
+            received.nonce = '\xff' * 8
+            self.assertIsNone(received.get_wire_data())
+            self.assertFalse(received.verify_authentication_data(key))
+
+            # Until the authentication data is calculated again
+            received.insert_authentication_data(key)
+            self.assertTrue(received.verify_authentication_data(key))
+
+            if not hasattr(received, 'records'):
+                continue
+
+            # Changing the list of records is noticed as well
+            received = message.__class__.from_bytes(data)
+            received.records.append(received.records[0])
+            self.assertIsNone(received.get_wire_data())
+            self.assertFalse(received.verify_authentication_data(key))
+
+            received = message.__class__.from_bytes(data)
+            del received.records[:]
+            self.assertFalse(received.verify_authentication_data(key))
+
+    def test_calculated(self):
+        '''
+        Both ways of verifying give the same result
+        '''
+        for message in sample_messages():
+            message.insert_authentication_data('secret')
+            self.assertIsNone(message._wire_data)
+            self.assertEqual(message.authentication_data,
+                             message.calculate_authentication_data(AuthenticationKey('secret')))
+            self.assertTrue(message.verify_authentication_data('secret'))
+            self.assertFalse(message.verify_authentication_data('wrong'))
+
+
+if __name__ == '__main__':
+    unittest.main()
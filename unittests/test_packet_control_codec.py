@@ -0,0 +1,246 @@
+#!/usr/bin/env python
+
+# Add the parent directory to the start of the path
+if __name__ == '__main__':
+    import sys
+    sys.path.insert(0, '.')
+    sys.path.insert(0, '..')
+
+from bitstring import ConstBitStream
+from ipaddress import IPv4Address, IPv4Network, IPv6Address, IPv6Network
+from pylisp.packet.lisp.control import codec, ControlMessage, \
+    MapRequestMessage, MapReplyMessage, MapRegisterMessage, MapNotifyMessage, \
+    MapReferralMessage, InfoMessage, EncapsulatedControlMessage, \
+    MapReplyRecord, MapRegisterRecord, MapReferralRecord, LocatorRecord, \
+    KEY_ID_HMAC_SHA_1_96
+from pylisp.utils.lcaf import LCAFInstanceAddress, LCAFNATTraversalAddress
+import doctest
+import random
+import re
+import unittest
+
+
+def load_tests(loader, tests, ignore):
+    '''
+    Add doctests to the test set
+    '''
+    tests.addTests(doctest.DocTestSuite(codec))
+    return tests
+
+
+def locators():
+    return [LocatorRecord(priority=1, weight=100, reachable=True,
+                          address=IPv4Address(u'192.0.2.1')),
+            LocatorRecord(priority=2, weight=50, m_priority=3, m_weight=4,
+                          local=True, reachable=True,
+                          address=IPv6Address(u'2001:db8::1'))]
+
+
+def sample_messages():
+    '''
+    Messages of every type, using as many features as possible
+    '''
+    messages = [
+        MapRequestMessage(probe=True, smr=True, nonce='abcdefgh',
+                          source_eid=IPv4Address(u'172.16.31.3'),
+                          itr_rlocs=[IPv4Address(u'192.0.2.1'),
+                                     IPv6Address(u'2001:db8::1')],
+                          eid_prefixes=[IPv4Network(u'10.0.0.0/8')],
+                          map_reply=MapReplyRecord(ttl=60, authoritative=True,
+                                                   eid_prefix=IPv4Network(u'172.16.31.0/24'),
+                                                   locator_records=locators())),
+        MapRequestMessage(authoritative=True, pitr=True, smr_invoked=True,
+                          itr_rlocs=[IPv6Address(u'2001:db8::1')],
+                          eid_prefixes=[IPv6Network(u'2001:db8:1::/48'),
+                                        IPv4Address(u'10.1.2.3')]),
+        MapReplyMessage(probe=True, enlra_enabled=True, nonce='12345678',
+                        records=[MapReplyRecord(ttl=1440, map_version=7,
+                                                eid_prefix=IPv6Network(u'2001:db8::/32'),
+                                                locator_records=locators()),
+                                 MapReplyRecord(ttl=15, action=MapReplyRecord.ACT_DROP,
+                                                eid_prefix=IPv4Network(u'10.0.0.0/16'))]),
+        MapReplyMessage(nonce='abc'),
+        MapRegisterMessage(proxy_map_reply=True, want_map_notify=True,
+                           nonce='nonce123', key_id=KEY_ID_HMAC_SHA_1_96,
+                           authentication_data='\x01' * 20,
+                           records=[MapRegisterRecord(ttl=1440, authoritative=True,
+                                                      eid_prefix=IPv4Network(u'37.77.57.56/30'),
+                                                      locator_records=locators())],
+                           xtr_id=266545332235412465937187393052518930680L,
+                           site_id=0x1234567890abcdefL),
+        MapRegisterMessage(for_rtr=True, nonce='nonce456',
+                           records=[MapRegisterRecord(ttl=10,
+                                                      eid_prefix=IPv6Network(u'2001:db8::/48'))]),
+        MapNotifyMessage(nonce='notify!!', key_id=KEY_ID_HMAC_SHA_1_96,
+                         authentication_data='\x02' * 20,
+                         records=[MapRegisterRecord(ttl=1440,
+                                                    eid_prefix=IPv4Network(u'192.0.2.0/24'),
+                                                    locator_records=locators())],
+                         xtr_id=1, site_id=2),
+        MapReferralMessage(nonce='referral',
+                           records=[MapReferralRecord(ttl=1440, authoritative=True,
+                                                      eid_prefix=IPv4Network(u'37.77.56.0/21'),
+                                                      locator_records=locators()),
+                                    MapReferralRecord(ttl=0, incomplete=True,
+                                                      action=MapReferralRecord.ACT_NOT_AUTHORITATIVE,
+                                                      eid_prefix=LCAFInstanceAddress(instance_id=123,
+                                                                                     address=IPv6Network(u'2001:db8::/32')))]),
+        InfoMessage(nonce='info-req', ttl=1440,
+                    eid_prefix=IPv4Network(u'192.0.2.0/24')),
+        InfoMessage(is_reply=True, nonce='info-rep', key_id=KEY_ID_HMAC_SHA_1_96,
+                    authentication_data='\x03' * 20, ttl=1440,
+                    eid_prefix=IPv6Network(u'2001:db8::/32'),
+                    reply=LCAFNATTraversalAddress(map_server_port=4342, etr_port=4342,
+                                                  global_etr_rloc=IPv4Address(u'192.0.2.1'),
+                                                  map_server_rloc=IPv4Address(u'192.0.2.2'),
+                                                  private_etr_rloc=IPv4Address(u'10.0.0.1'))),
+        EncapsulatedControlMessage(ddt_originated=True, payload='\x00Dummy'),
+    ]
+
+    return messages
+
+
+# Vectors copied from the doctests
+vectors = [
+    '13000001ae92b5574f849cd00001ac101f0300015cfe1cbd00200001ac101f01',
+    '80000000'
+    '6e000000004811402a0086400001ffff000000000000000a2a02000000000000'
+    '000000000000000010f610f60048739610000201ee924adef97a97d700000001'
+    '57c3c44d00015f61535d0002200109e085000b000000000000000001000f0002'
+    '2a020000000000000000000000000000',
+]
+
+
+class use_codec(object):
+    '''
+    Context manager to select the codec
+    '''
+    def __init__(self, use_struct):
+        self.use_struct = use_struct
+
+    def __enter__(self):
+        self.orig_use_struct = codec.USE_STRUCT_CODEC
+        codec.USE_STRUCT_CODEC = self.use_struct
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        codec.USE_STRUCT_CODEC = self.orig_use_struct
+
+
+def parse(data, use_struct):
+    with use_codec(use_struct):
+        if use_struct:
+            return ControlMessage.from_bytes(data)
+        else:
+            return ControlMessage.from_bytes(ConstBitStream(bytes=data))
+
+
+def encode(message, use_struct):
+    with use_codec(use_struct):
+        return message.to_bytes()
+
+
+def normalised_repr(message):
+    # Bitstring returns longs where struct returns ints
+    return re.sub(r'(\d)L\b', r'\1', repr(message))
+
+
+class CodecTestCase(unittest.TestCase):
+    def assertSameMessage(self, message1, message2):
+        self.assertIs(type(message1), type(message2))
+        self.assertEqual(normalised_repr(message1), normalised_repr(message2))
+        self.assertEqual(message1.__dict__.get('_reserved1'),
+                         message2.__dict__.get('_reserved1'))
+
+    def test_encode(self):
+        '''
+        Both codecs must produce exactly the same bytes
+        '''
+        for message in sample_messages():
+            self.assertEqual(encode(message, True).encode('hex'),
+                             encode(message, False).encode('hex'),
+                             message.__class__.__name__)
+
+    def test_decode(self):
+        '''
+        Both codecs must produce the same messages
+        '''
+        data_list = [encode(message, False) for message in sample_messages()]
+        data_list += [vector.decode('hex') for vector in vectors]
+
+        for data in data_list:
+            message1 = parse(data, True)
+            message2 = parse(data, False)
+            self.assertSameMessage(message1, message2)
+
+            # And they must encode to the original data again
+            self.assertEqual(encode(message1, True), data)
+            self.assertEqual(encode(message2, False), data)
+
+    def test_reserved_bits(self):
+        '''
+        Reserved bits must survive a round trip
+        '''
+        data = bytearray(encode(sample_messages()[0], False))
+        data[1] |= 0x3f
+        data[2] |= 0xe0
+        data = bytes(data)
+
+        message1 = parse(data, True)
+        message2 = parse(data, False)
+        self.assertEqual(message1._reserved1, 0x1ff)
+        self.assertSameMessage(message1, message2)
+        self.assertEqual(encode(message1, True), data)
+
+    def test_buffer_types(self):
+        '''
+        The struct codec accepts any kind of buffer
+        '''
+        data = encode(sample_messages()[4], True)
+        expected = repr(parse(data, True))
+
+        for buf in (bytearray(data), buffer(data), memoryview(data)):
+            self.assertEqual(repr(ControlMessage.from_bytes(buf)), expected)
+
+    def test_fuzz(self):
+        '''
+        Both codecs must accept and reject the same damaged messages
+        '''
+        rnd = random.Random(1234)
+        originals = [encode(message, False) for message in sample_messages()
+                     if not isinstance(message, EncapsulatedControlMessage)]
+
+        for dummy in range(2000):
+            data = bytearray(rnd.choice(originals))
+
+            mutation = rnd.randint(0, 2)
+            if mutation == 0:
+                # Truncate
+                del data[rnd.randint(1, len(data) - 1):]
+            elif mutation == 1:
+                # Flip some bits
+                for dummy in range(rnd.randint(1, 3)):
+                    data[rnd.randint(0, len(data) - 1)] ^= 1 << rnd.randint(0, 7)
+            else:
+                # Change a byte
+                data[rnd.randint(0, len(data) - 1)] = rnd.randint(0, 255)
+
+            data = bytes(data)
+
+            results = []
+            for use_struct in (True, False):
+                try:
+                    results.append(parse(data, use_struct))
+                except Exception, e:
+                    results.append(e)
+            message1, message2 = results
+
+            if isinstance(message1, Exception) or isinstance(message2, Exception):
+                # Both must reject it in the same way
+                self.assertIs(type(message1), type(message2),
+                              'struct codec gave %r and bitstring codec gave %r for %s'
+                              % (message1, message2, data.encode('hex')))
+            else:
+                self.assertSameMessage(message1, message2)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -7,6 +7,9 @@ if __name__ == '__main__':
     sys.path.insert(0, '.')
     sys.path.insert(0, '..')
 
+from bitstring import ConstBitStream
+from ipaddress import IPv6Address
+from pylisp.packet.ip.ipv6 import IPv6Packet
 from pylisp.packet.lisp import data
 import doctest
 import unittest
@@ -192,6 +195,95 @@ class DataPacketTestCase(unittest.TestCase):
              ]
 
 
+class LazyDataPacketTestCase(unittest.TestCase):
+    def test_header_fields(self):
+        '''
+        The lazy packet must decode the same header fields as DataPacket
+        '''
+        for case in DataPacketTestCase.cases:
+            if case.exception[0]:
+                continue
+
+            packet = case.bytes_hex.decode('hex')
+            message = data.DataPacket.from_bytes(packet)
+            lazy_message = data.LazyDataPacket.from_bytes(packet)
+
+            for name in ('echo_nonce_request', 'nonce', 'source_map_version',
+                         'destination_map_version', 'instance_id', 'lsb'):
+                self.assertEqual(getattr(lazy_message, name),
+                                 getattr(message, name), case.name)
+
+            self.assertEqual(lazy_message.to_bytes(), packet)
+
+    def test_echo_nonce_request_without_nonce(self):
+        '''
+        The E bit is ignored when the N bit is clear
+        '''
+        packet = data.DataPacket(source_map_version=1, destination_map_version=2,
+                                 payload='').to_bytes()
+        packet = chr(ord(packet[0]) | 0x20) + packet[1:]
+
+        for parse in (data.DataPacket.from_bytes,
+                      lambda packet: data.DataPacket.from_bytes(ConstBitStream(bytes=packet)),
+                      data.LazyDataPacket.from_bytes):
+            message = parse(packet)
+            self.assertFalse(message.echo_nonce_request)
+            self.assertIsNone(message.nonce)
+            self.assertEqual(message.source_map_version, 1)
+
+    def test_inner_packet(self):
+        '''
+        The inner packet is available without decoding it
+        '''
+        inner = IPv6Packet(next_header=59, hop_limit=10,
+                           source=IPv6Address(u'2001:db8::1'),
+                           destination=IPv6Address(u'2001:db8::2'),
+                           payload='Data').to_bytes()
+        packet = data.DataPacket(instance_id=1234, payload=inner).to_bytes()
+
+        lazy_message = data.LazyDataPacket.from_bytes(bytearray(packet))
+        self.assertEqual(lazy_message.inner_version, 6)
+        self.assertEqual(lazy_message.inner_source,
+                         IPv6Address(u'2001:db8::1'))
+        self.assertEqual(lazy_message.inner_destination,
+                         IPv6Address(u'2001:db8::2'))
+        self.assertEqual(lazy_message.inner_packet, inner)
+        self.assertEqual(lazy_message.payload.hop_limit, 10)
+
+    def test_no_inner_packet(self):
+        '''
+        Payloads that are not IP have no inner addresses
+        '''
+        lazy_message = data.LazyDataPacket.from_bytes('\x00' * 9 + 'Data')
+        self.assertIsNone(lazy_message.inner_version)
+        self.assertRaises(ValueError, getattr, lazy_message,
+                          'inner_destination')
+
+
+class DataHeaderTemplateTestCase(unittest.TestCase):
+    def test_same_as_packet(self):
+        '''
+        A patched template gives the same bytes as a DataPacket
+        '''
+        template = data.DataHeaderTemplate(nonce='\x00\x00\x00', echo_nonce_request=True,
+                                           lsb=[False] * 8, instance_id=0xabcdef)
+        template.set_nonce('abc')
+        template.set_lsb(0x81)
+        packet = data.DataPacket(nonce='abc', echo_nonce_request=True,
+                                 lsb=[True] + [False] * 6 + [True], instance_id=0xabcdef,
+                                 payload='Data')
+        self.assertEqual(template.encapsulate('Data'), packet.to_bytes())
+
+    def test_missing_fields(self):
+        '''
+        Fields that are not in the template can't be patched
+        '''
+        template = data.DataHeaderTemplate(instance_id=1)
+        self.assertRaises(ValueError, template.set_nonce, 'abc')
+        self.assertRaises(ValueError, template.set_map_versions, 1, 2)
+        self.assertRaises(ValueError, template.set_lsb, 1)
+
+
 suite = unittest.TestLoader().loadTestsFromTestCase(DataPacketTestCase)
 
 
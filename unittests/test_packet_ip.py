@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+
+# Add the parent directory to the start of the path
+if __name__ == '__main__':
+    import sys
+    sys.path.insert(0, '.')
+    sys.path.insert(0, '..')
+
+from bitstring import ConstBitStream
+from ipaddress import IPv4Address, IPv4Network, IPv6Address
+from pylisp.packet.ip import IPv4Packet, IPv6Packet, UDPMessage
+from pylisp.packet.ip.ipv6 import IPv6HopByHopOptionsHeader
+from pylisp.packet.lisp.control import ControlMessage, \
+    EncapsulatedControlMessage, MapRequestMessage
+from pylisp.packet.lisp.data import DataPacket
+from pylisp.utils import buffers
+from pylisp.utils.buffers import BufferView
+import doctest
+import re
+import unittest
+
+
+def load_tests(loader, tests, ignore):
+    '''
+    Add doctests to the test set
+    '''
+    tests.addTests(doctest.DocTestSuite(buffers))
+    return tests
+
+
+def map_request():
+    return MapRequestMessage(nonce='abcdefgh',
+                             source_eid=IPv4Address(u'10.0.0.1'),
+                             itr_rlocs=[IPv4Address(u'192.0.2.1')],
+                             eid_prefixes=[IPv4Network(u'10.1.0.0/16')])
+
+
+def ecm_ipv4():
+    udp = UDPMessage(source_port=4342, destination_port=4342,
+                     payload=map_request())
+    ip = IPv4Packet(ttl=64, protocol=17,
+                    source=IPv4Address(u'10.0.0.1'),
+                    destination=IPv4Address(u'10.1.2.3'),
+                    payload=udp)
+    return EncapsulatedControlMessage(payload=ip).to_bytes()
+
+
+def ecm_ipv6():
+    udp = UDPMessage(source_port=4342, destination_port=4342,
+                     payload=map_request())
+    hop_by_hop = IPv6HopByHopOptionsHeader(next_header=17, options='\x01\x04'
+                                           '\x00\x00\x00\x00', payload=udp)
+    ip = IPv6Packet(hop_limit=64, next_header=0,
+                    source=IPv6Address(u'2001:db8::1'),
+                    destination=IPv6Address(u'2001:db8:1::1'),
+                    payload=hop_by_hop)
+    return EncapsulatedControlMessage(payload=ip).to_bytes()
+
+
+def normalised_repr(message):
+    # Bitstring returns longs where struct returns ints
+    return re.sub(r'(\d)L\b', r'\1', repr(message))
+
+
+class ZeroCopyTestCase(unittest.TestCase):
+    def test_ecm_stack(self):
+        '''
+        Parsing in place must give the same result as parsing with bitstring
+        '''
+        for data in (ecm_ipv4(), ecm_ipv6()):
+            expected = normalised_repr(ControlMessage.from_bytes(
+                ConstBitStream(bytes=data)))
+
+            for buf in (data, bytearray(data), buffer(data),
+                        memoryview(data)):
+                message = ControlMessage.from_bytes(buf)
+                self.assertEqual(normalised_repr(message), expected)
+                self.assertIsInstance(message.get_udp().payload,
+                                      MapRequestMessage)
+                self.assertEqual(message.to_bytes(), data)
+
+    def test_payload_refers_to_receive_buffer(self):
+        '''
+        Payloads that are not decoded refer to the original data
+        '''
+        udp = UDPMessage(source_port=1234, destination_port=5678,
+                         payload='SomePayload')
+        ip = IPv4Packet(ttl=64, protocol=17,
+                        source=IPv4Address(u'10.0.0.1'),
+                        destination=IPv4Address(u'10.1.2.3'),
+                        payload=udp)
+        data = bytearray(ip.to_bytes())
+
+        packet = IPv4Packet.from_bytes(data)
+        payload = packet.payload.payload
+        self.assertIsInstance(payload, BufferView)
+        self.assertEqual(payload, 'SomePayload')
+
+        data[-7:] = 'Changed'
+        self.assertEqual(payload, 'SomeChanged')
+
+    def test_data_packet(self):
+        '''
+        Data packets are parsed the same way by both parsers
+        '''
+        udp = UDPMessage(source_port=1234, destination_port=5678,
+                         payload='SomePayload')
+        ip = IPv4Packet(ttl=64, protocol=17,
+                        source=IPv4Address(u'10.0.0.1'),
+                        destination=IPv4Address(u'10.1.2.3'),
+                        payload=udp)
+
+        for kwargs in ({'nonce': 'abc', 'echo_nonce_request': True},
+                       {'source_map_version': 1, 'destination_map_version': 2,
+                        'lsb': [True, False] * 16},
+                       {'instance_id': 1234, 'lsb': [False] * 7 + [True]}):
+            data = DataPacket(payload=ip, **kwargs).to_bytes()
+
+            packet1 = DataPacket.from_bytes(data)
+            packet2 = DataPacket.from_bytes(ConstBitStream(bytes=data))
+            self.assertEqual(normalised_repr(packet1), normalised_repr(packet2))
+            self.assertEqual(packet1.to_bytes(), data)
+
+    def test_truncated(self):
+        '''
+        Truncated packets must raise a ValueError
+        '''
+        data = ecm_ipv4()
+        for length in (2, 10, 30, len(data) - 1):
+            self.assertRaises(ValueError, ControlMessage.from_bytes,
+                              data[:length])
+
+    def test_checksum(self):
+        '''
+        A damaged IPv4 header must be detected
+        '''
+        data = bytearray(ecm_ipv4())
+        data[4 + 8] ^= 0xff
+        self.assertRaises(ValueError, ControlMessage.from_bytes, data)
+
+
+class PatchTestCase(unittest.TestCase):
+    def udp_packet(self):
+        udp = UDPMessage(source_port=1234, destination_port=5678,
+                         payload='SomePayload')
+        source = IPv4Address(u'10.0.0.1')
+        destination = IPv4Address(u'10.1.2.3')
+        udp.checksum = udp.calculate_checksum(source, destination)
+        return IPv4Packet(ttl=64, protocol=17, source=source,
+                          destination=destination, payload=udp)
+
+    def assertValidPacket(self, data):
+        packet = IPv4Packet.from_bytes(bytes(data), decode_payload=False)
+        udp = UDPMessage.from_bytes(packet.payload)
+        self.assertTrue(udp.verify_checksum(packet.source, packet.destination))
+        return packet, udp
+
+    def test_decrement_ttl(self):
+        '''
+        The header checksum must stay valid when the TTL changes
+        '''
+        data = bytearray(self.udp_packet().to_bytes())
+        self.assertEqual(IPv4Packet.decrement_ttl(data), 63)
+
+        packet, dummy = self.assertValidPacket(data)
+        self.assertEqual(packet.ttl, 63)
+
+        data[8] = 0
+        self.assertRaises(ValueError, IPv4Packet.decrement_ttl, data)
+
+    def test_patch_addresses_and_ports(self):
+        '''
+        The IP and UDP checksums must stay valid when addresses and ports
+        change
+        '''
+        data = bytearray(self.udp_packet().to_bytes())
+        IPv4Packet.patch_addresses(data, source=u'192.0.2.1',
+                                   destination=u'198.51.100.7')
+        UDPMessage.patch_ports(data, destination_port=5000, offset=20)
+
+        packet, udp = self.assertValidPacket(data)
+        self.assertEqual(packet.source, IPv4Address(u'192.0.2.1'))
+        self.assertEqual(packet.destination, IPv4Address(u'198.51.100.7'))
+        self.assertEqual((udp.source_port, udp.destination_port), (1234, 5000))
+
+    def test_decrement_hop_limit(self):
+        data = bytearray(IPv6Packet(hop_limit=1, next_header=59,
+                                    source=IPv6Address(u'2001:db8::1'),
+                                    destination=IPv6Address(u'2001:db8::2'))
+                         .to_bytes())
+        self.assertEqual(IPv6Packet.decrement_hop_limit(data), 0)
+        self.assertRaises(ValueError, IPv6Packet.decrement_hop_limit, data)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+
+# Add the parent directory to the start of the path
+if __name__ == '__main__':
+    import sys
+    sys.path.insert(0, '.')
+    sys.path.insert(0, '..')
+
+from pylisp.utils import checksum
+import doctest
+import random
+import unittest
+
+
+def load_tests(loader, tests, ignore):
+    '''
+    Add doctests to the test set
+    '''
+    tests.addTests(doctest.DocTestSuite(checksum))
+    return tests
+
+
+def reference_ones_complement(message):
+    # Straightforward implementation of RFC 1071
+    message = bytes(message)
+    if len(message) % 2 == 1:
+        message = message + '\x00'
+
+    total = 0
+    for i in range(0, len(message), 2):
+        total += (ord(message[i]) << 8) + ord(message[i + 1])
+        total = (total & 0xffff) + (total >> 16)
+
+    return ~total & 0xffff
+
+
+class ChecksumTestCase(unittest.TestCase):
+    def test_random_messages(self):
+        '''
+        Compare with the reference implementation
+        '''
+        rnd = random.Random(1071)
+        messages = [''.join(chr(rnd.randint(0, 255))
+                            for dummy in range(rnd.randint(0, 100)))
+                    for dummy in range(500)]
+        messages += ['', '\x00', '\xff', '\xff' * 20, '\x00' * 21]
+
+        expected = [reference_ones_complement(message)
+                    for message in messages]
+
+        self.assertEqual([checksum.ones_complement(message)
+                          for message in messages], expected)
+        self.assertEqual(checksum.ones_complement_many(messages), expected)
+
+    def test_incremental_update(self):
+        '''
+        Incremental updates must give the same result as a full calculation
+        '''
+        rnd = random.Random(1624)
+        for dummy in range(500):
+            message = bytearray(rnd.getrandbits(8)
+                                for dummy in range(rnd.randint(2, 60)))
+            old_checksum = checksum.ones_complement(message)
+
+            start = rnd.randrange(0, len(message), 2)
+            end = rnd.randint(start + 1, len(message))
+            old_data = bytes(message[start:end])
+            new_data = bytes(bytearray(rnd.getrandbits(8)
+                                       for dummy in range(end - start)))
+            message[start:end] = new_data
+
+            self.assertEqual(checksum.incremental_update(old_checksum,
+                                                         old_data, new_data),
+                             checksum.ones_complement(message))
+
+    def test_buffer_types(self):
+        '''
+        All kinds of buffers can be checksummed
+        '''
+        message = 'Some odd length message'
+        expected = reference_ones_complement(message)
+        for buf in (bytearray(message), buffer(message), memoryview(message),
+                    buffer('xx' + message, 2)):
+            self.assertEqual(checksum.ones_complement(buf), expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
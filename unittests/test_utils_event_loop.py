@@ -0,0 +1,303 @@
+#!/usr/bin/env python
+
+# Add the parent directory to the start of the path
+if __name__ == '__main__':
+    import sys
+    sys.path.insert(0, '.')
+    sys.path.insert(0, '..')
+
+from ipaddress import IPv4Address
+from pylisp.utils import syscalls
+from pylisp.utils.auto_socket import AutoUDPSocket
+from pylisp.utils.event_loop import CancelledError, EventLoop, Future, Return
+import doctest
+import errno
+import socket
+import time
+import unittest
+
+
+def load_tests(loader, tests, ignore):
+    '''
+    Add doctests to the test set
+    '''
+    tests.addTests(doctest.DocTestSuite(syscalls))
+    return tests
+
+
+class EventLoopTestCase(unittest.TestCase):
+    def setUp(self):
+        self.sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sender.bind(('127.0.0.1', 0))
+
+        self.socks = []
+        for dummy in range(2):
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.bind(('127.0.0.1', 0))
+            self.socks.append(sock)
+
+        self.received = []
+
+    def tearDown(self):
+        for sock in self.socks + [self.sender]:
+            sock.close()
+
+    def handler(self, sock, data, address):
+        self.received.append((sock, data, address))
+
+    def send(self, sock, count):
+        for i in range(count):
+            self.sender.sendto('packet %d' % i, sock.getsockname())
+
+    def test_recv_batch(self):
+        '''
+        Both ways of reading a batch give the same result
+        '''
+        receivers = [None]
+        if syscalls.have_recvmmsg():
+            receivers.append(syscalls.RecvMMsg(4))
+
+        for receiver in receivers:
+            self.send(self.socks[0], 6)
+
+            datagrams = syscalls.recv_batch(self.socks[0], 4, receiver=receiver)
+            datagrams += syscalls.recv_batch(self.socks[0], 4, receiver=receiver)
+            self.assertEqual([data for data, address in datagrams],
+                             ['packet %d' % i for i in range(6)])
+            self.assertEqual(datagrams[0][1],
+                             (IPv4Address(u'127.0.0.1'),
+                              self.sender.getsockname()[1]))
+
+            self.assertEqual(syscalls.recv_batch(self.socks[0], 4,
+                                                 receiver=receiver), [])
+
+    def test_send_batch(self):
+        '''
+        Both ways of sending a batch give the same result
+        '''
+        senders = [None]
+        if syscalls.have_sendmmsg():
+            senders.append(syscalls.SendMMsg(2))
+
+        destinations = [(IPv4Address(u'127.0.0.1'), sock.getsockname()[1]) for sock in self.socks]
+        for sender in senders:
+            datagrams = [('packet %d' % i, destinations[i % 2]) for i in range(5)]
+            self.assertEqual(syscalls.send_batch(self.sender, datagrams, sender), 5)
+
+            received = [syscalls.recv_batch(sock, 4) for sock in self.socks]
+            self.assertEqual([[data for data, address in datagrams] for datagrams in received],
+                             [['packet 0', 'packet 2', 'packet 4'], ['packet 1', 'packet 3']])
+
+    def test_send_batch_many_addresses(self):
+        '''
+        Addresses must stay valid when the address cache is cleared while a
+        batch is being sent
+        '''
+        if not syscalls.have_sendmmsg():
+            return
+
+        for dummy in range(4):
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.bind(('127.0.0.1', 0))
+            self.socks.append(sock)
+
+        old_size = syscalls.ADDRESS_CACHE_SIZE
+        syscalls.ADDRESS_CACHE_SIZE = 2
+        try:
+            destinations = [(IPv4Address(u'127.0.0.1'), sock.getsockname()[1]) for sock in self.socks]
+            datagrams = [('packet %d' % i, destination) for i, destination in enumerate(destinations)]
+            self.assertEqual(syscalls.send_batch(self.sender, datagrams, syscalls.SendMMsg(8)), 6)
+        finally:
+            syscalls.ADDRESS_CACHE_SIZE = old_size
+
+        received = [syscalls.recv_batch(sock, 4) for sock in self.socks]
+        self.assertEqual([[data for data, address in datagrams] for datagrams in received],
+                         [['packet %d' % i] for i in range(6)])
+
+    def test_recv_batch_error_after_data(self):
+        '''
+        Datagrams that were read before an error must not be lost
+        '''
+        class FailingSocket(object):
+            def __init__(self, results):
+                self.results = results
+
+            def recvfrom(self, bufsize, flags):
+                result = self.results.pop(0)
+                if isinstance(result, Exception):
+                    raise result
+                return result
+
+        address = ('192.0.2.1', 4342)
+        sock = FailingSocket([('packet 0', address),
+                              socket.error(errno.ECONNREFUSED, 'Connection refused'),
+                              ('packet 1', address),
+                              socket.error(errno.EAGAIN, 'Resource temporarily unavailable')])
+        self.assertEqual([data for data, address in syscalls.recv_batch(sock, 4)],
+                         ['packet 0', 'packet 1'])
+
+        # Without data the error is raised
+        sock = FailingSocket([socket.error(errno.ECONNREFUSED, 'Connection refused')])
+        self.assertRaises(socket.error, syscalls.recv_batch, sock, 4)
+
+    def test_recv_batch_after_error(self):
+        '''
+        A pending error on an AutoUDPSocket must not hide the datagrams that
+        are waiting
+        '''
+        sock = self.socks[0]
+
+        # Report ICMP errors on the unconnected socket
+        sock.setsockopt(socket.IPPROTO_IP, 11, 1)  # IP_RECVERR
+
+        dead = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        dead.bind(('127.0.0.1', 0))
+        dead_address = dead.getsockname()
+        dead.close()
+        sock.sendto('nobody there', dead_address)
+
+        # AutoUDPSockets don't bind to loopback addresses, so give it ours
+        auto_socket = AutoUDPSocket(IPv4Address(0), 0)
+        auto_socket._sock = sock
+
+        self.send(sock, 2)
+        time.sleep(0.01)
+        self.assertEqual([data for data, address in auto_socket.recv_batch(4)],
+                         ['packet 0', 'packet 1'])
+
+    def test_budget(self):
+        '''
+        A busy socket must not starve the others
+        '''
+        loop = EventLoop(budget=4, batch_size=2)
+        for sock in self.socks:
+            loop.add_datagram_socket(sock, self.handler)
+
+        self.send(self.socks[0], 10)
+        self.send(self.socks[1], 1)
+
+        loop.run_once(1.0)
+        self.assertEqual(len([sock for sock, data, address in self.received
+                              if sock is self.socks[0]]), 4)
+        self.assertEqual(len([sock for sock, data, address in self.received
+                              if sock is self.socks[1]]), 1)
+
+        # The rest is read without new events
+        loop.run_once(0)
+        loop.run_once(0)
+        self.assertEqual(len(self.received), 11)
+
+        loop.close()
+
+    def test_rebind(self):
+        '''
+        A rebound socket must be registered again
+        '''
+        class RebindingSocket(object):
+            def __init__(self, sock):
+                self.sock = sock
+                self.targets = []
+
+            def fileno(self):
+                return self.sock and self.sock.fileno()
+
+            def add_rebind_target(self, target):
+                self.targets.append(target)
+
+            def recv_batch(self, count, bufsize):
+                return syscalls.recv_batch(self.sock, count, bufsize)
+
+        wrapper = RebindingSocket(None)
+        loop = EventLoop()
+        loop.add_datagram_socket(wrapper, self.handler)
+        self.assertEqual(wrapper.targets, [loop])
+
+        wrapper.sock = self.socks[0]
+        for target in wrapper.targets:
+            target.on_socket_rebind(wrapper)
+
+        self.send(self.socks[0], 1)
+        loop.run_once(1.0)
+        self.assertEqual([data for sock, data, address in self.received],
+                         ['packet 0'])
+
+        loop.close()
+
+
+class TaskTestCase(unittest.TestCase):
+    def setUp(self):
+        self.loop = EventLoop()
+
+    def tearDown(self):
+        self.loop.close()
+
+    def run_until_done(self, future):
+        deadline = time.time() + 2.0
+        while not future.done() and time.time() < deadline:
+            self.loop.run_once(1.0)
+        self.assertTrue(future.done())
+        return future.result()
+
+    def test_timers(self):
+        calls = []
+        self.loop.call_later(0.02, calls.append, 'late')
+        self.loop.call_later(0.01, calls.append, 'early')
+        self.loop.call_later(0.01, calls.append, 'cancelled').cancel()
+        self.loop.call_soon(calls.append, 'soon')
+
+        self.run_until_done(self.loop.sleep(0.03))
+        self.assertEqual(calls, ['soon', 'early', 'late'])
+
+    def test_coroutines(self):
+        '''
+        Tasks wait for futures and other generators and get their results
+        '''
+        reply = Future(self.loop)
+
+        def wait_for_reply(timeout):
+            got_reply = yield self.loop.wait(reply, timeout)
+            raise Return(got_reply and reply.result())
+
+        def main():
+            first = yield wait_for_reply(0.01)
+            self.loop.call_later(0.01, reply.set_result, 'reply')
+            second = yield wait_for_reply(1.0)
+            raise Return((first, second))
+
+        task = self.loop.create_task(main())
+        self.assertEqual(self.run_until_done(task), (False, 'reply'))
+
+    def test_exception(self):
+        def fail():
+            yield self.loop.sleep(0)
+            raise KeyError('fail')
+
+        def main():
+            try:
+                yield fail()
+            except KeyError:
+                raise Return('caught')
+
+        task = self.loop.create_task(main())
+        self.assertEqual(self.run_until_done(task), 'caught')
+
+    def test_cancel(self):
+        cleaned_up = []
+
+        def main():
+            try:
+                yield self.loop.sleep(10.0)
+            finally:
+                cleaned_up.append(True)
+
+        task = self.loop.create_task(main())
+        self.loop.run_once(0)
+        task.cancel()
+
+        self.assertRaises(CancelledError, self.run_until_done, task)
+        self.assertTrue(task.cancelled())
+        self.assertEqual(cleaned_up, [True])
+
+
+if __name__ == '__main__':
+    unittest.main()
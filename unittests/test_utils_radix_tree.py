@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+from ipaddress import IPv4Network, IPv6Network, ip_network
+from pylisp.utils import radix_tree
+from pylisp.utils.radix_tree import RadixTree
+import doctest
+import random
+import unittest
+
+# Add the parent directory to the start of the path
+if __name__ == '__main__':
+    import sys
+    sys.path.insert(0, '.')
+    sys.path.insert(0, '..')
+
+
+def load_tests(loader, tests, ignore):
+    '''
+    Add doctests to the test set
+    '''
+    tests.addTests(doctest.DocTestSuite(radix_tree))
+    return tests
+
+
+class RadixTreeTestCase(unittest.TestCase):
+    def test_exact(self):
+        '''
+        Exact lookups must not match covering or covered prefixes
+        '''
+        tree = RadixTree(32)
+        tree[IPv4Network(u'10.0.0.0/8')] = 'a'
+        tree[IPv4Network(u'10.0.0.0/16')] = 'b'
+
+        self.assertEqual(tree[IPv4Network(u'10.0.0.0/8')], 'a')
+        self.assertEqual(tree[IPv4Network(u'10.0.0.0/16')], 'b')
+        self.assertNotIn(IPv4Network(u'10.0.0.0/12'), tree)
+        self.assertNotIn(IPv4Network(u'10.0.0.0/24'), tree)
+        self.assertNotIn(IPv4Network(u'0.0.0.0/0'), tree)
+
+    def test_replace(self):
+        '''
+        Inserting an existing prefix replaces the value
+        '''
+        tree = RadixTree(128)
+        tree[IPv6Network(u'2001:db8::/32')] = 'a'
+        tree[IPv6Network(u'2001:db8::/32')] = 'b'
+
+        self.assertEqual(len(tree), 1)
+        self.assertEqual(tree[IPv6Network(u'2001:db8::/32')], 'b')
+
+    def test_wrong_family(self):
+        tree = RadixTree(32)
+        with self.assertRaises(ValueError):
+            tree[IPv6Network(u'::/0')] = 'a'
+
+    def test_delete(self):
+        '''
+        Deleting must leave the rest of the tree intact
+        '''
+        tree = RadixTree(32)
+        prefixes = [u'10.0.0.0/8', u'10.128.0.0/9', u'10.0.0.0/24',
+                    u'10.0.1.0/24', u'11.0.0.0/8']
+        for prefix in prefixes:
+            tree[ip_network(prefix)] = prefix
+
+        del tree[ip_network(u'10.0.0.0/24')]
+        del tree[ip_network(u'10.0.0.0/8')]
+
+        self.assertEqual(sorted(tree), [u'10.0.1.0/24', u'10.128.0.0/9',
+                                        u'11.0.0.0/8'])
+        self.assertEqual(tree.longest_match(ip_network(u'10.0.1.1/32')),
+                         u'10.0.1.0/24')
+        self.assertIsNone(tree.longest_match(ip_network(u'10.0.0.1/32')))
+
+        with self.assertRaises(KeyError):
+            del tree[ip_network(u'10.0.0.0/8')]
+
+        for prefix in list(tree):
+            del tree[ip_network(prefix)]
+
+        self.assertEqual(len(tree), 0)
+        self.assertIsNone(tree._root)
+
+    def test_against_linear_scan(self):
+        '''
+        Compare the tree with a brute force search over random prefixes
+        '''
+        rnd = random.Random(42)
+
+        def random_prefix():
+            prefixlen = rnd.randint(0, 12)
+            address = rnd.getrandbits(12) << 20
+            return IPv4Network((address, prefixlen), strict=False)
+
+        tree = RadixTree(32)
+        stored = set()
+        for dummy in range(300):
+            prefix = random_prefix()
+            if rnd.random() < 0.3 and stored:
+                prefix = rnd.choice(sorted(stored))
+                tree.delete(prefix)
+                stored.discard(prefix)
+            else:
+                tree[prefix] = prefix
+                stored.add(prefix)
+
+        self.assertEqual(len(tree), len(stored))
+        self.assertEqual(set(tree), stored)
+
+        for dummy in range(300):
+            query = random_prefix()
+            covering = [prefix for prefix in stored
+                        if prefix.prefixlen <= query.prefixlen
+                        and prefix.overlaps(query)]
+            covered = [prefix for prefix in stored
+                       if prefix.prefixlen >= query.prefixlen
+                       and prefix.overlaps(query)]
+
+            self.assertEqual(tree.covering(query),
+                             sorted(covering, key=lambda p: p.prefixlen))
+            self.assertEqual(set(tree.covered(query)), set(covered))
+            self.assertEqual(set(tree.overlapping(query)),
+                             set(covering) | set(covered))
+            self.assertEqual(len(tree.overlapping(query)),
+                             len(set(covering) | set(covered)))
+            self.assertEqual(tree.get(query), query in stored and query or None)
+
+
+if __name__ == '__main__':
+    unittest.main()